@@ -1,78 +1,128 @@
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+from starter_templates import templates
+
+# Demora simulada de aprovisionamiento: opt-in (0 = sin espera).
+DEFAULT_SIMULATED_DELAY = float(os.getenv("ANTIGRAVITY_SIMULATED_DELAY", "0"))
+DEFAULT_MAX_WORKERS = int(os.getenv("ANTIGRAVITY_MAX_WORKERS", "4"))
+
+SCAFFOLD_DIRS = ("src", "infra")
+
 
 class Projects:
-    def create(self, output_path, plan_content=None, html_content=None, backend_content=None):
+    def __init__(self, simulated_delay=None, max_workers=None):
+        self.simulated_delay = DEFAULT_SIMULATED_DELAY if simulated_delay is None else float(simulated_delay)
+        self.max_workers = max(1, int(max_workers or DEFAULT_MAX_WORKERS))
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="antigravity")
+            return self._executor
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+    def scaffold(self, output_path, plan_content=None, html_content=None, backend_content=None):
+        """{relative path: content} for the project, built in memory before touching disk."""
+        name = os.path.basename(os.path.normpath(output_path))
+        if plan_content:
+            readme = f"# Project: {name}\n\n{plan_content}"
+        else:
+            readme = (
+                f"# Project: {name}\n\n"
+                "Generated by Anmar Engine using Antigravity SDK.\n"
+                "## Infrastructure\n- [x] Base directory created\n- [x] Environment configured\n"
+            )
+        files = {
+            "README.md": readme,
+            # Default 'Coming Soon' template
+            "index.html": html_content or templates.render("coming_soon", "index.html", {"project_name": name}),
+        }
+        if backend_content:
+            files["app.py"] = backend_content
+            files["requirements.txt"] = "flask\nflask-cors\n"
+        return files
+
+    def _write_scaffold(self, output_path, files):
+        for sub in SCAFFOLD_DIRS:
+            os.makedirs(os.path.join(output_path, sub), exist_ok=True)
+        for rel, content in files.items():
+            dest = os.path.join(output_path, rel)
+            tmp_path = dest + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(content)
+            os.replace(tmp_path, dest)
+
+    def create(self, output_path, plan_content=None, html_content=None, backend_content=None, simulated_delay=None):
         """
         Simulates the Antigravity SDK project creation.
         In a real scenario, this might provision cloud resources (AWS/GCP),
         set up CI/CD pipelines, or initialize a git repository.
+        Returns the result with per-step timings in milliseconds.
         """
         print(f"🚀 Antigravity SDK: Initializing project at '{output_path}'...")
-        
-        # Simulate processing time
-        time.sleep(1)
-        
-        # Create the local directory structure as a 'physical' manifestation of the infrastructure
+        timings = {}
+        started = time.perf_counter()
         try:
-            os.makedirs(output_path, exist_ok=True)
-            
-            # Create subdirectories for a standard full-stack app
-            os.makedirs(os.path.join(output_path, "src"), exist_ok=True)
-            os.makedirs(os.path.join(output_path, "infra"), exist_ok=True)
-            
-            # Create a README to signal success
-            with open(os.path.join(output_path, "README.md"), "w") as f:
-                f.write(f"# Project: {os.path.basename(output_path)}\n\n")
-                if plan_content:
-                    f.write(plan_content)
-                else:
-                    f.write("Generated by Anmar Engine using Antigravity SDK.\n")
-                    f.write("## Infrastructure\n- [x] Base directory created\n- [x] Environment configured\n")
-            
-            # Create index.html (Custom or Default)
-            with open(os.path.join(output_path, "index.html"), "w") as f:
-                if html_content:
-                    f.write(html_content)
-                else:
-                    # Default 'Coming Soon' template
-                    f.write(f"""<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>{os.path.basename(output_path)} - Coming Soon</title>
-    <style>
-        body {{ font-family: system-ui, sans-serif; display: flex; flex-direction: column; align-items: center; justify-content: center; height: 100vh; margin: 0; background: #f3f4f6; color: #1f2937; }}
-        .container {{ text-align: center; padding: 2rem; background: white; border-radius: 1rem; box-shadow: 0 4px 6px -1px rgba(0, 0, 0, 0.1); }}
-        h1 {{ color: #4f46e5; margin-bottom: 0.5rem; }}
-        p {{ color: #6b7280; }}
-        .badge {{ background: #def7ec; color: #03543f; padding: 0.25rem 0.75rem; border-radius: 9999px; font-size: 0.875rem; font-weight: 500; }}
-    </style>
-</head>
-<body>
-    <div class="container">
-        <span class="badge">Infrastructure Ready</span>
-        <h1>{os.path.basename(output_path)}</h1>
-        <p>The foundation for your project has been successfully provisioned.</p>
-        <p><em>Edit this file in generic_projects/{os.path.basename(output_path)}/index.html</em></p>
-    </div>
-</body>
-</html>""")
-
-            # Create Backend (app.py)
-            if backend_content:
-                with open(os.path.join(output_path, "app.py"), "w") as f:
-                    f.write(backend_content)
-                with open(os.path.join(output_path, "requirements.txt"), "w") as f:
-                    f.write("flask\nflask-cors\n")
-
-            print(f"✅ Antigravity SDK: Infrastructure for '{output_path}' created successfully.")
-            return {"status": "success", "path": output_path, "environment": "production"}
-            
+            delay = self.simulated_delay if simulated_delay is None else float(simulated_delay)
+            if delay > 0:
+                time.sleep(delay)
+            timings["delay_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+            step = time.perf_counter()
+            files = self.scaffold(output_path, plan_content, html_content, backend_content)
+            timings["render_ms"] = round((time.perf_counter() - step) * 1000, 2)
+
+            # Create the local directory structure as a 'physical' manifestation of the infrastructure
+            step = time.perf_counter()
+            self._write_scaffold(output_path, files)
+            timings["write_ms"] = round((time.perf_counter() - step) * 1000, 2)
+            timings["total_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+            print(f"✅ Antigravity SDK: Infrastructure for '{output_path}' created successfully ({timings['total_ms']} ms).")
+            return {
+                "status": "success",
+                "path": output_path,
+                "environment": "production",
+                "files": sorted(files),
+                "timings": timings,
+            }
         except Exception as e:
             print(f"❌ Antigravity SDK Error: {str(e)}")
             raise e
 
+    def create_async(self, output_path, **kwargs):
+        """Same as create() on the SDK worker pool; returns a Future."""
+        return self._pool().submit(self.create, output_path, **kwargs)
+
+    def create_many(self, specs):
+        """
+        Provisions several projects concurrently. specs is a list of dicts with
+        output_path plus create() kwargs; results come back in the same order and
+        a failed project is reported as {"status": "error"} without stopping the rest.
+        """
+        futures = []
+        for spec in specs or []:
+            spec = dict(spec)
+            output_path = spec.pop("output_path")
+            futures.append((output_path, self.create_async(output_path, **spec)))
+        results = []
+        for output_path, future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append({"status": "error", "path": output_path, "error": str(e)})
+        return results
+
+
 # Initialize the 'projects' namespace
 projects = Projects()
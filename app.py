@@ -1,37 +1,220 @@
 import os
-import shutil
 import json
 import re
 import uuid
 import difflib
 import base64
-import requests
-import stripe
-import google.generativeai as genai
-from flask import Flask, request, jsonify, send_from_directory, session, Response, stream_with_context
-from werkzeug.security import generate_password_hash, check_password_hash
+import hashlib
+import hmac
+import mimetypes
+from flask import Flask, request, jsonify, send_from_directory, session, Response, stream_with_context, g, has_request_context
+from flask.sessions import SecureCookieSessionInterface
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from dotenv import load_dotenv
+from lazy_imports import genai, requests, stripe
 import antigravity_sdk as antigravity
+from structured_output import loads_tolerant, coerce_to_schema, schema_prompt_hint, StreamingJSONParser
+from singleflight import SingleFlight, ConcurrencyLimiter, payload_fingerprint
+from job_queue import JobQueue
+from notification_outbox import NotificationOutbox
+from rate_limiter import RateLimiter, make_backend, parse_policies
+from entitlements import EntitlementService
+from schema_migrations import ensure_schema, pending_migrations
+from token_ledger import TokenLedger
+from webhook_events import WebhookInbox
+from project_versions import ProjectVersionStore
+from project_index import ProjectIndex
+from starter_templates import templates
+from startup_phases import StartupPhases
+from profiling import RequestProfiler, SamplingProfiler, sqlite_factory
+from metrics import Registry, FAST_BUCKETS, SLOW_BUCKETS, SIZE_BUCKETS
+import project_archive
+from asset_pipeline import (
+    negotiate_encoding, load_manifest as load_asset_manifest, MANIFEST_NAME,
+    precompress_tree,
+)
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, as_completed
+from functools import wraps
 import time as _time
 
+if __name__ == '__main__':
+    # Las blueprints importan el módulo "app"; el servidor de desarrollo corre desde
+    # ese módulo para no tener dos copias (dos Flask, dos pools de workers).
+    import app as _anmar_app
+    _anmar_app.main()
+    raise SystemExit(0)
+
+# ── STARTUP ── lo costoso se registra como fase perezosa (ver startup_phases.py)
+startup = StartupPhases()
+
 # Load environment variables
 load_dotenv()
 
-# ── SIMPLE RATE LIMITER (in-memory) ──
-_rate_store = defaultdict(list)
-
-def _rate_limit(ip, max_requests=10, window=60):
+# ── PROFILING (opt-in, ver profiling.py) ──
+# ANMAR_PROFILE_REQUESTS=1 activa el timing por petición (o POST /api/internal/profile);
+# ANMAR_PROFILE_STARTUP=<segundos> muestrea el import y el warm-up de cada worker.
+request_profiler = RequestProfiler(
+    enabled=os.getenv("ANMAR_PROFILE_REQUESTS", "0") == "1",
+    sample_rate=float(os.getenv("ANMAR_PROFILE_SAMPLE_RATE", "1.0")),
+)
+sampler = SamplingProfiler()
+PROFILE_STARTUP_SECONDS = float(os.getenv("ANMAR_PROFILE_STARTUP", "0") or 0)
+if PROFILE_STARTUP_SECONDS > 0:
+    sampler.start(PROFILE_STARTUP_SECONDS)
+
+# ── METRICS (Prometheus text format en GET /api/internal/metrics, ver metrics.py) ──
+# Los scrapers se autentican con "Authorization: Bearer $ANMAR_METRICS_TOKEN".
+METRICS_TOKEN = os.getenv("ANMAR_METRICS_TOKEN", "").strip()
+metrics_registry = Registry(prefix="anmar_")
+AI_REQUEST_SECONDS = metrics_registry.histogram(
+    "ai_request_seconds", "Provider call latency.", ("provider", "model", "endpoint", "outcome"), buckets=SLOW_BUCKETS)
+AI_TOKENS = metrics_registry.counter(
+    "ai_tokens_total", "Tokens reported by the provider.", ("provider", "model", "kind"))
+CACHE_REQUESTS = metrics_registry.counter(
+    "cache_requests_total", "Cache lookups by result.", ("cache", "result"))
+JSON_STORE_SECONDS = metrics_registry.histogram(
+    "json_store_seconds", "JSON file store read/write time.", ("store", "op"), buckets=FAST_BUCKETS)
+JSON_STORE_BYTES = metrics_registry.histogram(
+    "json_store_bytes", "JSON file size after each read/write.", ("store", "op"), buckets=SIZE_BUCKETS)
+SQLITE_QUERY_SECONDS = metrics_registry.histogram(
+    "sqlite_query_seconds", "SQLite execute/commit time (rows fetched later are not included).", ("statement",),
+    buckets=FAST_BUCKETS)
+QUEUE_DEPTH = metrics_registry.gauge("queue_depth", "Items per queue and status.", ("queue", "status"))
+QUEUE_LAG_SECONDS = metrics_registry.gauge(
+    "queue_oldest_pending_seconds", "Age of the oldest queued or in-flight item.", ("queue",))
+SLA_OVERDUE = metrics_registry.gauge("tickets_sla_overdue", "Open tickets past their SLA.", ("priority",))
+
+def metrics_token_ok(authorization):
+    if not METRICS_TOKEN:
+        return False
+    scheme, _, token = str(authorization or '').partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(token.strip(), METRICS_TOKEN)
+
+def _metrics_endpoint():
+    return (request.endpoint or 'unmatched') if has_request_context() else 'background'
+
+def observe_provider(provider, model_name):
+    """Decorator: latency per provider/model/endpoint. A None result (or (None, ...)) counts as an error."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = _time.perf_counter()
+            outcome = "error"
+            try:
+                result = fn(*args, **kwargs)
+                first = result[0] if isinstance(result, tuple) else result
+                outcome = "ok" if first is not None else "error"
+                return result
+            finally:
+                AI_REQUEST_SECONDS.labels(provider, model_name() or "unknown", _metrics_endpoint(), outcome).observe(
+                    _time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+def record_ai_tokens(provider, model_name, input_tokens=None, output_tokens=None):
+    for kind, value in (("input", input_tokens), ("output", output_tokens)):
+        if value:
+            AI_TOKENS.labels(provider, model_name or "unknown", kind).inc(int(value))
+
+def json_store(op, path):
+    """Decorator for the load_*/save_* JSON helpers: profiler phase + time and size metrics."""
+    store = os.path.splitext(os.path.basename(path))[0]
+    def decorator(fn):
+        timed_fn = request_profiler.timed("json_store")(fn)
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = _time.perf_counter()
+            try:
+                return timed_fn(*args, **kwargs)
+            finally:
+                JSON_STORE_SECONDS.labels(store, op).observe(_time.perf_counter() - started)
+                try:
+                    JSON_STORE_BYTES.labels(store, op).observe(os.path.getsize(path))
+                except OSError:
+                    pass
+        return wrapper
+    return decorator
+
+# ── RATE LIMITER (sliding window counter, see rate_limiter.py) ──
+# Backend: ANMAR_RATE_LIMIT_BACKEND = shm (default en Linux, compartido entre
+# workers de gunicorn) | sqlite | memory. Cada ruta tiene su propio contador;
+# ANMAR_RATE_LIMITS="login=5/60,register=3/60" sobreescribe límites por endpoint.
+_rate_limiter = RateLimiter(
+    make_backend(
+        os.getenv("ANMAR_RATE_LIMIT_BACKEND", ""),
+        sqlite_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend', 'rate_limits.db'),
+        shm_path=os.getenv("ANMAR_RATE_LIMIT_SHM_PATH", "/dev/shm/anmar-ratelimit-v2"),
+        max_keys=int(os.getenv("ANMAR_RATE_LIMIT_MAX_KEYS", "50000")),
+    ),
+    policies=parse_policies(os.getenv("ANMAR_RATE_LIMITS", "")),
+)
+
+def _rate_limit(ip, max_requests=10, window=60, scope=None):
     """Returns True if request should be blocked."""
-    now = _time.time()
-    _rate_store[ip] = [t for t in _rate_store[ip] if now - t < window]
-    if len(_rate_store[ip]) >= max_requests:
-        return True
-    _rate_store[ip].append(now)
-    return False
+    if scope is None:
+        # Con blueprints el endpoint es 'auth.login'; la política se nombra por la vista.
+        scope = (request.endpoint or 'global').rsplit('.', 1)[-1] if has_request_context() else 'global'
+    allowed, retry_after = _rate_limiter.check(scope, ip or 'unknown', max_requests, window)
+    if not allowed and has_request_context():
+        g.rate_limit_retry_after = retry_after
+    return not allowed
+
+# ── AI REQUEST COALESCING ──
+# Doble click / reintentos del frontend: peticiones idénticas en vuelo comparten
+# una sola llamada al proveedor; además cada usuario tiene un tope de generaciones
+# concurrentes.
+AI_MAX_CONCURRENT_PER_USER = int(os.getenv("ANMAR_AI_MAX_CONCURRENT_PER_USER", "2"))
+AI_COALESCE_WAIT_SECONDS = int(os.getenv("ANMAR_AI_COALESCE_WAIT_SECONDS", "180"))
+_ai_single_flight = SingleFlight()
+_ai_user_limiter = ConcurrencyLimiter(AI_MAX_CONCURRENT_PER_USER)
+
+
+def _ai_request_owner(data):
+    return (
+        str(session.get('user_email') or '').strip().lower()
+        or str((data or {}).get('user_email') or '').strip().lower()
+        or f"ip:{request.remote_addr}"
+    )
+
+
+def coalesce_ai_request(endpoint_key):
+    """Decorator: single-flight by (user, endpoint, normalized payload) + per-user cap."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            data = request.get_json(silent=True) or {}
+            owner = _ai_request_owner(data)
+            key = (owner, endpoint_key, payload_fingerprint(data))
+
+            def _lead():
+                if not _ai_user_limiter.try_acquire(owner):
+                    return (
+                        json.dumps({"error": "Too many AI requests in progress. Wait for the current one to finish."}).encode(),
+                        429,
+                        [("Content-Type", "application/json")],
+                    )
+                try:
+                    rv = app.make_response(view(*args, **kwargs))
+                    # Se comparte un snapshot, no el Response (cada petición arma el suyo).
+                    return rv.get_data(), rv.status_code, [
+                        (k, v) for k, v in rv.headers.items()
+                        if k.lower() not in ("content-length", "set-cookie")
+                    ]
+                finally:
+                    _ai_user_limiter.release(owner)
+
+            try:
+                (body, status, headers), shared = _ai_single_flight.do(key, _lead, timeout=AI_COALESCE_WAIT_SECONDS)
+            except TimeoutError:
+                return jsonify({"error": "Request still in progress. Try again shortly."}), 504
+            if shared:
+                log_debug(f"[COALESCE] {endpoint_key} shared result for {owner}")
+            return Response(body, status=status, headers=headers)
+        return wrapper
+    return decorator
+
 
 # --- CONFIGURATION ---
 # App is at project root (anmar-engine/), frontend is a child (anmar-engine/frontend/)
@@ -47,16 +230,15 @@ internal_path = os.path.abspath(os.path.join(BASE_DIR, 'internal'))
 # .. = .../Desktop
 # generated_projects = .../Desktop/generated_projects
 def resolve_projects_base_dir():
+    # ANMAR_PROJECTS_DIR evita el sondeo; si no, basta con os.access (sin escribir archivos).
+    configured = os.getenv("ANMAR_PROJECTS_DIR", "").strip()
     preferred = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'generated_projects'))
     fallback = os.path.abspath(os.path.join(BASE_DIR, 'generated_projects'))
-    for candidate in (preferred, fallback):
+    for candidate in ([os.path.abspath(configured)] if configured else []) + [preferred, fallback]:
         try:
             os.makedirs(candidate, exist_ok=True)
-            test_file = os.path.join(candidate, '.write_test')
-            with open(test_file, 'w') as f:
-                f.write('ok')
-            os.remove(test_file)
-            return candidate
+            if os.access(candidate, os.W_OK | os.X_OK):
+                return candidate
         except Exception:
             continue
     return fallback
@@ -64,6 +246,14 @@ def resolve_projects_base_dir():
 projects_base_dir = resolve_projects_base_dir()
 
 app = Flask(__name__, static_folder=frontend_path, template_folder=frontend_path)
+app.wsgi_app = request_profiler.middleware(app.wsgi_app)
+
+class _ProfiledJSONProvider(DefaultJSONProvider):
+    def response(self, *args, **kwargs):
+        with request_profiler.phase("serialize"):
+            return super().response(*args, **kwargs)
+
+app.json = _ProfiledJSONProvider(app)
 
 # ── SESSION SECRET ── persist across restarts
 import secrets as _secrets
@@ -89,12 +279,26 @@ def _get_or_create_secret():
         pass
     return new_secret
 
-app.secret_key = _get_or_create_secret()
+class _LazySecretSessionInterface(SecureCookieSessionInterface):
+    """Reads/creates the session secret on the first request that touches the session."""
+
+    def get_signing_serializer(self, app):
+        if not app.secret_key:
+            app.secret_key = startup.ensure("session_secret")
+        return super().get_signing_serializer(app)
+
+    def open_session(self, app, request):
+        with request_profiler.phase("auth"):
+            return super().open_session(app, request)
+
+startup.register("session_secret", _get_or_create_secret)
+app.session_interface = _LazySecretSessionInterface()
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SECURE'] = not os.getenv('ANMAR_DEV_MODE')
 from datetime import timedelta
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=7)
+startup.mark("config")
 
 # --- STRIPE CONFIG ---
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY", "").strip()
@@ -120,7 +324,7 @@ TOKEN_PACK_MAP = {
     "tokens_500": {"price_id": STRIPE_PRICE_PACK_500, "tokens": 500, "label": "Pack 500 Mensajes"},
 }
 
-stripe.api_key = STRIPE_SECRET_KEY
+stripe.on_import(lambda module: setattr(module, "api_key", STRIPE_SECRET_KEY))
 
 STRIPE_PLAN_LABELS = {
     "validate": "Validate",
@@ -133,259 +337,22 @@ STRIPE_PLAN_LABELS = {
     "marketing_build": "Elite"
 }
 
-@app.route('/internal/<path:filename>')
-def serve_internal(filename):
-    return send_from_directory(internal_path, filename)
 CORS(app, origins=["https://anmarenterprices.com"], supports_credentials=True)
 
-@app.route('/api/internal/status', methods=['GET'])
-def internal_status():
-    users = load_internal_users()
-    return jsonify({
-        "has_users": len(users) > 0
-    })
-
-@app.route('/api/internal/bootstrap', methods=['POST'])
-def internal_bootstrap():
-    try:
-        users = load_internal_users()
-        if users:
-            return jsonify({"error": "Bootstrap already completed"}), 403
-        data = request.json or {}
-        name = str(data.get('name') or '').strip()
-        username = str(data.get('username') or '').strip().lower()
-        email = str(data.get('email') or '').strip().lower()
-        password = str(data.get('password') or '').strip()
-        if not username and email:
-            username = email.split("@")[0]
-        if not username or not password:
-            return jsonify({"error": "username and password are required"}), 400
-        new_user = {
-            "id": str(uuid.uuid4()),
-            "name": name or username,
-            "username": username,
-            "email": email or "",
-            "role": "admin",
-            "password_hash": generate_password_hash(password),
-            "created_at": datetime.now().isoformat()
-        }
-        save_internal_users([new_user])
-        session.permanent = True
-        session['internal_user'] = {
-            "id": new_user["id"],
-            "name": new_user["name"],
-            "username": new_user["username"],
-            "email": new_user["email"],
-            "role": new_user["role"]
-        }
-        return jsonify({"status": "ok", "user": session['internal_user']})
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-@app.route('/api/internal/login', methods=['POST'])
-def internal_login():
-    try:
-        data = request.json or {}
-        identifier = str(data.get('identifier') or '').strip().lower()
-        password = str(data.get('password') or '').strip()
-        if not identifier or not password:
-            return jsonify({"error": "identifier and password are required"}), 400
-        user = find_internal_user(identifier)
-        if not user or not check_password_hash(user.get('password_hash', ''), password):
-            return jsonify({"error": "Invalid credentials"}), 401
-        session.permanent = True
-        session['internal_user'] = {
-            "id": user.get("id"),
-            "name": user.get("name"),
-            "username": user.get("username"),
-            "email": user.get("email"),
-            "role": user.get("role", "agent")
-        }
-        return jsonify({"status": "ok", "user": session['internal_user']})
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-@app.route('/api/internal/logout', methods=['POST'])
-def internal_logout():
-    session.pop('internal_user', None)
-    return jsonify({"status": "ok"})
-
-@app.route('/api/internal/google-login', methods=['POST'])
-def internal_google_login():
-    """Allow internal team members to log in with Google OAuth."""
-    try:
-        data = request.json or {}
-        id_token = data.get('token', '').strip()
-        if not id_token:
-            return jsonify({"error": "Token is required"}), 400
-
-        # Validate token with Google
-        import urllib.request as _urllib_req
-        import json as _json
-        try:
-            token_url = f"https://oauth2.googleapis.com/tokeninfo?id_token={id_token}"
-            with _urllib_req.urlopen(token_url, timeout=8) as resp:
-                google_data = _json.loads(resp.read().decode())
-        except Exception as e:
-            return jsonify({"error": "Invalid Google token"}), 401
-
-        email = google_data.get("email", "").strip().lower()
-        name = google_data.get("name") or google_data.get("given_name") or email.split("@")[0]
-        email_verified = google_data.get("email_verified") == "true"
-
-        if not email or not email_verified:
-            return jsonify({"error": "Google email not verified"}), 401
-
-        # Load existing internal users
-        users = load_internal_users()
-
-        # Check if this email is already an internal user
-        existing = next((u for u in users if u.get("email", "").lower() == email), None)
-
-        if existing:
-            # Existing user — log them in
-            user_session = {
-                "id": existing["id"],
-                "name": existing.get("name", name),
-                "username": existing.get("username", email.split("@")[0]),
-                "email": email,
-                "role": existing.get("role", "agent")
-            }
-        elif not users:
-            # No internal users exist — auto-bootstrap this Google account as first admin
-            import uuid as _uuid
-            new_user = {
-                "id": str(_uuid.uuid4())[:8],
-                "name": name,
-                "username": email.split("@")[0],
-                "email": email,
-                "password_hash": "",
-                "role": "admin",
-                "auth_method": "google",
-                "created_at": datetime.now().isoformat()
-            }
-            users.append(new_user)
-            save_internal_users(users)
-            user_session = {
-                "id": new_user["id"],
-                "name": name,
-                "username": new_user["username"],
-                "email": email,
-                "role": "admin"
-            }
-        else:
-            # Users exist but this email is not registered
-            return jsonify({
-                "error": "This email does not have internal access. Ask an administrator to add you."
-            }), 403
-
-        session['internal_user'] = user_session
-        session.permanent = True
-        return jsonify({"user": user_session, "message": f"Welcome, {name}"})
-
-    except Exception as e:
-        print(f"Internal Google Login Error: {e}")
-        return jsonify({"error": "Internal server error"}), 500
-
-@app.route('/api/internal/me', methods=['GET'])
-def internal_me():
-    user = session.get('internal_user')
-    if not user:
-        return jsonify({"error": "unauthorized"}), 401
-    return jsonify({"user": user})
-
-@app.route('/api/get-ai-suggestion', methods=['POST'])
-def get_ai_suggestion():
-    try:
-        if not require_internal_auth():
-            return jsonify({"error": "unauthorized"}), 401
-        data = request.json or {}
-        chat_history = str(data.get('chatHistory') or '').strip()
-        project_status = str(data.get('projectStatus') or '').strip()
-        project_identifier = str(data.get('projectIdentifier') or '').strip()
-        # Accept 'context' field as direct prompt (used by panel fallback)
-        direct_context = str(data.get('context') or '').strip()
-
-        if direct_context and not chat_history:
-            # Panel sent a direct context string — use it as-is
-            raw = call_ai_text(direct_context, engine=ENGINE_ANTIGRAVITY) or ""
-            return jsonify({"suggestion": raw, "response": raw})
-
-        master_prompt = os.getenv('ANMAR_MASTER_PROMPT', '').strip()
-        if not master_prompt:
-            master_prompt = (
-                "Eres analista interno de proyectos para ANMAR. "
-                "Devuelve JSON estricto con las claves Action y Draft_Response."
-            )
-
-        prompt = master_prompt.replace('[CHAT_HISTORY]', chat_history)\
-                              .replace('[PROJECT_STATUS]', project_status)\
-                              .replace('[PROJECT_IDENTIFIER]', project_identifier)
-
-        json_prompt = f"""
-{prompt}
-
-DEVUELVE SOLO JSON con esta forma:
-{{"Action":"...","Draft_Response":"..."}}
-""".strip()
-
-        text = call_ai_text(json_prompt, engine=ENGINE_ANTIGRAVITY) or ""
-        parsed = clean_and_parse_json(text)
-        if isinstance(parsed, dict) and parsed.get('Action') and parsed.get('Draft_Response'):
-            return jsonify(parsed)
-
-        return jsonify({
-            "Action": "Revisar el briefing y alinear próximos pasos.",
-            "Draft_Response": "Gracias por el detalle. Ya lo revisé y te confirmo el siguiente paso en breve."
-        })
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-@app.route('/api/internal/users', methods=['POST'])
-def create_internal_user():
-    if not require_internal_auth():
-        return jsonify({"error": "unauthorized"}), 401
-    actor = session.get('internal_user') or {}
-    if actor.get('role') != 'admin':
-        return jsonify({"error": "forbidden"}), 403
-    data = request.json or {}
-    name = str(data.get('name') or '').strip()
-    username = str(data.get('username') or '').strip().lower()
-    email = str(data.get('email') or '').strip().lower()
-    password = str(data.get('password') or '').strip()
-    if not username and email:
-        username = email.split("@")[0]
-    if not username:
-        return jsonify({"error": "username is required"}), 400
-    existing = find_internal_user(username) or (find_internal_user(email) if email else None)
-    if existing:
-        return jsonify({"error": "This user or email already exists"}), 409
-    users = load_internal_users()
-    new_member = {
-        "id": str(uuid.uuid4()),
-        "name": name or username,
-        "username": username,
-        "email": email or "",
-        "role": data.get("role") or "agent",
-        "auth_method": "google" if not password else "password",
-        "created_at": datetime.now().isoformat()
-    }
-    if password:
-        new_member["password_hash"] = generate_password_hash(password)
-    save_internal_users(users + [new_member])
-    return jsonify({"status": "ok", "user": {"name": new_member["name"], "username": username, "role": new_member["role"]}})
-
-@app.route('/api/internal/team', methods=['GET'])
-def get_internal_team():
-    """Return list of internal team members (admins can see all)."""
-    if not require_internal_auth():
-        return jsonify({"error": "unauthorized"}), 401
-    users = load_internal_users()
-    safe = [{"id": u.get("id",""), "name": u.get("name",""), "username": u.get("username",""),
-             "email": u.get("email",""), "role": u.get("role","agent"),
-             "auth_method": u.get("auth_method","password"),
-             "created_at": u.get("created_at","")} for u in users]
-    return jsonify({"users": safe})
+@app.after_request
+def _add_retry_after(response):
+    retry_after = getattr(g, 'rate_limit_retry_after', None)
+    if response.status_code == 429 and retry_after:
+        response.headers.setdefault('Retry-After', str(retry_after))
+    return response
+
+@app.after_request
+def _add_server_timing(response):
+    if request_profiler.label(request.endpoint):
+        timing = request_profiler.server_timing()
+        if timing:
+            response.headers.setdefault('Server-Timing', timing)
+    return response
 
 # Google AI Setup
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY", "").strip()
@@ -625,6 +592,10 @@ ANTHROPIC_MODEL = os.getenv("ANTHROPIC_MODEL", "claude-sonnet-4-5").strip()
 ANTHROPIC_VERSION = os.getenv("ANTHROPIC_VERSION", "2023-06-01").strip()
 ANTHROPIC_MAX_TOKENS = int(os.getenv("ANTHROPIC_MAX_TOKENS", "2048"))
 ANTHROPIC_TEMPERATURE = float(os.getenv("ANTHROPIC_TEMPERATURE", "0.6"))
+# Las ediciones/builds devuelven archivos completos: 2048 tokens los trunca.
+AI_EDIT_MAX_TOKENS = int(os.getenv("ANMAR_EDIT_MAX_TOKENS", "8192"))
+EDIT_PATCH_ATTEMPTS = int(os.getenv("ANMAR_EDIT_PATCH_ATTEMPTS", "2"))
+EDIT_CONTEXT_TOKENS = int(os.getenv("ANMAR_EDIT_CONTEXT_TOKENS", "6000"))
 ANTHROPIC_ENDPOINT = os.getenv("ANTHROPIC_ENDPOINT", "https://api.anthropic.com/v1/messages").strip()
 
 ENGINE_ANTIGRAVITY = "antigravity"
@@ -737,21 +708,26 @@ def connect_ai_model(force=False):
     return False
 
 
-def _safe_model_generate(prompt, timeout_seconds=22):
-    if not model:
+@request_profiler.timed("ai")
+@observe_provider("gemini", lambda: getattr(model, "model_name", None))
+def _safe_model_generate(prompt, timeout_seconds=22, generation_config=None):
+    if not get_ai_model(retry=False):
         return None, "Model not initialized"
 
     def _job():
-        return model.generate_content(
-            prompt,
-            request_options={"timeout": min(max(int(timeout_seconds), 1), 20)}
-        )
+        kwargs = {"request_options": {"timeout": min(max(int(timeout_seconds), 1), 20)}}
+        if generation_config:
+            kwargs["generation_config"] = generation_config
+        return model.generate_content(prompt, **kwargs)
 
     executor = ThreadPoolExecutor(max_workers=1)
     future = executor.submit(_job)
     try:
         result = future.result(timeout=timeout_seconds)
         executor.shutdown(wait=True)
+        usage = getattr(result, "usage_metadata", None)
+        record_ai_tokens("gemini", getattr(model, "model_name", None),
+                         getattr(usage, "prompt_token_count", None), getattr(usage, "candidates_token_count", None))
         return result, None
     except FuturesTimeoutError:
         future.cancel()
@@ -762,101 +738,136 @@ def _safe_model_generate(prompt, timeout_seconds=22):
         return None, str(e)
 
 
-# Intento inicial al levantar servidor.
-connect_ai_model(force=True)
+# Gemini se configura en el primer uso, no al importar ni en el warm-up por defecto:
+# google.generativeai es el import más pesado y un worker que solo sirve estáticos no lo usa.
+startup.register("ai_model", lambda: connect_ai_model(force=True), warm=False)
+
+def get_ai_model(retry=True):
+    """Gemini model; the first call runs the ai_model phase, later ones reconnect if retry."""
+    if model is None:
+        if not startup.done("ai_model"):
+            startup.ensure("ai_model")
+        elif retry:
+            connect_ai_model(force=True)
+    return model
+
+
+# ── STARTER TEMPLATES (starter_templates/, compiled on first render or warm-up) ──
+def _load_templates():
+    count = templates.load()
+    print(f"[TEMPLATES] {count} templates compiled ({', '.join(templates.kits())})")
+    return count
+
+startup.register("templates", _load_templates)
+startup.mark("ai")
+
+
+# ── STATIC ASSETS (frontend/dist, see asset_pipeline.py) ──
+ASSET_DIST_PATH = os.path.join(frontend_path, 'dist')
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+_asset_manifest_cache = {"mtime": None, "assets": {}, "hashed": {}}
+
+def get_asset_manifest():
+    """manifest.json de dist/, recargado solo si cambió en disco."""
+    manifest_path = os.path.join(ASSET_DIST_PATH, MANIFEST_NAME)
+    try:
+        mtime = os.path.getmtime(manifest_path)
+    except OSError:
+        return {"assets": {}, "hashed": {}}  # sin build: se sirve frontend/ tal cual
+    if mtime != _asset_manifest_cache["mtime"]:
+        data = load_asset_manifest(ASSET_DIST_PATH)
+        assets = data.get("assets", {}) if isinstance(data.get("assets"), dict) else {}
+        hashed = {info["path"]: info for info in assets.values() if info.get("immutable")}
+        for entry in data.get("previous", []):
+            # Manifests anteriores guardaban solo la ruta: encodings=None hace que se busquen en disco.
+            path, encodings = (entry, None) if isinstance(entry, str) else (entry.get("path"), entry.get("encodings"))
+            if path:
+                hashed.setdefault(path, {"path": path, "immutable": True, "encodings": encodings})
+        _asset_manifest_cache.update({"mtime": mtime, "assets": assets, "hashed": hashed})
+    return _asset_manifest_cache
+
+def send_precompressed(directory, filename, cache_control, encodings=None):
+    """send_from_directory con negociación br/gzip sobre variantes precomprimidas."""
+    if encodings is None:
+        encodings = [
+            enc for enc, suffix in (("br", ".br"), ("gzip", ".gz"))
+            if os.path.isfile(os.path.join(directory, filename + suffix))
+        ]
+    encoding = negotiate_encoding(request.headers.get('Accept-Encoding', ''), encodings)
+    if encoding:
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = send_from_directory(directory, filename + ('.br' if encoding == 'br' else '.gz'), mimetype=mimetype)
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response = send_from_directory(directory, filename)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+def send_frontend_file(filename):
+    manifest = get_asset_manifest()
+    hashed = manifest["hashed"].get(filename)
+    if hashed:
+        return send_precompressed(ASSET_DIST_PATH, filename, IMMUTABLE_CACHE_CONTROL, hashed.get("encodings"))
+    info = manifest["assets"].get(filename)
+    if info:
+        # Nombre lógico (index.html, script-v36.js legacy): revalidar siempre con ETag.
+        return send_precompressed(ASSET_DIST_PATH, info["path"], "no-cache", info.get("encodings"))
+    return send_from_directory(frontend_path, filename)
 
 
 # --- FRONTEND ROUTES (Served from Root) ---
 @app.route('/')
 def index():
-    return send_from_directory(frontend_path, 'index.html')
+    return send_frontend_file('index.html')
 
 @app.route('/dashboard.html')
 def dashboard():
-    return send_from_directory(frontend_path, 'dashboard.html')
+    return send_frontend_file('dashboard.html')
 
 @app.route('/<path:filename>')
 def serve_static_files(filename):
-    return send_from_directory(frontend_path, filename)
+    return send_frontend_file(filename)
 
 
 # --- DATABASE & AUTH SETUP ---
 import sqlite3
-from werkzeug.security import generate_password_hash, check_password_hash
+
+# execute/executemany/commit cuentan como fase "db" (profiling) y alimentan anmar_sqlite_query_seconds.
+_ProfiledConnection = sqlite_factory(
+    request_profiler, "db",
+    observe=lambda statement, seconds: SQLITE_QUERY_SECONDS.labels(statement).observe(seconds),
+)
 
 def get_db_connection():
-    conn = sqlite3.connect('database.db')
+    # La primera conexión del proceso comprueba el esquema (fase "database").
+    if not startup.done("database"):
+        startup.ensure("database")
+    conn = sqlite3.connect('database.db', factory=_ProfiledConnection)
     conn.row_factory = sqlite3.Row
     return conn
 
+# Las migraciones corren una vez por deploy (`python schema_migrations.py migrate`).
+# Con ANMAR_AUTO_MIGRATE=1 (default) un worker que encuentre el esquema atrasado
+# migra bajo lock; con 0 solo avisa y el deploy es responsable de migrar.
+AUTO_MIGRATE = os.getenv("ANMAR_AUTO_MIGRATE", "1") == "1"
+
 def init_db():
     conn = get_db_connection()
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            email TEXT NOT NULL UNIQUE,
-            password TEXT NOT NULL,
-            tokens INTEGER NOT NULL DEFAULT 50,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS tickets (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            project_name TEXT NOT NULL,
-            user_email TEXT NOT NULL,
-            request TEXT NOT NULL,
-            status TEXT NOT NULL DEFAULT 'pending_human_review',
-            ai_suggestion TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS chat_memory (
-            email TEXT PRIMARY KEY,
-            memory_json TEXT NOT NULL,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS pending_tickets (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_email TEXT NOT NULL,
-            project_name TEXT,
-            history_json TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS processed_webhooks (
-            session_id TEXT PRIMARY KEY,
-            processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    conn.commit()
-
-    # Lightweight migration for existing DBs created with older schema.
-    cols = {r['name'] for r in conn.execute("PRAGMA table_info(users)").fetchall()}
-    if 'tokens' not in cols:
-        conn.execute("ALTER TABLE users ADD COLUMN tokens INTEGER NOT NULL DEFAULT 50")
-    if 'subscription_active' not in cols:
-        conn.execute("ALTER TABLE users ADD COLUMN subscription_active INTEGER NOT NULL DEFAULT 0")
-    if 'subscription_plan' not in cols:
-        conn.execute("ALTER TABLE users ADD COLUMN subscription_plan TEXT NOT NULL DEFAULT 'none'")
-    if 'subscription_started_at' not in cols:
-        conn.execute("ALTER TABLE users ADD COLUMN subscription_started_at TIMESTAMP")
-    if 'stripe_customer_id' not in cols:
-        conn.execute("ALTER TABLE users ADD COLUMN stripe_customer_id TEXT")
-    if 'stripe_subscription_id' not in cols:
-        conn.execute("ALTER TABLE users ADD COLUMN stripe_subscription_id TEXT")
-    if 'subscription_status' not in cols:
-        conn.execute("ALTER TABLE users ADD COLUMN subscription_status TEXT NOT NULL DEFAULT 'inactive'")
-    conn.commit()
-    conn.close()
+    try:
+        if not AUTO_MIGRATE:
+            missing = pending_migrations(conn)
+            if missing:
+                print(f"[DB] WARNING schema is {len(missing)} migration(s) behind; run `python schema_migrations.py migrate`")
+            return
+        applied = ensure_schema(conn)
+    finally:
+        conn.close()
+    for version, name in applied:
+        print(f"[DB] applied migration {version:04d} {name}")
 
-# Initialize or migrate DB on start
-init_db()
+startup.register("database", init_db)
+startup.mark("database")
 
 import threading
 import uuid
@@ -875,36 +886,45 @@ TWILIO_MESSAGING_SID = os.environ.get("TWILIO_MESSAGING_SID", "").strip()
 TWILIO_ADMIN_PHONE   = os.environ.get("TWILIO_ADMIN_PHONE", "").strip()
 
 
-def _send_sms(to_phone, body):
-    """Envía SMS via Twilio. Silencia errores en log — nunca rompe el flujo principal."""
-    if not TWILIO_ACCOUNT_SID or not TWILIO_AUTH_TOKEN or not to_phone:
-        print(f"[SMS] Skipped — missing config or phone. to={to_phone}")
-        return
+def _normalize_phone(to_phone):
     # Normalize phone: ensure starts with +
-    phone = to_phone.strip()
-    if not phone.startswith('+'):
+    phone = (to_phone or '').strip()
+    if phone and not phone.startswith('+'):
         phone = '+1' + phone.replace(' ', '').replace('-', '').replace('(', '').replace(')', '')
+    return phone
+
+
+def _twilio_send_sms(phone, body):
+    """Envío directo a Twilio (lo usa el dispatcher del outbox). Lanza excepción si falla."""
+    payload = {
+        'To': phone,
+        'Body': body,
+    }
+    if TWILIO_MESSAGING_SID:
+        payload['MessagingServiceSid'] = TWILIO_MESSAGING_SID
+    else:
+        payload['From'] = TWILIO_FROM
+    r = requests.post(
+        f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_ACCOUNT_SID}/Messages.json",
+        data=payload,
+        auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN),
+        timeout=15
+    )
+    if r.status_code >= 400:
+        raise Exception(f"Twilio HTTP {r.status_code}: {r.text[:300]}")
+    print(f"[SMS] Sent to {phone} — status {r.status_code}")
+
+
+def _send_sms(to_phone, body, dedupe_key=None):
+    """Encola un SMS en el outbox; nunca bloquea ni rompe el flujo principal."""
+    if not TWILIO_ACCOUNT_SID or not TWILIO_AUTH_TOKEN or not to_phone:
+        print(f"[SMS] Skipped — missing config or phone. to={to_phone}")
+        return None
     try:
-        payload = {
-            'To': phone,
-            'Body': body,
-        }
-        if TWILIO_MESSAGING_SID:
-            payload['MessagingServiceSid'] = TWILIO_MESSAGING_SID
-        else:
-            payload['From'] = TWILIO_FROM
-        r = requests.post(
-            f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_ACCOUNT_SID}/Messages.json",
-            data=payload,
-            auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN),
-            timeout=15
-        )
-        if r.status_code >= 400:
-            print(f"[SMS] ERROR {r.status_code}: {r.text}")
-        else:
-            print(f"[SMS] Sent to {phone} — status {r.status_code}")
+        return notification_outbox.enqueue("sms", _normalize_phone(to_phone), {"body": body}, dedupe_key=dedupe_key)
     except Exception as e:
-        print(f"[SMS] Exception sending to {phone}: {e}")
+        print(f"[SMS] Could not queue SMS to {to_phone}: {e}")
+        return None
 
 
 def _resend_send_email(to_addr, subject, html_body):
@@ -931,30 +951,85 @@ def _resend_send_email(to_addr, subject, html_body):
     return r.text
 
 
-@app.route('/api/test-email', methods=['GET'])
-def test_email_endpoint():
-    """Diagnóstico: GET /api/test-email?to=x@x.com — envía email de prueba. Requiere auth interna."""
-    if not require_internal_auth():
-        return jsonify({"error": "unauthorized"}), 401
-    if _rate_limit(request.remote_addr, max_requests=3, window=60):
-        return jsonify({"error": "Too many attempts. Wait a moment."}), 429
-    to = request.args.get('to', RESEND_ADMIN)
+def send_email(to_addr, subject, html_body, dedupe_key=None):
+    """Encola un email en el outbox (Resend lo envía el dispatcher)."""
+    if not RESEND_API_KEY:
+        print(f"[EMAIL] Skipped — RESEND_API_KEY vacía. to={to_addr}")
+        return None
     try:
-        result = _resend_send_email(
-            to_addr=to,
-            subject="Test desde Anmar API",
-            html_body="<div style='font-family:sans-serif;padding:20px;background:#000;color:#fff;border-radius:12px;'><h2 style='color:#10b981;'>Email de prueba</h2><p>Si ves esto, Resend funciona correctamente desde Python.</p></div>"
+        return notification_outbox.enqueue(
+            "email", str(to_addr or '').strip().lower(),
+            {"subject": subject, "html": html_body}, dedupe_key=dedupe_key,
         )
-        return jsonify({"ok": True, "to": to})
     except Exception as e:
-        print(f"[TEST-EMAIL] Error: {e}")
-        return jsonify({"ok": False, "error": "Error al enviar email de prueba."}), 500
+        print(f"[EMAIL] Could not queue email to {to_addr}: {e}")
+        return None
+
+
+# ── NOTIFICATION OUTBOX (tabla notification_outbox, ver notification_outbox.py) ──
+# Ningún request espera a Twilio/Resend: se inserta la fila y el dispatcher
+# entrega en background con reintentos/backoff. SMS al mismo destinatario que
+# coinciden en la cola se combinan en uno.
+SMS_MAX_CHARS = 1600
+
+def _combine_sms(payloads):
+    bodies = [str(p.get("body") or "").strip() for p in payloads if p.get("body")]
+    combined = "\n\n".join(bodies)
+    if len(combined) > SMS_MAX_CHARS:
+        combined = combined[:SMS_MAX_CHARS - 1] + "…"
+    return {"body": combined}
+
+notification_outbox = NotificationOutbox(
+    get_db_connection,
+    max_workers=int(os.getenv("ANMAR_OUTBOX_WORKERS", "2")),
+    max_attempts=int(os.getenv("ANMAR_OUTBOX_MAX_ATTEMPTS", "5")),
+    base_backoff=float(os.getenv("ANMAR_OUTBOX_BACKOFF_SECONDS", "30")),
+)
+notification_outbox.register("sms", lambda phone, payload: _twilio_send_sms(phone, payload.get("body", "")), combine=_combine_sms)
+notification_outbox.register("email", lambda to_addr, payload: _resend_send_email(to_addr, payload.get("subject", ""), payload.get("html", "")))
+startup.register("notification_outbox", notification_outbox.start)
+
+
+# Alertas de chat al admin: un SMS por proyecto y ventana (ANMAR_ADMIN_DIGEST_SECONDS)
+# con el conteo y el último mensaje, en vez de un SMS por mensaje del cliente.
+ADMIN_DIGEST_SECONDS = int(os.getenv("ANMAR_ADMIN_DIGEST_SECONDS", "120"))
+
+def _render_chat_digest(items, count):
+    last = items[-1]
+    display_project = str(last.get("project") or "").replace('_', ' ').title()
+    if count == 1:
+        header = f"💬 New message from {last.get('sender')}"
+    else:
+        senders = sorted({str(i.get('sender')) for i in items if i.get('sender')})
+        header = f"💬 {count} new messages from {', '.join(senders) or 'client'}"
+    return {"body": (
+        f"{header}\n"
+        f"Project: {display_project}\n"
+        f"\"{last.get('preview', '')}\"\n"
+        f"Reply at anmarenterprices.com/internal/panel.html"
+    )}
+
+def queue_admin_chat_alert(project_name, sender, content):
+    if not TWILIO_ACCOUNT_SID or not TWILIO_AUTH_TOKEN or not TWILIO_ADMIN_PHONE:
+        print(f"[SMS] Skipped — missing config or admin phone.")
+        return None
+    content = str(content or '')
+    item = {
+        "project": project_name,
+        "sender": sender,
+        "preview": content[:100] + ('…' if len(content) > 100 else ''),
+        "at": datetime.now().isoformat(),
+    }
+    return notification_outbox.enqueue_digest(
+        "sms", _normalize_phone(TWILIO_ADMIN_PHONE), f"chat:{project_name}", item,
+        _render_chat_digest, window=ADMIN_DIGEST_SECONDS, max_items=5,
+    )
 
 
 def notify_new_registration(name, email, phone=None):
-    """Envía emails + SMS de bienvenida + alerta admin en hilo separado."""
+    """Ticket interno + emails/SMS de bienvenida y alerta admin (encolados en el outbox)."""
 
-    def background_task():
+    def _queue_notifications():
 
         # 1. Ticket interno
         try:
@@ -990,7 +1065,7 @@ def notify_new_registration(name, email, phone=None):
         # 2. Email bienvenida
         _name = (name or "there").strip()
         try:
-            _resend_send_email(
+            send_email(
                 to_addr=email,
                 subject="Your idea engine is live — Welcome to Anmar Enterprises",
                 html_body=f"""<!DOCTYPE html>
@@ -1146,7 +1221,7 @@ def notify_new_registration(name, email, phone=None):
 
         # 3. Email alerta admin
         try:
-            _resend_send_email(
+            send_email(
                 to_addr=RESEND_ADMIN,
                 subject=f"Nuevo lead: {email}",
                 html_body=f"""<div style="font-family:sans-serif;max-width:560px;margin:0 auto;padding:40px 32px;background:#000;color:#fff;border-radius:16px;">
@@ -1182,426 +1257,11 @@ def notify_new_registration(name, email, phone=None):
             except Exception as e:
                 print(f"[SMS] Error alert admin: {e}")
 
-        print(f"[NOTIFY] HILO COMPLETADO para {email}")
-
-    threading.Thread(target=background_task, daemon=True).start()
-    print(f"[NOTIFY] Hilo lanzado para {email}")
-
-# --- AUTH ROUTES ---
-@app.route('/api/register', methods=['POST'])
-def register():
-    if _rate_limit(request.remote_addr, max_requests=5, window=60):
-        return jsonify({"error": "Too many attempts. Try again in a minute."}), 429
-    data = request.json or {}
-    name  = (data.get('name') or '').strip()
-    email = (data.get('email') or '').strip().lower()
-    password = data.get('password') or ''
-    terms_accepted = data.get('termsAccepted')
-
-    # Fix #5: Server-side email format validation
-    import re as _re
-    if not email or not _re.match(r'^[^@\s]+@[^@\s]+\.[^@\s]+$', email):
-        return jsonify({"error": "Please enter a valid email address."}), 400
-    # Fix #6: Name required
-    if not name:
-        return jsonify({"error": "Please enter your full name."}), 400
-    if not password:
-        return jsonify({"error": "Password is required."}), 400
-    if len(password) < 6:
-        return jsonify({"error": "Password must be at least 6 characters."}), 400
-    if not terms_accepted:
-        return jsonify({"error": "You must accept the Terms and Conditions to register."}), 400
-
-    hashed_pw = generate_password_hash(password)
-
-    try:
-        conn = get_db_connection()
-        conn.execute('INSERT INTO users (name, email, password, tokens) VALUES (?, ?, ?, ?)',
-                     (name, email, hashed_pw, 8))
-        conn.commit()
-        conn.close()
-
-        notify_new_registration(name, email)
-
-        return jsonify({"message": "Account created successfully", "user": {"name": name, "email": email, "tokens": 8}})
-    except sqlite3.IntegrityError:
-        return jsonify({"error": "Email is already registered"}), 409
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-@app.route('/api/forgot-password', methods=['POST'])
-def forgot_password():
-    """Fix #2: Forgot password — sends a reset link by email."""
-    if _rate_limit(request.remote_addr, max_requests=3, window=60):
-        return jsonify({"error": "Too many attempts. Try again in a minute."}), 429
-    data  = request.json or {}
-    email = (data.get('email') or '').strip().lower()
-    if not email:
-        return jsonify({"error": "Email is required."}), 400
-
-    conn = get_db_connection()
-    user = conn.execute('SELECT name FROM users WHERE email = ?', (email,)).fetchone()
-    conn.close()
-
-    # Always return success to avoid revealing registered emails
-    if not user:
-        return jsonify({"message": "If that email exists, a reset link has been sent."}), 200
-
-    import secrets, hashlib
-    token     = secrets.token_urlsafe(32)
-    token_hash = hashlib.sha256(token.encode()).hexdigest()
-    expires_at = (datetime.utcnow() + timedelta(hours=1)).strftime('%Y-%m-%d %H:%M:%S')  # BUG FIX: was utcnow() — tokens expired instantly
-
-    # Store token in DB (reuse chat_memory table with special key)
-    conn = get_db_connection()
-    conn.execute(
-        "INSERT OR REPLACE INTO chat_memory (email, memory_json, updated_at) VALUES (?, ?, ?)",
-        (f"__reset__{email}", json.dumps({"token_hash": token_hash, "expires_at": expires_at}), expires_at)
-    )
-    conn.commit()
-    conn.close()
-
-    reset_url = f"https://anmarenterprices.com/reset-password.html?token={token}&email={email}"
-    print(f"[RESET] Password reset link for {email}: {reset_url}")
-
-    # BUG FIX Bug 14: send actual reset email (was wrongly calling notify_new_registration
-    # which sent the welcome email instead of the reset link)
-    try:
-        name_str = user['name'] or 'there'
-        reset_html = f"""
-        <div style="font-family:sans-serif;max-width:520px;margin:0 auto;padding:32px 24px;background:#0a0a0a;color:#e5e7eb;border-radius:12px;">
-          <h2 style="color:#10b981;margin-bottom:8px;">Password Reset</h2>
-          <p style="color:#9ca3af;">Hi {name_str},</p>
-          <p>We received a request to reset your Anmar password. Click the button below to set a new password. This link expires in <strong>1 hour</strong>.</p>
-          <a href="{reset_url}" style="display:inline-block;margin:24px 0;padding:12px 28px;background:#10b981;color:#000;font-weight:700;border-radius:8px;text-decoration:none;">Reset My Password</a>
-          <p style="color:#6b7280;font-size:0.85rem;">If you didn't request this, you can safely ignore this email. Your password won't change.</p>
-          <p style="color:#6b7280;font-size:0.8rem;">Or copy this link: <a href="{reset_url}" style="color:#10b981;">{reset_url}</a></p>
-        </div>
-        """
-        _resend_send_email(email, "Reset your Anmar password", reset_html)
-    except Exception as e:
-        print(f"[RESET] Could not send email to {email}: {e}")
-
-    return jsonify({"message": "If that email exists, a reset link has been sent."}), 200
-
-@app.route('/api/me', methods=['POST'])
-def api_me():
-    """Lightweight session validator — verifies the user still exists in DB and returns current tokens."""
-    data = request.json or {}
-    email = (data.get('email') or '').strip().lower()
-    if not email:
-        return jsonify({"error": "Not authenticated"}), 401
-
-    # Verify session and email match
-    session_email = session.get('user_email', '').strip().lower()
-    if not session_email:
-        return jsonify({"error": "You have not logged in"}), 401
-    if session_email != email:
-        return jsonify({"error": "Unauthorized"}), 403
-
-    conn = get_db_connection()
-    user = conn.execute('SELECT name, email, tokens FROM users WHERE LOWER(email) = ?', (email,)).fetchone()
-    conn.close()
-    if not user:
-        return jsonify({"error": "User not found"}), 401
-    tokens = int(user['tokens']) if user['tokens'] is not None else 0
-    return jsonify({"user": {"name": user['name'], "email": user['email'], "tokens": tokens}})
-
-@app.route('/api/check-email', methods=['POST'])
-def check_email():
-    if _rate_limit(request.remote_addr, max_requests=20, window=60):
-        return jsonify({"error": "Too many attempts. Try again in a minute."}), 429
-    try:
-        data = request.json or {}
-        email = str(data.get('email') or '').strip().lower()
-        if not email:
-            return jsonify({"error": "Email is required"}), 400
-        conn = get_db_connection()
-        user = conn.execute('SELECT 1 FROM users WHERE email = ?', (email,)).fetchone()
-        conn.close()
-        return jsonify({"exists": bool(user)})
-    except Exception as e:
-        print(f"Check email error: {e}")
-        return jsonify({"error": "Internal server error"}), 500
-
-@app.route('/api/login', methods=['POST'])
-def login():
-    if _rate_limit(request.remote_addr, max_requests=10, window=60):
-        return jsonify({"error": "Too many attempts. Try again in a minute."}), 429
-    data = request.json or {}
-    email = (data.get('email') or '').strip().lower()
-    password = data.get('password') or ''
-
-    conn = get_db_connection()
-    user = conn.execute('SELECT * FROM users WHERE LOWER(email) = ?', (email,)).fetchone()
-    conn.close()
-
-    if user and check_password_hash(user['password'], password):
-        tokens = int(user['tokens']) if user['tokens'] is not None else 0
-        session.permanent = True
-        session['user_email'] = user['email']
-        return jsonify({
-            "message": "Login successful",
-            "user": {"name": user['name'], "email": user['email'], "tokens": tokens}
-        })
-    else:
-        return jsonify({"error": "Credenciales inválidas"}), 401
-
-@app.route('/api/social-login', methods=['POST'])
-def social_login():
-    if _rate_limit(request.remote_addr, max_requests=10, window=60):
-        return jsonify({"error": "Too many attempts. Try again in a minute."}), 429
-    data = request.json or {}
-    provider = data.get('provider') # 'Google' or 'Apple'
-    token = data.get('token')
-    email = data.get('email')
-    name = data.get('name')
-    terms_accepted = data.get('termsAccepted')
-
-    if provider == 'Google':
-        if not token:
-            return jsonify({"error": "Missing authentic Google token to validate your Gmail."}), 400
-
-        import requests
-        try:
-            google_res = requests.get(f"https://oauth2.googleapis.com/tokeninfo?id_token={token}")
-            if google_res.status_code == 200:
-                google_data = google_res.json()
-                email = google_data.get('email')
-                name = google_data.get('name')
-                
-                if not email:
-                    return jsonify({"error": "Google account did not authorize email delivery."}), 400
-            else:
-                return jsonify({"error": "Invalid or expired Google token"}), 401
-        except Exception as e:
-            return jsonify({"error": "Error verificando token de Google"}), 500
-
-    if not email:
-        return jsonify({"error": "Missing social network data"}), 400
-
-    conn = get_db_connection()
-    email_lower = (email or '').strip().lower()
-    user = conn.execute('SELECT * FROM users WHERE LOWER(email) = ?', (email_lower,)).fetchone()
-
-    if not user:
-        if not terms_accepted:
-            conn.close()
-            return jsonify({"error": "You must accept the Terms and Conditions to create your account."}), 400
-        # User doesn't exist, create automatically using social info
-        import secrets
-        random_password = secrets.token_urlsafe(16)  # Generate a long placeholder password
-        from werkzeug.security import generate_password_hash
-        hashed_pw = generate_password_hash(random_password)
-        try:
-            conn.execute('INSERT INTO users (name, email, password, tokens) VALUES (?, ?, ?, ?)', (name, email, hashed_pw, 8))
-            conn.commit()
-            user_data = {"name": name, "email": email, "tokens": 8}
-
-            # ACTIVATE NOTIFICATIONS FOR SOCIAL SIGNUP
-            notify_new_registration(name, email)
-
-        except Exception as e:
-            conn.close()
-            return jsonify({"error": "Internal server error"}), 500
-    else:
-        # User exists, log them in
-        tokens = int(user['tokens']) if user['tokens'] is not None else 0
-        user_data = {"name": user['name'], "email": user['email'], "tokens": tokens}
-
-    conn.close()
-
-    # Set session for authenticated user
-    session.permanent = True
-    session['user_email'] = email
-
-    return jsonify({
-        "message": f"Authenticated with {provider} successfully",
-        "user": user_data
-    })
-
-@app.route('/api/logout', methods=['POST'])
-def logout():
-    """Clear user session."""
-    session.pop('user_email', None)
-    return jsonify({"status": "ok"})
+        print(f"[NOTIFY] Notificaciones encoladas para {email}")
 
+    _queue_notifications()
 
 # ── BUSINESS MODEL GENERATOR ──────────────────────────────────────────────────
-@app.route('/api/generate-business-model', methods=['POST'])
-def generate_business_model():
-    """Generate a personalized business model analysis using Anthropic. Returns full JSON."""
-    data = request.json or {}
-    project_name    = data.get('project_name', 'tu proyecto')
-    description     = data.get('description', '')
-    project_type    = data.get('project_type', '')
-    biz_model_type  = data.get('business_model', '')
-    audience        = data.get('audience', '')
-    geography       = data.get('geography', '')
-    stage           = data.get('stage', '')
-
-    if not ANTHROPIC_API_KEY:
-        return jsonify({'error': 'AI not available'}), 503
-
-    prompt = f"""You are a world-class business analyst and venture strategist with access to real market data.
-An entrepreneur just described their idea. Generate a DEEP, SPECIFIC, IMPRESSIVE business analysis using real numbers and real company names.
-
-CRITICAL: RESPOND ENTIRELY IN ENGLISH. Every single field must be in English.
-
-PROJECT DATA:
-- Name: {project_name}
-- Description: {description}
-- Type: {project_type}
-- Business model: {biz_model_type}
-- Target audience: {audience}
-- Target geography: {geography}
-- Current stage: {stage}
-
-Respond ONLY with a valid JSON object. No markdown, no code fences, no extra text. Use this EXACT structure:
-{{
-  "market": {{
-    "size": "Total Addressable Market with real USD figure (e.g. '$18.4B TAM')",
-    "sam": "Serviceable Addressable Market — realistic capture for this product (e.g. '$1.2B SAM')",
-    "growth": "CAGR with specific years (e.g. '27.3% CAGR 2024–2031')",
-    "insight": "One sharp, non-obvious observation about WHY this specific moment is ideal to enter — cite a recent shift, regulation, or behavior change",
-    "trends": [
-      "Specific macro trend driving this market right now",
-      "Behavioral or technological shift creating the opening",
-      "Regulatory or economic factor accelerating adoption"
-    ]
-  }},
-  "competitors": [
-    {{"name": "Real company name", "share": "~XX% market share", "weakness": "Their biggest gap that {project_name} can exploit", "strength": "What they genuinely do best"}},
-    {{"name": "Real company name 2", "share": "~XX% market share", "weakness": "Their biggest gap", "strength": "Their strongest trait"}},
-    {{"name": "Real company name 3", "share": "~XX% market share", "weakness": "Their biggest gap", "strength": "Their strongest trait"}}
-  ],
-  "advantage": {{
-    "main": "The single strongest and most specific competitive advantage of {project_name} — be concrete, not generic",
-    "moat": "What makes this defensible and hard to replicate in 12–18 months",
-    "differentiation": "In one sentence: exactly how this differs from existing solutions in terms a customer would notice"
-  }},
-  "risk": {{
-    "description": "The most critical, specific risk for this exact business at this stage",
-    "mitigation": "2–3 concrete actions to reduce this risk starting now",
-    "probability": "Low"
-  }},
-  "persona": {{
-    "name": "Full description of ideal first customer (e.g. 'Marcus, 38, VP of Operations at a 50-person logistics startup')",
-    "painPoint": "The exact painful problem they face today that {project_name} eliminates — be specific",
-    "willingness": "Why they would pay and estimated amount (e.g. 'Would pay $X/mo — saves 12 hrs/week and replaces a $X/yr tool')"
-  }},
-  "channels": [
-    {{"name": "Channel name", "reason": "Why this specific channel works for this exact product and audience"}},
-    {{"name": "Channel name", "reason": "Why this specific channel works for this exact product and audience"}},
-    {{"name": "Channel name", "reason": "Why this specific channel works for this exact product and audience"}}
-  ],
-  "score": {{
-    "overall": <integer 0-100 reflecting genuine strength of this idea based on market, timing, advantage and risk>,
-    "grade": "<A+|A|A-|B+|B|B-|C+|C — matching the overall score>",
-    "breakdown": {{
-      "market": <0-100 — how large and accessible the market is>,
-      "timing": <0-100 — how good the timing is right now>,
-      "advantage": <0-100 — how strong and defensible the competitive advantage is>,
-      "risk": <0-100 — how manageable the risks are, higher = less risky>
-    }},
-    "verdict": "One compelling sentence summarizing why this idea is or isn't ready for investment"
-  }},
-  "revenue": {{
-    "year1": "Realistic Year 1 revenue (e.g. '$120K')",
-    "year2": "Year 2 projection (e.g. '$680K')",
-    "year3": "Year 3 projection (e.g. '$2.4M')",
-    "assumption": "Key assumption driving these projections (e.g. '2% SAM penetration by Y3 at $X/mo ACV')"
-  }},
-  "analogy": {{
-    "company": "Name of a real successful company with similar positioning or model",
-    "raised": "How much they raised or their current valuation (e.g. 'Raised $275M' or '$4.2B valuation')",
-    "insight": "One sentence on why {project_name} has a similar opportunity right now"
-  }},
-  "nextStep": "The single most important action in the next 7 days to validate this and build real momentum"
-}}"""
-
-    try:
-        raw = call_anthropic_text(prompt, system_prompt="You are a business analyst. Respond only with valid JSON, no markdown, no extra text.", timeout_seconds=45, max_tokens_override=2048)
-        if not raw:
-            return jsonify({'error': 'AI timeout or unavailable'}), 503
-
-        # Strip markdown code fences if present
-        raw = raw.strip()
-        if raw.startswith("```"):
-            raw = raw.split("```")[1]
-            if raw.startswith("json"):
-                raw = raw[4:]
-        raw = raw.strip()
-
-        parsed = json.loads(raw)
-
-        # ── Cache BM result so internal panel can load it ─────────────────────
-        try:
-            bm_cache_path = os.path.join(BASE_DIR, 'backend', 'bm_cache.json')
-            bm_cache = {}
-            if os.path.exists(bm_cache_path):
-                with open(bm_cache_path, 'r') as _f:
-                    bm_cache = json.load(_f)
-            cache_key = project_name.lower().strip().replace(' ', '_')
-            bm_cache[cache_key] = {
-                'data': parsed,
-                'project_name': project_name,
-                'updated_at': datetime.utcnow().isoformat()
-            }
-            with open(bm_cache_path, 'w') as _f:
-                json.dump(bm_cache, _f)
-        except Exception as _e:
-            print(f'[BM Cache] Error saving: {_e}')
-
-        return jsonify({'ok': True, 'data': parsed})
-
-    except json.JSONDecodeError:
-        return jsonify({'error': 'Invalid AI response', 'raw': raw[:300]}), 500
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
-
-
-@app.route('/api/bm-data', methods=['GET'])
-def get_bm_data():
-    """Return cached BM analysis for a project. Used by internal panel for context."""
-    # BUG FIX: require authentication — internal team OR the project owner
-    is_internal = bool(session.get('internal_user'))
-    is_client   = bool(session.get('user_email'))
-    if not is_internal and not is_client:
-        return jsonify({'error': 'Unauthorized'}), 401
-
-    project_name = request.args.get('project_name', '').lower().strip().replace(' ', '_')
-    if not project_name:
-        return jsonify({'error': 'project_name required'}), 400
-
-    # Ownership check: clients may only access their own project's BM
-    if is_client and not is_internal:
-        client_email = session.get('user_email', '').strip().lower()
-        alerts = load_alerts()
-        project_ticket = next(
-            (t for t in alerts if str(t.get('project_name', '')).lower().replace(' ', '_') == project_name),
-            None
-        )
-        # If ticket exists, verify caller is the owner
-        if project_ticket and project_ticket.get('client_email', '').lower() != client_email:
-            return jsonify({'error': 'Forbidden'}), 403
-
-    bm_cache_path = os.path.join(BASE_DIR, 'backend', 'bm_cache.json')
-    if not os.path.exists(bm_cache_path):
-        return jsonify({'error': 'No BM cache found'}), 404
-    try:
-        with open(bm_cache_path, 'r') as f:
-            bm_cache = json.load(f)
-    except Exception:
-        return jsonify({'error': 'Error reading BM cache'}), 500
-    # Try both underscore and space variants
-    data = (bm_cache.get(project_name)
-            or bm_cache.get(project_name.replace('_', ' '))
-            or bm_cache.get(project_name.replace(' ', '_')))
-    if not data:
-        return jsonify({'error': 'BM not found for this project'}), 404
-    return jsonify(data)
-
 def _normalize_project_name(project_name):
     return str(project_name or "").strip().lower()
 
@@ -1645,109 +1305,16 @@ def save_chat_memory(email, memory_payload, project_name=None):
     conn.commit()
     conn.close()
 
-@app.route('/api/chat-memory', methods=['GET'])
-def read_chat_memory():
-    email = request.args.get('email', '').strip().lower()
-    project_name = request.args.get('project_name', '').strip().lower()
-    if not email:
-        return jsonify({"error": "email is required"}), 400
-    # Auth: only the owner or an internal user may read memory
-    is_internal = bool(session.get('internal_user'))
-    session_email = session.get('user_email', '').strip().lower()
-    if not is_internal and (not session_email or session_email != email):
-        return jsonify({"error": "Unauthorized"}), 401
-    memory = get_chat_memory(email, project_name=project_name)
-    return jsonify({"memory": memory or {}})
-
-@app.route('/api/chat-memory', methods=['POST'])
-def write_chat_memory():
-    data = request.json or {}
-    email = (data.get('email') or '').strip().lower()
-    project_name = (data.get('project_name') or '').strip().lower()
-    # Auth: only the owner may write their own memory
-    session_email = session.get('user_email', '').strip().lower()
-    if not session_email or session_email != email:
-        return jsonify({"error": "Unauthorized"}), 401
-    memory = data.get('memory')
-    if not email:
-        return jsonify({"error": "email is required"}), 400
-    if not isinstance(memory, dict):
-        return jsonify({"error": "memory must be an object"}), 400
-
-    # Merge with existing memory to avoid losing agent state.
-    existing = get_chat_memory(email, project_name=project_name) or {}
-    merged = dict(existing)
-    merged.update(memory)
-
-    # Keep payload bounded and predictable.
-    history = merged.get('conversation_history', [])
-    if isinstance(history, list):
-        merged['conversation_history'] = history[-40:]
-    else:
-        merged['conversation_history'] = []
-
-    merged['chat_stage'] = str(merged.get('chat_stage', 'initial'))
-    merged['current_project_name'] = str(merged.get('current_project_name', ''))
-    merged['current_ticket_project_id'] = str(merged.get('current_ticket_project_id', ''))
-    merged['summary'] = str(merged.get('summary', ''))[:500]
-    merged['audience'] = str(merged.get('audience', ''))[:500]
-    merged['business_model'] = str(merged.get('business_model', ''))[:500]
-    merged['timeline'] = str(merged.get('timeline', ''))[:250]
-
-    save_chat_memory(email, merged, project_name=project_name)
-    return jsonify({"status": "ok"})
-
-@app.route('/api/chat-memory/reset', methods=['POST'])
-def reset_chat_memory_endpoint():
-    data = request.json or {}
-    email = (data.get('email') or '').strip().lower()
-    project_name = (data.get('project_name') or '').strip().lower()
-    if not email:
-        return jsonify({"error": "email is required"}), 400
-    # Auth: only the owner or internal user may reset memory
-    is_internal = bool(session.get('internal_user'))
-    session_email = session.get('user_email', '').strip().lower()
-    if not is_internal and (not session_email or session_email != email):
-        return jsonify({"error": "Unauthorized"}), 401
-
-    existing = get_chat_memory(email, project_name=project_name) or {}
-    reset_payload = reset_memory_payload(existing)
-    save_chat_memory(email, reset_payload, project_name=project_name)
-    return jsonify({"status": "ok", "memory": reset_payload})
-
 # --- HELPER: ROBUST JSON PARSER ---
-def clean_and_parse_json(text):
+def clean_and_parse_json(text, allow_partial=False):
     """
-    Cleans AI response text to ensure valid JSON parsing.
-    Handles Markdown fences and unescaped newlines in strings.
+    Parses AI response text as JSON (fences, prose around the payload,
+    raw newlines in strings, trailing commas). See structured_output.
     """
-    try:
-        # 1. Remove Markdown Code Blocks
-        text = text.replace("```json", "").replace("```", "").strip()
-        
-        # 2. Try Standard Parse
-        return json.loads(text)
-    except json.JSONDecodeError:
-        try:
-            # 2.5 Extract a JSON object/array from surrounding text.
-            if "{" in text and "}" in text:
-                start = text.find("{")
-                end = text.rfind("}")
-                if end > start:
-                    return json.loads(text[start:end + 1])
-            if "[" in text and "]" in text:
-                start = text.find("[")
-                end = text.rfind("]")
-                if end > start:
-                    return json.loads(text[start:end + 1])
-            # 3. Aggressive Fix: Escape control characters (newlines) inside strings?
-            # A safer fallback for Python is using ast.literal_eval if it looks like a Python dict
-            import ast
-            return ast.literal_eval(text)
-        except Exception as e:
-            # 4. Last Resort: parsing failed
-            print(f"[JSON PARSE] Failed: {str(e)[:80]}")
-            return None
+    parsed = loads_tolerant(text, allow_partial=allow_partial)
+    if parsed is None and text:
+        print(f"[JSON PARSE] Failed: {str(text)[:80]!r}")
+    return parsed
 
 def is_greeting_text(text):
     t = (text or "").strip().lower()
@@ -2002,6 +1569,8 @@ def generate_blueprint_markdown(brief, tech_stack):
 - Al cierre se entrega como `completed` con URL de preview.
 """
 
+@request_profiler.timed("ai")
+@observe_provider("openai", lambda: OPENAI_CODEX_MODEL)
 def call_openai_codex_text(prompt, timeout_seconds=28):
     if not OPENAI_API_KEY:
         return None
@@ -2026,6 +1595,8 @@ def call_openai_codex_text(prompt, timeout_seconds=28):
             log_debug(f"OpenAI error {response.status_code}: {response.text[:300]}")
             return None
         payload = response.json()
+        usage = payload.get("usage") or {}
+        record_ai_tokens("openai", OPENAI_CODEX_MODEL, usage.get("prompt_tokens"), usage.get("completion_tokens"))
         choices = payload.get("choices") or []
         if not choices:
             return None
@@ -2038,9 +1609,18 @@ def call_openai_codex_text(prompt, timeout_seconds=28):
         log_debug(f"OpenAI Codex call failed: {e}")
         return None
 
-def call_openai_codex_json(prompt, timeout_seconds=28):
+@request_profiler.timed("ai")
+@observe_provider("openai", lambda: OPENAI_CODEX_MODEL)
+def call_openai_codex_json(prompt, timeout_seconds=28, schema=None, schema_name="response"):
     if not OPENAI_API_KEY:
         return None
+    response_format = {"type": "json_object"}
+    if schema:
+        # Structured outputs: el modelo queda restringido al schema (modo no estricto).
+        response_format = {
+            "type": "json_schema",
+            "json_schema": {"name": schema_name, "schema": schema, "strict": False},
+        }
     try:
         response = requests.post(
             "https://api.openai.com/v1/chat/completions",
@@ -2055,7 +1635,7 @@ def call_openai_codex_json(prompt, timeout_seconds=28):
                     {"role": "user", "content": prompt},
                 ],
                 "temperature": 0.2,
-                "response_format": {"type": "json_object"},
+                "response_format": response_format,
             },
             timeout=timeout_seconds,
         )
@@ -2063,6 +1643,8 @@ def call_openai_codex_json(prompt, timeout_seconds=28):
             log_debug(f"OpenAI JSON error {response.status_code}: {response.text[:300]}")
             return None
         payload = response.json()
+        usage = payload.get("usage") or {}
+        record_ai_tokens("openai", OPENAI_CODEX_MODEL, usage.get("prompt_tokens"), usage.get("completion_tokens"))
         choices = payload.get("choices") or []
         if not choices:
             return None
@@ -2081,6 +1663,8 @@ def call_openai_codex_json(prompt, timeout_seconds=28):
         return None
 
 
+@request_profiler.timed("ai")
+@observe_provider("anthropic", lambda: ANTHROPIC_MODEL)
 def call_anthropic_text(prompt, system_prompt=None, timeout_seconds=22, max_tokens_override=None):
     if not ANTHROPIC_API_KEY:
         return None
@@ -2114,6 +1698,8 @@ def call_anthropic_text(prompt, system_prompt=None, timeout_seconds=22, max_toke
             log_debug(f"Anthropic error {response.status_code}: {response.text[:300]}")
             return None
         data = response.json() or {}
+        usage = data.get("usage") or {}
+        record_ai_tokens("anthropic", ANTHROPIC_MODEL, usage.get("input_tokens"), usage.get("output_tokens"))
         content_blocks = data.get("content") or []
         text = "".join(
             [block.get("text", "") for block in content_blocks if isinstance(block, dict) and block.get("type") == "text"]
@@ -2140,6 +1726,8 @@ def call_anthropic_text(prompt, system_prompt=None, timeout_seconds=22, max_toke
         return None
 
 
+@request_profiler.timed("ai")
+@observe_provider("anthropic", lambda: ANTHROPIC_MODEL)
 def call_anthropic_chat(messages, system_prompt=None, timeout_seconds=30, max_tokens_override=None):
     """
     Llama a Anthropic con historial de conversación multi-turno real.
@@ -2203,6 +1791,8 @@ def call_anthropic_chat(messages, system_prompt=None, timeout_seconds=30, max_to
             log_debug(f"Anthropic chat error {response.status_code}: {response.text[:300]}")
             return None
         data = response.json() or {}
+        usage = data.get("usage") or {}
+        record_ai_tokens("anthropic", ANTHROPIC_MODEL, usage.get("input_tokens"), usage.get("output_tokens"))
         content_blocks = data.get("content") or []
         text = "".join(
             [block.get("text", "") for block in content_blocks
@@ -2229,36 +1819,222 @@ def call_anthropic_chat(messages, system_prompt=None, timeout_seconds=30, max_to
         return None
 
 
-def call_ai_json(prompt, engine=ENGINE_ANTIGRAVITY):
-    normalized_engine = normalize_engine(engine)
-    if normalized_engine == ENGINE_OPENAI_CODEX:
-        parsed = call_openai_codex_json(prompt)
-        if isinstance(parsed, dict):
-            return parsed
-    text = call_ai_text(prompt, engine=normalized_engine)
-    if not text:
-        return None
-    return clean_and_parse_json(text)
-
-
-def call_ai_text(prompt, engine=ENGINE_ANTIGRAVITY):
-    normalized_engine = normalize_engine(engine)
-    if normalized_engine == ENGINE_OPENAI_CODEX:
-        codex_text = call_openai_codex_text(prompt)
-        if codex_text:
-            return codex_text.replace("```", "").strip()
-        # Hard fallback to Antigravity/Gemini if OpenAI is unavailable.
-    if normalized_engine in {ENGINE_ANTHROPIC, ENGINE_ANTIGRAVITY} and ANTHROPIC_API_KEY:
-        anth_text = call_anthropic_text(prompt, system_prompt=SYSTEM_INSTRUCTION_TEXT)
-        if anth_text:
-            return anth_text.replace("```", "").strip()
-    if not model:
-        connect_ai_model(force=True)
-    if not model:
-        AI_RUNTIME["connected"] = False
-        return None
+@request_profiler.timed("ai")
+@observe_provider("anthropic", lambda: ANTHROPIC_MODEL)
+def call_anthropic_json(prompt, schema, tool_name="structured_response", system_prompt=None, timeout_seconds=45, max_tokens_override=None):
+    """
+    Structured output via Anthropic tool use: the schema is the tool's
+    input_schema and tool_choice forces the call. The response is streamed
+    so a payload cut by max_tokens can still be recovered partially.
+    Returns (data, complete).
+    """
+    if not ANTHROPIC_API_KEY:
+        return None, False
+    system_payload = system_prompt if system_prompt is not None else SYSTEM_INSTRUCTION_TEXT
+    tokens = max_tokens_override if max_tokens_override else max(1, int(ANTHROPIC_MAX_TOKENS))
+    payload = {
+        "model": ANTHROPIC_MODEL or "claude-sonnet-4-5",
+        "max_tokens": tokens,
+        "temperature": float(ANTHROPIC_TEMPERATURE),
+        "system": system_payload,
+        "messages": [
+            {"role": "user", "content": str(prompt or "")}
+        ],
+        "tools": [{
+            "name": tool_name,
+            "description": "Return the requested result. Always call this tool.",
+            "input_schema": schema,
+        }],
+        "tool_choice": {"type": "tool", "name": tool_name},
+        "stream": True,
+    }
+    tool_parser = StreamingJSONParser()
+    text_parser = StreamingJSONParser()
+    stop_reason = None
+    usage = {}
     try:
-        response, gen_error = _safe_model_generate(prompt, timeout_seconds=22)
+        response = requests.post(
+            ANTHROPIC_ENDPOINT,
+            headers={
+                "x-api-key": ANTHROPIC_API_KEY,
+                "anthropic-version": ANTHROPIC_VERSION,
+                "content-type": "application/json",
+            },
+            json=payload,
+            timeout=timeout_seconds,
+            stream=True,
+        )
+        if response.status_code >= 400:
+            AI_RUNTIME["connected"] = False
+            AI_RUNTIME["model_name"] = ANTHROPIC_MODEL
+            AI_RUNTIME["last_error"] = f"Anthropic json {response.status_code}: {response.text[:300]}"
+            AI_RUNTIME["last_check_at"] = _now_iso()
+            log_debug(f"Anthropic json error {response.status_code}: {response.text[:300]}")
+            return None, False
+        started = _time.time()
+        for line in response.iter_lines(decode_unicode=True):
+            if _time.time() - started > timeout_seconds:
+                log_debug(f"Anthropic json stream exceeded {timeout_seconds}s, keeping partial payload")
+                break
+            if not line or not line.startswith("data:"):
+                continue
+            try:
+                event = json.loads(line[5:].strip())
+            except ValueError:
+                continue
+            event_type = event.get("type")
+            if event_type == "message_start":
+                usage.update((event.get("message") or {}).get("usage") or {})
+            elif event_type == "content_block_delta":
+                delta = event.get("delta") or {}
+                if delta.get("type") == "input_json_delta":
+                    tool_parser.feed(delta.get("partial_json", ""))
+                elif delta.get("type") == "text_delta":
+                    text_parser.feed(delta.get("text", ""))
+            elif event_type == "message_delta":
+                stop_reason = (event.get("delta") or {}).get("stop_reason") or stop_reason
+                usage.update(event.get("usage") or {})
+            elif event_type == "error":
+                raise RuntimeError(str(event.get("error"))[:300])
+        response.close()
+    except Exception as e:
+        AI_RUNTIME["connected"] = False
+        AI_RUNTIME["model_name"] = ANTHROPIC_MODEL
+        AI_RUNTIME["last_error"] = str(e)
+        AI_RUNTIME["last_check_at"] = _now_iso()
+        log_debug(f"Anthropic json call failed: {e}")
+        if not tool_parser.raw:
+            return None, False
+    record_ai_tokens("anthropic", ANTHROPIC_MODEL, usage.get("input_tokens"), usage.get("output_tokens"))
+
+    parser = tool_parser if tool_parser.raw else text_parser
+    data = parser.snapshot()
+    if not isinstance(data, dict):
+        AI_RUNTIME["connected"] = False
+        AI_RUNTIME["last_error"] = "Empty structured response from Anthropic"
+        AI_RUNTIME["last_check_at"] = _now_iso()
+        return None, False
+    complete = parser.complete and stop_reason != "max_tokens"
+    if not complete:
+        log_debug(f"Anthropic json truncated (stop_reason={stop_reason}), using partial payload")
+    AI_RUNTIME["connected"] = True
+    AI_RUNTIME["model_name"] = ANTHROPIC_MODEL
+    AI_RUNTIME["candidate_models"] = [ANTHROPIC_MODEL]
+    AI_RUNTIME["last_error"] = None
+    AI_RUNTIME["last_check_at"] = _now_iso()
+    AI_RUNTIME["provider"] = "anthropic"
+    return data, complete
+
+
+@request_profiler.timed("ai")
+def call_gemini_json(prompt, schema=None, timeout_seconds=22):
+    """Gemini JSON mode (response_mime_type); older models ignore or reject it, then plain text is parsed."""
+    if not model:
+        get_ai_model()
+    if not model:
+        AI_RUNTIME["connected"] = False
+        return None
+    full_prompt = f"{prompt}\n\n{schema_prompt_hint(schema)}" if schema else prompt
+    response, gen_error = _safe_model_generate(
+        full_prompt,
+        timeout_seconds=timeout_seconds,
+        generation_config={"response_mime_type": "application/json"},
+    )
+    if gen_error and "timeout" not in gen_error.lower():
+        response, gen_error = _safe_model_generate(full_prompt, timeout_seconds=timeout_seconds)
+    if gen_error or not response:
+        AI_RUNTIME["connected"] = False
+        AI_RUNTIME["last_error"] = gen_error or "Empty response from AI model"
+        AI_RUNTIME["last_check_at"] = _now_iso()
+        log_debug(f"Gemini JSON call failed: {gen_error}")
+        return None
+    try:
+        text = (response.text or "").strip()
+    except Exception as e:
+        log_debug(f"Gemini JSON response unreadable: {e}")
+        return None
+    AI_RUNTIME["connected"] = True
+    AI_RUNTIME["last_error"] = None
+    AI_RUNTIME["last_check_at"] = _now_iso()
+    return clean_and_parse_json(text)
+
+
+@request_profiler.timed("ai")
+def call_ai_json(prompt, engine=ENGINE_ANTIGRAVITY, schema=None, name="structured_response",
+                 system_prompt=None, timeout_seconds=None, max_tokens_override=None):
+    """
+    JSON from the engine's provider chain. With a schema each provider is
+    asked for structured output (OpenAI json_schema, Anthropic tool use,
+    Gemini JSON mode) and the result is coerced to the schema; the first
+    result without schema errors wins, otherwise the best partial one.
+    """
+    normalized_engine = normalize_engine(engine)
+    if not schema:
+        if normalized_engine == ENGINE_OPENAI_CODEX:
+            parsed = call_openai_codex_json(prompt)
+            if isinstance(parsed, dict):
+                return parsed
+        text = call_ai_text(prompt, engine=normalized_engine)
+        if not text:
+            return None
+        return clean_and_parse_json(text)
+
+    best, best_errors = None, None
+
+    def _accept(candidate, source):
+        nonlocal best, best_errors
+        if not isinstance(candidate, dict):
+            return False
+        coerced, errors = coerce_to_schema(candidate, schema)
+        if errors:
+            log_debug(f"[STRUCTURED] {name} via {source}: {', '.join(errors[:5])}")
+        if best is None or len(errors) < len(best_errors):
+            best, best_errors = coerced, errors
+        return not errors
+
+    if normalized_engine == ENGINE_OPENAI_CODEX:
+        if _accept(call_openai_codex_json(prompt, timeout_seconds=timeout_seconds or 28, schema=schema, schema_name=name), "openai"):
+            return best
+    if normalized_engine in {ENGINE_ANTHROPIC, ENGINE_ANTIGRAVITY} and ANTHROPIC_API_KEY:
+        data, complete = call_anthropic_json(
+            prompt,
+            schema,
+            tool_name=name,
+            system_prompt=system_prompt,
+            timeout_seconds=timeout_seconds or 45,
+            max_tokens_override=max_tokens_override,
+        )
+        if _accept(data, "anthropic") and complete:
+            return best
+    if best is None or best_errors:
+        _accept(call_gemini_json(prompt, schema=schema, timeout_seconds=min(timeout_seconds or 22, 22)), "gemini")
+    return best
+
+
+@request_profiler.timed("ai")
+def call_ai_text(prompt, engine=ENGINE_ANTIGRAVITY, max_tokens_override=None, timeout_seconds=22):
+    normalized_engine = normalize_engine(engine)
+    if normalized_engine == ENGINE_OPENAI_CODEX:
+        codex_text = call_openai_codex_text(prompt)
+        if codex_text:
+            return codex_text.replace("```", "").strip()
+        # Hard fallback to Antigravity/Gemini if OpenAI is unavailable.
+    if normalized_engine in {ENGINE_ANTHROPIC, ENGINE_ANTIGRAVITY} and ANTHROPIC_API_KEY:
+        anth_text = call_anthropic_text(
+            prompt,
+            system_prompt=SYSTEM_INSTRUCTION_TEXT,
+            timeout_seconds=timeout_seconds,
+            max_tokens_override=max_tokens_override,
+        )
+        if anth_text:
+            return anth_text.replace("```", "").strip()
+    if not model:
+        get_ai_model()
+    if not model:
+        AI_RUNTIME["connected"] = False
+        return None
+    try:
+        response, gen_error = _safe_model_generate(prompt, timeout_seconds=timeout_seconds)
         if gen_error:
             raise RuntimeError(gen_error)
         AI_RUNTIME["connected"] = True
@@ -2278,6 +2054,110 @@ def call_ai_text(prompt, engine=ENGINE_ANTIGRAVITY):
         connect_ai_model(force=True)
         return None
 
+# ── STRUCTURED OUTPUT SCHEMAS ──
+def _str_props(*names):
+    return {n: {"type": "string"} for n in names}
+
+BUSINESS_MODEL_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "market": {
+            "type": "object",
+            "properties": dict(_str_props("size", "sam", "growth", "insight"),
+                               trends={"type": "array", "items": {"type": "string"}}),
+            "required": ["size", "growth", "insight"],
+        },
+        "competitors": {
+            "type": "array",
+            "items": {"type": "object", "properties": _str_props("name", "share", "weakness", "strength"), "required": ["name"]},
+        },
+        "advantage": {"type": "object", "properties": _str_props("main", "moat", "differentiation"), "required": ["main"]},
+        "risk": {"type": "object", "properties": _str_props("description", "mitigation", "probability"), "required": ["description"]},
+        "persona": {"type": "object", "properties": _str_props("name", "painPoint", "willingness"), "required": ["name"]},
+        "channels": {
+            "type": "array",
+            "items": {"type": "object", "properties": _str_props("name", "reason"), "required": ["name"]},
+        },
+        "score": {
+            "type": "object",
+            "properties": {
+                "overall": {"type": "integer"},
+                "grade": {"type": "string"},
+                "breakdown": {
+                    "type": "object",
+                    "properties": {k: {"type": "integer"} for k in ("market", "timing", "advantage", "risk")},
+                },
+                "verdict": {"type": "string"},
+            },
+            "required": ["overall", "grade"],
+        },
+        "revenue": {"type": "object", "properties": _str_props("year1", "year2", "year3", "assumption")},
+        "analogy": {"type": "object", "properties": _str_props("company", "raised", "insight")},
+        "nextStep": {"type": "string"},
+    },
+    "required": ["market", "competitors", "advantage", "risk", "persona", "channels", "score", "revenue", "nextStep"],
+}
+
+EDIT_PROJECT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "summary": {"type": "string"},
+        "files": {
+            "type": "object",
+            "description": "Changed files only. Keys: index.html, styles.css, app.js. Values: full file content.",
+            "properties": _str_props("index.html", "styles.css", "style.css", "app.js", "script.js"),
+        },
+    },
+    "required": ["summary", "files"],
+}
+
+EDIT_PATCH_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "summary": {"type": "string"},
+        "edits": {
+            "type": "array",
+            "description": "Targeted edits. Use search/replace (search copied verbatim from the current file) or a unified diff.",
+            "items": {
+                "type": "object",
+                "properties": _str_props("file", "search", "replace", "diff"),
+                "required": ["file"],
+            },
+        },
+    },
+    "required": ["summary", "edits"],
+}
+
+BUILD_SPEC_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "title": {"type": "string"},
+        "tagline": {"type": "string"},
+        "language": {"type": "string"},
+        "palette": {"type": "object", "properties": _str_props("background", "surface", "text", "muted", "accent")},
+        "font": {"type": "string"},
+        "sections": {
+            "type": "array",
+            "items": {"type": "object", "properties": _str_props("id", "heading", "content"), "required": ["id", "heading"]},
+        },
+        "interactions": {
+            "type": "array",
+            "items": {"type": "object", "properties": _str_props("element_id", "event", "behavior"), "required": ["element_id", "behavior"]},
+        },
+    },
+    "required": ["title", "sections", "interactions"],
+}
+
+VIABILITY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "summary": {"type": "string"},
+        "score": {"type": "integer"},
+        "complexity": {"type": "string"},
+    },
+    "required": ["summary", "score", "complexity"],
+}
+
 def parse_image_data_url(image_data_url):
     try:
         if not image_data_url or not isinstance(image_data_url, str):
@@ -2293,12 +2173,13 @@ def parse_image_data_url(image_data_url):
     except Exception:
         return None, None
 
+@request_profiler.timed("ai")
 def describe_image_for_chat(image_data_url):
     mime_type, image_bytes = parse_image_data_url(image_data_url)
     if not mime_type or not image_bytes:
         return ""
     if not model:
-        connect_ai_model(force=True)
+        get_ai_model()
     if not model:
         return ""
     try:
@@ -2320,12 +2201,13 @@ def describe_image_for_chat(image_data_url):
         log_debug(f"Image describe failed: {e}")
         return ""
 
+@request_profiler.timed("ai")
 def describe_ui_reference(image_data_url):
     mime_type, image_bytes = parse_image_data_url(image_data_url)
     if not mime_type or not image_bytes:
         return ""
     if not model:
-        connect_ai_model(force=True)
+        get_ai_model()
     if not model:
         return ""
     try:
@@ -3012,6 +2894,13 @@ TICKET_PROGRESS = {
     "completed": 100,
 }
 
+# Estados previos a la cola de ingenieros (build en background, ver build_jobs).
+BUILD_STATUS_PROGRESS = {
+    "queued": 3,
+    "building": 8,
+    "build_failed": 0,
+}
+
 PRIORITY_SLA_HOURS = {
     "high": 24,
     "medium": 48,
@@ -3034,59 +2923,76 @@ def ensure_user_exists_for_tokens(conn, email):
     conn.commit()
     return conn.execute('SELECT tokens FROM users WHERE email = ?', (email,)).fetchone()
 
+# Suscripción + saldo en una sola consulta; el descuento es un único UPDATE ... RETURNING.
+entitlements = EntitlementService(
+    get_db_connection,
+    cache_ttl=float(os.getenv("ANMAR_ENTITLEMENT_CACHE_SECONDS", "30")),
+)
+
+# Cargos de tokens: se autorizan en memoria y se liquidan por lotes en token_ledger.
+# ANMAR_TOKEN_LEDGER=0 vuelve al UPDATE directo por cargo.
+TOKEN_LEDGER_ENABLED = os.getenv("ANMAR_TOKEN_LEDGER", "1") == "1"
+token_ledger = TokenLedger(
+    get_db_connection,
+    lambda email: entitlements.snapshot(email)["tokens"],
+    flush_interval=float(os.getenv("ANMAR_TOKEN_LEDGER_FLUSH_SECONDS", "1")),
+    max_batch=int(os.getenv("ANMAR_TOKEN_LEDGER_MAX_BATCH", "500")),
+    refresh_seconds=float(os.getenv("ANMAR_TOKEN_LEDGER_REFRESH_SECONDS", "30")),
+)
+
 def consume_user_tokens(email, amount, reason=""):
     if not email:
         return False, "You have not logged in.", None
-    if is_user_subscribed(email):
-        return True, "subscribed", get_user_token_balance(email)
     try:
         amount = int(amount)
     except Exception:
         amount = 1
     if amount <= 0:
         return True, "ok", None
-
+    if not TOKEN_LEDGER_ENABLED:
+        return entitlements.consume(email, amount, reason=reason)
+    if entitlements.is_subscribed(email):
+        return True, "subscribed", token_ledger.balance(email)
+    ok, balance = token_ledger.authorize(email, amount, reason=reason)
+    if not ok:
+        return False, f"Insufficient credits for {reason or 'this action'} (requires {amount}).", balance
+    return True, "ok", balance
+
+def credit_user_tokens(email, amount, kind="credit", reason="", ref=None):
+    """Adds tokens (purchase, grant, refund). Returns the new balance, or None if ref was already applied."""
+    try:
+        amount = int(amount)
+    except Exception:
+        return None
+    if not email or amount <= 0:
+        return None
+    if TOKEN_LEDGER_ENABLED:
+        return token_ledger.credit(email, amount, kind=kind, reason=reason, ref=ref)
     conn = get_db_connection()
-    ensure_user_exists_for_tokens(conn, email)
-    # Atomic deduction: UPDATE only if sufficient tokens (prevents race condition / negative balance)
-    cursor = conn.execute(
-        'UPDATE users SET tokens = tokens - ? WHERE email = ? AND tokens >= ?',
-        (amount, email, amount)
-    )
-    conn.commit()
-    if cursor.rowcount == 0:
-        # No rows updated = insufficient tokens
-        current = conn.execute('SELECT tokens FROM users WHERE email = ?', (email,)).fetchone()
+    try:
+        ensure_user_exists_for_tokens(conn, email)
+        conn.execute('UPDATE users SET tokens = tokens + ? WHERE email = ?', (amount, email))
+        conn.commit()
+        row = conn.execute('SELECT tokens FROM users WHERE email = ?', (email,)).fetchone()
+    finally:
         conn.close()
-        current_balance = int(current['tokens']) if current else 0
-        return False, f"Insufficient credits for {reason or 'this action'} (requires {amount}).", current_balance
+    return int(row['tokens']) if row else None
 
-    updated = conn.execute('SELECT tokens FROM users WHERE email = ?', (email,)).fetchone()
-    conn.close()
-    return True, "ok", int(updated['tokens'])
+def refund_user_tokens(email, amount, reason="", ref=None):
+    return credit_user_tokens(email, amount, kind="refund", reason=reason, ref=ref)
 
 def get_user_token_balance(email):
     if not email:
         return None
-    conn = get_db_connection()
-    user = ensure_user_exists_for_tokens(conn, email)
-    balance = int(user['tokens'])
-    conn.close()
-    return balance
+    if TOKEN_LEDGER_ENABLED:
+        return token_ledger.balance(email)
+    return entitlements.snapshot(email)["tokens"]
 
 def is_user_subscribed(email):
     if not email:
         return False
-    conn = get_db_connection()
-    user = conn.execute(
-        'SELECT subscription_active FROM users WHERE email = ?',
-        (email,)
-    ).fetchone()
-    conn.close()
-    if not user:
-        return False
     try:
-        return int(user['subscription_active']) == 1
+        return entitlements.is_subscribed(email)
     except Exception:
         return False
 
@@ -3180,7 +3086,7 @@ PLAN_TOKEN_ALLOTMENT = {
     "marketing_build": 2000,
 }
 
-def set_user_subscription(email, active, plan_key=None, customer_id=None, subscription_id=None, status=None):
+def set_user_subscription(email, active, plan_key=None, customer_id=None, subscription_id=None, status=None, grant_ref=None):
     if not email:
         return
     conn = get_db_connection()
@@ -3191,11 +3097,6 @@ def set_user_subscription(email, active, plan_key=None, customer_id=None, subscr
     values = [sub_active, plan_label]
     if active:
         fields.append("subscription_started_at = CURRENT_TIMESTAMP")
-        # ADD tokens based on plan (don't overwrite existing balance)
-        tokens_to_grant = PLAN_TOKEN_ALLOTMENT.get(plan_key, 0)
-        if tokens_to_grant > 0:
-            fields.append("tokens = tokens + ?")
-            values.append(tokens_to_grant)
     if customer_id is not None:
         fields.append("stripe_customer_id = ?")
         values.append(customer_id)
@@ -3209,6 +3110,10 @@ def set_user_subscription(email, active, plan_key=None, customer_id=None, subscr
     conn.execute(f"UPDATE users SET {', '.join(fields)} WHERE email = ?", values)
     conn.commit()
     conn.close()
+    entitlements.invalidate(email)
+    if active:
+        # ADD tokens based on plan (don't overwrite existing balance)
+        credit_user_tokens(email, PLAN_TOKEN_ALLOTMENT.get(plan_key, 0), kind="grant", reason=f"plan {plan_key}", ref=grant_ref)
 
 def find_user_by_stripe_customer(customer_id):
     if not customer_id:
@@ -3240,8 +3145,9 @@ def consume_chat_message_quota(email, project_name, reason="enviar mensaje al ch
     """
     if not email:
         return False, "You have not logged in.", None
-    if is_user_subscribed(email):
-        return consume_user_tokens(email, CHAT_MESSAGE_TOKEN_COST, reason=reason)
+    snapshot = entitlements.snapshot(email)
+    if snapshot["subscribed"]:
+        return True, "subscribed", get_user_token_balance(email)
 
     paywall = get_project_paywall_state(email, project_name)
     if not paywall.get("first_free_message_used"):
@@ -3259,8 +3165,9 @@ def consume_build_quota(email, project_name, reason="construir proyecto"):
     """
     if not email:
         return False, "You have not logged in.", None
-    if is_user_subscribed(email):
-        return consume_user_tokens(email, BUILD_TOKEN_COST, reason=reason)
+    snapshot = entitlements.snapshot(email)
+    if snapshot["subscribed"]:
+        return True, "subscribed", get_user_token_balance(email)
 
     paywall = get_project_paywall_state(email, project_name)
     if not paywall.get("free_preview_build_used"):
@@ -3341,6 +3248,12 @@ def status_message(status, engineer=None, project_id=None):
         return "Request temporarily blocked. Waiting for internal resolution."
     if status == "completed":
         return "Project completed and deployed."
+    if status == "queued":
+        return "Build queued. Your preview will be generated shortly."
+    if status == "building":
+        return "Generating your project files."
+    if status == "build_failed":
+        return "Automatic build failed. The team has been notified."
     return f"Status updated: {status}"
 
 def normalize_preview_url(preview_url, project_id):
@@ -3357,6 +3270,7 @@ def normalize_preview_url(preview_url, project_id):
         return f"/projects/{project_id}/{value}"
     return f"/projects/{project_id}/index.html"
 
+@json_store("read", ALERTS_FILE)
 def load_alerts():
     if not os.path.exists(ALERTS_FILE):
         return []
@@ -3367,6 +3281,7 @@ def load_alerts():
     except Exception:
         return []
 
+@json_store("write", ALERTS_FILE)
 def save_alerts(alerts):
     os.makedirs(os.path.dirname(ALERTS_FILE), exist_ok=True)
     tmp_path = ALERTS_FILE + '.tmp'
@@ -3445,6 +3360,7 @@ def normalize_ticket_status(ticket):
 
     return ticket
 
+@json_store("read", ORDER_STATUS_FILE)
 def get_orders_map():
     if not os.path.exists(ORDER_STATUS_FILE):
         return {}
@@ -3471,6 +3387,7 @@ def get_orders_map():
         pass
     return {}
 
+@json_store("write", ORDER_STATUS_FILE)
 def save_orders_map(orders):
     os.makedirs(os.path.dirname(ORDER_STATUS_FILE), exist_ok=True)
     tmp_path = ORDER_STATUS_FILE + '.tmp'
@@ -3483,7 +3400,14 @@ def save_orders_map(orders):
         if os.path.exists(tmp_path):
             os.remove(tmp_path)
 
-def update_order_status(project_id, status, log_entry=None, engineer=None, deployed_url=None):
+_orders_lock = threading.RLock()
+
+def update_order_status(project_id, status, log_entry=None, engineer=None, deployed_url=None, build=None):
+    # Los jobs de build y las peticiones escriben el mismo archivo.
+    with _orders_lock:
+        return _update_order_status_locked(project_id, status, log_entry, engineer, deployed_url, build)
+
+def _update_order_status_locked(project_id, status, log_entry=None, engineer=None, deployed_url=None, build=None):
     orders = get_orders_map()
     now = datetime.now().isoformat()
     current = orders.get(project_id, {
@@ -3496,13 +3420,15 @@ def update_order_status(project_id, status, log_entry=None, engineer=None, deplo
         "logs": [],
     })
     current["status"] = status
-    current["progress"] = TICKET_PROGRESS.get(status, current.get("progress", 0))
+    current["progress"] = TICKET_PROGRESS.get(status, BUILD_STATUS_PROGRESS.get(status, current.get("progress", 0)))
     current["message"] = status_message(status, engineer=engineer, project_id=project_id)
     current["updated_at"] = now
     if engineer:
         current["engineer"] = engineer
     if deployed_url:
         current["deployed_url"] = deployed_url
+    if build:
+        current["build"] = build
     if log_entry:
         current.setdefault("logs", []).append({"timestamp": now, "message": log_entry})
     orders[project_id] = current
@@ -3576,6 +3502,7 @@ def list_queue(engineer=None, status=None, priority=None, mode="all"):
     )
     return alerts
 
+@json_store("read", DISPATCH_STATE_FILE)
 def load_dispatch_state():
     if not os.path.exists(DISPATCH_STATE_FILE):
         return {"rr_cursor": 0}
@@ -3589,6 +3516,7 @@ def load_dispatch_state():
         pass
     return {"rr_cursor": 0}
 
+@json_store("write", DISPATCH_STATE_FILE)
 def save_dispatch_state(state):
     os.makedirs(os.path.dirname(DISPATCH_STATE_FILE), exist_ok=True)
     tmp_path = DISPATCH_STATE_FILE + '.tmp'
@@ -3640,631 +3568,120 @@ def pending_queue_sorted(alerts):
     )
     return pending
 
-@app.route('/api/user-stats', methods=['GET'])
-def get_user_stats():
-    if _rate_limit(request.remote_addr, max_requests=10, window=60):
-        return jsonify({"error": "Too many attempts. Try again in a minute."}), 429
-
-    email = request.args.get('email')
-    if not email: return jsonify({"error": "No email provided"}), 400
-
-    # Verify session and email match
-    session_email = session.get('user_email', '').strip().lower()
-    if not session_email:
-        return jsonify({"error": "You have not logged in"}), 401
-    if session_email != email.strip().lower():
-        return jsonify({"error": "Unauthorized"}), 403
-
-    conn = get_db_connection()
-    user = conn.execute(
-        'SELECT tokens, created_at, subscription_active, subscription_plan, subscription_status FROM users WHERE email = ?',
-        (email,)
-    ).fetchone()
-    conn.close()
-
-    if user:
-        return jsonify({
-            "tokens": user['tokens'],
-            "joined": user['created_at'],
-            "subscription_active": int(user['subscription_active']) == 1 if 'subscription_active' in user.keys() else False,
-            "subscription_plan": user['subscription_plan'] if 'subscription_plan' in user.keys() else 'none',
-            "subscription_status": user['subscription_status'] if 'subscription_status' in user.keys() else 'inactive'
-        })
-    else:
-        return jsonify({"error": "User not found"}), 404
-
-# --- STRIPE CHECKOUT ---
-@app.route('/api/stripe/create-checkout-session', methods=['POST'])
-def stripe_create_checkout_session():
-    if _rate_limit(request.remote_addr, max_requests=5, window=60):
-        return jsonify({"error": "Too many attempts. Wait a moment."}), 429
-    try:
-        if not STRIPE_SECRET_KEY:
-            return jsonify({"error": "Stripe is not configured"}), 500
-        data = request.json or {}
-        email = (data.get('email') or '').strip().lower()
-        plan_key = (data.get('plan') or '').strip()
-        plan_map = get_stripe_plan_map()
-        price_id = plan_map.get(plan_key)
-
-        if not email or not price_id:
-            return jsonify({"error": "Invalid email or plan"}), 400
-
-        origin = request.headers.get('Origin')
-        if not origin:
-            origin = request.host_url.rstrip('/')
-
-        success_url = os.getenv("STRIPE_SUCCESS_URL", "").strip() or f"{origin}/dashboard.html?checkout=success&session_id={{CHECKOUT_SESSION_ID}}"
-        cancel_url = os.getenv("STRIPE_CANCEL_URL", "").strip() or f"{origin}/dashboard.html?checkout=cancel"
-
-        checkout_mode = "payment" if plan_key in ONE_TIME_PLANS else "subscription"
-        session = stripe.checkout.Session.create(
-            mode=checkout_mode,
-            line_items=[{"price": price_id, "quantity": 1}],
-            customer_email=email,
-            client_reference_id=email,
-            success_url=success_url,
-            cancel_url=cancel_url,
-            allow_promotion_codes=True,
-            metadata={
-                "plan": plan_key,
-                "email": email
-            }
-        )
-
-        return jsonify({"url": session.url})
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-
-@app.route('/api/stripe/create-token-pack-session', methods=['POST'])
-def stripe_create_token_pack_session():
-    """One-time payment checkout for token packs (50/150/500 messages)."""
-    if _rate_limit(request.remote_addr, max_requests=5, window=60):
-        return jsonify({"error": "Too many attempts. Wait a moment."}), 429
-    try:
-        if not STRIPE_SECRET_KEY:
-            return jsonify({"error": "Stripe is not configured"}), 500
-        data = request.json or {}
-        email = (data.get('email') or '').strip().lower()
-        user_email = (data.get('user_email') or '').strip().lower()
-        pack_key = (data.get('pack') or '').strip()
-
-        # Verify requesting user's email matches - use user_email if provided, fallback to email
-        auth_email = user_email or email
-        if not auth_email or auth_email != email:
-            return jsonify({"error": "Unauthorized: email mismatch"}), 403
-
-        pack_info = TOKEN_PACK_MAP.get(pack_key)
-        if not email or not pack_info:
-            return jsonify({"error": "Invalid email or pack"}), 400
-        if not pack_info.get("price_id"):
-            return jsonify({"error": "This pack is not yet available. Contact us."}), 400
-
-        origin = request.headers.get('Origin') or request.host_url.rstrip('/')
-        success_url = os.getenv("STRIPE_SUCCESS_URL", "").strip() or f"{origin}/dashboard.html?checkout=success&pack={pack_key}"
-        cancel_url  = os.getenv("STRIPE_CANCEL_URL",  "").strip() or f"{origin}/dashboard.html?checkout=cancel"
-
-        checkout_session = stripe.checkout.Session.create(
-            mode="payment",
-            line_items=[{"price": pack_info["price_id"], "quantity": 1}],
-            customer_email=email,
-            client_reference_id=email,
-            success_url=success_url,
-            cancel_url=cancel_url,
-            metadata={
-                "type": "token_pack",
-                "pack": pack_key,
-                "tokens": str(pack_info["tokens"]),
-                "email": email
-            }
-        )
-        return jsonify({"url": checkout_session.url})
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-
-@app.route('/api/stripe/webhook', methods=['POST'])
-def stripe_webhook():
-    payload = request.data
-    sig_header = request.headers.get('Stripe-Signature', '')
-
-    if not STRIPE_WEBHOOK_SECRET:
-        return jsonify({"error": "Stripe webhook secret missing"}), 500
-
-    try:
-        event = stripe.Webhook.construct_event(
-            payload=payload,
-            sig_header=sig_header,
-            secret=STRIPE_WEBHOOK_SECRET
-        )
-    except Exception as e:
-        return jsonify({"error": "Invalid request"}), 400
-
-    event_type = event.get('type')
+# --- STRIPE EVENTS ---
+# El webhook solo verifica la firma, guarda el evento y responde 200; estos
+# handlers corren en el procesador de stripe_events, en orden por cliente.
+# Deben ser idempotentes: los reintentos y replays los vuelven a ejecutar.
+def _apply_checkout_completed(event):
     data_object = (event.get('data') or {}).get('object') or {}
-
-    if event_type == 'checkout.session.completed':
-        email = (data_object.get('customer_email') or '').strip().lower()
-        metadata = data_object.get('metadata') or {}
-        event_type_meta = (metadata.get('type') or '').strip()
-        customer_id = data_object.get('customer')
-
-        if event_type_meta == 'token_pack':
-            # One-time token pack purchase — verify tokens from server-side map, NOT metadata
-            pack_key = (metadata.get('pack') or '').strip()
-            pack_info = TOKEN_PACK_MAP.get(pack_key)
-            tokens_to_add = pack_info['tokens'] if pack_info else 0
-            # Idempotency: check if this checkout session was already processed
-            checkout_session_id = data_object.get('id', '')
-            if email and tokens_to_add > 0:
-                conn = get_db_connection()
-                ensure_user_exists_for_tokens(conn, email)
-                # Check idempotency — store processed session IDs
-                already = conn.execute(
-                    "SELECT 1 FROM processed_webhooks WHERE session_id = ?", (checkout_session_id,)
-                ).fetchone() if checkout_session_id else None
-                if not already:
-                    conn.execute('UPDATE users SET tokens = tokens + ? WHERE email = ?', (tokens_to_add, email))
+    email = (data_object.get('customer_email') or '').strip().lower()
+    metadata = data_object.get('metadata') or {}
+    event_type_meta = (metadata.get('type') or '').strip()
+    customer_id = data_object.get('customer')
+
+    if event_type_meta == 'token_pack':
+        # One-time token pack purchase — verify tokens from server-side map, NOT metadata
+        pack_key = (metadata.get('pack') or '').strip()
+        pack_info = TOKEN_PACK_MAP.get(pack_key)
+        tokens_to_add = pack_info['tokens'] if pack_info else 0
+        # Idempotency: check if this checkout session was already processed
+        checkout_session_id = data_object.get('id', '')
+        if email and tokens_to_add > 0:
+            conn = get_db_connection()
+            ensure_user_exists_for_tokens(conn, email)
+            # Check idempotency — store processed session IDs
+            already = conn.execute(
+                "SELECT 1 FROM processed_webhooks WHERE session_id = ?", (checkout_session_id,)
+            ).fetchone() if checkout_session_id else None
+            conn.close()
+            # El ledger también es idempotente por ref (= checkout session).
+            new_balance = None if already else credit_user_tokens(
+                email, tokens_to_add, kind="purchase", reason=f"token pack {pack_key}",
+                ref=f"checkout:{checkout_session_id}" if checkout_session_id else None,
+            )
+            if new_balance is not None:
+                if checkout_session_id:
+                    conn = get_db_connection()
                     try:
-                        conn.execute("INSERT INTO processed_webhooks (session_id, processed_at) VALUES (?, CURRENT_TIMESTAMP)", (checkout_session_id,))
+                        conn.execute("INSERT OR IGNORE INTO processed_webhooks (session_id, processed_at) VALUES (?, CURRENT_TIMESTAMP)", (checkout_session_id,))
+                        conn.commit()
                     except Exception:
                         pass  # Table may not exist yet, tokens still granted
-                    conn.commit()
-                    print(f"[WEBHOOK] Added {tokens_to_add} tokens to {email} (pack: {pack_key}, session: {checkout_session_id})")
-                else:
-                    print(f"[WEBHOOK] Duplicate webhook ignored for session {checkout_session_id}")
-                conn.close()
-        else:
-            # Subscription plan purchase
-            plan_key = (metadata.get('plan') or '').strip()
-            subscription_id = data_object.get('subscription')
-            if email:
-                set_user_subscription(
-                    email,
-                    True,
-                    plan_key=plan_key,
-                    customer_id=customer_id,
-                    subscription_id=subscription_id,
-                    status="active"
-                )
-                try:
-                    submit_pending_tickets_for_email(email)
-                except Exception as e:
-                    print(f"Pending ticket auto-submit failed: {e}")
-
-    if event_type in ('customer.subscription.updated', 'customer.subscription.deleted'):
-        customer_id = data_object.get('customer')
-        status = (data_object.get('status') or '').strip().lower()
-        plan_key = None
-        items = data_object.get('items') or {}
-        data_items = items.get('data') if isinstance(items, dict) else []
-        if data_items:
-            price_id = data_items[0].get('price', {}).get('id')
-            for key, value in get_stripe_plan_map().items():
-                if value and value == price_id:
-                    plan_key = key
-                    break
-        email = find_user_by_stripe_customer(customer_id)
+                    finally:
+                        conn.close()
+                print(f"[WEBHOOK] Added {tokens_to_add} tokens to {email} (pack: {pack_key}, session: {checkout_session_id})")
+            else:
+                print(f"[WEBHOOK] Duplicate webhook ignored for session {checkout_session_id}")
+    else:
+        # Subscription plan purchase
+        plan_key = (metadata.get('plan') or '').strip()
+        subscription_id = data_object.get('subscription')
         if email:
-            active = status in ('active', 'trialing')
             set_user_subscription(
                 email,
-                active,
-                plan_key=plan_key,
-                customer_id=customer_id,
-                subscription_id=data_object.get('id'),
-                status=status or ("active" if active else "inactive")
-            )
-
-    return jsonify({"received": True})
-
-@app.route('/api/stripe/verify-session', methods=['GET'])
-def stripe_verify_session():
-    try:
-        session_id = (request.args.get('session_id') or '').strip()
-        user_email = (request.args.get('user_email') or '').strip().lower()
-        if not session_id or not user_email:
-            return jsonify({"error": "Missing session_id or user_email"}), 400
-        if not STRIPE_SECRET_KEY:
-            return jsonify({"error": "Stripe is not configured"}), 500
-
-        session_data = stripe.checkout.Session.retrieve(session_id)
-        stripe_email = (session_data.get('customer_email') or '').strip().lower()
-
-        # Verify requesting user matches the Stripe session's email
-        if stripe_email != user_email:
-            return jsonify({"error": "Unauthorized: email mismatch"}), 403
-
-        metadata = session_data.get('metadata') or {}
-        plan_key = (metadata.get('plan') or '').strip()
-        customer_id = session_data.get('customer')
-        subscription_id = session_data.get('subscription')
-
-        if stripe_email:
-            set_user_subscription(
-                stripe_email,
                 True,
                 plan_key=plan_key,
                 customer_id=customer_id,
                 subscription_id=subscription_id,
-                status="active"
+                status="active",
+                grant_ref=f"checkout:{data_object.get('id')}:plan" if data_object.get('id') else None,
             )
             try:
-                submit_pending_tickets_for_email(stripe_email)
+                submit_pending_tickets_for_email(email)
             except Exception as e:
                 print(f"Pending ticket auto-submit failed: {e}")
-        return jsonify({"status": "ok"})
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-# ── RETENTION / CANCELLATION ROUTES ──────────────────────────────────────────
-
-def get_user_subscription_id(email):
-    """Obtiene el stripe_subscription_id del usuario desde la DB."""
-    conn = get_db_connection()
-    row = conn.execute('SELECT stripe_subscription_id, stripe_customer_id, subscription_plan FROM users WHERE email = ?', (email,)).fetchone()
-    conn.close()
-    return row if row else None
-
-@app.route('/api/stripe/cancel-subscription', methods=['POST'])
-def cancel_subscription():
-    """Cancela la suscripción al final del período actual (no inmediato)."""
-    try:
-        data = request.json or {}
-        email = (data.get('email') or '').strip().lower()
-        reason = (data.get('reason') or 'not_specified').strip()
-        if not email:
-            return jsonify({"error": "Email is required"}), 400
-        if not STRIPE_SECRET_KEY:
-            # Sin Stripe: solo marcar en DB
-            set_user_subscription(email, False, status='canceled')
-            return jsonify({"status": "canceled", "message": "Subscription canceled."})
-        row = get_user_subscription_id(email)
-        if not row or not row['stripe_subscription_id']:
-            set_user_subscription(email, False, status='canceled')
-            return jsonify({"status": "canceled", "message": "Subscription canceled."})
-        sub_id = row['stripe_subscription_id']
-        # Cancelar al final del período (no cortar inmediatamente)
-        stripe.Subscription.modify(sub_id, cancel_at_period_end=True, metadata={"cancel_reason": reason})
-        set_user_subscription(email, True, status='cancel_at_period_end')
-        print(f"[CANCEL] {email} — reason: {reason}")
-        return jsonify({"status": "cancel_at_period_end", "message": "Your subscription will cancel at the end of the billing period."})
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-@app.route('/api/stripe/pause-subscription', methods=['POST'])
-def pause_subscription():
-    """Pausa la suscripción por 30 días (sin cobro)."""
-    try:
-        data = request.json or {}
-        email = (data.get('email') or '').strip().lower()
-        if not email:
-            return jsonify({"error": "Email is required"}), 400
-        if not STRIPE_SECRET_KEY:
-            set_user_subscription(email, True, status='paused')
-            return jsonify({"status": "paused"})
-        row = get_user_subscription_id(email)
-        if not row or not row['stripe_subscription_id']:
-            return jsonify({"error": "No active subscription found"}), 404
-        sub_id = row['stripe_subscription_id']
-        resume_at = int((datetime.now() + timedelta(days=30)).timestamp())
-        stripe.Subscription.modify(sub_id, pause_collection={"behavior": "void", "resumes_at": resume_at})
-        set_user_subscription(email, True, status='paused')
-        print(f"[PAUSE] {email} — resumes in 30 days")
-        return jsonify({"status": "paused", "message": "Your subscription is paused for 30 days. You will not be charged and it will reactivate automatically."})
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-@app.route('/api/stripe/apply-retention-discount', methods=['POST'])
-def apply_retention_discount():
-    """Aplica cupón del 50% en el próximo mes."""
-    try:
-        data = request.json or {}
-        email = (data.get('email') or '').strip().lower()
-        if not email:
-            return jsonify({"error": "Email is required"}), 400
-        if not STRIPE_SECRET_KEY:
-            return jsonify({"status": "discount_applied", "message": "Discount applied (demo mode)."})
-        row = get_user_subscription_id(email)
-        if not row or not row['stripe_subscription_id']:
-            return jsonify({"error": "No active subscription found"}), 404
-        sub_id = row['stripe_subscription_id']
-        # Crear o recuperar cupón de retención 50% off por 1 mes
-        coupon_id = "RETENTION_50_1M"
-        try:
-            stripe.Coupon.retrieve(coupon_id)
-        except stripe.error.InvalidRequestError:
-            stripe.Coupon.create(
-                id=coupon_id,
-                percent_off=50,
-                duration="once",
-                name="Retención — 50% off 1 mes"
-            )
-        stripe.Subscription.modify(sub_id, coupon=coupon_id)
-        print(f"[DISCOUNT] {email} — 50% aplicado")
-        return jsonify({"status": "discount_applied", "message": "50% discount applied to your next month!"})
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-@app.route('/api/stripe/downgrade-plan', methods=['POST'])
-def downgrade_plan():
-    """Baja el plan al nivel inmediatamente inferior."""
-    try:
-        data = request.json or {}
-        email = (data.get('email') or '').strip().lower()
-        target_plan = (data.get('target_plan') or '').strip()
-        if not email or not target_plan:
-            return jsonify({"error": "Email y plan requeridos"}), 400
-        plan_map = get_stripe_plan_map()
-        new_price_id = plan_map.get(target_plan)
-        if not new_price_id:
-            return jsonify({"error": "Invalid plan"}), 400
-        if not STRIPE_SECRET_KEY:
-            set_user_subscription(email, True, plan_key=target_plan, status='active')
-            return jsonify({"status": "downgraded", "new_plan": target_plan})
-        row = get_user_subscription_id(email)
-        if not row or not row['stripe_subscription_id']:
-            return jsonify({"error": "No active subscription found"}), 404
-        sub_id = row['stripe_subscription_id']
-        sub = stripe.Subscription.retrieve(sub_id)
-        item_id = sub['items']['data'][0]['id']
-        stripe.Subscription.modify(sub_id, items=[{"id": item_id, "price": new_price_id}],
-                                   proration_behavior='none')
-        set_user_subscription(email, True, plan_key=target_plan, status='active')
-        print(f"[DOWNGRADE] {email} → {target_plan}")
-        return jsonify({"status": "downgraded", "new_plan": target_plan,
-                        "message": f"Plan changed to {normalize_plan_label(target_plan)} successfully."})
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
 
-# ─────────────────────────────────────────────────────────────────────────────
-
-@app.route('/api/tickets/submit-pending', methods=['POST'])
-def submit_pending_tickets():
-    try:
-        data = request.json or {}
-        email = (data.get('user_email') or '').strip().lower()
-        project_name = (data.get('project_name') or '').strip().lower()
-        if not email:
-            return jsonify({"error": "Email is required"}), 400
-        if not is_user_subscribed(email):
-            return jsonify({"error": "Plan is required"}), 402
-        results = submit_pending_tickets_for_email(email, project_name=project_name or None)
-        return jsonify({"status": "ok", "tickets": results})
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
 
-@app.route('/api/submit-ticket', methods=['POST'])
-def submit_ticket():
-    try:
-        data = request.json or {}
-        user_email = (data.get('user_email') or '').strip().lower()
-        project_name = (data.get('project_name') or '').strip().lower()
-        user_request = data.get('request', '').strip()
-        channel = (data.get('channel') or 'build').strip().lower()
-
-        # Auth: verify session matches requested email
-        session_email = session.get('user_email', '').strip().lower()
-        if not session_email or session_email != user_email:
-            return jsonify({"error": "You must be logged in"}), 401
-
-        if not all([user_email, project_name, user_request]):
-            return jsonify({"error": "Missing required fields"}), 400
-
-        ok_tokens, token_msg, remaining = consume_user_tokens(
-            user_email,
-            HUMAN_SUPPORT_TOKEN_COST,
-            reason="request human support"
+def _apply_subscription_change(event):
+    data_object = (event.get('data') or {}).get('object') or {}
+    customer_id = data_object.get('customer')
+    status = (data_object.get('status') or '').strip().lower()
+    plan_key = None
+    items = data_object.get('items') or {}
+    data_items = items.get('data') if isinstance(items, dict) else []
+    if data_items:
+        price_id = data_items[0].get('price', {}).get('id')
+        for key, value in get_stripe_plan_map().items():
+            if value and value == price_id:
+                plan_key = key
+                break
+    email = find_user_by_stripe_customer(customer_id)
+    if email:
+        active = status in ('active', 'trialing')
+        set_user_subscription(
+            email,
+            active,
+            plan_key=plan_key,
+            customer_id=customer_id,
+            subscription_id=data_object.get('id'),
+            status=status or ("active" if active else "inactive"),
+            grant_ref=f"stripe:{event.get('id')}" if event.get('id') else None,
         )
-        if not ok_tokens:
-            return jsonify({"error": token_msg, "remaining_tokens": remaining}), 402
-
-        # --- CONSOLIDATION CHECK: Look for existing open ticket ---
-        existing_ticket = find_existing_ticket(user_email, channel)
-
-        # --- HYBRID AI LOGIC ---
-        # 1. Read Current Project State to give context to AI
-        project_path = os.path.join(projects_base_dir, project_name, 'index.html')
-        current_code = ""
-        if os.path.exists(project_path):
-            with open(project_path, 'r') as f:
-                current_code = f.read()[:3000] # Limit context
-
-        # 2. Ask AI for the Solution Code (Draft for Humans)
-        prompt = f"""
-        ACT AS A SENIOR DEVELOPER ASSISTANT.
-        Project: {project_name}
-        User Request: "{user_request}"
-        Current HTML Snippet: {current_code}...
-
-        TASK:
-        Generate the EXACT code change needed to fulfill this request.
-        Do NOT apply it yet. Just provide the code block that the human engineer should copy-paste.
-
-        RETURN JSON:
-        {{
-            "ai_suggestion": "The code block or CSS needed..."
-        }}
-        """
-        parsed = call_ai_json(prompt)
-        ai_code = parsed.get('ai_suggestion', 'Manual review needed.') if parsed else "Manual review needed."
-
-        # 3. Save to DB for Human Review or add to existing ticket
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        if existing_ticket:
-            # UPDATE existing internal_alerts ticket with new message
-            ticket_id = existing_ticket["id"]
-            append_ticket_event(existing_ticket, existing_ticket["status"],
-                              f"User request: {user_request[:200]}", actor=user_email)
-            alerts = load_alerts()
-            save_alerts(alerts)
-            # Also log in database for tracking
-            cursor.execute(
-                'INSERT INTO tickets (project_name, user_email, request, status, ai_suggestion) VALUES (?, ?, ?, ?, ?)',
-                (project_name, user_email, user_request, 'consolidated', ai_code)
-            )
-        else:
-            # CREATE new ticket
-            cursor.execute(
-                'INSERT INTO tickets (project_name, user_email, request, status, ai_suggestion) VALUES (?, ?, ?, ?, ?)',
-                (project_name, user_email, user_request, 'pending_human_review', ai_code)
-            )
-            ticket_id = cursor.lastrowid
 
-        conn.commit()
-        conn.close()
 
-        return jsonify({
-            "message": "Support request assigned to expert team.",
-            "ticket_id": ticket_id,
-            "assigned_to": "George (Design Lead)" if "design" in user_request.lower() else "Marta (Senior Dev)",
-            "remaining_tokens": remaining
-        })
+stripe_events = WebhookInbox(
+    get_db_connection,
+    table="stripe_events",
+    max_workers=int(os.getenv("ANMAR_WEBHOOK_WORKERS", "2")),
+)
+stripe_events.register('checkout.session.completed', _apply_checkout_completed)
+# Actualizaciones fuera de orden: gana la más reciente por cliente.
+stripe_events.register('customer.subscription.updated', _apply_subscription_change, latest_wins=True)
+stripe_events.register('customer.subscription.deleted', _apply_subscription_change, latest_wins=True)
+startup.register("stripe_events", stripe_events.start)
+startup.mark("billing")
 
-    except Exception as e:
-        print(f"Ticket Error: {e}")
-        return jsonify({"error": "Internal server error"}), 500
 
+# ── RETENTION / CANCELLATION ROUTES ──────────────────────────────────────────
 
-# --- ADMIN ROUTES ---
-@app.route('/api/admin/tickets', methods=['GET'])
-def get_tickets():
-    if not require_internal_auth():
-        return jsonify({"error": "unauthorized"}), 401
+def get_user_subscription_id(email):
+    """Obtiene el stripe_subscription_id del usuario desde la DB."""
     conn = get_db_connection()
-    tickets = conn.execute("SELECT * FROM tickets WHERE status != 'completed' ORDER BY created_at DESC").fetchall()
+    row = conn.execute('SELECT stripe_subscription_id, stripe_customer_id, subscription_plan FROM users WHERE email = ?', (email,)).fetchone()
     conn.close()
-    return jsonify([dict(t) for t in tickets])
-
-@app.route('/api/admin/resolve-ticket', methods=['POST'])
-def resolve_ticket():
-    if not require_internal_auth():
-        return jsonify({"error": "unauthorized"}), 401
-    try:
-        data = request.json or {}
-        ticket_id = data.get('ticket_id')
-        code_snippet = data.get('code_snippet') # The approved code
-        
-        conn = get_db_connection()
-        ticket = conn.execute("SELECT * FROM tickets WHERE id = ?", (ticket_id,)).fetchone()
-        
-        if not ticket:
-            conn.close()
-            return jsonify({"error": "Ticket not found"}), 404
-            
-        project_name = ticket['project_name']
-        project_path = os.path.join(projects_base_dir, project_name, 'index.html')
-        
-        # APPLY THE FIX (Simplified Strategy: Append or Replace if identifiable)
-        # Ideally, the AI suggestion includes instructions. For MVP, we assume it's a replacement block provided by the admin.
-        # But to be safe, we will just APPEND it to the body or head if it's CSS/JS, 
-        # or we rely on the admin to paste the FULL file content if it's a structural change.
-        
-        # Power User Mode: Admin sends the FULL new HTML or a specific patch.
-        # Let's assume for this MVP the 'code_snippet' IS the fix. 
-        # Since 'edit-project' logic already exists, we could reuse that or just overwrite validation.
-        
-        # For this demo: We'll overwrite the file with the code_snippet if it looks like full HTML, 
-        # otherwise we might fail. Let's assume the admin acts as the final editor.
-        if "<html>" in code_snippet:
-             with open(project_path, 'w') as f:
-                f.write(code_snippet)
-        else:
-            # Fallback for small snippets: Admin must ensure it's full code or use a different tool.
-            # In a real tool, we'd use diff/patch.
-            pass 
-
-        # Update Status
-        conn.execute("UPDATE tickets SET status = 'completed' WHERE id = ?", (ticket_id,))
-        conn.commit()
-        conn.close()
-        
-        return jsonify({"message": "Ticket resolved and code deployed."})
-        
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-@app.route('/analyze-idea', methods=['POST'])
-def analyze_idea():
-    if _rate_limit(request.remote_addr, max_requests=10, window=60):
-        return jsonify({"error": "Rate limit exceeded"}), 429
-    try:
-        data = request.json or {}
-        idea = data.get('idea', '').strip()
-        image_data_url = data.get('image_data_url', '')
-        engine = normalize_engine(data.get('engine'))
-        user_email = (data.get('user_email') or '').strip().lower()
-        project_name = (data.get('project_name') or '').strip().lower()
-        # Chat con IA es libre — paywall solo al enviar a equipo humano (/api/create-ticket)
-        image_context = describe_image_for_chat(image_data_url) if image_data_url else ""
-        enriched_idea = idea
-        if image_context:
-            enriched_idea = f"{idea}\n\nContexto de imagen adjunta:\n{image_context}".strip()
-        elif image_data_url and not idea:
-            enriched_idea = "El usuario adjuntó una imagen. Analiza el contexto visual para definir el producto."
-        ok_tokens, token_msg, remaining = consume_chat_message_quota(
-            user_email,
-            project_name,
-            reason="enviar mensaje al chat"
-        )
-        if not ok_tokens:
-            return jsonify({"error": token_msg, "remaining_tokens": remaining}), 402
-        if has_reset_intent(idea):
-            if user_email:
-                save_chat_memory(
-                    user_email,
-                    reset_memory_payload(get_chat_memory(user_email, project_name=project_name) or {}),
-                    project_name=project_name
-                )
-            return jsonify({
-                "status": "chat",
-                "message": "Done, we reset context. Let's start fresh: tell me your new idea in one sentence.",
-                "ready_to_build": False
-            })
-        history = [{"role": "user", "content": enriched_idea}]
-
-        existing_memory = None
-        if user_email:
-            stored = get_chat_memory(user_email, project_name=project_name) or {}
-            existing_memory = stored.get("agent_memory") if isinstance(stored, dict) else None
-
-        analysis = analyze_turn_state(history, enriched_idea, existing_memory=existing_memory)
-        reply = compose_consultant_reply(analysis, enriched_idea, history, engine=engine)
-
-        if user_email:
-            to_store = get_chat_memory(user_email, project_name=project_name) or {}
-            to_store["agent_memory"] = analysis["memory"]
-            to_store["summary"] = analysis["memory"].get("summary", "")
-            to_store["audience"] = analysis["memory"].get("audience", "")
-            to_store["business_model"] = analysis["memory"].get("business_model", "")
-            to_store["timeline"] = analysis["memory"].get("timeline", "")
-            to_store["engine_preference"] = engine
-            save_chat_memory(user_email, to_store, project_name=project_name)
-
-        return jsonify({
-            "status": "chat",
-            "message": reply,
-            "ready_to_build": analysis["ready_to_build"],
-            "ready_by_data": analysis.get("ready_by_data", False),
-            "missing_fields": analysis.get("missing_fields", []),
-            "brief_score": compute_brief_score(analysis.get("missing_fields", [])),
-            "remaining_tokens": remaining,
-            "memory_summary": analysis["memory"].get("summary", ""),
-            "memory_snapshot": {
-                "audience": analysis["memory"].get("audience", ""),
-                "business_model": analysis["memory"].get("business_model", ""),
-                "timeline": analysis["memory"].get("timeline", ""),
-                "features": analysis["memory"].get("features", []),
-            },
-            "engine_used": engine
-        })
+    return row if row else None
 
-    except Exception as e:
-        print(f"Analyze Error: {e}")
-        return jsonify({"error": "Internal server error"}), 500
+# ─────────────────────────────────────────────────────────────────────────────
 
 # --- NEW: SYNTHESIS BRAIN ---
 # --- NEW: TICKET SYSTEM (Step 1: Chat -> Ticket) ---
@@ -4438,539 +3855,52 @@ Stack: {', '.join(tech_stack)}
     }
 
 
-@app.route('/api/create-ticket', methods=['POST'])
-def create_ticket():
-    try:
-        data = request.json or {}
-        history = data.get('history', [])
-        user_email = (data.get('user_email') or '').strip().lower()
-        project_name = (data.get('project_name') or '').strip().lower()
-        channel = (data.get('channel') or 'build').strip().lower()  # build | marketing | organic
-        if not history:
-            return jsonify({"error": "History is required"}), 400
-        if not user_email:
-            return jsonify({"error": "Email is required"}), 400
-
-        if not is_user_subscribed(user_email):
-            save_pending_ticket(user_email, project_name, history)
-            return jsonify({
-                "requires_subscription": True,
-                "status": "pending_payment",
-                "message": "Your project is ready. Activate a plan to send it to our team."
-            }), 402
-
-        payload = build_ticket_from_history(history, user_email, project_name, channel=channel)
-        return jsonify(payload)
-
-    except Exception as e:
-        print(f"Ticket Error: {e}")
-        return jsonify({"error": "Internal server error"}), 500
-
-# --- STEP 2: ENGINEER ACCEPTANCE (Admin Panel -> Project Folder) ---
-@app.route('/api/accept-ticket', methods=['POST'])
-def accept_ticket():
-    try:
-        if not require_internal_auth():
-            return jsonify({"error": "unauthorized"}), 401
-        data = request.json or {}
-        ticket_id = data.get('ticket_id')
-        engineer = data.get('engineer', 'Staff Anmar')
-        if not ticket_id:
-            return jsonify({"error": "ticket_id is required"}), 400
-        
-        alerts = load_alerts()
-        ticket = next((t for t in alerts if t.get('id') == ticket_id), None)
-        if not ticket: return jsonify({"error": "Ticket not found"}), 404
-
-        project_id = ticket['project_name']
-        if str(engineer).strip().lower() in ("auto", "dispatch", "smart"):
-            state = load_dispatch_state()
-            engineer = choose_engineer_for_auto_dispatch([normalize_ticket_status(a) for a in alerts], state) or engineer
-            save_dispatch_state(state)
-        
-        # 2. CREATE FOLDER STRUCTURE
-        project_dir = os.path.join(projects_base_dir, project_id)
-        os.makedirs(project_dir, exist_ok=True)
-        
-        # Base Files
-        with open(os.path.join(project_dir, 'index.html'), 'w') as f:
-            f.write(f"<!-- Anmar Project: {project_id} -->\n<h1>{project_id} - Under Construction</h1>")
-        with open(os.path.join(project_dir, 'style.css'), 'w') as f:
-            f.write("/* Styles */")
-        with open(os.path.join(project_dir, 'app.js'), 'w') as f:
-            f.write("// Logic")
-        with open(os.path.join(project_dir, 'blueprint.md'), 'w') as f:
-            f.write(ticket.get('blueprint_md', '# Blueprint'))
-            
-        # 3. UPDATE TICKET STATUS
-        set_ticket_status(ticket_id, "accepted", actor=engineer, engineer=engineer)
-        set_ticket_status(ticket_id, "developing", actor=engineer, engineer=engineer)
-            
-        return jsonify({"success": True, "project_id": project_id})
-
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-@app.route('/api/deliver-ticket', methods=['POST'])
-def deliver_ticket():
-    try:
-        if not require_internal_auth():
-            return jsonify({"error": "unauthorized"}), 401
-        data = request.json or {}
-        ticket_id = data.get('ticket_id')
-        preview_url = data.get('preview_url') or ''
-        delivery_note = data.get('delivery_note') or ''
-
-        alerts = load_alerts()
-        ticket_seed = next((t for t in alerts if t.get('id') == ticket_id), None)
-        if not ticket_seed:
-            return jsonify({"error": "Ticket not found"}), 404
-        project_id = ticket_seed.get("project_name")
-        normalized_preview = normalize_preview_url(preview_url, project_id) if preview_url else f"/projects/{project_id}/index.html"
-
-        ticket = set_ticket_status(
-            ticket_id,
-            "completed",
-            actor="engineer",
-            deployed_url=normalized_preview,
-            delivery_note=(str(delivery_note or "").strip() or None)
-        )
-        if not ticket:
-            return jsonify({"error": "Ticket not found"}), 404
-
-        return jsonify({"success": True, "ticket": ticket})
-
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-@app.route('/api/admin/update-ticket', methods=['POST'])
-def admin_update_ticket():
-    try:
-        if not require_internal_auth():
-            return jsonify({"error": "unauthorized"}), 401
-        data = request.json or {}
-        ticket_id = str(data.get('ticket_id') or '').strip()
-        if not ticket_id:
-            return jsonify({"error": "ticket_id is required"}), 400
-
-        status = str(data.get('status') or '').strip().lower()
-        engineer = str(data.get('engineer') or '').strip()
-        preview_input = data.get('preview_url')
-        delivery_note = str(data.get('delivery_note') or '').strip()
-        internal_notes_raw = data.get('internal_notes')
-        internal_notes = None
-        if internal_notes_raw is not None:
-            internal_notes = str(internal_notes_raw).strip()
-        actor = engineer or str(data.get('actor') or 'admin')
-
-        alerts = load_alerts()
-        ticket = next((t for t in alerts if t.get('id') == ticket_id), None)
-        if not ticket:
-            return jsonify({"error": "Ticket not found"}), 404
-
-        project_id = ticket.get("project_name")
-        normalized_preview = ""
-        if preview_input is not None:
-            normalized_preview = normalize_preview_url(preview_input, project_id)
-
-        if status:
-            updated = set_ticket_status(
-                ticket_id,
-                status,
-                actor=actor,
-                engineer=engineer if engineer else None,
-                deployed_url=normalized_preview or None,
-                delivery_note=delivery_note or None
-            )
-            if not updated:
-                return jsonify({"error": "Ticket not found"}), 404
-            if internal_notes is not None:
-                refreshed = load_alerts()
-                ticket_ref = next((t for t in refreshed if t.get('id') == ticket_id), None)
-                if ticket_ref:
-                    ticket_ref["internal_notes"] = internal_notes
-                    ticket_ref["updated_at"] = datetime.now().isoformat()
-                    save_alerts(refreshed)
-                    updated = ticket_ref
-        else:
-            # No status transition, just update operational fields.
-            ticket = normalize_ticket_status(ticket)
-            if engineer:
-                ticket["engineer"] = engineer
-            if preview_input is not None:
-                ticket["preview_url"] = normalized_preview
-            if delivery_note:
-                ticket["delivery_note"] = delivery_note
-            if internal_notes is not None:
-                ticket["internal_notes"] = internal_notes
-            ticket["updated_at"] = datetime.now().isoformat()
-            append_ticket_event(
-                ticket,
-                ticket.get("status", "pending"),
-                "Internal update: preview and/or delivery notes.",
-                actor=actor
-            )
-            save_alerts(alerts)
-
-            update_order_status(
-                project_id,
-                ticket.get("status", "pending"),
-                log_entry="Internal update applied to project.",
-                engineer=ticket.get("engineer"),
-                deployed_url=(ticket.get("preview_url") or None)
-            )
-            updated = ticket
-
-        return jsonify({"success": True, "ticket": normalize_ticket_status(updated)})
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-# --- POLLING ENDPOINTS ---
-@app.route('/api/project-status', methods=['GET'])
-def get_project_status():
-    try:
-        project_id = request.args.get('project_id')
-        orders = get_orders_map()
-        if project_id:
-            order = orders.get(project_id)
-            if order:
-                return jsonify(order)
-            return jsonify({"status": "unknown", "progress": 0, "project_id": project_id}), 404
-
-        if not orders:
-            return jsonify({"status": "idle", "progress": 0})
-
-        latest = sorted(
-            orders.values(),
-            key=lambda o: o.get("updated_at", o.get("created_at", "")),
-            reverse=True
-        )[0]
-        return jsonify(latest)
-    except Exception:
-        return jsonify({"status": "error"}), 500
-
-@app.route('/api/internal-alerts', methods=['GET'])
-def get_internal_alerts():
-    try:
-        if not require_internal_auth():
-            return jsonify({"error": "unauthorized"}), 401
-        alerts = [normalize_ticket_status(a) for a in load_alerts()]
-        alerts.sort(key=lambda a: a.get("updated_at", a.get("timestamp", "")), reverse=True)
-        # Enrich with client plan info
-        try:
-            conn = get_db_connection()  # BUG FIX Bug 2: get_db() no existe, nombre correcto es get_db_connection()
-            for alert in alerts:
-                client_email = alert.get('user_email') or alert.get('client_email') or ''
-                if client_email:
-                    row = conn.execute('SELECT subscription_plan, subscription_active FROM users WHERE email = ?', (client_email,)).fetchone()
-                    if row:
-                        alert['client_plan'] = row['subscription_plan'] if row['subscription_plan'] else 'none'
-                        alert['client_plan_active'] = bool(row['subscription_active'])
-                    else:
-                        alert['client_plan'] = 'none'
-                        alert['client_plan_active'] = False
-        except Exception:
-            pass
-        return jsonify(alerts)
-    except Exception:
-        return jsonify([])
-
-@app.route('/api/internal-queue', methods=['GET'])
-def get_internal_queue():
-    try:
-        if not require_internal_auth():
-            return jsonify({"error": "unauthorized"}), 401
-        engineer = request.args.get('engineer')
-        status = request.args.get('status', 'all')
-        priority = request.args.get('priority', 'all')
-        mode = request.args.get('mode', 'all')  # all | mine
-        queue = list_queue(engineer=engineer, status=status, priority=priority, mode=mode)
-        return jsonify({
-            "items": queue,
-            "meta": {
-                "total": len(queue),
-                "overdue": len([q for q in queue if q.get("sla_overdue")]),
-                "pending": len([q for q in queue if q.get("status") == "pending"])
-            }
-        })
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-@app.route('/api/internal/order-history', methods=['GET'])
-def get_internal_order_history():
-    try:
-        if not require_internal_auth():
-            return jsonify({"error": "unauthorized"}), 401
-        project_name = (request.args.get('project_name') or '').strip().lower()
-        client_email = (request.args.get('client_email') or '').strip().lower()
-
-        alerts = [normalize_ticket_status(a) for a in load_alerts()]
-        history = []
-        for a in alerts:
-            p_name = str(a.get("project_name") or "").strip().lower()
-            c_email = str(a.get("client_email") or a.get("client") or "").strip().lower()
-            if project_name and p_name == project_name:
-                history.append(a)
-                continue
-            if client_email and c_email == client_email:
-                history.append(a)
-
-        history.sort(key=lambda x: x.get("updated_at", x.get("timestamp", "")), reverse=True)
-
-        project_status = None
-        if project_name:
-            project_status = get_order_status(project_name)
-
-        return jsonify({
-            "orders": history[:25],
-            "project_status": project_status,
-            "meta": {
-                "total_orders": len(history),
-                "project_name": project_name,
-                "client_email": client_email
-            }
-        })
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-@app.route('/api/client-tickets', methods=['GET'])
-def get_client_tickets():
-    """
-    Returns all tickets for a given client_email, grouped by project.
-    Requires internal authentication.
-    Query params: client_email (required)
-    """
-    try:
-        if not require_internal_auth():
-            return jsonify({"error": "unauthorized"}), 401
-
-        client_email = (request.args.get('client_email') or '').strip().lower()
-        if not client_email:
-            return jsonify({"error": "client_email parameter is required"}), 400
-
-        alerts = [normalize_ticket_status(a) for a in load_alerts()]
-        client_tickets = [
-            a for a in alerts
-            if str(a.get("client_email") or a.get("client") or "").strip().lower() == client_email
-        ]
-
-        # Group by project
-        grouped = {}
-        for ticket in client_tickets:
-            project = ticket.get("project_name", "unknown")
-            if project not in grouped:
-                grouped[project] = []
-            grouped[project].append(ticket)
-
-        # Sort each group by updated_at
-        for project in grouped:
-            grouped[project].sort(key=lambda t: t.get("updated_at", t.get("timestamp", "")), reverse=True)
-
-        return jsonify({
-            "client_email": client_email,
-            "tickets_by_project": grouped,
-            "meta": {
-                "total_tickets": len(client_tickets),
-                "projects_count": len(grouped),
-                "open_tickets": len([t for t in client_tickets if t.get("status") in ("pending", "accepted", "developing")])
-            }
-        })
-    except Exception as e:
-        print(f"Error in get_client_tickets: {e}")
-        return jsonify({"error": "Internal server error"}), 500
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+HUMAN_CHATS_FILE = os.path.join(BASE_DIR, 'backend', 'human_chats.json')
+PROJECT_OWNERS_FILE = os.path.join(BASE_DIR, 'backend', 'project_owners.json')
+PROJECT_META_FILE = os.path.join(BASE_DIR, 'backend', 'project_meta.json')
+INTERNAL_USERS_FILE = os.path.join(BASE_DIR, 'backend', 'internal_users.json')
+PROJECT_STORE_DIR = os.path.join(BASE_DIR, 'backend', 'project_store')
 
+# ── PROJECT VERSIONS (content-addressed) ──
+project_store = ProjectVersionStore(
+    PROJECT_STORE_DIR,
+    max_versions=int(os.getenv("ANMAR_PROJECT_MAX_VERSIONS", "200")),
+)
 
-@app.route('/api/internal/clients', methods=['GET'])
-def get_internal_clients():
-    """
-    Returns a consolidated list of clients (one entry per unique email).
-    Merges data from the users table and alerts/tickets.
-    """
+def record_project_version(project_name, source, summary=None, author=None):
+    """Snapshot del proyecto tras build/edición. Nunca rompe el flujo principal."""
     try:
-        if not require_internal_auth():
-            return jsonify({"error": "unauthorized"}), 401
-
-        conn = get_db_connection()  # BUG FIX Bug 2
-        # Get all users from the users table
-        users_rows = conn.execute(
-            'SELECT email, name, subscription_plan, subscription_active, created_at, stripe_customer_id FROM users ORDER BY created_at DESC'
-        ).fetchall()
-
-        # Get all alerts/tickets
-        alerts = [normalize_ticket_status(a) for a in load_alerts()]
-
-        # Build a map of client email → ticket data
-        ticket_map = {}
-        for a in alerts:
-            email = (a.get('user_email') or a.get('client_email') or '').strip().lower()
-            if not email:
-                continue
-            if email not in ticket_map:
-                ticket_map[email] = {
-                    'tickets': [],
-                    'channels': set(),
-                    'latest_activity': None
-                }
-            ticket_map[email]['tickets'].append(a)
-            ch = a.get('channel') or 'build'
-            ticket_map[email]['channels'].add(ch)
-            ts = a.get('updated_at') or a.get('created_at') or a.get('timestamp') or ''
-            if ts and (not ticket_map[email]['latest_activity'] or ts > ticket_map[email]['latest_activity']):
-                ticket_map[email]['latest_activity'] = ts
-
-        # Build consolidated client list
-        clients = []
-        seen_emails = set()
-        for row in users_rows:
-            email = row['email'].strip().lower() if row['email'] else ''
-            if not email or email in seen_emails:
-                continue
-            seen_emails.add(email)
-            tdata = ticket_map.get(email, {})
-            tickets = tdata.get('tickets', [])
-            open_tickets = [t for t in tickets if t.get('status') in ('pending', 'pending_human_review', 'accepted', 'developing')]
-            clients.append({
-                'email': email,
-                'name': row['name'] or email.split('@')[0],
-                'plan': row['subscription_plan'] or 'none',
-                'plan_active': bool(row['subscription_active']),
-                'stripe_customer_id': row['stripe_customer_id'] or '',
-                'created_at': row['created_at'] or '',
-                'total_tickets': len(tickets),
-                'open_tickets': len(open_tickets),
-                'channels': list(tdata.get('channels', [])),
-                'latest_activity': tdata.get('latest_activity', row['created_at'] or ''),
-            })
-
-        # Also add clients from tickets that aren't in users table
-        for email, tdata in ticket_map.items():
-            if email in seen_emails:
-                continue
-            seen_emails.add(email)
-            tickets = tdata.get('tickets', [])
-            open_tickets = [t for t in tickets if t.get('status') in ('pending', 'pending_human_review', 'accepted', 'developing')]
-            clients.append({
-                'email': email,
-                'name': email.split('@')[0],
-                'plan': 'none',
-                'plan_active': False,
-                'stripe_customer_id': '',
-                'created_at': '',
-                'total_tickets': len(tickets),
-                'open_tickets': len(open_tickets),
-                'channels': list(tdata.get('channels', [])),
-                'latest_activity': tdata.get('latest_activity', ''),
-            })
-
-        # Sort: paying clients first, then by latest activity
-        clients.sort(key=lambda c: (
-            0 if c['plan'] != 'none' and c['plan_active'] else 1,
-            c.get('latest_activity') or ''
-        ), reverse=False)
-        # Actually we want paying first (0 < 1), then newest activity first
-        clients.sort(key=lambda c: (
-            0 if c['plan'] != 'none' and c['plan_active'] else 1,
-            -(len(c.get('latest_activity') or ''))  # rough sort
-        ))
-        # Better sort
-        def client_sort_key(c):
-            is_paying = 1 if (c['plan'] != 'none' and c['plan_active']) else 0
-            activity = c.get('latest_activity') or '0'
-            return (-is_paying, activity)
-        clients.sort(key=client_sort_key, reverse=True)
-
-        return jsonify({"clients": clients, "total": len(clients)})
+        project_path = os.path.join(projects_base_dir, project_name)
+        if not os.path.isdir(project_path):
+            return None
+        version = project_store.record_version(project_name, project_path, source, summary=summary, author=author)
+        precompress_project(project_name)
+        return version
     except Exception as e:
-        print(f"Error in get_internal_clients: {e}")
-        return jsonify({"error": "Internal server error"}), 500
-
+        print(f"[VERSIONS] Error recording {project_name}: {e}")
+        return None
 
-@app.route('/api/internal/upgrade-client', methods=['POST'])
-def internal_upgrade_client():
-    """
-    Upgrade or change a client's plan internally.
-    Admin-only. Updates subscription_plan and subscription_active in the users table.
-    Optionally creates a Stripe subscription for MVP/Growth.
-    """
+def precompress_project(project_name):
+    """Variantes .gz/.br del preview, generadas al escribir y no en cada request."""
+    project_path = os.path.join(projects_base_dir, project_name)
+    if not os.path.isdir(project_path):
+        return 0
     try:
-        if not require_internal_auth():
-            return jsonify({"error": "unauthorized"}), 401
-        # Check admin role
-        internal_user = session.get('internal_user', {})
-        if internal_user.get('role') != 'admin':
-            return jsonify({"error": "Admin access required"}), 403
-
-        data = request.json or {}
-        client_email = (data.get('client_email') or '').strip().lower()
-        new_plan = (data.get('plan') or '').strip().lower()
-        custom_price = (data.get('stripe_price_id') or '').strip()
-
-        if not client_email:
-            return jsonify({"error": "client_email is required"}), 400
-        if new_plan not in ('validate', 'mvp', 'growth', 'none'):
-            return jsonify({"error": "Invalid plan. Must be validate, mvp, growth, or none"}), 400
-
-        conn = get_db_connection()  # BUG FIX Bug 2
-        user = conn.execute('SELECT email, stripe_customer_id FROM users WHERE email = ?', (client_email,)).fetchone()
-        if not user:
-            return jsonify({"error": "Client not found in database"}), 404
-
-        # Update the plan in database
-        if new_plan == 'none':
-            conn.execute(
-                'UPDATE users SET subscription_plan = ?, subscription_active = 0 WHERE email = ?',
-                ('none', client_email)
-            )
-        else:
-            conn.execute(
-                'UPDATE users SET subscription_plan = ?, subscription_active = 1, subscription_started_at = CURRENT_TIMESTAMP WHERE email = ?',
-                (new_plan, client_email)
-            )
-        conn.commit()
-
-        # Optionally create Stripe subscription for MVP/Growth
-        stripe_result = None
-        if custom_price and new_plan in ('mvp', 'growth') and STRIPE_SECRET_KEY:
-            try:
-                customer_id = user['stripe_customer_id'] if user['stripe_customer_id'] else None
-                if not customer_id:
-                    # Create a Stripe customer
-                    customer = stripe.Customer.create(email=client_email)
-                    customer_id = customer.id
-                    conn.execute('UPDATE users SET stripe_customer_id = ? WHERE email = ?', (customer_id, client_email))
-                    conn.commit()
-
-                # Create subscription with custom price
-                subscription = stripe.Subscription.create(
-                    customer=customer_id,
-                    items=[{"price": custom_price}],
-                    metadata={"plan": new_plan, "email": client_email, "source": "internal_upgrade"}
-                )
-                # Store subscription ID
-                conn.execute('UPDATE users SET stripe_subscription_id = ? WHERE email = ?', (subscription.id, client_email))
-                conn.commit()
-                stripe_result = {"subscription_id": subscription.id, "status": subscription.status}
-            except Exception as stripe_err:
-                print(f"Stripe error during internal upgrade: {stripe_err}")
-                stripe_result = {"error": str(stripe_err)}
-
-        return jsonify({
-            "status": "ok",
-            "client_email": client_email,
-            "new_plan": new_plan,
-            "stripe": stripe_result
-        })
+        return precompress_tree(project_path)
     except Exception as e:
-        print(f"Error in internal_upgrade_client: {e}")
-        return jsonify({"error": "Internal server error"}), 500
-
+        print(f"[PREVIEW] precompress error for {project_name}: {e}")
+        return 0
 
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-HUMAN_CHATS_FILE = os.path.join(BASE_DIR, 'backend', 'human_chats.json')
-PROJECT_OWNERS_FILE = os.path.join(BASE_DIR, 'backend', 'project_owners.json')
-PROJECT_META_FILE = os.path.join(BASE_DIR, 'backend', 'project_meta.json')
-INTERNAL_USERS_FILE = os.path.join(BASE_DIR, 'backend', 'internal_users.json')
+@request_profiler.timed("auth")
+def can_access_project(project_name):
+    if require_internal_auth():
+        return True
+    owner = project_index.owner_of(project_name)
+    user_email = str(session.get('user_email') or '').strip().lower()
+    return bool(user_email) and owner == user_email
 
+@json_store("read", PROJECT_OWNERS_FILE)
 def load_project_owners():
     if not os.path.exists(PROJECT_OWNERS_FILE):
         return {}
@@ -4981,18 +3911,7 @@ def load_project_owners():
     except Exception:
         return {}
 
-def save_project_owners(data):
-    os.makedirs(os.path.dirname(PROJECT_OWNERS_FILE), exist_ok=True)
-    tmp_path = PROJECT_OWNERS_FILE + '.tmp'
-    try:
-        with open(tmp_path, 'w') as f:
-            json.dump(data, f, indent=2)
-        os.replace(tmp_path, PROJECT_OWNERS_FILE)
-    except Exception as e:
-        print(f"Error saving project owners: {e}")
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
-
+@json_store("read", PROJECT_META_FILE)
 def load_project_meta():
     if not os.path.exists(PROJECT_META_FILE):
         return {}
@@ -5003,6 +3922,7 @@ def load_project_meta():
     except Exception:
         return {}
 
+@json_store("write", PROJECT_META_FILE)
 def save_project_meta(data):
     os.makedirs(os.path.dirname(PROJECT_META_FILE), exist_ok=True)
     tmp_path = PROJECT_META_FILE + '.tmp'
@@ -5015,6 +3935,24 @@ def save_project_meta(data):
         if os.path.exists(tmp_path):
             os.remove(tmp_path)
 
+# ── PROJECT INDEX (owner -> projects, tabla project_index) ──
+# Fuente de verdad de dueños; project_owners.json solo se lee para el backfill inicial.
+def _backfill_project_index():
+    seeded = project_index.backfill(projects_base_dir, load_project_owners(), load_project_meta())
+    if seeded:
+        print(f"[PROJECT INDEX] backfilled {seeded} projects")
+    return seeded
+
+def _project_index_connection():
+    # El backfill inicial corre antes de la primera consulta al índice.
+    if not startup.done("project_index"):
+        startup.ensure("project_index")
+    return get_db_connection()
+
+project_index = ProjectIndex(_project_index_connection)
+startup.register("project_index", _backfill_project_index)
+
+@json_store("read", INTERNAL_USERS_FILE)
 def load_internal_users():
     if not os.path.exists(INTERNAL_USERS_FILE):
         return []
@@ -5025,6 +3963,7 @@ def load_internal_users():
     except Exception:
         return []
 
+@json_store("write", INTERNAL_USERS_FILE)
 def save_internal_users(users):
     os.makedirs(os.path.dirname(INTERNAL_USERS_FILE), exist_ok=True)
     tmp_path = INTERNAL_USERS_FILE + '.tmp'
@@ -5037,6 +3976,7 @@ def save_internal_users(users):
         if os.path.exists(tmp_path):
             os.remove(tmp_path)
 
+@request_profiler.timed("auth")
 def find_internal_user(identifier):
     ident = str(identifier or '').strip().lower()
     if not ident:
@@ -5046,11 +3986,13 @@ def find_internal_user(identifier):
             return u
     return None
 
+@request_profiler.timed("auth")
 def require_internal_auth():
     if not session.get('internal_user'):
         return False
     return True
 
+@json_store("read", HUMAN_CHATS_FILE)
 def load_human_chats():
     if not os.path.exists(HUMAN_CHATS_FILE):
         return {}
@@ -5060,6 +4002,7 @@ def load_human_chats():
     except Exception:
         return {}
 
+@json_store("write", HUMAN_CHATS_FILE)
 def save_human_chats(data):
     import tempfile
     try:
@@ -5076,1549 +4019,454 @@ def save_human_chats(data):
     except Exception as e:
         print(f"Error saving human chats: {e}")
 
-@app.route('/api/human-chat/send', methods=['POST'])
-def send_human_chat():
-    try:
-        data = request.json or {}
-        project_name = (data.get('project_name') or '').strip().lower()
-        role = data.get('role', 'human') # 'human' or 'client'
-        content = (data.get('content') or data.get('message') or '').strip()
-        actor = data.get('actor') or data.get('sender') or ''
-        client_email = (data.get('client_email') or '').strip().lower()
-        kind = (data.get('kind') or '').strip().lower()
-        payload = data.get('payload')
-
-        if role in ('human', 'internal') or kind == 'blueprint':
-            if not require_internal_auth():
-                return jsonify({"error": "unauthorized"}), 401
-            # For internal users, override actor with verified session identity
-            internal_user = session.get('internal_user', '')
-            if internal_user:
-                actor = internal_user
-        if role == 'client':
-            if not client_email:
-                return jsonify({"error": "You have not logged in."}), 401
-            # BUG FIX: verify client_email matches the authenticated session to prevent impersonation
-            # FIXED: changed from `if session_email and ...` to `if not session_email or ...`
-            # to prevent bypass when no session exists (unauthenticated attacker)
-            session_email = session.get('user_email', '').lower()
-            if not session_email or session_email != client_email.lower():
-                return jsonify({"error": "Forbidden"}), 403
-            if not is_user_subscribed(client_email):
-                return jsonify({"error": "Plan is required to chat with the team.", "code": "subscription_required"}), 402
-            # For clients, get verified name from DB to prevent spoofing
-            try:
-                conn = get_db_connection()
-                user_row = conn.execute('SELECT name FROM users WHERE email = ?', (client_email,)).fetchone()
-                conn.close()
-                if user_row and user_row['name']:
-                    actor = user_row['name']
-                else:
-                    actor = client_email
-            except Exception:
-                actor = client_email
-        
-        if not project_name or not content:
-            return jsonify({"error": "Missing parameters"}), 400
-            
-        chats = load_human_chats()
-        if project_name not in chats:
-            chats[project_name] = []
-            
-        message = {
-            "id": str(uuid.uuid4()),
-            "role": role,
-            "content": content,
-            "actor": actor,
-            "sender": actor,
-            "timestamp": datetime.now().isoformat()
-        }
-        if kind:
-            message["kind"] = kind
-        if payload is not None:
-            message["payload"] = payload
-        chats[project_name].append(message)
-        
-        save_human_chats(chats)
-        # Ensure an internal ticket exists and stays updated with unread counts.
-        try:
-            alerts = load_alerts()
-            ticket = next((t for t in alerts if str(t.get("project_name", "")).lower() == project_name), None)
-            now = datetime.now().isoformat()
-            summary_text = content[:140]
-            base_project = project_name[:-11] if project_name.endswith("__marketing") else project_name
-            if not ticket:
-                # Look up client plan for display in panel
-                client_plan = 'none'
-                try:
-                    _conn = get_db_connection()
-                    _row = _conn.execute('SELECT subscription_plan FROM users WHERE LOWER(email)=?', (client_email.lower(),)).fetchone()
-                    _conn.close()
-                    if _row: client_plan = _row['subscription_plan'] or 'none'
-                except Exception: pass
-
-                ticket = {
-                    "id": str(uuid.uuid4())[:8],
-                    "project_name": project_name,
-                    "client_email": client_email,
-                    "summary": summary_text,
-                    "timestamp": now,
-                    "updated_at": now,
-                    "status": "pending",
-                    "priority": "high",
-                    "channel": "validate",
-                    "client_plan": client_plan,
-                    "preview_url": f"/projects/{base_project}/index.html",
-                    "unread_messages": 0,
-                    "events": []
-                }
-                alerts.insert(0, ticket)
-            else:
-                if client_email:
-                    ticket["client_email"] = client_email
-                if summary_text:
-                    ticket["summary"] = summary_text
-                ticket["updated_at"] = now
-
-            if role == "client":
-                ticket["unread_messages"] = int(ticket.get("unread_messages") or 0) + 1
-                append_ticket_event(ticket, ticket.get("status", "pending"), "Nuevo mensaje del cliente.", actor="client")
-            else:
-                ticket["unread_messages"] = 0
-                append_ticket_event(ticket, ticket.get("status", "pending"), "Respuesta enviada al cliente.", actor=actor or "engineer")
-            save_alerts(alerts)
-        except Exception as e:
-            print(f"Error updating internal alerts for human chat: {e}")
-
-        # SMS notification to admin when a paying client sends a message
-        if role == "client" and TWILIO_ADMIN_PHONE:
-            try:
-                display_project = project_name.replace('_', ' ').title()
-                preview = content[:100] + ('…' if len(content) > 100 else '')
-                _send_sms(
-                    to_phone=TWILIO_ADMIN_PHONE,
-                    body=(
-                        f"💬 New message from {actor or client_email}\n"
-                        f"Project: {display_project}\n"
-                        f"\"{preview}\"\n"
-                        f"Reply at anmarenterprices.com/internal/panel.html"
-                    )
-                )
-            except Exception as e:
-                print(f"[SMS] Error sending admin alert: {e}")
-
-        return jsonify({"status": "success"})
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-@app.route('/api/human-chat/history', methods=['GET'])
-def get_human_chat_history():
-    try:
-        project_name = (request.args.get('project_name') or '').strip().lower()
-        mark_read = str(request.args.get('mark_read', '')).lower() in ('1', 'true', 'yes')
-        if not project_name:
-            return jsonify({"error": "Missing project_name"}), 400
-
-        # Auth: allow internal users OR the client who owns the project
-        client_email = (request.args.get('client_email') or request.args.get('email') or '').strip().lower()
-        is_internal = require_internal_auth()
-        if not is_internal:
-            # Verify client owns this project by checking alerts/tickets
-            if not client_email:
-                return jsonify({"error": "Authentication required"}), 401
-            alerts = load_alerts()
-            project_owner = next(
-                (t.get('client_email', '') for t in alerts if str(t.get('project_name', '')).lower() == project_name),
-                None
-            )
-            # Allow if project doesn't exist in alerts (new chat) or email matches
-            if project_owner and project_owner.lower() != client_email:
-                return jsonify({"error": "You do not have access to this project"}), 403
-
-        chats = load_human_chats()
-        history = chats.get(project_name, [])
-        if mark_read:
-            try:
-                alerts = load_alerts()
-                ticket = next((t for t in alerts if str(t.get("project_name", "")).lower() == project_name), None)
-                if ticket:
-                    ticket["unread_messages"] = 0
-                    ticket["updated_at"] = datetime.now().isoformat()
-                    save_alerts(alerts)
-            except Exception as e:
-                print(f"Error marking chat read: {e}")
-        return jsonify({"history": history})
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-@app.route('/api/human-chat/accept-blueprint', methods=['POST'])
-def accept_blueprint():
-    try:
-        data = request.json or {}
-        project_name = (data.get('project_name') or '').strip().lower()
-        blueprint_id = str(data.get('blueprint_id') or '').strip()
-        actor = str(data.get('actor') or 'Client').strip()
-        client_email = (data.get('client_email') or '').strip().lower()
-        if not project_name or not blueprint_id:
-            return jsonify({"error": "Missing parameters"}), 400
-
-        # Auth: require Flask session — prevent unauthenticated blueprint approval
-        session_email = session.get('user_email', '').strip().lower()
-        if not session_email:
-            return jsonify({"error": "Authentication required"}), 401
-        # client_email in body must match the session to prevent CSRF/impersonation
-        if client_email and client_email != session_email:
-            return jsonify({"error": "Forbidden"}), 403
-        # Use session email as canonical identity
-        if not client_email:
-            client_email = session_email
-
-        alerts = load_alerts()
-        project_ticket = next(
-            (t for t in alerts if str(t.get('project_name', '')).lower() == project_name),
-            None
-        )
-        if project_ticket and project_ticket.get('client_email', '').lower() != client_email:
-            return jsonify({"error": "You do not have permission to approve this blueprint"}), 403
-
-        chats = load_human_chats()
-        if project_name not in chats:
-            return jsonify({"error": "Project not found"}), 404
-
-        target = None
-        for msg in chats[project_name]:
-            if str(msg.get("id")) == blueprint_id:
-                target = msg
-                break
-
-        if not target or target.get("kind") != "blueprint":
-            return jsonify({"error": "Blueprint not found"}), 404
-
-        target["accepted"] = True
-        target["accepted_at"] = datetime.now().isoformat()
-        if client_email:
-            target["accepted_by"] = client_email
-
-        # Add confirmation message from client.
-        chats[project_name].append({
-            "id": str(uuid.uuid4()),
-            "role": "client",
-            "content": "✅ Blueprint approved. Ready to start.",
-            "actor": actor,
-            "timestamp": datetime.now().isoformat(),
-            "kind": "blueprint_accept"
-        })
-        save_human_chats(chats)
-
-        # Update internal ticket status to developing (if exists) and mark unread.
-        try:
-            alerts = load_alerts()
-            ticket = next((t for t in alerts if str(t.get("project_name", "")).lower() == project_name), None)
-            if ticket:
-                set_ticket_status(ticket.get("id"), "developing", actor="client", engineer=ticket.get("engineer"))
-                refreshed = load_alerts()
-                ticket_ref = next((t for t in refreshed if str(t.get("project_name", "")).lower() == project_name), None)
-                if ticket_ref:
-                    ticket_ref["unread_messages"] = int(ticket_ref.get("unread_messages") or 0) + 1
-                    ticket_ref["updated_at"] = datetime.now().isoformat()
-                    append_ticket_event(ticket_ref, ticket_ref.get("status", "developing"), "Blueprint approved by client.", actor=actor)
-                    save_alerts(refreshed)
-        except Exception as e:
-            print(f"Error updating ticket after blueprint accept: {e}")
-
-        return jsonify({"status": "ok"})
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-@app.route('/api/internal/ai-reply', methods=['POST'])
-def internal_ai_reply():
-    try:
-        if not require_internal_auth():
-            return jsonify({"error": "unauthorized"}), 401
-        data = request.json or {}
-        project_name = (data.get('project_name') or '').strip().lower()
-        client_email = (data.get('client_email') or '').strip().lower()
-        status = (data.get('status') or '').strip().lower()
-        messages = data.get('messages') or []
-
-        # Build short conversation context (last 8 messages).
-        convo_lines = []
-        for msg in messages[-8:]:
-            if not isinstance(msg, dict):
-                continue
-            role = (msg.get('role') or '').strip().lower()
-            label = "Cliente" if role == "client" else "Ingeniero"
-            content = str(msg.get('content') or '').strip()
-            if content:
-                convo_lines.append(f"{label}: {content}")
-        convo = "\n".join(convo_lines) if convo_lines else "Cliente: (sin mensajes previos)"
-
-        prompt = f"""
-Eres operador interno de ANMAR. Genera 3 posibles respuestas cortas para enviar al cliente.
-Reglas: español neutro, tono humano, máximo 2 frases por respuesta. Si falta información, incluye solo 1 pregunta.
-No prometas tiempos exactos ni menciones que eres IA.
-
-Proyecto: {project_name or 'N/D'}
-Estado: {status or 'pending'}
-Cliente: {client_email or 'N/D'}
-Conversación reciente:
-{convo}
-
-Devuelve 3 opciones, una por línea, sin numeración.
-""".strip()
-
-        text = call_ai_text(prompt, engine=ENGINE_ANTIGRAVITY) or ""
-        lines = [l.strip().lstrip("-•").strip() for l in text.splitlines() if l.strip()]
-        suggestions = lines[:3]
-        if not suggestions:
-            suggestions = [
-                "Gracias por el detalle. Ya lo revisé y te confirmo el siguiente paso en breve.",
-                "Perfecto, con eso avanzamos. ¿Hay algún ejemplo o referencia que quieras que tomemos en cuenta?",
-                "Entendido. Voy a preparar la primera propuesta y te la comparto para revisión."
-            ]
-
-        return jsonify({"suggestions": suggestions})
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-@app.route('/api/dispatch/auto-assign', methods=['POST'])
-def auto_assign_dispatch():
-    try:
-        data = request.json or {}
-        limit = int(data.get("limit", 1))
-        if limit < 1:
-            limit = 1
-        if limit > 20:
-            limit = 20
-        actor = data.get("actor", "dispatcher")
-
-        alerts = [normalize_ticket_status(a) for a in load_alerts()]
-        queue = pending_queue_sorted(alerts)
-        if not queue:
-            return jsonify({"assigned": [], "message": "No pending tickets."})
-
-        state = load_dispatch_state()
-        assigned = []
-        for ticket in queue[:limit]:
-            engineer = choose_engineer_for_auto_dispatch(alerts, state)
-            if not engineer:
-                break
-            updated = set_ticket_status(ticket.get("id"), "accepted", actor=actor, engineer=engineer)
-            if updated:
-                assigned.append({
-                    "ticket_id": updated.get("id"),
-                    "project_id": updated.get("project_name"),
-                    "engineer": engineer,
-                    "priority": updated.get("priority"),
-                })
-                # Update in-memory snapshot for next load balancing decision.
-                ticket["status"] = "accepted"
-                ticket["engineer"] = engineer
-
-        save_dispatch_state(state)
-        return jsonify({
-            "assigned": assigned,
-            "count": len(assigned),
-            "message": f"{len(assigned)} ticket(s) assigned."
-        })
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
 # --- ENGINEER TOOLS (The "Antigravity" for Maria) ---
 
-@app.route('/api/engineer/file', methods=['GET', 'POST'])
-def manage_project_file():
-    try:
-        if not require_internal_auth():
-            return jsonify({"error": "unauthorized"}), 401
-
-        json_data = request.json or {} if request.is_json else {}
-        project_id = request.args.get('project_id') or json_data.get('project_id') or request.args.get('project_name') or json_data.get('project_name')
-        filename = request.args.get('filename') or json_data.get('filename')
-
-        if not project_id:
-            return jsonify({"error": "Missing project_id"}), 400
-        if not filename:
-            return jsonify({"error": "Missing filename"}), 400
-
-        # Validate project_id has no path traversal
-        if '..' in project_id or '/' in project_id or '\\' in project_id:
-            return jsonify({"error": "Invalid project ID"}), 400
-
-        # Validate filename has no path traversal
-        if '..' in filename or '/' in filename or '\\' in filename:
-            return jsonify({"error": "Invalid filename"}), 400
-
-        # Security: only allow safe filenames
-        safe_name = os.path.basename(filename)
-        project_dir = os.path.join(projects_base_dir, project_id)
-        file_path = os.path.join(project_dir, safe_name)
-
-        # Security check: ensure path is within project dir
-        if not os.path.abspath(file_path).startswith(os.path.abspath(project_dir) + os.sep):
-            return jsonify({"error": "Invalid path"}), 403
-
-        if request.method == 'GET':
-            if not os.path.exists(file_path):
-                return jsonify({"content": "", "exists": False}), 200
-            with open(file_path, 'r') as f:
-                return jsonify({"content": f.read(), "exists": True})
-
-        if request.method == 'POST':
-            content = json_data.get('content', '')
-            os.makedirs(project_dir, exist_ok=True)
-            with open(file_path, 'w') as f:
-                f.write(content)
-            return jsonify({"success": True})
-
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-@app.route('/api/engineer/ai-assist', methods=['POST'])
-def engineer_ai_assist():
-    try:
-        if not require_internal_auth():
-            return jsonify({"error": "unauthorized"}), 401
-        data = request.json or {}
-        # Accept both field-name conventions (panel sends project_name/context/prompt/history)
-        project_id = data.get('project_id') or data.get('project_name') or ''
-        instruction = data.get('instruction') or data.get('prompt') or ''
-        target_file = data.get('target_file') or ''
-        current_content = data.get('file_content', '')
-        extra_context = data.get('context', '')
-        history = data.get('history') or []
-
-        if not instruction:
-            return jsonify({"error": "instruction/prompt is required"}), 400
-
-        # ----- Mode A: Code editing (target_file provided) -----
-        if target_file and project_id:
-            context_files = ""
-            project_dir = os.path.join(projects_base_dir, project_id)
-            if target_file.endswith('.html'):
-                css_path = os.path.join(project_dir, 'style.css')
-                if os.path.exists(css_path):
-                    with open(css_path, 'r') as f: context_files += f"\n/* style.css context */\n{f.read()[:1000]}"
-            if target_file.endswith('.js'):
-                html_path = os.path.join(project_dir, 'index.html')
-                if os.path.exists(html_path):
-                    with open(html_path, 'r') as f: context_files += f"\n<!-- index.html context -->\n{f.read()[:1000]}"
-
-            prompt = f"""
-ACT AS: Senior Lead Developer (Co-pilot).
-CONTEXT: We are building '{project_id}'.
-TARGET FILE: {target_file}
-
-OTHER CONTEXT FILES:
-{context_files}
-
-CURRENT CONTENT OF {target_file}:
-```
-{current_content}
-```
-
-USER INSTRUCTION: "{instruction}"
-
-TASK:
-1. Analyze the instruction and the current code.
-2. Rewrite the code to fulfill the instruction.
-3. Maintain existing functionality unless asked to change.
-4. Use modern best practices.
-
-RETURN FORMAT (JSON):
-{{"thought": "Brief explanation of changes (1-2 sentences)", "code": "FULL new content for the file"}}
-"""
-            response = model.generate_content(prompt)
-            text = response.text.strip()
-            if text.startswith('```json'): text = text[7:]
-            if text.startswith('```'): text = text[3:]
-            if text.endswith('```'): text = text[:-3]
-            try:
-                ai_response = json.loads(text.strip())
-            except Exception:
-                ai_response = {"thought": "Respuesta generada.", "code": text.strip()}
-            return jsonify(ai_response)
+# --- ORDER STATUS MANAGER ---
+# Implemented above with normalized status handling and event logs.
 
-        # ----- Mode B: Conversational AI assistant (panel chat) -----
-        history_text = ""
-        if history:
-            for msg in history[-10:]:
-                role = msg.get('role', 'user')
-                content = msg.get('content', '')
-                history_text += f"\n{role}: {content}"
+# --- PROJECT BUILDER (background jobs) ---
+# /create-project solo valida y encola; el build (IA, validación, escritura,
+# smoke checks y alerta de viabilidad) corre en el pool de build_jobs.
+BUILD_JOB_WORKERS = int(os.getenv("ANMAR_BUILD_WORKERS", "2"))
+BUILD_JOB_LEASE_SECONDS = float(os.getenv("ANMAR_BUILD_JOB_LEASE_SECONDS", "300"))
+build_jobs = JobQueue(get_db_connection, table="build_jobs", max_workers=BUILD_JOB_WORKERS,
+                      lease_seconds=BUILD_JOB_LEASE_SECONDS)
 
-        prompt = f"""
-Eres un asistente técnico senior de ANMAR Enterprises. Ayuda al ingeniero con el proyecto '{project_id}'.
 
-{extra_context}
+class BuildFailed(Exception):
+    def __init__(self, message, result=None):
+        super().__init__(message)
+        self.result = result
 
-Historial de conversación:
-{history_text}
 
-Solicitud actual del ingeniero: "{instruction}"
+def _build_fallback_files(project_name, theme, plan_content):
+    safe_name = project_name.replace("_", " ").title()
+    summary = (str(plan_content or "").strip()[:260] or "Proyecto generado por Anmar Engine.")
+    return templates.render_kit("build_fallback", {
+        "safe_name": safe_name,
+        "summary": summary,
+        "theme": theme,
+        "plan": plan_content or "Sin detalles.",
+    }, theme=theme)
 
-Responde de forma clara, concisa y útil en español. Si te piden código, entrégalo listo para producción.
-"""
-        raw = call_ai_text(prompt, engine=ENGINE_ANTIGRAVITY) or "No pude generar una respuesta."
-        return jsonify({"response": raw, "suggestion": raw})
+def _clean_code_block(text):
+    if not text:
+        return ""
+    cleaned = str(text).strip()
+    cleaned = cleaned.replace("```html", "").replace("```css", "").replace("```js", "").replace("```javascript", "").replace("```markdown", "").replace("```", "").strip()
+    return cleaned
 
-    except Exception as e:
-        print(f"AI Assist Error: {e}")
-        return jsonify({"response": "Error interno procesando solicitud.", "thought": "Error processing.", "code": "// Error"}), 500
+def _validate_build_files(file_map):
+    errors = []
+    html = file_map.get("index.html", "")
+    if "<html" not in html.lower() or "</html>" not in html.lower():
+        errors.append("index.html incompleto")
+    if "<body" not in html.lower():
+        errors.append("index.html sin body")
+    if not file_map.get("styles.css", "").strip():
+        errors.append("styles.css vacío")
+    if not file_map.get("app.js", "").strip():
+        errors.append("app.js vacío")
+    return errors
+
+# Pipeline de build: spec compartido -> cada archivo en paralelo con reintentos
+# y validación propios. index.html, styles.css y app.js comparten ids y clases,
+# así que si uno falla los tres caen juntos al fallback; README.md va aparte.
+BUILD_FILE_RETRIES = int(os.getenv("ANMAR_BUILD_FILE_RETRIES", "2"))
+BUILD_COUPLED_FILES = ("index.html", "styles.css", "app.js")
+
+BUILD_FILE_INSTRUCTIONS = {
+    "index.html": (
+        "a complete HTML5 document. Link ./styles.css in <head> and load ./app.js at the end of <body>. "
+        "Render every section of the spec as <section id=\"...\"> with real copy, and give each "
+        "interaction element the exact id from the spec."
+    ),
+    "styles.css": (
+        "the full stylesheet. Use the palette as CSS variables in :root, style every section id "
+        "and interaction element from the spec, modern and responsive (mobile-first, one media query at least)."
+    ),
+    "app.js": (
+        "plain browser JavaScript (no frameworks, no imports). Implement every interaction of the spec, "
+        "looking elements up by their ids and guarding against missing elements."
+    ),
+    "README.md": "a short markdown README: what the project is, its sections and how to run it (open index.html).",
+}
 
-@app.route('/api/engineer/ai-generate', methods=['POST'])
-def engineer_ai_generate():
-    try:
-        if not require_internal_auth():
-            return jsonify({"error": "unauthorized"}), 401
-        data = request.json or {}
-        project_id = data.get('project_id') or data.get('project_name') or ''
-        instruction = data.get('instruction') or data.get('context') or ''
-        engine = data.get('engine', ENGINE_ANTIGRAVITY)
-        filename = data.get('filename', 'index.html')
-
-        if not project_id or not instruction:
-            return jsonify({"error": "project_id and instruction are required"}), 400
-
-        # Determine file type for the prompt
-        is_css = filename.endswith('.css')
-        is_js = filename.endswith('.js')
-        is_html = filename.endswith('.html')
-
-        if is_css:
-            prompt = f"""Eres un ingeniero senior de ANMAR. Genera CSS profesional y moderno.
-Instrucción: \"\"\"{instruction}\"\"\"
-Entrega SOLO el CSS, sin markdown ni backticks."""
-        elif is_js:
-            prompt = f"""Eres un ingeniero senior de ANMAR. Genera JavaScript profesional y moderno.
-Instrucción: \"\"\"{instruction}\"\"\"
-Entrega SOLO el JavaScript, sin markdown ni backticks."""
-        else:
-            prompt = f"""Eres un ingeniero senior de ANMAR. Genera un sitio web completo en un solo archivo HTML (con CSS y JS inline si aplica).
-Debe ser una primera versión presentable para mostrar al cliente como preview.
-Usa diseño moderno, tipografía limpia y secciones claras.
-Instrucción del cliente:
-\"\"\"{instruction}\"\"\"
-Entrega SOLO el HTML completo, sin markdown ni backticks."""
-
-        code = call_ai_text(prompt, engine=engine) or ""
-        # Strip markdown code fences if present
-        code = code.strip()
-        if code.startswith('```'):
-            first_nl = code.find('\n')
-            if first_nl != -1:
-                code = code[first_nl+1:]
-            if code.endswith('```'):
-                code = code[:-3]
-            code = code.strip()
-
-        if is_html and not code.strip().lower().startswith('<!doctype'):
-            code = f"<!DOCTYPE html>\n{code}"
-
-        safe_name = os.path.basename(filename)
-        project_dir = os.path.join(projects_base_dir, project_id)
-        os.makedirs(project_dir, exist_ok=True)
-        file_path = os.path.join(project_dir, safe_name)
-        with open(file_path, 'w') as f:
-            f.write(code)
-
-        return jsonify({
-            "status": "ok",
-            "code": code,
-            "content": code,
-            "preview_url": f"/projects/{project_id}/index.html"
-        })
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
 
-@app.route('/create-blueprint', methods=['POST'])
-def create_blueprint():
-    try:
-        data = request.json or {}
-        idea = data.get('idea', '')
-        
-        prompt = f"""
-        Act as a Senior Software Architect. User Idea: "{idea}"
-        
-        CRITICAL: WRITE IN THE SAME LANGUAGE AS THE USER'S IDEA.
-        
-        Create a TECHNICAL BLUEPRINT markdown.
-        
-        RETURN JSON:
-        {{
-            "blueprint": "## Plan... (use \\n for newlines)"
-        }}
-        """
-        response = model.generate_content(prompt)
-        result = clean_and_parse_json(response.text)
-        
-        if result: 
-            return jsonify(result)
-        else:
-            return jsonify({"blueprint": "## Error generating blueprint.\nProceeding..."})
-            
-    except Exception as e:
-        print(f"Blueprint Error: {e}")
-        return jsonify({"blueprint": "## Error.\nProceeding..."})
+def _default_build_spec(project_name, theme, plan_content):
+    title = project_name.replace("_", " ").title()
+    return {
+        "title": title,
+        "tagline": (str(plan_content or "").strip()[:160] or f"{title} MVP"),
+        "language": "es",
+        "palette": {"background": "#070c14", "surface": "#111827", "text": "#e5e7eb", "muted": "#9ca3af", "accent": "#22d3ee"},
+        "font": "Inter",
+        "sections": [
+            {"id": "hero", "heading": title, "content": "Propuesta de valor principal."},
+            {"id": "features", "heading": "Funcionalidades", "content": "Tres beneficios clave del producto."},
+            {"id": "cta", "heading": "Comienza hoy", "content": "Llamado a la acción con formulario de contacto."},
+        ],
+        "interactions": [
+            {"element_id": "ctaBtn", "event": "click", "behavior": "Desplaza la página hasta la sección cta."},
+        ],
+    }
 
-@app.route('/generate-plan', methods=['POST'])
-def generate_plan():
-    try:
-        data = request.json or {}
-        business_idea = data.get('idea')
-        if not business_idea: return jsonify({"error": "No idea provided"}), 400
 
+def _generate_build_spec(project_name, theme, plan_content):
+    prompt = f"""
+    You are a senior product engineer planning a small frontend MVP.
+    - project_name: {project_name}
+    - theme: {theme}
+    - plan: {plan_content}
+
+    Produce the shared spec every file will be generated from: title, tagline,
+    language of the copy, palette (hex colors), font, 3-6 sections (id, heading,
+    content summary) and 2-4 interactions (element_id, event, behavior).
+    Ids must be short kebab-case or camelCase HTML ids.
+    """
+    spec = call_ai_json(prompt, schema=BUILD_SPEC_SCHEMA, name="build_spec", timeout_seconds=30)
+    if not isinstance(spec, dict) or not spec.get("sections"):
+        return _default_build_spec(project_name, theme, plan_content)
+    return spec
+
+
+def _validate_build_file(fname, content, spec):
+    errors = []
+    text = content or ""
+    lower = text.lower()
+    if not text.strip():
+        return [f"{fname} vacío"]
+    if fname == "index.html":
+        if "<html" not in lower or "</html>" not in lower:
+            errors.append("index.html incompleto")
+        if "<body" not in lower or "</body>" not in lower:
+            errors.append("index.html sin body")
+        if "styles.css" not in lower or "app.js" not in lower:
+            errors.append("index.html no enlaza styles.css/app.js")
+        missing_ids = [
+            s.get("id") for s in spec.get("sections", [])
+            if s.get("id") and not re.search(r"""id\s*=\s*["']%s["']""" % re.escape(str(s.get("id")).lower()), lower)
+        ]
+        if missing_ids:
+            errors.append(f"secciones faltantes: {', '.join(missing_ids[:5])}")
+    elif fname in ("styles.css", "app.js"):
+        if _brace_depth(text, js=fname == "app.js") != 0:
+            errors.append(f"{fname} con llaves desbalanceadas")
+    return errors
+
+
+def _brace_depth(text, js=False):
+    """{ minus } outside strings and comments (plus template literals and // comments when js)."""
+    depth, i, n = 0, 0, len(text)
+    while i < n:
+        ch = text[i]
+        if ch in ("\"'`" if js else "\"'"):
+            i += 1
+            while i < n and text[i] != ch:
+                i += 2 if text[i] == "\\" else 1
+        elif text.startswith("/*", i):
+            end = text.find("*/", i + 2)
+            i = n if end < 0 else end + 1
+        elif js and text.startswith("//", i):
+            end = text.find("\n", i)
+            i = n if end < 0 else end
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+        i += 1
+    return depth
+
+
+def _generate_build_file(fname, spec, project_name, theme, plan_content):
+    """Returns (content, errors, attempts) for one file, retrying only that file."""
+    spec_json = json.dumps(spec, ensure_ascii=False, indent=2)
+    last_errors = []
+    for attempt in range(1, BUILD_FILE_RETRIES + 2):
+        feedback = f"\nPrevious attempt was rejected: {'; '.join(last_errors)}. Fix it." if last_errors else ""
         prompt = f"""
-        Act as a Senior CTO. Idea: "{business_idea}".
-        
-        CRITICAL: GENERATE THE PLAN IN THE SAME LANGUAGE AS THE IDEA.
-        
-        Return JSON object (ESCAPE NEWLINES inside values!):
-        {{
-            "project_name": "snake_case_name",
-            "plan": "Markdown plan with \\n for newlines"
-        }}
-        """
-        response = model.generate_content(prompt)
-        result = clean_and_parse_json(response.text)
-        
-        if result:
-            return jsonify(result)
-        else:
-            # Fallback Manual Construction if JSON fails entirely
-            return jsonify({
-                "project_name": "project_fallback",
-                "plan": "# Generated Plan\nCheck details..."
-            })
-    except Exception as e:
-        print(f"Generation Error: {e}")
-        return jsonify({"error": "Internal server error"}), 500
+    You are a senior software engineer shipping production-ready MVP scaffolds.
+    Project: {project_name} (theme: {theme})
+    Plan: {str(plan_content or '')[:1500]}
 
-@app.route('/edit-project', methods=['POST'])
-def edit_project():
-    try:
-        data = request.json or {}
-        project_name = str(data.get('project_name') or '').strip()
-        instruction = str(data.get('instruction') or '').strip()
-        user_email = str(data.get('user_email') or '').strip().lower()
-        engine = normalize_engine(data.get('engine'))
-        history = data.get('history') if isinstance(data.get('history'), list) else []
-        image_data_url = data.get('image_data_url', '')
-
-        if not project_name:
-            return jsonify({"error": "project_name is required"}), 400
-        if not instruction:
-            return jsonify({"error": "instruction is required"}), 400
-        # Edición libre — paywall solo al enviar a equipo humano
-        ok_tokens, token_msg, remaining = consume_user_tokens(
-            user_email,
-            CHAT_MESSAGE_TOKEN_COST,
-            reason="aplicar edición con IA"
-        )
-        if not ok_tokens:
-            return jsonify({"error": token_msg, "remaining_tokens": remaining}), 402
+    SHARED SPEC (other files are generated from the same spec in parallel, follow it exactly):
+    {spec_json}
 
-        project_path = os.path.join(projects_base_dir, project_name)
-        if not os.path.isdir(project_path):
-            return jsonify({"error": "Project folder not found"}), 404
-
-        allowed_files = ["index.html", "styles.css", "style.css", "app.js", "script.js"]
-        file_snapshots = {}
-        for fname in allowed_files:
-            fpath = os.path.join(project_path, fname)
-            if os.path.exists(fpath):
-                with open(fpath, 'r', encoding='utf-8') as f:
-                    file_snapshots[fname] = f.read()
-            else:
-                file_snapshots[fname] = ""
-
-        if not any(file_snapshots.values()):
-            return jsonify({"error": "No editable project files found"}), 404
-
-        def _parse_changed_files(ai_payload):
-            if not ai_payload or not isinstance(ai_payload, dict):
-                return "", {}
-            summary_local = str(ai_payload.get("summary") or "Cambios aplicados por IA.").strip()
-            files_obj_local = ai_payload.get("files")
-            if not isinstance(files_obj_local, dict):
-                files_obj_local = {}
-            changed_local = {}
-            for fname in allowed_files:
-                if fname not in files_obj_local:
-                    continue
-                content = files_obj_local.get(fname)
-                if not isinstance(content, str):
-                    continue
-                cleaned = (
-                    content
-                    .replace("```html", "")
-                    .replace("```css", "")
-                    .replace("```javascript", "")
-                    .replace("```js", "")
-                    .replace("```", "")
-                    .strip()
-                )
-                if cleaned:
-                    changed_local[fname] = cleaned
-            return summary_local, changed_local
-
-        def _smoke_checks_for_html(changed_local):
-            checks = []
-            if "index.html" in changed_local:
-                html_out = changed_local["index.html"].lower()
-                checks.extend([
-                    {"name": "html_has_head", "ok": "<head" in html_out and "</head>" in html_out},
-                    {"name": "html_has_body", "ok": "<body" in html_out and "</body>" in html_out},
-                    {"name": "html_closed", "ok": "</html>" in html_out},
-                ])
-            return checks
-
-        build_intent = bool(re.search(
-            r"(crea|créalo|crealo|construye|construyelo|constrúyelo|completo|mvp|full app|aplicacion completa|aplicación completa)",
-            instruction.lower()
+    Write {fname}: {BUILD_FILE_INSTRUCTIONS[fname]}
+    Return ONLY the raw file content, no markdown fences, no explanations.{feedback}
+    """
+        content = _clean_code_block(call_ai_text(
+            prompt,
+            max_tokens_override=AI_EDIT_MAX_TOKENS,
+            timeout_seconds=60,
         ))
-        ui_reference = describe_ui_reference(image_data_url) if image_data_url else ""
-        design_intent = bool(re.search(
-            r"(replica|recrear|inspira|inspirate|inspirar|igual que|como calm|diseñ[oó]|ui|ux|look and feel|layout)",
-            instruction.lower()
-        )) or bool(ui_reference)
-        strict_redesign_mode = build_intent or design_intent
-
-        reference_block = (
-            f"REFERENCIA VISUAL OBLIGATORIA (imagen adjunta):\n{ui_reference}\n"
-            "Debes aproximarte al look&feel de esa referencia en estructura, estilos y jerarquía visual."
-            if ui_reference else
-            "No hay referencia visual adjunta."
-        )
-
-        summary = "Cambios aplicados por IA."
-        changed_files = {}
-        smoke_checks = []
-        last_failure_reason = ""
-        max_attempts = 3
-
-        for attempt in range(1, max_attempts + 1):
-            feedback_block = f"Intento {attempt}/{max_attempts}."
-            if last_failure_reason:
-                feedback_block += f" Error previo a corregir: {last_failure_reason}"
-
-            if strict_redesign_mode:
-                mode_rules = """
-MODO: CONSTRUCCIÓN COMPLETA (no edición mínima).
-- Debes entregar una versión MVP usable y visualmente cuidada.
-- Entrega obligatoria: index.html + styles.css (o style.css) + app.js (o script.js).
-- Debe incluir UI moderna, layout responsive, componentes útiles y al menos 2 interacciones JS reales.
-- Prohibido entregar solo placeholders vacíos o texto genérico.
-- No uses "Coming soon", "TODO", ni secciones vacías.
-"""
+        last_errors = _validate_build_file(fname, content, spec)
+        if not last_errors:
+            return content, [], attempt
+    return None, last_errors, BUILD_FILE_RETRIES + 1
+
+
+def _build_with_ai(project_name, theme, plan_content, report=None):
+    """Returns (files, sources) or (None, {}) when no file could be generated."""
+    spec = _generate_build_spec(project_name, theme, plan_content)
+    if report:
+        report("generating", 30, f"Spec listo ({len(spec.get('sections', []))} secciones). Generando archivos en paralelo.")
+
+    files, sources = {}, {}
+    with ThreadPoolExecutor(max_workers=len(BUILD_FILE_INSTRUCTIONS)) as pool:
+        futures = {
+            pool.submit(_generate_build_file, fname, spec, project_name, theme, plan_content): fname
+            for fname in BUILD_FILE_INSTRUCTIONS
+        }
+        done_count = 0
+        for future in as_completed(futures):
+            fname = futures[future]
+            done_count += 1
+            try:
+                content, errors, attempts = future.result()
+            except Exception as e:
+                content, errors, attempts = None, [str(e)], 0
+            if content:
+                files[fname] = content
+                sources[fname] = "ai"
             else:
-                mode_rules = """
-MODO: EDICIÓN INCREMENTAL.
-- Cambia solo lo necesario para cumplir la instrucción.
-"""
-
-            prompt = f"""
-Eres un Senior Software Engineer. Debes editar un proyecto real con precisión.
-
-PROYECTO: {project_name}
-INSTRUCCIÓN DEL USUARIO: {instruction}
-HISTORIAL RECIENTE: {history[-10:]}
-FEEDBACK DE INTENTOS: {feedback_block}
-{reference_block}
-
-ARCHIVOS ACTUALES:
-index.html:
-{file_snapshots.get('index.html', '')[:15000]}
-
-styles.css:
-{file_snapshots.get('styles.css', '')[:12000]}
-
-style.css:
-{file_snapshots.get('style.css', '')[:12000]}
-
-app.js:
-{file_snapshots.get('app.js', '')[:12000]}
-
-script.js:
-{file_snapshots.get('script.js', '')[:12000]}
-
-REGLAS:
-- Devuelve JSON válido, sin markdown.
-- Mantén funcionalidad existente.
-- Si tocas HTML, debe seguir siendo un documento HTML completo.
-- Puedes devolver uno o varios archivos modificados.
-{mode_rules}
-- Si hay referencia visual adjunta, prioriza reproducir su composición visual sobre estilos previos.
-- Cuando aplique, ajusta también CSS y JS para que el resultado no quede solo en texto plano.
-
-FORMATO OBLIGATORIO:
-{{
-  "summary": "qué se cambió en una frase",
-  "files": {{
-    "index.html": "contenido completo del archivo solo si cambió",
-    "styles.css": "contenido completo si cambió",
-    "style.css": "contenido completo si cambió",
-    "app.js": "contenido completo si cambió",
-    "script.js": "contenido completo si cambió"
-  }}
-}}
-"""
-            ai_payload = call_ai_json(prompt, engine=engine)
-            summary_try, changed_try = _parse_changed_files(ai_payload)
-            checks_try = _smoke_checks_for_html(changed_try)
-            checks_ok = all(c["ok"] for c in checks_try) if checks_try else True
-            css_present = ("styles.css" in changed_try or "style.css" in changed_try)
-            js_present = ("app.js" in changed_try or "script.js" in changed_try)
-
-            if not changed_try:
-                last_failure_reason = "No devolviste cambios de archivos válidos."
-                continue
-            if strict_redesign_mode and "index.html" not in changed_try:
-                last_failure_reason = "Falta index.html completo para modo construcción."
-                continue
-            if strict_redesign_mode and (not css_present or not js_present):
-                last_failure_reason = "En modo construcción debes incluir HTML + CSS + JS."
-                continue
-            if not checks_ok:
-                last_failure_reason = "Los smoke checks de HTML fallaron. Debes devolver un HTML completo válido."
-                continue
+                log_debug(f"[BUILD] {project_name}/{fname} falló tras {attempts} intentos: {errors}")
+            if report:
+                report("generating", 30 + int(20 * done_count / len(futures)), f"{fname} listo.")
+
+    if not files:
+        return None, {}
+    fallback = _build_fallback_files(project_name, theme, plan_content)
+    missing = [fname for fname in BUILD_FILE_INSTRUCTIONS if fname not in files]
+    if any(fname in BUILD_COUPLED_FILES for fname in missing):
+        # Un index.html de la IA con el CSS/JS del fallback (o al revés) sale sin estilos ni eventos.
+        log_debug(f"[BUILD] {project_name}: {', '.join(missing)} inválido(s), fallback para {', '.join(BUILD_COUPLED_FILES)}")
+        missing = sorted(set(missing) | set(BUILD_COUPLED_FILES))
+    for fname in missing:
+        files[fname] = fallback[fname]
+        sources[fname] = "fallback"
+    return files, sources
+
+def _summarize_diff(old_text, new_text):
+    old_lines = (old_text or "").splitlines()
+    new_lines = (new_text or "").splitlines()
+    diff = list(difflib.unified_diff(old_lines, new_lines, lineterm=''))
+    additions = len([l for l in diff if l.startswith('+') and not l.startswith('+++')])
+    deletions = len([l for l in diff if l.startswith('-') and not l.startswith('---')])
+    return additions, deletions
+
+
+def _build_job_view(job):
+    if not job:
+        return None
+    return {
+        "job_id": job.get("id"),
+        "state": job.get("status"),
+        "step": job.get("step"),
+        "progress": job.get("progress"),
+        "message": job.get("message"),
+        "error": job.get("error"),
+        "attempts": job.get("attempts"),
+        "created_at": job.get("created_at"),
+        "finished_at": job.get("finished_at"),
+    }
 
-            # Gate de calidad visual para evitar respuestas "mínimas".
-            if strict_redesign_mode:
-                html_candidate = changed_try.get("index.html", "")
-                if len(html_candidate) < 2800:
-                    last_failure_reason = "La salida fue demasiado simple. Debe ser una UI completa, no un bloque básico."
-                    continue
-                section_count = len(re.findall(r"<section\\b", html_candidate.lower()))
-                if section_count < 3:
-                    last_failure_reason = "Faltan secciones suficientes. Se requieren al menos 3 secciones visibles."
-                    continue
-
-            summary = summary_try or summary
-            changed_files = changed_try
-            smoke_checks = checks_try
-            break
 
-        if not changed_files:
-            if strict_redesign_mode:
-                safe_title = project_name.replace("_", " ").title()
-                fallback_html = f"""<!doctype html>
-<html lang="es">
-<head>
-  <meta charset="utf-8" />
-  <meta name="viewport" content="width=device-width,initial-scale=1" />
-  <title>{safe_title}</title>
-  <link rel="stylesheet" href="./styles.css" />
-</head>
-<body>
-  <header class="topbar">
-    <div class="brand">{safe_title}</div>
-    <nav class="nav">
-      <a href="#inicio">Inicio</a><a href="#beneficios">Beneficios</a><a href="#planes">Planes</a><a href="#faq">FAQ</a>
-    </nav>
-    <button id="ctaTop">Comenzar</button>
-  </header>
-
-  <main>
-    <section id="inicio" class="hero">
-      <h1>Entrena tu concentracion con ciencia y habitos diarios</h1>
-      <p>Rutinas breves, audio guiado y seguimiento real de progreso para estudiantes de 15 a 30 anios.</p>
-      <div class="hero-actions">
-        <button id="ctaHero">Probar ahora</button>
-        <button class="ghost">Ver demo</button>
-      </div>
-    </section>
-
-    <section id="beneficios" class="grid">
-      <article class="card"><h3>Test inicial</h3><p>Evalua foco y distracciones en 3 minutos.</p></article>
-      <article class="card"><h3>Sesiones guiadas</h3><p>Audio de 5-10 min para activar enfoque profundo.</p></article>
-      <article class="card"><h3>Progreso</h3><p>Metricas semanales con objetivos personalizados.</p></article>
-    </section>
-
-    <section id="planes" class="plans">
-      <article class="plan"><h4>Free</h4><p>Funciones base</p></article>
-      <article class="plan featured"><h4>Pro</h4><p>Analitica y sesiones premium</p></article>
-      <article class="plan"><h4>Campus</h4><p>Acceso para instituciones</p></article>
-    </section>
-
-    <section id="faq" class="faq">
-      <h2>Preguntas frecuentes</h2>
-      <details><summary>Cuanto tarda en verse progreso?</summary><p>Entre 2 y 4 semanas con uso constante.</p></details>
-      <details><summary>Funciona en movil?</summary><p>Si, disenado mobile-first.</p></details>
-    </section>
-  </main>
-  <script src="./app.js"></script>
-</body>
-</html>"""
-                fallback_css = """
-:root{--bg:#0b1020;--panel:#111a33;--text:#ecf0ff;--muted:#9fb0da;--accent:#61dafb;--accent2:#7c9cff}
-*{box-sizing:border-box}body{margin:0;font-family:Inter,system-ui,sans-serif;color:var(--text);background:radial-gradient(1200px 600px at 70% -10%,#1a2d5a 0,#0b1020 52%),#0b1020}
-a{color:inherit;text-decoration:none}.topbar{position:sticky;top:0;z-index:20;display:flex;gap:16px;align-items:center;justify-content:space-between;padding:14px 22px;background:rgba(7,10,20,.72);backdrop-filter:blur(10px);border-bottom:1px solid rgba(255,255,255,.08)}
-.brand{font-weight:800}.nav{display:flex;gap:14px;opacity:.9}.nav a{padding:6px 8px;border-radius:8px}.nav a:hover{background:rgba(255,255,255,.08)}
-button{background:linear-gradient(90deg,var(--accent),var(--accent2));border:0;color:#041120;padding:10px 14px;border-radius:10px;font-weight:700;cursor:pointer}
-.ghost{background:transparent;border:1px solid rgba(255,255,255,.25);color:var(--text)}
-main{max-width:1100px;margin:0 auto;padding:26px 18px 50px}.hero{padding:42px 0}.hero h1{font-size:clamp(2rem,4vw,3.6rem);margin:0 0 12px}.hero p{max-width:65ch;color:var(--muted);line-height:1.65}
-.hero-actions{display:flex;gap:10px;margin-top:18px;flex-wrap:wrap}.grid{display:grid;grid-template-columns:repeat(auto-fit,minmax(220px,1fr));gap:14px;margin:18px 0 20px}
-.card,.plan{background:linear-gradient(180deg,rgba(255,255,255,.08),rgba(255,255,255,.03));border:1px solid rgba(255,255,255,.12);border-radius:14px;padding:16px}
-.plans{display:grid;grid-template-columns:repeat(auto-fit,minmax(200px,1fr));gap:12px}.featured{outline:2px solid rgba(97,218,251,.5)}
-.faq{margin-top:26px}.faq h2{margin-top:0}details{background:rgba(255,255,255,.04);border:1px solid rgba(255,255,255,.1);border-radius:10px;padding:10px 12px;margin:8px 0}
-@media (max-width:820px){.nav{display:none}}
-"""
-                fallback_js = """
-const pulse = (id)=>document.getElementById(id)?.addEventListener('click',()=>alert('Perfecto. Siguiente paso: test inicial y onboarding.'));
-pulse('ctaTop'); pulse('ctaHero');
-"""
-                changed_files = {
-                    "index.html": fallback_html,
-                    "styles.css": fallback_css,
-                    "app.js": fallback_js,
-                }
-                smoke_checks = _smoke_checks_for_html(changed_files)
-                summary = "Se aplico un fallback de UI completa (HTML/CSS/JS) porque el motor no devolvio edicion valida."
+def _sync_build_job_to_order(job):
+    """Refleja el progreso del job en order_status (visible en /api/status/<project_id>)."""
+    project_name = job.get("project_id")
+    if not project_name:
+        return
+    state = job.get("status")
+    if state == "completed":
+        # El job ya dejó la orden en 'pending' (cola de ingenieros); solo se guarda el resumen.
+        with _orders_lock:
+            orders = get_orders_map()
+            if project_name in orders:
+                orders[project_name]["build"] = _build_job_view(job)
+                save_orders_map(orders)
+        return
+    if state == "failed":
+        # Un build fallido devuelve lo cobrado; ref por job para no reembolsar dos veces.
+        payload = job.get("payload") or {}
+        charged = int(payload.get("charged_tokens") or 0)
+        if charged > 0 and payload.get("user_email"):
+            refund_user_tokens(payload["user_email"], charged, reason="build fallido", ref=f"build:{job.get('id')}")
+    status = {"queued": "queued", "running": "building", "failed": "build_failed"}.get(state, "building")
+    log_entry = job.get("message") if state == "running" else (
+        f"Build fallido: {job.get('error')}" if state == "failed" else None
+    )
+    update_order_status(project_name, status, log_entry, build=_build_job_view(job))
+
+
+def _run_project_build(job, report):
+    payload = job.get("payload") or {}
+    project_name = payload.get("project_name")
+    plan_content = payload.get("plan")
+    theme = payload.get("theme") or "Modern Startup"
+    user_email = payload.get("user_email")
+
+    project_path = os.path.join(projects_base_dir, project_name)
+    if not os.path.exists(project_path):
+        os.makedirs(project_path)
+
+    # Codex-like build loop: plan -> generate files -> validate -> fallback.
+    report("generating", 20, "Generando spec del proyecto.")
+    files, sources = _build_with_ai(project_name, theme, plan_content, report=report)
+    if not files:
+        files = _build_fallback_files(project_name, theme, plan_content)
+        sources = {fname: "fallback" for fname in files}
+    report("validating", 55, "Validando archivos generados.")
+    validation_errors = _validate_build_files(files)
+    if validation_errors:
+        files = _build_fallback_files(project_name, theme, plan_content)
+        sources = {fname: "fallback" for fname in files}
+        validation_errors = _validate_build_files(files)
+    if validation_errors:
+        raise BuildFailed(f"Build validation failed: {', '.join(validation_errors)}")
+
+    report("writing", 70, "Escribiendo archivos.")
+    # Incremental write: only rewrite files that changed and report the delta.
+    build_report = []
+    for filename, content in files.items():
+        target = os.path.join(project_path, filename)
+        old_content = ""
+        file_status = "created"
+        if os.path.exists(target):
+            with open(target, 'r') as rf:
+                old_content = rf.read()
+            if old_content == content:
+                file_status = "unchanged"
             else:
-                return jsonify({
-                    "error": "No valid file edits returned by AI after retries.",
-                    "detail": last_failure_reason or "Unknown edit failure.",
-                    "remaining_tokens": remaining
-                }), 500
-
-        build_report = []
-        for fname, new_content in changed_files.items():
-            old_content = file_snapshots.get(fname, "")
-            diff = list(difflib.unified_diff(
-                (old_content or "").splitlines(),
-                (new_content or "").splitlines(),
-                lineterm=''
-            ))
-            additions = len([l for l in diff if l.startswith('+') and not l.startswith('+++')])
-            deletions = len([l for l in diff if l.startswith('-') and not l.startswith('---')])
-            status = "updated" if old_content else "created"
-
-            with open(os.path.join(project_path, fname), 'w', encoding='utf-8') as f:
-                f.write(new_content)
-
-            build_report.append({
-                "file": fname,
-                "status": status,
-                "additions": additions,
-                "deletions": deletions
-            })
-
-        return jsonify({
-            "message": "Project updated",
-            "summary": summary,
-            "project_name": project_name,
-            "preview_url": f"/projects/{project_name}/index.html",
-            "changed_files": list(changed_files.keys()),
-            "build_report": build_report,
-            "smoke_checks": smoke_checks,
-            "remaining_tokens": remaining,
-            "engine_used": engine
+                file_status = "updated"
+
+        additions, deletions = _summarize_diff(old_content, content)
+        if file_status != "unchanged":
+            with open(target, 'w') as wf:
+                wf.write(content)
+
+        build_report.append({
+            "file": filename,
+            "status": file_status,
+            "additions": additions,
+            "deletions": deletions,
+            "source": sources.get(filename, "ai")
         })
 
-    except Exception as e:
-        print(f"Edit Error: {e}")
-        return jsonify({"error": "Internal server error"}), 500
-
-# --- ORDER STATUS MANAGER ---
-# Implemented above with normalized status handling and event logs.
-
-@app.route('/api/recharge-tokens', methods=['POST'])
-def recharge_tokens():
-    if _rate_limit(request.remote_addr, max_requests=5, window=60):
-        return jsonify({"error": "Too many attempts. Try again in a minute."}), 429
-
-    if not require_internal_auth():
-        return jsonify({"error": "Unauthorized"}), 401
-
-    try:
-        data = request.json or {}
-        email = data.get('email')
-        plan = data.get('plan_id')
-
-        if not email: return jsonify({"error": "Missing email"}), 400
-
-        tokens_to_add = 0
-        if plan == 'starter': tokens_to_add = 10
-        elif plan == 'pro': tokens_to_add = 50
-        elif plan == 'agency': tokens_to_add = 9999 # Unlimited simulation
-
-        conn = get_db_connection()
-        user = conn.execute('SELECT tokens FROM users WHERE email = ?', (email,)).fetchone()
-
-        if not user:
-            conn.close()
-            return jsonify({"error": "User not found"}), 404
-
-        new_balance = user['tokens'] + tokens_to_add
-        conn.execute(
-            'UPDATE users SET tokens = ?, subscription_active = 1, subscription_plan = ?, subscription_started_at = CURRENT_TIMESTAMP WHERE email = ?',
-            (new_balance, plan or 'starter', email)
-        )
-        conn.commit()
-        conn.close()
-
-        return jsonify({"status": "success", "new_balance": new_balance, "added": tokens_to_add})
-
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
+    build_version = record_project_version(project_name, "build", summary="Initial AI build", author=user_email)
+
+    report("smoke_checks", 85, "Ejecutando smoke checks.")
+    # Mini post-build smoke checks.
+    smoke_checks = []
+    index_path = os.path.join(project_path, "index.html")
+    css_path = os.path.join(project_path, "styles.css")
+    js_path = os.path.join(project_path, "app.js")
+    for fp in [index_path, css_path, js_path]:
+        smoke_checks.append({
+            "name": f"exists::{os.path.basename(fp)}",
+            "ok": os.path.exists(fp)
+        })
 
-@app.route('/create-project', methods=['POST'])
-def create_project():
     try:
-        data = request.json or {}
-        project_name = data.get('project_name')
-        plan_content = data.get('plan')
-        theme = data.get('theme', 'Modern Startup')
-        user_email = data.get('user_email') # Must be sent from frontend
-
-        # Auth: verify session matches requested email
-        session_email = session.get('user_email', '').strip().lower()
-        user_email_clean = (user_email or '').strip().lower()
-        if not session_email or session_email != user_email_clean:
-            return jsonify({"error": "You must be logged in"}), 401
-
-        if not user_email:
-            return jsonify({"error": "You must be logged in"}), 401
-        ok_tokens, token_msg, remaining = consume_build_quota(
-            user_email,
-            project_name,
-            reason="construir proyecto"
-        )
-        if not ok_tokens:
-            return jsonify({"error": token_msg, "remaining_tokens": remaining}), 402
-        
-        def build_fallback_files():
-            safe_name = project_name.replace("_", " ").title()
-            summary = (str(plan_content or "").strip()[:260] or "Proyecto generado por Anmar Engine.")
-            index_html = f"""<!DOCTYPE html>
-<html lang="es">
-<head>
-  <meta charset="UTF-8" />
-  <meta name="viewport" content="width=device-width, initial-scale=1.0" />
-  <title>{safe_name}</title>
-  <link rel="preconnect" href="https://fonts.googleapis.com">
-  <link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>
-  <link href="https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700;800&display=swap" rel="stylesheet">
-  <link rel="stylesheet" href="./styles.css" />
-</head>
-<body>
-  <header class="topbar">
-    <span class="logo">{safe_name}</span>
-    <button id="ctaBtn">Comenzar</button>
-  </header>
-  <main class="container">
-    <section class="hero">
-      <h1>{safe_name}</h1>
-      <p>{summary}</p>
-    </section>
-    <section class="cards">
-      <article class="card"><h3>Valor</h3><p>Propuesta central lista para validar con usuarios.</p></article>
-      <article class="card"><h3>MVP</h3><p>Flujo inicial optimizado para entrega rápida.</p></article>
-      <article class="card"><h3>Siguiente paso</h3><p>Iterar desde feedback real en producción.</p></article>
-    </section>
-  </main>
-  <script src="./app.js"></script>
-</body>
-</html>"""
-            styles_css = """
-:root{--bg:#070c14;--panel:#111827;--text:#e5e7eb;--muted:#9ca3af;--accent:#22d3ee}
-*{box-sizing:border-box}body{margin:0;background:radial-gradient(circle at 20% 20%,#14233e 0,#070c14 55%);color:var(--text);font-family:Inter,system-ui,sans-serif;min-height:100vh}
-.topbar{display:flex;justify-content:space-between;align-items:center;padding:18px 26px;background:rgba(17,24,39,.65);backdrop-filter:blur(12px);border-bottom:1px solid rgba(255,255,255,.08)}
-.logo{font-weight:800;letter-spacing:.2px}button{background:var(--accent);color:#022c3a;border:0;padding:10px 14px;border-radius:10px;font-weight:700;cursor:pointer}
-.container{max-width:1050px;margin:48px auto;padding:0 20px}.hero h1{margin:0 0 12px;font-size:clamp(2rem,4vw,3.4rem)}.hero p{color:var(--muted);line-height:1.6;max-width:75ch}
-.cards{margin-top:30px;display:grid;grid-template-columns:repeat(auto-fit,minmax(220px,1fr));gap:14px}.card{background:rgba(17,24,39,.72);border:1px solid rgba(255,255,255,.08);border-radius:14px;padding:16px}
-.card h3{margin:0 0 8px}.card p{margin:0;color:var(--muted)}
-"""
-            app_js = """
-document.getElementById('ctaBtn')?.addEventListener('click', () => {
-  alert('MVP generado. Continúa iterando desde el chat de ANMAR.');
-});
-"""
-            readme = f"# {safe_name}\n\nProyecto generado por ANMAR en modo builder.\n\n## Theme\n{theme}\n\n## Plan\n{plan_content or 'Sin detalles.'}\n"
-            return {
-                "index.html": index_html,
-                "styles.css": styles_css,
-                "app.js": app_js,
-                "README.md": readme,
-            }
-
-        def clean_code_block(text):
-            if not text:
-                return ""
-            cleaned = str(text).strip()
-            cleaned = cleaned.replace("```html", "").replace("```css", "").replace("```js", "").replace("```javascript", "").replace("```markdown", "").replace("```", "").strip()
-            return cleaned
-
-        def validate_files(file_map):
-            errors = []
-            html = file_map.get("index.html", "")
-            if "<html" not in html.lower() or "</html>" not in html.lower():
-                errors.append("index.html incompleto")
-            if "<body" not in html.lower():
-                errors.append("index.html sin body")
-            if not file_map.get("styles.css", "").strip():
-                errors.append("styles.css vacío")
-            if not file_map.get("app.js", "").strip():
-                errors.append("app.js vacío")
-            return errors
-
-        def build_with_ai():
-            prompt = f"""
-            You are a senior software engineer shipping production-ready MVP scaffolds.
-            Build a small but coherent frontend project for:
-            - project_name: {project_name}
-            - theme: {theme}
-            - plan: {plan_content}
-
-            Return JSON with EXACT keys:
-            {{
-              "index_html": "...full html...",
-              "styles_css": "...full css...",
-              "app_js": "...full js...",
-              "readme_md": "...short markdown..."
-            }}
-            Requirements:
-            - index_html references ./styles.css and ./app.js
-            - modern, responsive, readable UI
-            - no markdown fences inside values
-            """
-            built = call_ai_json(prompt) or {}
-            files = {
-                "index.html": clean_code_block(built.get("index_html", "")),
-                "styles.css": clean_code_block(built.get("styles_css", "")),
-                "app.js": clean_code_block(built.get("app_js", "")),
-                "README.md": clean_code_block(built.get("readme_md", "")),
-            }
-            if any(not v for v in files.values()):
-                return None
-            return files
-
-        if not project_name: return jsonify({"error": "Project name required"}), 400
-        
-        project_path = os.path.join(projects_base_dir, project_name)
-        if not os.path.exists(project_path):
-            os.makedirs(project_path)
-
-        # Codex-like build loop: plan -> generate files -> validate -> fallback.
-        files = build_with_ai() or build_fallback_files()
-        validation_errors = validate_files(files)
-        if validation_errors:
-            files = build_fallback_files()
-            validation_errors = validate_files(files)
-        if validation_errors:
-            return jsonify({"error": f"Build validation failed: {', '.join(validation_errors)}"}), 500
-
-        def summarize_diff(old_text, new_text):
-            old_lines = (old_text or "").splitlines()
-            new_lines = (new_text or "").splitlines()
-            diff = list(difflib.unified_diff(old_lines, new_lines, lineterm=''))
-            additions = len([l for l in diff if l.startswith('+') and not l.startswith('+++')])
-            deletions = len([l for l in diff if l.startswith('-') and not l.startswith('---')])
-            return additions, deletions
-
-        # Incremental write: only rewrite files that changed and report the delta.
-        build_report = []
-        for filename, content in files.items():
-            target = os.path.join(project_path, filename)
-            old_content = ""
-            file_status = "created"
-            if os.path.exists(target):
-                with open(target, 'r') as rf:
-                    old_content = rf.read()
-                if old_content == content:
-                    file_status = "unchanged"
-                else:
-                    file_status = "updated"
-
-            additions, deletions = summarize_diff(old_content, content)
-            if file_status != "unchanged":
-                with open(target, 'w') as wf:
-                    wf.write(content)
-
-            build_report.append({
-                "file": filename,
-                "status": file_status,
-                "additions": additions,
-                "deletions": deletions
-            })
-
-        # Mini post-build smoke checks.
-        smoke_checks = []
-        index_path = os.path.join(project_path, "index.html")
-        css_path = os.path.join(project_path, "styles.css")
-        js_path = os.path.join(project_path, "app.js")
-        for fp in [index_path, css_path, js_path]:
-            smoke_checks.append({
-                "name": f"exists::{os.path.basename(fp)}",
-                "ok": os.path.exists(fp)
-            })
-
-        try:
-            with open(index_path, 'r') as fidx:
-                html_check = fidx.read().lower()
-            smoke_checks.append({"name": "html_has_body", "ok": "<body" in html_check and "</body>" in html_check})
-            smoke_checks.append({"name": "html_links_css", "ok": "styles.css" in html_check})
-            smoke_checks.append({"name": "html_links_js", "ok": "app.js" in html_check})
-        except Exception:
-            smoke_checks.append({"name": "html_readable", "ok": False})
-
-        all_checks_ok = all(c.get("ok") for c in smoke_checks)
-        if not all_checks_ok:
-            failed = [c["name"] for c in smoke_checks if not c.get("ok")]
-            return jsonify({
-                "error": "Build smoke checks failed",
-                "failed_checks": failed,
-                "build_report": build_report
-            }), 500
-            
-        # --- NEW: INITIALIZE ORDER STATUS ---
-        update_order_status(project_name, 'pending', "Proyecto creado e ingresado a la cola de Anmar.")
-        mark_preview_delivered_for_project(user_email, project_name)
-            
-        # --- GENERATE HANDOFF ALERT (POST-PROCESS) ---
-        try:
-            viability_prompt = f"""
-            Analyze project: "{project_name}" based on plan: "{plan_content[:300]}..."
-            RETURN JSON: {{ "summary": "1 sentence executive summary", "score": 85 (0-100 int), "complexity": "High/Med/Low" }}
-            """
-            # Using model.generate_content (assuming 'model' is global per app.py context)
-            v_data = call_ai_json(viability_prompt) or {"summary": "New project created.", "score": 50, "complexity": "Unknown"}
-            
-            # Ensure BASE_DIR is defined or use '.'
-            base = os.getcwd() # Fallback if BASE_DIR not in scope here
-            alerts_dir = os.path.join(base, 'backend')
-            if not os.path.exists(alerts_dir): os.makedirs(alerts_dir)
-            
-            alerts_path = os.path.join(alerts_dir, 'internal_alerts.json')
-            
-            new_alert = {
-                "id": str(uuid.uuid4())[:8],
-                "project_name": project_name,
-                "client": user_name if 'user_name' in locals() else user_email,
-                "summary": v_data.get('summary', 'No summary'),
-                "viability": v_data.get('score', 50),
-                "complexity": v_data.get('complexity', 'Medium'),
-                "timestamp": datetime.now().isoformat(),
-                "updated_at": datetime.now().isoformat(),
-                "status": "pending",
-                "priority": "medium",
-                "sla_due_at": compute_sla_due_at("medium"),
-                "events": [{
-                    "timestamp": datetime.now().isoformat(),
-                    "status": "pending",
-                    "actor": "system",
-                    "message": "Proyecto creado e ingresado a cola interna."
-                }]
-            }
-            
-            current_alerts = []
-            if os.path.exists(alerts_path):
-                with open(alerts_path, 'r') as af:
-                    try: current_alerts = json.load(af)
-                    except Exception: pass
-            
-            current_alerts.insert(0, new_alert)
-            tmp_alerts_path = alerts_path + '.tmp'
-            try:
-                with open(tmp_alerts_path, 'w') as af:
-                    json.dump(current_alerts, af, indent=2)
-                os.replace(tmp_alerts_path, alerts_path)
-            except Exception:
-                if os.path.exists(tmp_alerts_path):
-                    os.remove(tmp_alerts_path)
-                raise
-                
-            print(f"✅ Alert generated for {project_name}")
-
-        except Exception as alert_e:
-            print(f"⚠️ Alert Generation Failed: {alert_e}")
-
-        return jsonify({
-            "message": "Project created",
-            "path": project_path,
-            "builder_mode": "codex_like",
-            "files": list(files.keys()),
-            "build_report": build_report,
-            "smoke_checks": smoke_checks,
-            "remaining_tokens": remaining
+        with open(index_path, 'r') as fidx:
+            html_check = fidx.read().lower()
+        smoke_checks.append({"name": "html_has_body", "ok": "<body" in html_check and "</body>" in html_check})
+        smoke_checks.append({"name": "html_links_css", "ok": "styles.css" in html_check})
+        smoke_checks.append({"name": "html_links_js", "ok": "app.js" in html_check})
+    except Exception:
+        smoke_checks.append({"name": "html_readable", "ok": False})
+
+    all_checks_ok = all(c.get("ok") for c in smoke_checks)
+    if not all_checks_ok:
+        failed = [c["name"] for c in smoke_checks if not c.get("ok")]
+        raise BuildFailed("Build smoke checks failed", result={
+            "failed_checks": failed,
+            "build_report": build_report
         })
 
-    except Exception as e:
-        print(f"Creation Error: {e}")
-        return jsonify({"error": "Internal server error"}), 500
+    update_order_status(project_name, 'pending', "Proyecto creado e ingresado a la cola de Anmar.")
+    mark_preview_delivered_for_project(user_email, project_name)
 
-# --- MARKETING MODULE ---
-@app.route('/api/generate-marketing', methods=['POST'])
-def generate_marketing():
+    # --- GENERATE HANDOFF ALERT (POST-PROCESS) ---
     try:
-        data = request.json or {}
-        project_name = data.get('project_name')
-        focus = data.get('focus', 'Conversion') # Brand Awareness, Conversion, Retention
-        
-        # Context from Project Name (Simulating read of project content)
+        viability_prompt = f"""
+        Analyze project: "{project_name}" based on plan: "{plan_content[:300]}..."
+        RETURN JSON: {{ "summary": "1 sentence executive summary", "score": 85 (0-100 int), "complexity": "High/Med/Low" }}
+        """
+        # Using model.generate_content (assuming 'model' is global per app.py context)
+        v_data = call_ai_json(viability_prompt, schema=VIABILITY_SCHEMA, name="viability") or {"summary": "New project created.", "score": 50, "complexity": "Unknown"}
         
-        prompt = f"""
-        ACT AS A LEGENDARY CREATIVE DIRECTOR (Ogilvy/Draper style).
-        Project: {project_name}
-        Goal: {focus}
+        # Ensure BASE_DIR is defined or use '.'
+        base = os.getcwd() # Fallback if BASE_DIR not in scope here
+        alerts_dir = os.path.join(base, 'backend')
+        if not os.path.exists(alerts_dir): os.makedirs(alerts_dir)
         
-        TASK:
-        Generate the "Base Assets" for a high-performance campaign.
+        alerts_path = os.path.join(alerts_dir, 'internal_alerts.json')
         
-        RETURN JSON:
-        {{
-            "strategy_hook": "A one-sentence powerful hook defining the campaign.",
-            "target_audience": "Specific user persona description.",
-            "ads": [
-                {{
-                    "platform": "Instagram/TikTok Reels",
-                    "concept": "Visual description of the video",
-                    "script": "Voiceover script 15s"
-                }},
-                {{
-                    "platform": "LinkedIn/Twitter",
-                    "concept": "Text-based value proposition",
-                    "copy": "The actual post text"
-                }}
-            ],
-            "visual_direction": "Moodboard description (colors, vibe) for human designers."
-        }}
-        """
+        new_alert = {
+            "id": str(uuid.uuid4())[:8],
+            "project_name": project_name,
+            "client": user_name if 'user_name' in locals() else user_email,
+            "summary": v_data.get('summary', 'No summary'),
+            "viability": v_data.get('score', 50),
+            "complexity": v_data.get('complexity', 'Medium'),
+            "timestamp": datetime.now().isoformat(),
+            "updated_at": datetime.now().isoformat(),
+            "status": "pending",
+            "priority": "medium",
+            "sla_due_at": compute_sla_due_at("medium"),
+            "events": [{
+                "timestamp": datetime.now().isoformat(),
+                "status": "pending",
+                "actor": "system",
+                "message": "Proyecto creado e ingresado a cola interna."
+            }]
+        }
         
-        model_response = model.generate_content(prompt)
-        campaign = clean_and_parse_json(model_response.text)
+        current_alerts = []
+        if os.path.exists(alerts_path):
+            with open(alerts_path, 'r') as af:
+                try: current_alerts = json.load(af)
+                except Exception: pass
         
-        if not campaign:
-            return jsonify({"error": "Failed to generate campaign"}), 500
+        current_alerts.insert(0, new_alert)
+        tmp_alerts_path = alerts_path + '.tmp'
+        try:
+            with open(tmp_alerts_path, 'w') as af:
+                json.dump(current_alerts, af, indent=2)
+            os.replace(tmp_alerts_path, alerts_path)
+        except Exception:
+            if os.path.exists(tmp_alerts_path):
+                os.remove(tmp_alerts_path)
+            raise
             
-        return jsonify(campaign)
+        print(f"✅ Alert generated for {project_name}")
 
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
+    except Exception as alert_e:
+        print(f"⚠️ Alert Generation Failed: {alert_e}")
 
-# --- ADMIN COMMAND CENTER ENDPOINTS ---
-@app.route('/api/admin/alerts', methods=['GET'])
-def get_admin_alerts():
-    if not require_internal_auth():
-        return jsonify({"error": "unauthorized"}), 401
-    alerts = [normalize_ticket_status(a) for a in load_alerts()]
-    alerts.sort(key=lambda a: a.get("updated_at", a.get("timestamp", "")), reverse=True)
-    return jsonify(alerts)
+    return {
+        "message": "Project created",
+        "path": project_path,
+        "builder_mode": "codex_like",
+        "files": list(files.keys()),
+        "build_report": build_report,
+        "smoke_checks": smoke_checks,
+        "version": build_version["version"] if build_version else None,
+    }
 
-@app.route('/api/admin/reclaim', methods=['POST'])
-def reclaim_project():
-    if not require_internal_auth():
-        return jsonify({"error": "unauthorized"}), 401
-    try:
-        data = request.json or {}
-        full_project_name = data.get('project_id') # Usually full path or name
-        engineer = data.get('engineer', 'Maria')
-        
-        # Parse project name from path if needed, or use as ID
-        # The alerts usually store "project_path"
-        
-        alerts = load_alerts()
-        if not alerts:
-            return jsonify({"error": "No alerts file"}), 404
-            
-        updated = False
-        for alert in alerts:
-            # Match by project name or checking if path contains ID
-            if alert.get('project_name') == full_project_name or full_project_name in alert.get('project_path', ''):
-                alert['status'] = 'accepted'
-                alert['engineer'] = engineer
-                alert['assigned_at'] = datetime.now().isoformat()
-                append_ticket_event(alert, "accepted", status_message("accepted", engineer=engineer, project_id=alert.get("project_name")), actor=engineer)
-                update_order_status(
-                    alert.get("project_name"),
-                    "accepted",
-                    log_entry=f"{engineer} took the project from admin reclaim.",
-                    engineer=engineer
-                )
-                updated = True
-                break
-        
-        if updated:
-            save_alerts(alerts)
-            return jsonify({"status": "success", "message": f"Project assigned to {engineer}"})
-        else:
-            return jsonify({"error": "Project not found"}), 404
 
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
+build_jobs.register("project_build", _run_project_build)
+build_jobs.on_update(_sync_build_job_to_order)
+# Reanuda jobs pendientes de un reinicio; enqueue() también arranca el pool.
+startup.register("build_jobs", build_jobs.start)
+
 
 # --- ORDER STATUS MANAGER ---
 # Implemented above with normalized status handling and event logs.
 
 # --- ENDPOINTS ---
 
-@app.route('/api/status/<project_id>', methods=['GET'])
-def check_status(project_id):
-    status = get_order_status(project_id)
-    if not status:
-        return jsonify({"status": "unknown"}), 404
-    return jsonify(status)
-
-@app.route('/api/claim-task', methods=['POST'])
-def claim_task():
-    try:
-        data = request.json or {}
-        project_id = data.get('project_id')
-        engineer = data.get('engineer', 'Maria')
-        
-        if not project_id:
-            return jsonify({"error": "Missing project_id"}), 400
-
-        # Update alerts + order status
-        alerts = load_alerts()
-        ticket = next((a for a in alerts if a.get("project_name") == project_id), None)
-        if ticket:
-            ticket["status"] = "accepted"
-            ticket["engineer"] = engineer
-            ticket["updated_at"] = datetime.now().isoformat()
-            append_ticket_event(ticket, "accepted", status_message("accepted", engineer=engineer, project_id=project_id), actor=engineer)
-            save_alerts(alerts)
-
-        update_order_status(project_id, 'accepted', f"Ingeniero {engineer} asignado al proyecto.", engineer=engineer)
-        update_order_status(project_id, 'developing', "Desarrollo en curso.", engineer=engineer)
-        
-        return jsonify({"status": "success", "message": f"Project {project_id} claimed by {engineer}"})
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-@app.route('/api/deliver-work', methods=['POST'])
-def deliver_work():
-    try:
-        data = request.json or {}
-        project_id = data.get('project_id')
-        code = data.get('code')
-        
-        if not project_id or not code:
-            return jsonify({"error": "Missing data"}), 400
-
-        # 1. Update File System
-        project_dir = os.path.join(projects_base_dir, project_id)
-        if not os.path.exists(project_dir):
-            return jsonify({"error": "Project dir not found"}), 404
-            
-        index_path = os.path.join(project_dir, 'index.html')
-        with open(index_path, 'w', encoding='utf-8') as f:
-            f.write(code)
-            
-        # 2. Update Alert Status
-        alerts = load_alerts()
-        for alert in alerts:
-            if alert.get('project_name') == project_id:
-                alert['status'] = 'completed'
-                alert['delivered_at'] = datetime.now().isoformat()
-                alert['updated_at'] = datetime.now().isoformat()
-                append_ticket_event(alert, "completed", status_message("completed", project_id=project_id), actor="engineer")
-                break
-        save_alerts(alerts)
-
-        update_order_status(
-            project_id,
-            "completed",
-            log_entry="Code delivered from /api/deliver-work.",
-            deployed_url=f"/projects/{project_id}/index.html"
-        )
-                
-        return jsonify({"status": "completed", "message": "Code updated and pushed to production."})
-
-    except Exception as e:
-        print(f"Delivery Error: {e}")
-        return jsonify({"error": "Internal server error"}), 500
-    return jsonify([])
-
-@app.route('/api/admin/system-status', methods=['GET'])
-def get_system_status():
-    if not require_internal_auth():
-        return jsonify({"error": "unauthorized"}), 401
-    import random
-    return jsonify({
-        "george_status": random.choice(["Free", "Busy", "Designing"]),
-        "julian_status": random.choice(["Coding", "Reviewing", "Free"]),
-        "server_load": f"{random.randint(10, 80)}%"
-    })
-
-# File Management Routes
-@app.route('/list-projects', methods=['GET'])
-def list_projects():
-    try:
-        if not os.path.exists(projects_base_dir):
-            return jsonify([])
-        projects = [
-            name for name in os.listdir(projects_base_dir)
-            if os.path.isdir(os.path.join(projects_base_dir, name)) and not name.startswith('.')
-        ]
-        email = str(request.args.get('email') or '').strip().lower()
-        if email:
-            owners = load_project_owners()
-            meta = load_project_meta()
-            # Legacy fallback: if there is exactly one project and no owners yet, assign it.
-            if not owners and len(projects) == 1:
-                owners[projects[0]] = email
-                save_project_owners(owners)
-            filtered = []
-            for p in projects:
-                owner = owners.get(p) or (meta.get(p, {}).get('owner') if isinstance(meta, dict) else None)
-                if owner == email:
-                    filtered.append(p)
-            return jsonify(filtered)
-        return jsonify(projects)
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-@app.route('/api/projects-meta', methods=['GET'])
-def projects_meta():
-    try:
-        email = str(request.args.get('email') or '').strip().lower()
-        meta = load_project_meta()
-        if not email:
-            return jsonify(meta)
-        owners = load_project_owners()
-        filtered = {}
-        for project, owner in owners.items():
-            if owner == email and project in meta:
-                filtered[project] = meta.get(project)
-        return jsonify(filtered)
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-@app.route('/delete-project', methods=['POST'])
-def delete_project():
-    try:
-        data = request.json or {}
-        project_name = sanitize_project_name(data.get('project_name', ''))
-        user_email = str(data.get('user_email') or '').strip().lower()
-        if not project_name:
-            return jsonify({"error": "project_name is required"}), 400
-        if user_email:
-            owners = load_project_owners()
-            owner = owners.get(project_name)
-            if owner and owner != user_email:
-                return jsonify({"error": "You do not have permission to delete this project."}), 403
-        project_path = os.path.join(projects_base_dir, project_name)
-        if not os.path.abspath(project_path).startswith(os.path.abspath(projects_base_dir)):
-            return jsonify({"error": "Invalid project path"}), 403
-        if os.path.exists(project_path):
-            shutil.rmtree(project_path)
-            if user_email:
-                owners = load_project_owners()
-                if owners.get(project_name) == user_email:
-                    owners.pop(project_name, None)
-                    save_project_owners(owners)
-            meta = load_project_meta()
-            if project_name in meta:
-                meta.pop(project_name, None)
-                save_project_meta(meta)
-            return jsonify({"message": "Deleted", "project_name": project_name})
-        return jsonify({"error": "Not found"}), 404
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-
 def sanitize_project_name(raw_name):
     base = (raw_name or "").strip().lower()
     base = re.sub(r'[^a-z0-9_\-\s]', '', base)
@@ -6628,137 +4476,49 @@ def sanitize_project_name(raw_name):
     return base[:80]
 
 
-@app.route('/api/create-empty-project', methods=['POST'])
-def create_empty_project():
-    try:
-        data = request.json or {}
-        raw_name = data.get('project_name', '')
-        user_email = str(data.get('user_email') or '').strip().lower()
-        phone = str(data.get('phone') or '').strip()
-        if not user_email:
-            return jsonify({"error": "login_required"}), 401
-        project_name = sanitize_project_name(raw_name)
-        project_path = os.path.join(projects_base_dir, project_name)
-
-        if os.path.exists(project_path):
-            # Si el proyecto ya existe y le pertenece al mismo usuario, retornarlo como éxito
-            owners = load_project_owners()
-            existing_owner = owners.get(project_name, '')
-            if existing_owner == user_email:
-                return jsonify({"project_name": project_name, "project_id": project_name, "resumed": True}), 200
-            return jsonify({"error": "That project name is already taken. Please choose a different name."}), 409
-
-        os.makedirs(project_path, exist_ok=True)
-
-        # Save owner mapping
-        if user_email:
-            owners = load_project_owners()
-            owners[project_name] = user_email
-            save_project_owners(owners)
-
-        # Save metadata (phone, owner, description, wizard fields)
-        description = str(data.get('description') or '').strip()[:500]
-        project_type = str(data.get('project_type') or '').strip()[:100]
-        business_model = str(data.get('business_model') or '').strip()[:100]
-        stage = str(data.get('stage') or '').strip()[:100]
-        meta = load_project_meta()
-        meta[project_name] = {
-            "phone": phone,
-            "owner": user_email,
-            "description": description,
-            "project_type": project_type,
-            "business_model": business_model,
-            "stage": stage,
-            "created_at": datetime.utcnow().isoformat()
-        }
-        save_project_meta(meta)
-
-        starter_html = f"""<!DOCTYPE html>
-<html lang="es">
-<head>
-  <meta charset="UTF-8" />
-  <meta name="viewport" content="width=device-width, initial-scale=1.0" />
-  <title>{project_name}</title>
-  <style>
-    body {{
-      margin: 0;
-      min-height: 100vh;
-      display: grid;
-      place-items: center;
-      font-family: Inter, system-ui, -apple-system, sans-serif;
-      background: #0b0f14;
-      color: #e5e7eb;
-    }}
-    .card {{
-      border: 1px solid rgba(255,255,255,0.15);
-      border-radius: 12px;
-      padding: 24px;
-      max-width: 720px;
-      width: calc(100% - 48px);
-      background: rgba(255,255,255,0.03);
-    }}
-    h1 {{ margin: 0 0 10px; font-size: 1.4rem; }}
-    p {{ margin: 0; opacity: .85; line-height: 1.5; }}
-  </style>
-</head>
-<body>
-  <section class="card">
-    <h1>{project_name}</h1>
-    <p>Proyecto creado. Ve al chat de ANMAR y describe tu visión para generar la primera versión.</p>
-  </section>
-</body>
-</html>
-"""
-        with open(os.path.join(project_path, 'index.html'), 'w', encoding='utf-8') as f:
-            f.write(starter_html)
-
-        # SMS notifications for new project
-        def _sms_project():
-            display = project_name.replace('_', ' ').title()
-            # SMS to client
-            if phone:
-                _send_sms(
-                    to_phone=phone,
-                    body=f"Hi! Your project \"{display}\" has been created on Anmar Enterprises. Our team will start working on it shortly. Reply STOP to unsubscribe."
-                )
-            # SMS to admin
-            if TWILIO_ADMIN_PHONE:
-                _send_sms(
-                    to_phone=TWILIO_ADMIN_PHONE,
-                    body=f"🚀 New project created!\nProject: {display}\nOwner: {user_email}\nPhone: {phone or 'not provided'}\nType: {project_type or 'N/A'}\nStage: {stage or 'N/A'}"
-                )
-        threading.Thread(target=_sms_project, daemon=True).start()
-
-        return jsonify({
-            "status": "ok",
-            "project_name": project_name,
-            "preview_url": f"/projects/{project_name}/index.html"
-        })
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
+# Preview: ETag = versión del proyecto (project_store), 304 sin tocar disco y
+# variantes .gz/.br generadas en build/edición. Con ANMAR_PREVIEW_OFFLOAD el
+# envío del archivo lo hace el proxy:
+#   x-accel    -> X-Accel-Redirect: <ANMAR_PREVIEW_ACCEL_PREFIX>/<ruta> (nginx internal location, gzip_static on)
+#   x-sendfile -> X-Sendfile: <ruta absoluta> (Apache mod_xsendfile / lighttpd)
+PREVIEW_OFFLOAD = os.getenv("ANMAR_PREVIEW_OFFLOAD", "").strip().lower()
+PREVIEW_ACCEL_PREFIX = os.getenv("ANMAR_PREVIEW_ACCEL_PREFIX", "/_protected_projects").rstrip("/")
+PREVIEW_CACHE_CONTROL = "no-cache"
 
-@app.route('/api/delete-all-projects', methods=['POST'])
-def delete_all_projects():
-    if _rate_limit(request.remote_addr, max_requests=2, window=60):
-        return jsonify({"error": "Too many attempts."}), 429
+def _preview_etag(project_name, filename, full_path, encoding):
+    version = project_store.current_version(project_name)
     try:
-        if not os.path.exists(projects_base_dir):
-            return jsonify({"status": "ok", "deleted": 0})
-        deleted = 0
-        for name in os.listdir(projects_base_dir):
-            path = os.path.join(projects_base_dir, name)
-            if os.path.isdir(path) and not name.startswith('.'):
-                shutil.rmtree(path)
-                deleted += 1
-        return jsonify({"status": "ok", "deleted": deleted})
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
+        stat = os.stat(full_path)
+    except OSError:
+        return None
+    # El tamaño/mtime cubre archivos cambiados fuera del flujo versionado (uploads manuales).
+    raw = f"{project_name}:{version}:{filename}:{stat.st_size}:{stat.st_mtime_ns}"
+    digest = hashlib.sha256(raw.encode('utf-8')).hexdigest()[:16]
+    return f'"v{version or 0}-{digest}-{encoding or "identity"}"'
 
-@app.route('/projects/<path:filename>')
-def serve_projects(filename):
-    # Serve files from generated projects
-    return send_from_directory(projects_base_dir, filename)
+def _etag_matches(header_value, etag):
+    if not header_value or not etag:
+        return False
+    if header_value.strip() == '*':
+        return True
+    candidates = [t.strip() for t in header_value.split(',')]
+    return any(c == etag or c == f'W/{etag}' for c in candidates)
+
+# ── PROJECT EXPORT / IMPORT (streaming archives, see project_archive.py) ──
+def _export_response(names, fmt, download_name):
+    meta = load_project_meta()
+    owners = {name: project_index.owner_of(name) for name in names}
+    manifest = project_archive.build_manifest(names, owners, meta)
+    stream = project_archive.export_stream(projects_base_dir, names, manifest, fmt)
+    extension = 'zip' if fmt == 'zip' else 'tar.gz'
+    return Response(
+        stream_with_context(stream),
+        mimetype='application/zip' if fmt == 'zip' else 'application/gzip',
+        headers={
+            'Content-Disposition': f'attachment; filename="{download_name}.{extension}"',
+            'Cache-Control': 'no-store',
+        },
+    )
 
 # --- CHAT & REFINE ENDPOINT ---
 # --- DEBUG LOGGER ---
@@ -6838,561 +4598,87 @@ def generate_contextual_options(missing_fields, phase, lang, memory=None):
 
     return []
 
-@app.route('/api/continue-chat', methods=['POST'])
-def continue_chat():
-    try:
-        data = request.json or {}
-        history = trim_history_after_last_reset(data.get('history', []))
-        current_input = data.get('message', '').strip()
-        image_data_url = data.get('image_data_url', '')
-        engine = normalize_engine(data.get('engine'))
-        user_email = (data.get('user_email') or '').strip().lower()
-        project_name = (data.get('project_name') or '').strip().lower()
-
-        # Auth: verify session matches requested email
-        session_email = session.get('user_email', '').strip().lower()
-        if not session_email or session_email != user_email:
-            return jsonify({"error": "You must be logged in"}), 401
-
-        if not user_email:
-            return jsonify({"error": "login_required"}), 401
-        if not project_name:
-            return jsonify({"error": "project_required"}), 400
-        image_context = describe_image_for_chat(image_data_url) if image_data_url else ""
-        enriched_input = current_input
-        if image_context:
-            enriched_input = f"{current_input}\n\nAttached image context:\n{image_context}".strip()
-        elif image_data_url and not current_input:
-            enriched_input = "The user attached an image. Analyze the visual context and continue the brief."
-
-        if not enriched_input:
-            return jsonify({"error": "message is required"}), 400
-        remaining = get_user_token_balance(user_email) if user_email else None
-        if has_reset_intent(current_input):
-            if user_email:
-                save_chat_memory(
-                    user_email,
-                    reset_memory_payload(get_chat_memory(user_email, project_name=project_name) or {}),
-                    project_name=project_name
-                )
-            return jsonify({
-                "ai_reply": "Done. Context reset. Let's start fresh. What product would you like to build now?",
-                "ready_to_build": False,
-                "missing_fields": ["summary", "audience", "business_model", "timeline", "features"]
-            })
-
-        full_history = history + [{"role": "user", "content": enriched_input}]
-        existing_memory = None
-        if user_email:
-            stored = get_chat_memory(user_email, project_name=project_name) or {}
-            existing_memory = stored.get("agent_memory") if isinstance(stored, dict) else None
-
-        analysis = analyze_turn_state(full_history, enriched_input, existing_memory=existing_memory)
-        reply = compose_consultant_reply(analysis, enriched_input, full_history, engine=engine)
-
-        if user_email:
-            to_store = get_chat_memory(user_email, project_name=project_name) or {}
-            to_store["agent_memory"] = analysis["memory"]
-            to_store["summary"] = analysis["memory"].get("summary", "")
-            to_store["audience"] = analysis["memory"].get("audience", "")
-            to_store["business_model"] = analysis["memory"].get("business_model", "")
-            to_store["timeline"] = analysis["memory"].get("timeline", "")
-            to_store["engine_preference"] = engine
-            save_chat_memory(user_email, to_store, project_name=project_name)
-
-        lang = detect_language(current_input)
-        options = generate_contextual_options(
-            analysis["missing_fields"],
-            analysis.get("phase", "initial"),
-            lang,
-            analysis["memory"]
-        )
-
-        return jsonify({
-            "ai_reply": reply,
-            "ready_to_build": analysis["ready_to_build"],
-            "ready_by_data": analysis.get("ready_by_data", False),
-            "missing_fields": analysis["missing_fields"],
-            "brief_score": compute_brief_score(analysis.get("missing_fields", [])),
-            "remaining_tokens": remaining,
-            "memory_summary": analysis["memory"].get("summary", ""),
-            "memory_snapshot": {
-                "audience": analysis["memory"].get("audience", ""),
-                "business_model": analysis["memory"].get("business_model", ""),
-                "timeline": analysis["memory"].get("timeline", ""),
-                "features": analysis["memory"].get("features", []),
-            },
-            "engine_used": engine,
-            "options": options
-        })
-        
-    except Exception as e:
-        print(f"SERVER ERROR: {e}")
-        return jsonify({"error": "Internal server error"}), 500
-
-@app.route('/api/continue-marketing', methods=['POST'])
-def continue_marketing():
-    try:
-        data = request.json or {}
-        history = trim_history_after_last_reset(data.get('history', []))
-        current_input = str(data.get('message', '') or '').strip()
-        image_data_url = data.get('image_data_url', '')
-        user_email = (data.get('user_email') or '').strip().lower()
-        project_name = (data.get('project_name') or '').strip().lower()
-        construction_context = str(data.get('construction_context') or '').strip()
-        bootstrap = bool(data.get('bootstrap'))
-        channel = str(data.get('channel') or 'marketing').strip().lower()
-        if not user_email:
-            return jsonify({"error": "login_required"}), 401
-        if not project_name:
-            return jsonify({"error": "project_required"}), 400
-        if not current_input and not image_data_url and not construction_context:
-            return jsonify({"error": "message is required"}), 400
-
-        image_context = describe_image_for_chat(image_data_url) if image_data_url else ""
-        enriched_input = current_input
-        if image_context:
-            enriched_input = f"{current_input}\n\nContexto de imagen adjunta:\n{image_context}".strip()
-        elif image_data_url and not current_input:
-            enriched_input = "El usuario adjunto una imagen. Describe su contexto y sugiere activos de marketing."
-        if not enriched_input and construction_context:
-            enriched_input = "Inicia la estrategia de marketing con el contexto de construcción."
-
-        if has_reset_intent(current_input):
-            if user_email:
-                save_chat_memory(
-                    user_email,
-                    reset_memory_payload(get_chat_memory(user_email, project_name=project_name) or {}),
-                    project_name=project_name
-                )
-            return jsonify({
-                "ai_reply": "Contexto de marketing reiniciado. Definamos objetivo, audiencia y oferta.",
-                "missing_fields": MARKETING_REQUIRED_FIELDS,
-                "brief_score": 0,
-                "ready_for_handoff": False,
-                "marketing_brief": {}
-            })
-
-        history_text = "\n".join(
-            [f"{m.get('role', 'user')}: {m.get('content', '')}" for m in history[-12:] if isinstance(m, dict)]
-        )
-
-        context_block = f"Contexto de construcción:\n{construction_context}\n" if construction_context else ""
-        bootstrap_block = "INSTRUCCION: Comienza con propuesta directa. Primera linea debe mencionar que ya se esta construyendo el proyecto y que ahora toca marketing. No hagas preguntas en la primera respuesta.\n" if bootstrap else ""
-
-        # Channel-specific system instructions
-        channel_instructions = {
-            'organic': "CANAL: Contenido Orgánico. Enfócate en estrategia de contenido NO PAGO: posts, reels, stories, blogs, SEO, community management. NO incluir pauta pagada, CPC o presupuesto de ads. Los campos clave son: goal, audience, platforms, content_pillars, posting_frequency, brand_voice, key_topics.",
-            'capital': "CANAL: Inversión y Capital. Enfócate en preparar pitch deck, modelo de negocio, métricas de tracción, estrategia de levantamiento de capital, valuación. Los campos clave son: funding_stage, amount_needed, business_model, revenue, traction, use_of_funds, timeline.",
-            'marketing': ""
-        }
-        channel_block = channel_instructions.get(channel, '') + "\n" if channel_instructions.get(channel) else ""
-
-        prompt = f"""
-Proyecto: {project_name}
-{channel_block}{context_block}{bootstrap_block}
-Conversacion previa:
-{history_text}
-
-Mensaje actual:
-{enriched_input}
-
-Devuelve SOLO JSON valido con esta estructura:
-{{
-  "reply": "Respuesta corta y directa en espanol, con la siguiente pregunta o confirmacion.",
-  "brief": {{
-    "goal": "Objetivo de campana",
-    "audience": "Audiencia ideal",
-    "offer": "Oferta o propuesta de valor",
-    "channels": ["Instagram", "TikTok", "YouTube", "Facebook", "Google Ads", "LinkedIn", "X", "Pinterest"],
-    "budget": "Presupuesto o rango",
-    "timeline": "Timeline o fecha",
-    "brand_voice": "Tono de marca",
-    "key_message": "Mensaje principal"
-  }},
-  "preview_assets": [
-    {{
-      "platform": "Instagram",
-      "format": "Reel",
-      "hook": "Hook de 1 linea",
-      "caption": "Copy de 1-2 lineas",
-      "cta": "CTA",
-      "hashtags": ["#hashtag"],
-      "metrics": {{"views": 12000, "ctr": 1.8, "cpc": 0.6}}
-    }},
-    {{
-      "platform": "TikTok",
-      "format": "Short",
-      "hook": "...",
-      "caption": "...",
-      "cta": "...",
-      "hashtags": ["#hashtag"],
-      "metrics": {{"views": 18000, "ctr": 2.1, "cpc": 0.5}}
-    }},
-    {{
-      "platform": "YouTube",
-      "format": "Shorts",
-      "hook": "...",
-      "caption": "...",
-      "cta": "...",
-      "hashtags": ["#hashtag"],
-      "metrics": {{"views": 14000, "ctr": 1.6, "cpc": 0.7}}
-    }},
-    {{
-      "platform": "Facebook",
-      "format": "Ad",
-      "hook": "...",
-      "caption": "...",
-      "cta": "...",
-      "hashtags": ["#hashtag"],
-      "metrics": {{"views": 11000, "ctr": 1.4, "cpc": 0.8}}
-    }},
-    {{
-      "platform": "Google Ads",
-      "format": "Search",
-      "hook": "...",
-      "caption": "...",
-      "cta": "...",
-      "hashtags": ["#hashtag"],
-      "metrics": {{"views": 9000, "ctr": 2.3, "cpc": 1.1}}
-    }},
-    {{
-      "platform": "LinkedIn",
-      "format": "Sponsored",
-      "hook": "...",
-      "caption": "...",
-      "cta": "...",
-      "hashtags": ["#hashtag"],
-      "metrics": {{"views": 7000, "ctr": 1.2, "cpc": 1.4}}
-    }},
-    {{
-      "platform": "X",
-      "format": "Thread",
-      "hook": "...",
-      "caption": "...",
-      "cta": "...",
-      "hashtags": ["#hashtag"],
-      "metrics": {{"views": 8000, "ctr": 1.1, "cpc": 0.9}}
-    }},
-    {{
-      "platform": "Pinterest",
-      "format": "Pin",
-      "hook": "...",
-      "caption": "...",
-      "cta": "...",
-      "hashtags": ["#hashtag"],
-      "metrics": {{"views": 6000, "ctr": 1.0, "cpc": 0.7}}
-    }}
-  ],
-  "ready_for_handoff": false,
-  "next_step": "Proxima accion sugerida"
-}}
-"""
-
-        def _marketing_ai_payload():
-            text = None
-            parsed_local = None
-            # Marketing JSON es grande: usar max_tokens elevado y timeout mayor
-            MARKETING_MAX_TOKENS = 4096
-            if ANTHROPIC_API_KEY:
-                text = call_anthropic_text(
-                    prompt,
-                    system_prompt=MARKETING_SYSTEM_INSTRUCTION_TEXT,
-                    timeout_seconds=45,
-                    max_tokens_override=MARKETING_MAX_TOKENS,
-                )
-                if text:
-                    parsed_local = clean_and_parse_json(text)
-            else:
-                text = call_ai_text(prompt) or ""
-                parsed_local = clean_and_parse_json(text) if text else None
-            return parsed_local, text
-
-        try:
-            parsed, raw_text = _marketing_ai_payload()
-        except Exception as e:
-            return jsonify({"error": "ai_runtime_error", "detail": "Error en el motor de IA"}), 502
-        if not isinstance(parsed, dict):
-            # Fallback to raw text if JSON parse fails.
-            reply = str(raw_text or "").strip()
-            if not reply:
-                reply = "Estoy listo para ayudarte con tu estrategia de marketing. ¿Cuál es tu objetivo principal con esta campaña?"
-            return jsonify({
-                "ai_reply": reply[:1400],
-                "missing_fields": MARKETING_REQUIRED_FIELDS,
-                "brief_score": 0,
-                "ready_for_handoff": False,
-                "marketing_brief": {},
-                "preview_assets": []
-            })
-        reply = str(parsed.get("reply") or parsed.get("next_step") or "").strip()
-        if not reply:
-            return jsonify({"error": "ai_empty_reply"}), 502
-        brief = normalize_marketing_brief(parsed.get("brief", {}))
-        preview_assets = parsed.get("preview_assets") if isinstance(parsed.get("preview_assets"), list) else []
-        missing_fields = compute_marketing_missing(brief)
-        brief_score = compute_marketing_score(missing_fields)
-        ready_for_handoff = bool(parsed.get("ready_for_handoff")) or (len(missing_fields) == 0)
-        confirm_intent = any(k in (current_input or "").lower() for k in ["si", "sí", "yes", "ok", "listo", "confirmo", "confirmar", "de acuerdo", "dale", "envia", "envía"])
-        auto_handoff = bool(confirm_intent and ready_for_handoff)
-
-        if user_email:
-            stored = get_chat_memory(user_email, project_name=project_name) or {}
-            stored["marketing_brief"] = brief
-            stored["marketing_ready"] = ready_for_handoff
-            if preview_assets:
-                stored["marketing_preview_assets"] = preview_assets[:12]
-            stored["summary"] = brief.get("key_message") or brief.get("offer") or stored.get("summary", "")
-            save_chat_memory(user_email, stored, project_name=project_name)
-
-        return jsonify({
-            "ai_reply": reply,
-            "missing_fields": missing_fields,
-            "brief_score": brief_score,
-            "ready_for_handoff": ready_for_handoff,
-            "auto_handoff": auto_handoff,
-            "marketing_brief": brief,
-            "preview_assets": preview_assets
-        })
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-@app.route('/api/continue-organic', methods=['POST'])
-def continue_organic():
-    """
-    Endpoint para el canal de Contenido Organico / Community Manager.
-    Usa historial multi-turno real con Anthropic y el system prompt de organico.
-    """
-    try:
-        data = request.json or {}
-        history = data.get('history', [])
-        current_input = str(data.get('message') or '').strip()
-        image_data_url = data.get('image_data_url', '')
-        user_email = str(data.get('user_email') or '').strip().lower()
-        project_name = str(data.get('project_name') or '').strip().lower()
-
-        if not user_email:
-            return jsonify({"error": "login_required"}), 401
-        if not project_name:
-            return jsonify({"error": "project_required"}), 400
-        if not current_input and not image_data_url:
-            return jsonify({"error": "message is required"}), 400
-
-        image_context = describe_image_for_chat(image_data_url) if image_data_url else ""
-        enriched_input = current_input
-        if image_context:
-            enriched_input = f"{current_input}\n\nContexto de imagen adjunta:\n{image_context}".strip()
-        elif image_data_url and not current_input:
-            enriched_input = "El usuario adjunto una imagen. Analiza su contexto para la estrategia de contenido organico."
-
-        if has_reset_intent(current_input):
-            if user_email:
-                save_chat_memory(
-                    user_email,
-                    reset_memory_payload(get_chat_memory(user_email, project_name=project_name) or {}),
-                    project_name=project_name
-                )
-            return jsonify({
-                "ai_reply": "Listo, empezamos de cero. Cuentame sobre tu marca o negocio: que vendes, a quien le hablas y en que redes estas activo ahora mismo.",
-                "ready_for_handoff": False,
-            })
-
-        # Construir historial completo para Anthropic
-        full_history = list(history) + [{"role": "user", "content": enriched_input}]
-
-        # Llamar a Anthropic con historial real y system prompt organico
-        ai_reply = None
-        if ANTHROPIC_API_KEY:
-            recent = full_history[-14:] if len(full_history) > 14 else full_history
-            ai_reply = call_anthropic_chat(
-                recent,
-                system_prompt=ORGANIC_CONTENT_SYSTEM_PROMPT,
-                timeout_seconds=35,
-            )
-
-        # Fallback a Gemini si Anthropic falla
-        if not ai_reply:
-            lang = detect_language(current_input)
-            fallback_prompt = f"""
-Eres Anmar AI, experto en contenido organico y community management.
-Historial: {full_history[-6:]}
-Mensaje actual: {enriched_input}
-Responde como consultor senior de contenido organico. Un solo mensaje al cliente, sin lista de preguntas. Maximo 1 pregunta al final.
-Idioma: {"English" if lang == "en" else "Spanish"}
-"""
-            ai_reply = call_ai_text(fallback_prompt)
-
-        if not ai_reply:
-            ai_reply = "Entiendo tu marca y veo un potencial organico enorme. Cuentame: cual es el mayor reto que tienes hoy para crear contenido de forma consistente?"
-
-        ai_reply = ai_reply.replace("```", "").strip()
-
-        # Guardar memoria
-        if user_email:
-            stored = get_chat_memory(user_email, project_name=project_name) or {}
-            stored["organic_last_message"] = enriched_input
-            stored["organic_last_reply"] = ai_reply[:500]
-            save_chat_memory(user_email, stored, project_name=project_name)
-
-        return jsonify({
-            "ai_reply": ai_reply,
-            "ready_for_handoff": False,
-            "channel": "organic"
-        })
-
-    except Exception as e:
-        log_debug(f"continue_organic error: {e}")
-        return jsonify({"error": "Internal server error"}), 500
-
-
-@app.route('/api/continue-capital', methods=['POST'])
-def continue_capital():
-    try:
-        data = request.json or {}
-        history = data.get('history', [])
-        current_input = (data.get('message') or '').strip()
-        image_data_url = data.get('image_data_url', '')
-        user_email = (data.get('user_email') or '').strip().lower()
-        project_name = (data.get('project_name') or '').strip().lower()
-
-        if not current_input:
-            return jsonify({"error": "message is required"}), 400
-
-        image_context = describe_image_for_chat(image_data_url) if image_data_url else ""
-        enriched_input = current_input
-        if image_context:
-            enriched_input = f"{current_input}\n\nContexto de imagen adjunta:\n{image_context}".strip()
-        elif image_data_url and not current_input:
-            enriched_input = "El usuario adjuntó una imagen. Analiza su contexto para la estrategia de capital e inversión."
-
-        if has_reset_intent(current_input):
-            if user_email:
-                save_chat_memory(
-                    user_email,
-                    reset_memory_payload(get_chat_memory(user_email, project_name=project_name) or {}),
-                    project_name=project_name
-                )
-            return jsonify({
-                "ai_reply": "Perfecto, empezamos de cero. Cuéntame sobre tu negocio: ¿qué etapa estás, cuánto capital necesitas y para qué lo usarías?",
-                "ready_for_handoff": False,
-            })
-
-        # Construir historial completo para Anthropic
-        full_history = list(history) + [{"role": "user", "content": enriched_input}]
-
-        # Llamar a Anthropic con historial real y system prompt de capital
-        ai_reply = None
-        if ANTHROPIC_API_KEY:
-            recent = full_history[-14:] if len(full_history) > 14 else full_history
-            ai_reply = call_anthropic_chat(
-                recent,
-                system_prompt=CAPITAL_SYSTEM_PROMPT,
-                timeout_seconds=35,
-            )
-
-        # Fallback a Gemini si Anthropic falla
-        if not ai_reply:
-            lang = detect_language(current_input)
-            fallback_prompt = f"""
-Eres Anmar AI, experto en capital, inversión y financiación para startups y negocios.
-Historial: {full_history[-6:]}
-Mensaje actual: {enriched_input}
-Responde como un CFO y asesor de inversión senior. Un solo mensaje al cliente, sin lista de preguntas. Máximo 1 pregunta al final.
-Idioma: {"English" if lang == "en" else "Spanish"}
-"""
-            ai_reply = call_ai_text(fallback_prompt)
-
-        if not ai_reply:
-            ai_reply = "Entiendo tu situación y veo varias rutas de financiación posibles. Cuéntame: ¿cuánto capital necesitas y en qué etapa está tu negocio?"
-
-        ai_reply = ai_reply.replace("```", "").strip()
-
-        # Guardar memoria
-        if user_email:
-            stored = get_chat_memory(user_email, project_name=project_name) or {}
-            stored["capital_last_message"] = enriched_input
-            stored["capital_last_reply"] = ai_reply[:500]
-            save_chat_memory(user_email, stored, project_name=project_name)
-
-        return jsonify({
-            "ai_reply": ai_reply,
-            "ready_for_handoff": False,
-            "channel": "capital"
-        })
-
-    except Exception as e:
-        log_debug(f"continue_capital error: {e}")
-        return jsonify({"error": "Internal server error"}), 500
-
-
-@app.route('/api/analyze-turn', methods=['POST'])
-def analyze_turn_endpoint():
-    try:
-        data = request.json or {}
-        history = data.get('history', [])
-        current_input = (data.get('message') or '').strip()
-        user_email = (data.get('user_email') or '').strip().lower()
-        project_name = (data.get('project_name') or '').strip().lower()
-        if not current_input:
-            return jsonify({"error": "message is required"}), 400
-
-        full_history = history + [{"role": "user", "content": current_input}]
-        existing_memory = None
-        if user_email:
-            stored = get_chat_memory(user_email, project_name=project_name) or {}
-            existing_memory = stored.get("agent_memory") if isinstance(stored, dict) else None
-
-        analysis = analyze_turn_state(full_history, current_input, existing_memory=existing_memory)
-        # Safe payload for debug/inspection.
-        return jsonify({
-            "summary": analysis.get("summary"),
-            "missing_fields": analysis.get("missing_fields"),
-            "ready_by_data": analysis.get("ready_by_data"),
-            "ready_to_build": analysis.get("ready_to_build"),
-            "brief_score": compute_brief_score(analysis.get("missing_fields", [])),
-            "next_question": analysis.get("next_question"),
-            "memory": analysis.get("memory"),
-        })
-    except Exception as e:
-        return jsonify({"error": "Internal server error"}), 500
-
-@app.route('/api/ai-health', methods=['GET'])
-def ai_health():
-    # Optional ping via query param: /api/ai-health?ping=1
-    do_ping = str(request.args.get("ping", "")).lower() in ("1", "true", "yes")
-    if do_ping:
-        probe = call_ai_text("Responde solo con: ok")
-        if not probe:
-            return jsonify({
-                "connected": False,
-                "model_name": AI_RUNTIME.get("model_name"),
-                "last_error": AI_RUNTIME.get("last_error"),
-                "last_check_at": AI_RUNTIME.get("last_check_at"),
-            }), 503
-
-    return jsonify({
-        "connected": bool(AI_RUNTIME.get("connected")),
-        "provider": AI_RUNTIME.get("provider"),
-        "model_name": AI_RUNTIME.get("model_name"),
-        "candidate_models": AI_RUNTIME.get("candidate_models", []),
-        "last_error": AI_RUNTIME.get("last_error"),
-        "last_check_at": AI_RUNTIME.get("last_check_at"),
-        "attempts": AI_RUNTIME.get("attempts", 0),
-    })
-
-
 @app.errorhandler(404)
 def page_not_found(e):
-    return f"""<!DOCTYPE html>
-<html lang="es"><head><meta charset="UTF-8"><meta name="viewport" content="width=device-width,initial-scale=1.0">
-<title>404 | Anmar Enterprises</title><link rel="icon" type="image/svg+xml" href="/frontend/favicon.svg">
-<style>*{{margin:0;padding:0;box-sizing:border-box}}body{{background:#0a0a14;color:#fff;font-family:'Inter',sans-serif;display:flex;align-items:center;justify-content:center;min-height:100vh;text-align:center}}
-.c{{max-width:480px;padding:40px}}h1{{font-size:6rem;font-weight:800;color:#10b981;line-height:1}}p{{color:rgba(255,255,255,0.6);margin:16px 0 32px;font-size:1.1rem}}
-a{{display:inline-block;background:#10b981;color:#000;font-weight:700;padding:12px 28px;border-radius:10px;text-decoration:none;transition:opacity 0.2s}}a:hover{{opacity:0.85}}</style></head>
-<body><div class="c"><h1>404</h1><p>La pagina que buscas no existe o fue movida.</p><a href="/">Volver al inicio</a></div></body></html>""", 404
+    return templates.render("errors", "404.html", {}), 404
 
 
-if __name__ == '__main__':
+# ── WARM-UP ──
+# ANMAR_WARMUP: background (default; las fases corren en un hilo tras importar y
+# el worker acepta peticiones enseguida) | eager (antes de terminar el import,
+# comportamiento anterior, incluye Gemini) | lazy (solo en el primer uso / primera petición).
+STARTUP_WARMUP = os.getenv("ANMAR_WARMUP", "background").strip().lower()
+_warmup_started = threading.Event()
+
+def warm_up(background=True, trigger="warm-up", names=None):
+    if background:
+        if _warmup_started.is_set():
+            return None
+        _warmup_started.set()
+        return startup.warm_async(names, trigger=trigger)
+    _warmup_started.set()
+    return startup.warm(names, trigger=trigger)
+
+@app.before_request
+def _warm_up_on_first_request():
+    if not _warmup_started.is_set():
+        warm_up(trigger="first request")
+
+# ── METRICS COLLECTORS (se leen en cada scrape) ──
+@metrics_registry.collect
+def _collect_queue_metrics():
+    QUEUE_DEPTH.clear()
+    QUEUE_LAG_SECONDS.clear()
+    jobs = build_jobs.stats()
+    for status, n in jobs["jobs"].items():
+        QUEUE_DEPTH.labels("build_jobs", status).set(n)
+    QUEUE_LAG_SECONDS.labels("build_jobs").set(jobs["oldest_pending_seconds"])
+    outbox = notification_outbox.stats()
+    totals = {}
+    for statuses in outbox["queue"].values():
+        for status, n in statuses.items():
+            totals[status] = totals.get(status, 0) + n
+    for status, n in totals.items():
+        QUEUE_DEPTH.labels("notification_outbox", status).set(n)
+    QUEUE_LAG_SECONDS.labels("notification_outbox").set(outbox["oldest_pending_seconds"])
+    webhooks = stripe_events.stats()
+    for status, n in webhooks["events"].items():
+        QUEUE_DEPTH.labels("stripe_events", status).set(n)
+    QUEUE_LAG_SECONDS.labels("stripe_events").set(webhooks["oldest_pending_seconds"])
+    if TOKEN_LEDGER_ENABLED:
+        QUEUE_DEPTH.labels("token_ledger", "queued").set(token_ledger.stats()["queued"])
+
+@metrics_registry.collect
+def _collect_sla_metrics():
+    overdue = {"high": 0, "medium": 0, "low": 0}
+    for alert in load_alerts():
+        if is_sla_overdue(alert):
+            overdue[normalize_priority(alert.get("priority"))] += 1
+    for priority, n in overdue.items():
+        SLA_OVERDUE.labels(priority).set(n)
+
+@metrics_registry.collect
+def _collect_cache_metrics():
+    flight = _ai_single_flight.stats
+    CACHE_REQUESTS.labels("ai_single_flight", "hit").set(flight["shared"])
+    CACHE_REQUESTS.labels("ai_single_flight", "miss").set(flight["leaders"])
+    CACHE_REQUESTS.labels("entitlements", "hit").set(entitlements.stats["hits"])
+    CACHE_REQUESTS.labels("entitlements", "miss").set(entitlements.stats["misses"])
+
+# ── BLUEPRINTS (blueprints/; se importan al final porque usan los helpers de este módulo) ──
+from blueprints import register_blueprints
+register_blueprints(app)
+
+startup.mark("routes")
+if STARTUP_WARMUP == "eager":
+    warm_up(background=False, trigger="import", names=startup.names())
+elif STARTUP_WARMUP == "background":
+    warm_up(trigger="import (background)")
+print(f"[STARTUP] app imported in {startup.import_ms()}ms (warm-up: {STARTUP_WARMUP})")
+
+
+def main():
+    warm_up(background=False, trigger="__main__", names=startup.names())
     print(f"Server starting at http://localhost:5001")
     print(f"Serving Frontend from: {frontend_path}")
     print(f"📦 Projects Directory: {projects_base_dir}")
@@ -0,0 +1,286 @@
+"""
+Build step for frontend/ static assets.
+
+    python asset_pipeline.py            # frontend/ -> frontend/dist/
+
+Minifies CSS (and JS when rjsmin is installed), fingerprints asset names
+with a content hash (styles.css -> styles.3f2a9c1b.css), rewrites the HTML
+references to the hashed names and writes .gz / .br (brotli is optional)
+variants next to every text file. app.py serves dist/ through
+manifest.json with immutable cache headers and content negotiation.
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+from datetime import datetime
+
+try:
+    import brotli  # optional
+except ImportError:
+    brotli = None
+
+try:
+    import rjsmin  # optional
+except ImportError:
+    rjsmin = None
+
+FINGERPRINT_EXTENSIONS = {".js", ".css", ".svg", ".png", ".jpg", ".jpeg", ".webp", ".gif", ".ico", ".woff", ".woff2", ".mp4"}
+COMPRESSIBLE_EXTENSIONS = {".js", ".css", ".html", ".svg", ".txt", ".xml", ".json"}
+COMPRESS_MIN_BYTES = 512
+MANIFEST_NAME = "manifest.json"
+
+
+# ── minify ──
+def minify_css(text):
+    """Drops comments and redundant whitespace; strings are copied untouched."""
+    out = []
+    i, n = 0, len(text)
+    pending_space = False
+    while i < n:
+        ch = text[i]
+        if ch in "\"'":
+            end = i + 1
+            while end < n and text[end] != ch:
+                end += 2 if text[end] == "\\" else 1
+            if pending_space and out and out[-1] not in "{};,>(:":
+                out.append(" ")
+            pending_space = False
+            out.append(text[i:end + 1])
+            i = end + 1
+            continue
+        if text.startswith("/*", i):
+            end = text.find("*/", i + 2)
+            i = n if end < 0 else end + 2
+            pending_space = True
+            continue
+        if ch.isspace():
+            pending_space = True
+            i += 1
+            continue
+        if ch in "{};,>)":
+            pending_space = False
+            if ch == "}" and out and out[-1] == ";":
+                out.pop()
+            out.append(ch)
+            i += 1
+            continue
+        if pending_space and out and out[-1] not in "{};,>(:":
+            out.append(" ")
+        pending_space = False
+        out.append(ch)
+        i += 1
+    return "".join(out).strip()
+
+
+def minify_js(text):
+    # Sin rjsmin no se toca el JS: la compresión ya da la mayor parte del ahorro.
+    if rjsmin is None:
+        return text
+    return rjsmin.jsmin(text)
+
+
+# ── compression ──
+def precompress(path):
+    """Writes path.gz (and path.br if brotli is available); returns the encodings written."""
+    with open(path, "rb") as f:
+        data = f.read()
+    encodings = []
+    if len(data) < COMPRESS_MIN_BYTES:
+        return encodings
+    gz_data = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(gz_data) < len(data):
+        _write_atomic(path + ".gz", gz_data)
+        encodings.append("gzip")
+    if brotli is not None:
+        br_data = brotli.compress(data, quality=11)
+        if len(br_data) < len(data):
+            _write_atomic(path + ".br", br_data)
+            encodings.append("br")
+    return encodings
+
+
+def precompress_tree(root, extensions=COMPRESSIBLE_EXTENSIONS):
+    """
+    Refreshes .gz/.br next to every compressible file under root and drops
+    variants whose source no longer exists. Returns the number of files compressed.
+    """
+    compressed = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        present = set(filenames)
+        for name in filenames:
+            full = os.path.join(dirpath, name)
+            if name.endswith((".gz", ".br")):
+                if name[:-3] not in present:
+                    os.remove(full)
+                continue
+            if os.path.splitext(name)[1].lower() not in extensions or name.endswith(".tmp"):
+                continue
+            suffixes = (".gz", ".br") if brotli is not None else (".gz",)
+            if not all(variant_is_fresh(full, suffix) for suffix in suffixes):
+                for suffix in (".gz", ".br"):
+                    if os.path.exists(full + suffix):
+                        os.remove(full + suffix)
+                precompress(full)
+                compressed += 1
+    return compressed
+
+
+def variant_is_fresh(path, suffix):
+    """True if path+suffix exists and is not older than path."""
+    try:
+        return os.path.getmtime(path + suffix) >= os.path.getmtime(path)
+    except OSError:
+        return False
+
+
+def negotiate_encoding(accept_encoding, available):
+    """Picks br/gzip from an Accept-Encoding header among the available encodings."""
+    accepted = {}
+    for part in str(accept_encoding or "").lower().split(","):
+        token, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if token:
+            accepted[token] = q
+    for encoding in ("br", "gzip"):
+        if encoding in (available or ()) and accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+def _write_atomic(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+# ── build ──
+def _fingerprint(name, data):
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:10]}{ext}"
+
+
+def rewrite_references(html, mapping):
+    """src/href="name(?v=..)" -> hashed name for every fingerprinted asset."""
+    def _sub(match):
+        attr, quote, ref = match.group(1), match.group(2), match.group(3)
+        bare = ref.split("?", 1)[0].split("#", 1)[0]
+        prefix = ""
+        if bare.startswith("./"):
+            prefix, bare = "./", bare[2:]
+        elif bare.startswith("/"):
+            prefix, bare = "/", bare[1:]
+        if bare in mapping:
+            return f"{attr}={quote}{prefix}{mapping[bare]}{quote}"
+        return match.group(0)
+    return re.sub(r"""\b(src|href)=(["'])([^"'#:]+?)\2""", _sub, html)
+
+
+def build_assets(src_dir, out_dir=None):
+    out_dir = out_dir or os.path.join(src_dir, "dist")
+    staging = out_dir + ".staging"
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    os.makedirs(staging)
+
+    names = sorted(
+        name for name in os.listdir(src_dir)
+        if os.path.isfile(os.path.join(src_dir, name)) and not name.startswith(".")
+    )
+    mapping, assets = {}, {}
+
+    # 1) Assets con huella (css/js/imágenes).
+    for name in names:
+        ext = os.path.splitext(name)[1].lower()
+        if ext not in FINGERPRINT_EXTENSIONS:
+            continue
+        with open(os.path.join(src_dir, name), "rb") as f:
+            data = f.read()
+        if ext == ".css":
+            data = minify_css(data.decode("utf-8")).encode("utf-8")
+        elif ext == ".js":
+            data = minify_js(data.decode("utf-8")).encode("utf-8")
+        hashed = _fingerprint(name, data)
+        _write_atomic(os.path.join(staging, hashed), data)
+        mapping[name] = hashed
+        assets[name] = {"path": hashed, "immutable": True, "size": len(data)}
+
+    # 2) HTML y demás archivos: mismo nombre, referencias reescritas.
+    for name in names:
+        if name in mapping:
+            continue
+        with open(os.path.join(src_dir, name), "rb") as f:
+            data = f.read()
+        if name.lower().endswith((".html", ".htm")):
+            data = rewrite_references(data.decode("utf-8"), mapping).encode("utf-8")
+        _write_atomic(os.path.join(staging, name), data)
+        assets[name] = {"path": name, "immutable": False, "size": len(data)}
+
+    for info in assets.values():
+        ext = os.path.splitext(info["path"])[1].lower()
+        info["encodings"] = precompress(os.path.join(staging, info["path"])) if ext in COMPRESSIBLE_EXTENSIONS else []
+
+    # Se conservan los assets con huella del build anterior: páginas ya cargadas
+    # durante el deploy siguen pidiendo esos nombres.
+    previous_paths = []
+    for info in load_manifest(out_dir).get("assets", {}).values():
+        if not info.get("immutable") or os.path.exists(os.path.join(staging, info["path"])):
+            continue
+        encodings = []
+        for encoding, suffix in [(None, ""), ("gzip", ".gz"), ("br", ".br")]:
+            old_path = os.path.join(out_dir, info["path"] + suffix)
+            if os.path.exists(old_path):
+                shutil.copy2(old_path, os.path.join(staging, info["path"] + suffix))
+                if encoding:
+                    encodings.append(encoding)
+        previous_paths.append({"path": info["path"], "encodings": encodings})
+
+    manifest = {
+        "version": 1,
+        "generated_at": datetime.now().isoformat(),
+        "assets": assets,
+        "previous": previous_paths,
+    }
+    with open(os.path.join(staging, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    # Swap del directorio completo para no servir un dist a medio escribir.
+    previous = out_dir + ".old"
+    if os.path.exists(previous):
+        shutil.rmtree(previous)
+    if os.path.exists(out_dir):
+        os.replace(out_dir, previous)
+    os.replace(staging, out_dir)
+    if os.path.exists(previous):
+        shutil.rmtree(previous)
+    return manifest
+
+
+def load_manifest(out_dir):
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except Exception:
+        return {}
+
+
+if __name__ == "__main__":
+    base = os.path.dirname(os.path.abspath(__file__))
+    src = sys.argv[1] if len(sys.argv) > 1 else os.path.join(base, "frontend")
+    result = build_assets(src)
+    original = sum(os.path.getsize(os.path.join(src, n)) for n in result["assets"])
+    built = sum(a["size"] for a in result["assets"].values())
+    print(f"[ASSETS] {len(result['assets'])} files -> {os.path.join(src, 'dist')} "
+          f"({original} -> {built} bytes before compression, brotli={'on' if brotli else 'off'})")
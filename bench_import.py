@@ -0,0 +1,82 @@
+"""
+Import-time benchmark for app.py (guards startup regressions).
+
+Imports the app in a fresh interpreter several times with warm-up
+disabled (ANMAR_WARMUP=lazy), so only module-level work is measured, and
+fails when the median exceeds the budget or when a heavy provider SDK
+(see lazy_imports.py) was imported eagerly:
+
+    python bench_import.py [--runs 5] [--budget-ms 1500]
+
+ANMAR_IMPORT_BUDGET_MS sets the default budget. Exit status is 1 on a
+regression, so deploy_fixes.sh can run it before restarting the service.
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+LAZY_MODULES = ("google.generativeai", "stripe", "requests")
+
+_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import app
+elapsed = (time.perf_counter() - started) * 1000
+print(json.dumps({
+    "total_ms": round(elapsed, 2),
+    "module_ms": app.startup.import_ms(),
+    "routes": len(list(app.app.url_map.iter_rules())),
+    "eager": [name for name in %r if name in sys.modules],
+}))
+"""
+
+
+def measure(root, runs=5):
+    env = dict(os.environ, ANMAR_WARMUP="lazy")
+    samples = []
+    for _ in range(max(1, int(runs))):
+        proc = subprocess.run(
+            [sys.executable, "-c", _PROBE % (LAZY_MODULES,)],
+            cwd=root, env=env, capture_output=True, text=True,
+        )
+        if proc.returncode != 0:
+            raise RuntimeError(f"importing app failed:\n{proc.stderr[-2000:]}")
+        samples.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+    return samples
+
+
+def summarize(samples):
+    totals = [s["total_ms"] for s in samples]
+    return {
+        "runs": len(samples),
+        "median_ms": round(statistics.median(totals), 2),
+        "min_ms": min(totals),
+        "max_ms": max(totals),
+        "module_ms": round(statistics.median(s["module_ms"] for s in samples), 2),
+        "routes": samples[-1]["routes"],
+        "eager": sorted({name for s in samples for name in s["eager"]}),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Measure how long importing app.py takes.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("ANMAR_IMPORT_BUDGET_MS", "1500")))
+    parser.add_argument("--root", default=os.path.dirname(os.path.abspath(__file__)))
+    args = parser.parse_args()
+
+    report = summarize(measure(args.root, args.runs))
+    report["budget_ms"] = args.budget_ms
+    print(json.dumps(report, indent=2))
+    problems = []
+    if report["median_ms"] > args.budget_ms:
+        problems.append(f"median import {report['median_ms']}ms exceeds budget {args.budget_ms}ms")
+    if report["eager"]:
+        problems.append(f"imported eagerly: {', '.join(report['eager'])} (use lazy_imports)")
+    for problem in problems:
+        print(f"[BENCH] {problem}", file=sys.stderr)
+    sys.exit(1 if problems else 0)
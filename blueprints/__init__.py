@@ -0,0 +1,16 @@
+"""
+HTTP routes, grouped by area. Each module defines a Blueprint named after
+it; the helpers, stores and workers they use still live in app.py and are
+imported from there, so register_blueprints() runs at the end of app.py,
+once everything it needs is defined.
+"""
+
+BLUEPRINTS = ("auth", "chat", "tickets", "builder", "billing", "internal", "marketing")
+
+
+def register_blueprints(app):
+    import importlib
+
+    for name in BLUEPRINTS:
+        module = importlib.import_module(f"blueprints.{name}")
+        app.register_blueprint(module.bp)
@@ -0,0 +1,260 @@
+"""
+Client account routes: registration, password reset, login (email and
+social), logout and the /api/me session probe.
+"""
+import json
+import sqlite3
+from datetime import datetime, timedelta
+from flask import Blueprint, jsonify, request, session
+from werkzeug.security import check_password_hash, generate_password_hash
+from app import (
+    _rate_limit, get_db_connection, notify_new_registration, send_email,
+)
+
+bp = Blueprint("auth", __name__)
+
+
+# --- AUTH ROUTES ---
+@bp.route('/api/register', methods=['POST'])
+def register():
+    if _rate_limit(request.remote_addr, max_requests=5, window=60):
+        return jsonify({"error": "Too many attempts. Try again in a minute."}), 429
+    data = request.json or {}
+    name  = (data.get('name') or '').strip()
+    email = (data.get('email') or '').strip().lower()
+    password = data.get('password') or ''
+    terms_accepted = data.get('termsAccepted')
+
+    # Fix #5: Server-side email format validation
+    import re as _re
+    if not email or not _re.match(r'^[^@\s]+@[^@\s]+\.[^@\s]+$', email):
+        return jsonify({"error": "Please enter a valid email address."}), 400
+    # Fix #6: Name required
+    if not name:
+        return jsonify({"error": "Please enter your full name."}), 400
+    if not password:
+        return jsonify({"error": "Password is required."}), 400
+    if len(password) < 6:
+        return jsonify({"error": "Password must be at least 6 characters."}), 400
+    if not terms_accepted:
+        return jsonify({"error": "You must accept the Terms and Conditions to register."}), 400
+
+    hashed_pw = generate_password_hash(password)
+
+    try:
+        conn = get_db_connection()
+        conn.execute('INSERT INTO users (name, email, password, tokens) VALUES (?, ?, ?, ?)',
+                     (name, email, hashed_pw, 8))
+        conn.commit()
+        conn.close()
+
+        notify_new_registration(name, email)
+
+        return jsonify({"message": "Account created successfully", "user": {"name": name, "email": email, "tokens": 8}})
+    except sqlite3.IntegrityError:
+        return jsonify({"error": "Email is already registered"}), 409
+    except Exception as e:
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/forgot-password', methods=['POST'])
+def forgot_password():
+    """Fix #2: Forgot password — sends a reset link by email."""
+    if _rate_limit(request.remote_addr, max_requests=3, window=60):
+        return jsonify({"error": "Too many attempts. Try again in a minute."}), 429
+    data  = request.json or {}
+    email = (data.get('email') or '').strip().lower()
+    if not email:
+        return jsonify({"error": "Email is required."}), 400
+
+    conn = get_db_connection()
+    user = conn.execute('SELECT name FROM users WHERE email = ?', (email,)).fetchone()
+    conn.close()
+
+    # Always return success to avoid revealing registered emails
+    if not user:
+        return jsonify({"message": "If that email exists, a reset link has been sent."}), 200
+
+    import secrets, hashlib
+    token     = secrets.token_urlsafe(32)
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    expires_at = (datetime.utcnow() + timedelta(hours=1)).strftime('%Y-%m-%d %H:%M:%S')  # BUG FIX: was utcnow() — tokens expired instantly
+
+    # Store token in DB (reuse chat_memory table with special key)
+    conn = get_db_connection()
+    conn.execute(
+        "INSERT OR REPLACE INTO chat_memory (email, memory_json, updated_at) VALUES (?, ?, ?)",
+        (f"__reset__{email}", json.dumps({"token_hash": token_hash, "expires_at": expires_at}), expires_at)
+    )
+    conn.commit()
+    conn.close()
+
+    reset_url = f"https://anmarenterprices.com/reset-password.html?token={token}&email={email}"
+    print(f"[RESET] Password reset link for {email}: {reset_url}")
+
+    # BUG FIX Bug 14: send actual reset email (was wrongly calling notify_new_registration
+    # which sent the welcome email instead of the reset link)
+    try:
+        name_str = user['name'] or 'there'
+        reset_html = f"""
+        <div style="font-family:sans-serif;max-width:520px;margin:0 auto;padding:32px 24px;background:#0a0a0a;color:#e5e7eb;border-radius:12px;">
+          <h2 style="color:#10b981;margin-bottom:8px;">Password Reset</h2>
+          <p style="color:#9ca3af;">Hi {name_str},</p>
+          <p>We received a request to reset your Anmar password. Click the button below to set a new password. This link expires in <strong>1 hour</strong>.</p>
+          <a href="{reset_url}" style="display:inline-block;margin:24px 0;padding:12px 28px;background:#10b981;color:#000;font-weight:700;border-radius:8px;text-decoration:none;">Reset My Password</a>
+          <p style="color:#6b7280;font-size:0.85rem;">If you didn't request this, you can safely ignore this email. Your password won't change.</p>
+          <p style="color:#6b7280;font-size:0.8rem;">Or copy this link: <a href="{reset_url}" style="color:#10b981;">{reset_url}</a></p>
+        </div>
+        """
+        send_email(email, "Reset your Anmar password", reset_html)
+    except Exception as e:
+        print(f"[RESET] Could not send email to {email}: {e}")
+
+    return jsonify({"message": "If that email exists, a reset link has been sent."}), 200
+
+
+@bp.route('/api/me', methods=['POST'])
+def api_me():
+    """Lightweight session validator — verifies the user still exists in DB and returns current tokens."""
+    data = request.json or {}
+    email = (data.get('email') or '').strip().lower()
+    if not email:
+        return jsonify({"error": "Not authenticated"}), 401
+
+    # Verify session and email match
+    session_email = session.get('user_email', '').strip().lower()
+    if not session_email:
+        return jsonify({"error": "You have not logged in"}), 401
+    if session_email != email:
+        return jsonify({"error": "Unauthorized"}), 403
+
+    conn = get_db_connection()
+    user = conn.execute('SELECT name, email, tokens FROM users WHERE email_normalized = ?', (email,)).fetchone()
+    conn.close()
+    if not user:
+        return jsonify({"error": "User not found"}), 401
+    tokens = int(user['tokens']) if user['tokens'] is not None else 0
+    return jsonify({"user": {"name": user['name'], "email": user['email'], "tokens": tokens}})
+
+
+@bp.route('/api/check-email', methods=['POST'])
+def check_email():
+    if _rate_limit(request.remote_addr, max_requests=20, window=60):
+        return jsonify({"error": "Too many attempts. Try again in a minute."}), 429
+    try:
+        data = request.json or {}
+        email = str(data.get('email') or '').strip().lower()
+        if not email:
+            return jsonify({"error": "Email is required"}), 400
+        conn = get_db_connection()
+        user = conn.execute('SELECT 1 FROM users WHERE email = ?', (email,)).fetchone()
+        conn.close()
+        return jsonify({"exists": bool(user)})
+    except Exception as e:
+        print(f"Check email error: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/login', methods=['POST'])
+def login():
+    if _rate_limit(request.remote_addr, max_requests=10, window=60):
+        return jsonify({"error": "Too many attempts. Try again in a minute."}), 429
+    data = request.json or {}
+    email = (data.get('email') or '').strip().lower()
+    password = data.get('password') or ''
+
+    conn = get_db_connection()
+    user = conn.execute('SELECT * FROM users WHERE email_normalized = ?', (email,)).fetchone()
+    conn.close()
+
+    if user and check_password_hash(user['password'], password):
+        tokens = int(user['tokens']) if user['tokens'] is not None else 0
+        session.permanent = True
+        session['user_email'] = user['email']
+        return jsonify({
+            "message": "Login successful",
+            "user": {"name": user['name'], "email": user['email'], "tokens": tokens}
+        })
+    else:
+        return jsonify({"error": "Credenciales inválidas"}), 401
+
+
+@bp.route('/api/social-login', methods=['POST'])
+def social_login():
+    if _rate_limit(request.remote_addr, max_requests=10, window=60):
+        return jsonify({"error": "Too many attempts. Try again in a minute."}), 429
+    data = request.json or {}
+    provider = data.get('provider') # 'Google' or 'Apple'
+    token = data.get('token')
+    email = data.get('email')
+    name = data.get('name')
+    terms_accepted = data.get('termsAccepted')
+
+    if provider == 'Google':
+        if not token:
+            return jsonify({"error": "Missing authentic Google token to validate your Gmail."}), 400
+
+        import requests
+        try:
+            google_res = requests.get(f"https://oauth2.googleapis.com/tokeninfo?id_token={token}")
+            if google_res.status_code == 200:
+                google_data = google_res.json()
+                email = google_data.get('email')
+                name = google_data.get('name')
+                
+                if not email:
+                    return jsonify({"error": "Google account did not authorize email delivery."}), 400
+            else:
+                return jsonify({"error": "Invalid or expired Google token"}), 401
+        except Exception as e:
+            return jsonify({"error": "Error verificando token de Google"}), 500
+
+    if not email:
+        return jsonify({"error": "Missing social network data"}), 400
+
+    conn = get_db_connection()
+    email_lower = (email or '').strip().lower()
+    user = conn.execute('SELECT * FROM users WHERE email_normalized = ?', (email_lower,)).fetchone()
+
+    if not user:
+        if not terms_accepted:
+            conn.close()
+            return jsonify({"error": "You must accept the Terms and Conditions to create your account."}), 400
+        # User doesn't exist, create automatically using social info
+        import secrets
+        random_password = secrets.token_urlsafe(16)  # Generate a long placeholder password
+        from werkzeug.security import generate_password_hash
+        hashed_pw = generate_password_hash(random_password)
+        try:
+            conn.execute('INSERT INTO users (name, email, password, tokens) VALUES (?, ?, ?, ?)', (name, email, hashed_pw, 8))
+            conn.commit()
+            user_data = {"name": name, "email": email, "tokens": 8}
+
+            # ACTIVATE NOTIFICATIONS FOR SOCIAL SIGNUP
+            notify_new_registration(name, email)
+
+        except Exception as e:
+            conn.close()
+            return jsonify({"error": "Internal server error"}), 500
+    else:
+        # User exists, log them in
+        tokens = int(user['tokens']) if user['tokens'] is not None else 0
+        user_data = {"name": user['name'], "email": user['email'], "tokens": tokens}
+
+    conn.close()
+
+    # Set session for authenticated user
+    session.permanent = True
+    session['user_email'] = email
+
+    return jsonify({
+        "message": f"Authenticated with {provider} successfully",
+        "user": user_data
+    })
+
+
+@bp.route('/api/logout', methods=['POST'])
+def logout():
+    """Clear user session."""
+    session.pop('user_email', None)
+    return jsonify({"status": "ok"})
@@ -0,0 +1,367 @@
+"""
+Billing routes: Stripe checkout, webhook intake and session verification,
+subscription retention actions, token recharge and usage stats.
+"""
+import os
+from datetime import datetime, timedelta
+from flask import Blueprint, jsonify, request, session
+from lazy_imports import stripe
+from app import (
+    ONE_TIME_PLANS, STRIPE_SECRET_KEY, STRIPE_WEBHOOK_SECRET, TOKEN_PACK_MAP, _rate_limit,
+    credit_user_tokens, entitlements, get_db_connection, get_stripe_plan_map,
+    get_user_subscription_id, get_user_token_balance, normalize_plan_label, require_internal_auth,
+    set_user_subscription, stripe_events, submit_pending_tickets_for_email,
+)
+
+bp = Blueprint("billing", __name__)
+
+
+@bp.route('/api/user-stats', methods=['GET'])
+def get_user_stats():
+    if _rate_limit(request.remote_addr, max_requests=10, window=60):
+        return jsonify({"error": "Too many attempts. Try again in a minute."}), 429
+
+    email = request.args.get('email')
+    if not email: return jsonify({"error": "No email provided"}), 400
+
+    # Verify session and email match
+    session_email = session.get('user_email', '').strip().lower()
+    if not session_email:
+        return jsonify({"error": "You have not logged in"}), 401
+    if session_email != email.strip().lower():
+        return jsonify({"error": "Unauthorized"}), 403
+
+    conn = get_db_connection()
+    user = conn.execute(
+        'SELECT tokens, created_at, subscription_active, subscription_plan, subscription_status FROM users WHERE email = ?',
+        (email,)
+    ).fetchone()
+    conn.close()
+
+    if user:
+        return jsonify({
+            "tokens": user['tokens'],
+            "joined": user['created_at'],
+            "subscription_active": int(user['subscription_active']) == 1 if 'subscription_active' in user.keys() else False,
+            "subscription_plan": user['subscription_plan'] if 'subscription_plan' in user.keys() else 'none',
+            "subscription_status": user['subscription_status'] if 'subscription_status' in user.keys() else 'inactive'
+        })
+    else:
+        return jsonify({"error": "User not found"}), 404
+
+
+# --- STRIPE CHECKOUT ---
+@bp.route('/api/stripe/create-checkout-session', methods=['POST'])
+def stripe_create_checkout_session():
+    if _rate_limit(request.remote_addr, max_requests=5, window=60):
+        return jsonify({"error": "Too many attempts. Wait a moment."}), 429
+    try:
+        if not STRIPE_SECRET_KEY:
+            return jsonify({"error": "Stripe is not configured"}), 500
+        data = request.json or {}
+        email = (data.get('email') or '').strip().lower()
+        plan_key = (data.get('plan') or '').strip()
+        plan_map = get_stripe_plan_map()
+        price_id = plan_map.get(plan_key)
+
+        if not email or not price_id:
+            return jsonify({"error": "Invalid email or plan"}), 400
+
+        origin = request.headers.get('Origin')
+        if not origin:
+            origin = request.host_url.rstrip('/')
+
+        success_url = os.getenv("STRIPE_SUCCESS_URL", "").strip() or f"{origin}/dashboard.html?checkout=success&session_id={{CHECKOUT_SESSION_ID}}"
+        cancel_url = os.getenv("STRIPE_CANCEL_URL", "").strip() or f"{origin}/dashboard.html?checkout=cancel"
+
+        checkout_mode = "payment" if plan_key in ONE_TIME_PLANS else "subscription"
+        session = stripe.checkout.Session.create(
+            mode=checkout_mode,
+            line_items=[{"price": price_id, "quantity": 1}],
+            customer_email=email,
+            client_reference_id=email,
+            success_url=success_url,
+            cancel_url=cancel_url,
+            allow_promotion_codes=True,
+            metadata={
+                "plan": plan_key,
+                "email": email
+            }
+        )
+
+        return jsonify({"url": session.url})
+    except Exception as e:
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/stripe/create-token-pack-session', methods=['POST'])
+def stripe_create_token_pack_session():
+    """One-time payment checkout for token packs (50/150/500 messages)."""
+    if _rate_limit(request.remote_addr, max_requests=5, window=60):
+        return jsonify({"error": "Too many attempts. Wait a moment."}), 429
+    try:
+        if not STRIPE_SECRET_KEY:
+            return jsonify({"error": "Stripe is not configured"}), 500
+        data = request.json or {}
+        email = (data.get('email') or '').strip().lower()
+        user_email = (data.get('user_email') or '').strip().lower()
+        pack_key = (data.get('pack') or '').strip()
+
+        # Verify requesting user's email matches - use user_email if provided, fallback to email
+        auth_email = user_email or email
+        if not auth_email or auth_email != email:
+            return jsonify({"error": "Unauthorized: email mismatch"}), 403
+
+        pack_info = TOKEN_PACK_MAP.get(pack_key)
+        if not email or not pack_info:
+            return jsonify({"error": "Invalid email or pack"}), 400
+        if not pack_info.get("price_id"):
+            return jsonify({"error": "This pack is not yet available. Contact us."}), 400
+
+        origin = request.headers.get('Origin') or request.host_url.rstrip('/')
+        success_url = os.getenv("STRIPE_SUCCESS_URL", "").strip() or f"{origin}/dashboard.html?checkout=success&pack={pack_key}"
+        cancel_url  = os.getenv("STRIPE_CANCEL_URL",  "").strip() or f"{origin}/dashboard.html?checkout=cancel"
+
+        checkout_session = stripe.checkout.Session.create(
+            mode="payment",
+            line_items=[{"price": pack_info["price_id"], "quantity": 1}],
+            customer_email=email,
+            client_reference_id=email,
+            success_url=success_url,
+            cancel_url=cancel_url,
+            metadata={
+                "type": "token_pack",
+                "pack": pack_key,
+                "tokens": str(pack_info["tokens"]),
+                "email": email
+            }
+        )
+        return jsonify({"url": checkout_session.url})
+    except Exception as e:
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/stripe/webhook', methods=['POST'])
+def stripe_webhook():
+    payload = request.data
+    sig_header = request.headers.get('Stripe-Signature', '')
+
+    if not STRIPE_WEBHOOK_SECRET:
+        return jsonify({"error": "Stripe webhook secret missing"}), 500
+
+    try:
+        event = stripe.Webhook.construct_event(
+            payload=payload,
+            sig_header=sig_header,
+            secret=STRIPE_WEBHOOK_SECRET
+        )
+    except Exception as e:
+        return jsonify({"error": "Invalid request"}), 400
+
+    try:
+        stripe_events.record(event, raw=payload)
+    except Exception as e:
+        # Sin persistir no se confirma: Stripe reintentará la entrega.
+        print(f"[WEBHOOK] could not store event {event.get('id')}: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+    return jsonify({"received": True})
+
+
+@bp.route('/api/stripe/verify-session', methods=['GET'])
+def stripe_verify_session():
+    try:
+        session_id = (request.args.get('session_id') or '').strip()
+        user_email = (request.args.get('user_email') or '').strip().lower()
+        if not session_id or not user_email:
+            return jsonify({"error": "Missing session_id or user_email"}), 400
+        if not STRIPE_SECRET_KEY:
+            return jsonify({"error": "Stripe is not configured"}), 500
+
+        session_data = stripe.checkout.Session.retrieve(session_id)
+        stripe_email = (session_data.get('customer_email') or '').strip().lower()
+
+        # Verify requesting user matches the Stripe session's email
+        if stripe_email != user_email:
+            return jsonify({"error": "Unauthorized: email mismatch"}), 403
+
+        metadata = session_data.get('metadata') or {}
+        plan_key = (metadata.get('plan') or '').strip()
+        customer_id = session_data.get('customer')
+        subscription_id = session_data.get('subscription')
+
+        if stripe_email:
+            set_user_subscription(
+                stripe_email,
+                True,
+                plan_key=plan_key,
+                customer_id=customer_id,
+                subscription_id=subscription_id,
+                status="active",
+                grant_ref=f"checkout:{session_id}:plan",
+            )
+            try:
+                submit_pending_tickets_for_email(stripe_email)
+            except Exception as e:
+                print(f"Pending ticket auto-submit failed: {e}")
+        return jsonify({"status": "ok"})
+    except Exception as e:
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/stripe/cancel-subscription', methods=['POST'])
+def cancel_subscription():
+    """Cancela la suscripción al final del período actual (no inmediato)."""
+    try:
+        data = request.json or {}
+        email = (data.get('email') or '').strip().lower()
+        reason = (data.get('reason') or 'not_specified').strip()
+        if not email:
+            return jsonify({"error": "Email is required"}), 400
+        if not STRIPE_SECRET_KEY:
+            # Sin Stripe: solo marcar en DB
+            set_user_subscription(email, False, status='canceled')
+            return jsonify({"status": "canceled", "message": "Subscription canceled."})
+        row = get_user_subscription_id(email)
+        if not row or not row['stripe_subscription_id']:
+            set_user_subscription(email, False, status='canceled')
+            return jsonify({"status": "canceled", "message": "Subscription canceled."})
+        sub_id = row['stripe_subscription_id']
+        # Cancelar al final del período (no cortar inmediatamente)
+        stripe.Subscription.modify(sub_id, cancel_at_period_end=True, metadata={"cancel_reason": reason})
+        set_user_subscription(email, True, status='cancel_at_period_end')
+        print(f"[CANCEL] {email} — reason: {reason}")
+        return jsonify({"status": "cancel_at_period_end", "message": "Your subscription will cancel at the end of the billing period."})
+    except Exception as e:
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/stripe/pause-subscription', methods=['POST'])
+def pause_subscription():
+    """Pausa la suscripción por 30 días (sin cobro)."""
+    try:
+        data = request.json or {}
+        email = (data.get('email') or '').strip().lower()
+        if not email:
+            return jsonify({"error": "Email is required"}), 400
+        if not STRIPE_SECRET_KEY:
+            set_user_subscription(email, True, status='paused')
+            return jsonify({"status": "paused"})
+        row = get_user_subscription_id(email)
+        if not row or not row['stripe_subscription_id']:
+            return jsonify({"error": "No active subscription found"}), 404
+        sub_id = row['stripe_subscription_id']
+        resume_at = int((datetime.now() + timedelta(days=30)).timestamp())
+        stripe.Subscription.modify(sub_id, pause_collection={"behavior": "void", "resumes_at": resume_at})
+        set_user_subscription(email, True, status='paused')
+        print(f"[PAUSE] {email} — resumes in 30 days")
+        return jsonify({"status": "paused", "message": "Your subscription is paused for 30 days. You will not be charged and it will reactivate automatically."})
+    except Exception as e:
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/stripe/apply-retention-discount', methods=['POST'])
+def apply_retention_discount():
+    """Aplica cupón del 50% en el próximo mes."""
+    try:
+        data = request.json or {}
+        email = (data.get('email') or '').strip().lower()
+        if not email:
+            return jsonify({"error": "Email is required"}), 400
+        if not STRIPE_SECRET_KEY:
+            return jsonify({"status": "discount_applied", "message": "Discount applied (demo mode)."})
+        row = get_user_subscription_id(email)
+        if not row or not row['stripe_subscription_id']:
+            return jsonify({"error": "No active subscription found"}), 404
+        sub_id = row['stripe_subscription_id']
+        # Crear o recuperar cupón de retención 50% off por 1 mes
+        coupon_id = "RETENTION_50_1M"
+        try:
+            stripe.Coupon.retrieve(coupon_id)
+        except stripe.error.InvalidRequestError:
+            stripe.Coupon.create(
+                id=coupon_id,
+                percent_off=50,
+                duration="once",
+                name="Retención — 50% off 1 mes"
+            )
+        stripe.Subscription.modify(sub_id, coupon=coupon_id)
+        print(f"[DISCOUNT] {email} — 50% aplicado")
+        return jsonify({"status": "discount_applied", "message": "50% discount applied to your next month!"})
+    except Exception as e:
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/stripe/downgrade-plan', methods=['POST'])
+def downgrade_plan():
+    """Baja el plan al nivel inmediatamente inferior."""
+    try:
+        data = request.json or {}
+        email = (data.get('email') or '').strip().lower()
+        target_plan = (data.get('target_plan') or '').strip()
+        if not email or not target_plan:
+            return jsonify({"error": "Email y plan requeridos"}), 400
+        plan_map = get_stripe_plan_map()
+        new_price_id = plan_map.get(target_plan)
+        if not new_price_id:
+            return jsonify({"error": "Invalid plan"}), 400
+        if not STRIPE_SECRET_KEY:
+            set_user_subscription(email, True, plan_key=target_plan, status='active')
+            return jsonify({"status": "downgraded", "new_plan": target_plan})
+        row = get_user_subscription_id(email)
+        if not row or not row['stripe_subscription_id']:
+            return jsonify({"error": "No active subscription found"}), 404
+        sub_id = row['stripe_subscription_id']
+        sub = stripe.Subscription.retrieve(sub_id)
+        item_id = sub['items']['data'][0]['id']
+        stripe.Subscription.modify(sub_id, items=[{"id": item_id, "price": new_price_id}],
+                                   proration_behavior='none')
+        set_user_subscription(email, True, plan_key=target_plan, status='active')
+        print(f"[DOWNGRADE] {email} → {target_plan}")
+        return jsonify({"status": "downgraded", "new_plan": target_plan,
+                        "message": f"Plan changed to {normalize_plan_label(target_plan)} successfully."})
+    except Exception as e:
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/recharge-tokens', methods=['POST'])
+def recharge_tokens():
+    if _rate_limit(request.remote_addr, max_requests=5, window=60):
+        return jsonify({"error": "Too many attempts. Try again in a minute."}), 429
+
+    if not require_internal_auth():
+        return jsonify({"error": "Unauthorized"}), 401
+
+    try:
+        data = request.json or {}
+        email = data.get('email')
+        plan = data.get('plan_id')
+
+        if not email: return jsonify({"error": "Missing email"}), 400
+
+        tokens_to_add = 0
+        if plan == 'starter': tokens_to_add = 10
+        elif plan == 'pro': tokens_to_add = 50
+        elif plan == 'agency': tokens_to_add = 9999 # Unlimited simulation
+
+        conn = get_db_connection()
+        user = conn.execute('SELECT tokens FROM users WHERE email = ?', (email,)).fetchone()
+
+        if not user:
+            conn.close()
+            return jsonify({"error": "User not found"}), 404
+
+        conn.execute(
+            'UPDATE users SET subscription_active = 1, subscription_plan = ?, subscription_started_at = CURRENT_TIMESTAMP WHERE email = ?',
+            (plan or 'starter', email)
+        )
+        conn.commit()
+        conn.close()
+        entitlements.invalidate(email)
+        new_balance = credit_user_tokens(email, tokens_to_add, kind="grant", reason=f"recharge {plan or 'starter'}")
+        if new_balance is None:
+            new_balance = get_user_token_balance(email)
+
+        return jsonify({"status": "success", "new_balance": new_balance, "added": tokens_to_add})
+
+    except Exception as e:
+        return jsonify({"error": "Internal server error"}), 500
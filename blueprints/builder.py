@@ -0,0 +1,783 @@
+"""
+Project builder routes: blueprint and plan generation, create/edit (build
+jobs), project listing and deletion, preview serving, versions, rollback
+and per-project export.
+"""
+import difflib
+import mimetypes
+import os
+import re
+import shutil
+import threading
+import uuid
+from datetime import datetime
+from flask import Blueprint, Response, jsonify, request, send_file, session
+from werkzeug.utils import safe_join
+from asset_pipeline import negotiate_encoding, variant_is_fresh
+from edit_context import compact_history, select_context
+from patch_edits import apply_edits
+from starter_templates import templates
+from app import (
+    AI_EDIT_MAX_TOKENS, BUILD_TOKEN_COST, CACHE_REQUESTS, CHAT_MESSAGE_TOKEN_COST,
+    EDIT_CONTEXT_TOKENS, EDIT_PATCH_ATTEMPTS, EDIT_PATCH_SCHEMA, EDIT_PROJECT_SCHEMA,
+    PREVIEW_ACCEL_PREFIX, PREVIEW_CACHE_CONTROL, PREVIEW_OFFLOAD, TWILIO_ADMIN_PHONE,
+    _build_job_view, _etag_matches, _export_response, _preview_etag, _rate_limit, _send_sms,
+    build_jobs, call_ai_json, can_access_project, clean_and_parse_json, coalesce_ai_request,
+    consume_build_quota, consume_user_tokens, describe_ui_reference, get_ai_model,
+    get_order_status, load_project_meta, log_debug, normalize_engine, precompress_project,
+    project_index, project_store, projects_base_dir, record_project_version, refund_user_tokens,
+    request_profiler, require_internal_auth, sanitize_project_name, save_project_meta,
+)
+
+bp = Blueprint("builder", __name__)
+
+
+@bp.route('/create-blueprint', methods=['POST'])
+def create_blueprint():
+    try:
+        data = request.json or {}
+        idea = data.get('idea', '')
+        
+        prompt = f"""
+        Act as a Senior Software Architect. User Idea: "{idea}"
+        
+        CRITICAL: WRITE IN THE SAME LANGUAGE AS THE USER'S IDEA.
+        
+        Create a TECHNICAL BLUEPRINT markdown.
+        
+        RETURN JSON:
+        {{
+            "blueprint": "## Plan... (use \\n for newlines)"
+        }}
+        """
+        with request_profiler.phase("ai"):
+            response = get_ai_model().generate_content(prompt)
+        result = clean_and_parse_json(response.text)
+        
+        if result: 
+            return jsonify(result)
+        else:
+            return jsonify({"blueprint": "## Error generating blueprint.\nProceeding..."})
+            
+    except Exception as e:
+        print(f"Blueprint Error: {e}")
+        return jsonify({"blueprint": "## Error.\nProceeding..."})
+
+
+@bp.route('/generate-plan', methods=['POST'])
+def generate_plan():
+    try:
+        data = request.json or {}
+        business_idea = data.get('idea')
+        if not business_idea: return jsonify({"error": "No idea provided"}), 400
+
+        prompt = f"""
+        Act as a Senior CTO. Idea: "{business_idea}".
+        
+        CRITICAL: GENERATE THE PLAN IN THE SAME LANGUAGE AS THE IDEA.
+        
+        Return JSON object (ESCAPE NEWLINES inside values!):
+        {{
+            "project_name": "snake_case_name",
+            "plan": "Markdown plan with \\n for newlines"
+        }}
+        """
+        with request_profiler.phase("ai"):
+            response = get_ai_model().generate_content(prompt)
+        result = clean_and_parse_json(response.text)
+        
+        if result:
+            return jsonify(result)
+        else:
+            # Fallback Manual Construction if JSON fails entirely
+            return jsonify({
+                "project_name": "project_fallback",
+                "plan": "# Generated Plan\nCheck details..."
+            })
+    except Exception as e:
+        print(f"Generation Error: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/edit-project', methods=['POST'])
+@coalesce_ai_request('edit-project')
+def edit_project():
+    try:
+        data = request.json or {}
+        project_name = str(data.get('project_name') or '').strip()
+        instruction = str(data.get('instruction') or '').strip()
+        user_email = str(data.get('user_email') or '').strip().lower()
+        engine = normalize_engine(data.get('engine'))
+        history = data.get('history') if isinstance(data.get('history'), list) else []
+        image_data_url = data.get('image_data_url', '')
+
+        if not project_name:
+            return jsonify({"error": "project_name is required"}), 400
+        if not instruction:
+            return jsonify({"error": "instruction is required"}), 400
+        # Edición libre — paywall solo al enviar a equipo humano
+        ok_tokens, token_msg, remaining = consume_user_tokens(
+            user_email,
+            CHAT_MESSAGE_TOKEN_COST,
+            reason="aplicar edición con IA"
+        )
+        if not ok_tokens:
+            return jsonify({"error": token_msg, "remaining_tokens": remaining}), 402
+
+        project_path = os.path.join(projects_base_dir, project_name)
+        if not os.path.isdir(project_path):
+            return jsonify({"error": "Project folder not found"}), 404
+
+        allowed_files = ["index.html", "styles.css", "style.css", "app.js", "script.js"]
+        file_snapshots = {}
+        for fname in allowed_files:
+            fpath = os.path.join(project_path, fname)
+            if os.path.exists(fpath):
+                with open(fpath, 'r', encoding='utf-8') as f:
+                    file_snapshots[fname] = f.read()
+            else:
+                file_snapshots[fname] = ""
+
+        if not any(file_snapshots.values()):
+            return jsonify({"error": "No editable project files found"}), 404
+
+        def _parse_changed_files(ai_payload):
+            if not ai_payload or not isinstance(ai_payload, dict):
+                return "", {}
+            summary_local = str(ai_payload.get("summary") or "Cambios aplicados por IA.").strip()
+            files_obj_local = ai_payload.get("files")
+            if not isinstance(files_obj_local, dict):
+                files_obj_local = {}
+            changed_local = {}
+            for fname in allowed_files:
+                if fname not in files_obj_local:
+                    continue
+                content = files_obj_local.get(fname)
+                if not isinstance(content, str):
+                    continue
+                cleaned = (
+                    content
+                    .replace("```html", "")
+                    .replace("```css", "")
+                    .replace("```javascript", "")
+                    .replace("```js", "")
+                    .replace("```", "")
+                    .strip()
+                )
+                if cleaned:
+                    changed_local[fname] = cleaned
+            return summary_local, changed_local
+
+        def _smoke_checks_for_html(changed_local):
+            checks = []
+            if "index.html" in changed_local:
+                html_out = changed_local["index.html"].lower()
+                checks.extend([
+                    {"name": "html_has_head", "ok": "<head" in html_out and "</head>" in html_out},
+                    {"name": "html_has_body", "ok": "<body" in html_out and "</body>" in html_out},
+                    {"name": "html_closed", "ok": "</html>" in html_out},
+                ])
+            return checks
+
+        build_intent = bool(re.search(
+            r"(crea|créalo|crealo|construye|construyelo|constrúyelo|completo|mvp|full app|aplicacion completa|aplicación completa)",
+            instruction.lower()
+        ))
+        ui_reference = describe_ui_reference(image_data_url) if image_data_url else ""
+        design_intent = bool(re.search(
+            r"(replica|recrear|inspira|inspirate|inspirar|igual que|como calm|diseñ[oó]|ui|ux|look and feel|layout)",
+            instruction.lower()
+        )) or bool(ui_reference)
+        strict_redesign_mode = build_intent or design_intent
+
+        reference_block = (
+            f"REFERENCIA VISUAL OBLIGATORIA (imagen adjunta):\n{ui_reference}\n"
+            "Debes aproximarte al look&feel de esa referencia en estructura, estilos y jerarquía visual."
+            if ui_reference else
+            "No hay referencia visual adjunta."
+        )
+
+        summary = "Cambios aplicados por IA."
+        changed_files = {}
+        smoke_checks = []
+        last_failure_reason = ""
+        max_attempts = 3
+        edit_mode = "full"
+
+        # Edición incremental: primero parches (search/replace o diff unificado);
+        # la reescritura completa queda como fallback.
+        history_block = compact_history(history)
+        if not strict_redesign_mode and not data.get('full_rewrite'):
+            # Solo los fragmentos relevantes a la instrucción, dentro del presupuesto de tokens.
+            files_context, context_stats = select_context(
+                file_snapshots,
+                f"{instruction} {ui_reference}",
+                budget_tokens=EDIT_CONTEXT_TOKENS,
+            )
+            log_debug(f"[EDIT CONTEXT] {project_name}: {context_stats}")
+            patch_feedback = ""
+            for patch_attempt in range(1, EDIT_PATCH_ATTEMPTS + 1):
+                patch_prompt = f"""
+Eres un Senior Software Engineer. Debes editar un proyecto real con precisión y cambios mínimos.
+
+PROYECTO: {project_name}
+INSTRUCCIÓN DEL USUARIO: {instruction}
+HISTORIAL RECIENTE:
+{history_block}
+{reference_block}
+{patch_feedback}
+
+ARCHIVOS ACTUALES:
+{files_context}
+""" + """
+REGLAS:
+- Devuelve SOLO ediciones puntuales en "edits", nunca el archivo completo.
+- Si solo ves fragmentos de un archivo, edita únicamente texto que aparece en ellos.
+- Cada edit: {"file", "search", "replace"}; "search" se copia literal del archivo actual
+  (3-8 líneas, suficiente contexto para que sea único). Alternativa: {"file", "diff"} con hunks de diff unificado.
+- Para crear un archivo vacío usa "search": "".
+- Mantén funcionalidad existente y el HTML como documento completo.
+"""
+                patch_payload = call_ai_json(
+                    patch_prompt,
+                    engine=engine,
+                    schema=EDIT_PATCH_SCHEMA,
+                    name="project_patch",
+                    timeout_seconds=45,
+                )
+                if patch_payload is None:
+                    break
+                patched, patch_errors = apply_edits(file_snapshots, patch_payload.get("edits"), allowed_files)
+                checks_try = _smoke_checks_for_html(patched)
+                if patched and not patch_errors and all(c["ok"] for c in checks_try):
+                    summary = str(patch_payload.get("summary") or summary).strip()
+                    changed_files = patched
+                    smoke_checks = checks_try
+                    edit_mode = "patch"
+                    break
+                reasons = patch_errors[:5] or (["no se aplicó ningún cambio"] if not patched else ["smoke checks de HTML fallaron"])
+                log_debug(f"[EDIT PATCH] {project_name} intento {patch_attempt}: {reasons}")
+                patch_feedback = "ERRORES DEL INTENTO ANTERIOR (corrige los bloques search): " + "; ".join(reasons)
+
+        for attempt in range(1, max_attempts + 1):
+            if changed_files:
+                break
+            feedback_block = f"Intento {attempt}/{max_attempts}."
+            if last_failure_reason:
+                feedback_block += f" Error previo a corregir: {last_failure_reason}"
+
+            if strict_redesign_mode:
+                mode_rules = """
+MODO: CONSTRUCCIÓN COMPLETA (no edición mínima).
+- Debes entregar una versión MVP usable y visualmente cuidada.
+- Entrega obligatoria: index.html + styles.css (o style.css) + app.js (o script.js).
+- Debe incluir UI moderna, layout responsive, componentes útiles y al menos 2 interacciones JS reales.
+- Prohibido entregar solo placeholders vacíos o texto genérico.
+- No uses "Coming soon", "TODO", ni secciones vacías.
+"""
+            else:
+                mode_rules = """
+MODO: EDICIÓN INCREMENTAL.
+- Cambia solo lo necesario para cumplir la instrucción.
+"""
+
+            prompt = f"""
+Eres un Senior Software Engineer. Debes editar un proyecto real con precisión.
+
+PROYECTO: {project_name}
+INSTRUCCIÓN DEL USUARIO: {instruction}
+HISTORIAL RECIENTE:
+{history_block}
+FEEDBACK DE INTENTOS: {feedback_block}
+{reference_block}
+
+ARCHIVOS ACTUALES:
+index.html:
+{file_snapshots.get('index.html', '')[:15000]}
+
+styles.css:
+{file_snapshots.get('styles.css', '')[:12000]}
+
+style.css:
+{file_snapshots.get('style.css', '')[:12000]}
+
+app.js:
+{file_snapshots.get('app.js', '')[:12000]}
+
+script.js:
+{file_snapshots.get('script.js', '')[:12000]}
+
+REGLAS:
+- Devuelve JSON válido, sin markdown.
+- Mantén funcionalidad existente.
+- Si tocas HTML, debe seguir siendo un documento HTML completo.
+- Puedes devolver uno o varios archivos modificados.
+{mode_rules}
+- Si hay referencia visual adjunta, prioriza reproducir su composición visual sobre estilos previos.
+- Cuando aplique, ajusta también CSS y JS para que el resultado no quede solo en texto plano.
+
+FORMATO OBLIGATORIO:
+{{
+  "summary": "qué se cambió en una frase",
+  "files": {{
+    "index.html": "contenido completo del archivo solo si cambió",
+    "styles.css": "contenido completo si cambió",
+    "style.css": "contenido completo si cambió",
+    "app.js": "contenido completo si cambió",
+    "script.js": "contenido completo si cambió"
+  }}
+}}
+"""
+            ai_payload = call_ai_json(
+                prompt,
+                engine=engine,
+                schema=EDIT_PROJECT_SCHEMA,
+                name="project_edit",
+                timeout_seconds=60,
+                max_tokens_override=AI_EDIT_MAX_TOKENS,
+            )
+            if ai_payload is None:
+                # Sin respuesta de ningún proveedor: reintentar la generación completa no ayuda.
+                last_failure_reason = "El motor de IA no respondió."
+                break
+            summary_try, changed_try = _parse_changed_files(ai_payload)
+            checks_try = _smoke_checks_for_html(changed_try)
+            checks_ok = all(c["ok"] for c in checks_try) if checks_try else True
+            css_present = ("styles.css" in changed_try or "style.css" in changed_try)
+            js_present = ("app.js" in changed_try or "script.js" in changed_try)
+
+            if not changed_try:
+                last_failure_reason = "No devolviste cambios de archivos válidos."
+                continue
+            if strict_redesign_mode and "index.html" not in changed_try:
+                last_failure_reason = "Falta index.html completo para modo construcción."
+                continue
+            if strict_redesign_mode and (not css_present or not js_present):
+                last_failure_reason = "En modo construcción debes incluir HTML + CSS + JS."
+                continue
+            if not checks_ok:
+                last_failure_reason = "Los smoke checks de HTML fallaron. Debes devolver un HTML completo válido."
+                continue
+
+            # Gate de calidad visual para evitar respuestas "mínimas".
+            if strict_redesign_mode:
+                html_candidate = changed_try.get("index.html", "")
+                if len(html_candidate) < 2800:
+                    last_failure_reason = "La salida fue demasiado simple. Debe ser una UI completa, no un bloque básico."
+                    continue
+                section_count = len(re.findall(r"<section\b", html_candidate.lower()))
+                if section_count < 3:
+                    last_failure_reason = "Faltan secciones suficientes. Se requieren al menos 3 secciones visibles."
+                    continue
+
+            summary = summary_try or summary
+            changed_files = changed_try
+            smoke_checks = checks_try
+            break
+
+        if not changed_files:
+            if strict_redesign_mode:
+                safe_title = project_name.replace("_", " ").title()
+                changed_files = templates.render_kit("redesign_fallback", {"safe_title": safe_title})
+                smoke_checks = _smoke_checks_for_html(changed_files)
+                summary = "Se aplico un fallback de UI completa (HTML/CSS/JS) porque el motor no devolvio edicion valida."
+            else:
+                if token_msg == "ok":
+                    remaining = refund_user_tokens(user_email, CHAT_MESSAGE_TOKEN_COST, reason="edición con IA fallida")
+                return jsonify({
+                    "error": "No valid file edits returned by AI after retries.",
+                    "detail": last_failure_reason or "Unknown edit failure.",
+                    "remaining_tokens": remaining
+                }), 500
+
+        build_report = []
+        for fname, new_content in changed_files.items():
+            old_content = file_snapshots.get(fname, "")
+            diff = list(difflib.unified_diff(
+                (old_content or "").splitlines(),
+                (new_content or "").splitlines(),
+                lineterm=''
+            ))
+            additions = len([l for l in diff if l.startswith('+') and not l.startswith('+++')])
+            deletions = len([l for l in diff if l.startswith('-') and not l.startswith('---')])
+            status = "updated" if old_content else "created"
+
+            with open(os.path.join(project_path, fname), 'w', encoding='utf-8') as f:
+                f.write(new_content)
+
+            build_report.append({
+                "file": fname,
+                "status": status,
+                "additions": additions,
+                "deletions": deletions
+            })
+
+        edit_version = record_project_version(project_name, "edit", summary=summary, author=user_email or None)
+
+        return jsonify({
+            "message": "Project updated",
+            "summary": summary,
+            "project_name": project_name,
+            "preview_url": f"/projects/{project_name}/index.html",
+            "changed_files": list(changed_files.keys()),
+            "build_report": build_report,
+            "smoke_checks": smoke_checks,
+            "remaining_tokens": remaining,
+            "engine_used": engine,
+            "edit_mode": edit_mode,
+            "version": edit_version["version"] if edit_version else None
+        })
+
+    except Exception as e:
+        print(f"Edit Error: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/create-project', methods=['POST'])
+@coalesce_ai_request('create-project')
+def create_project():
+    try:
+        data = request.json or {}
+        project_name = data.get('project_name')
+        plan_content = data.get('plan')
+        theme = data.get('theme', 'Modern Startup')
+        user_email = data.get('user_email') # Must be sent from frontend
+
+        # Auth: verify session matches requested email
+        session_email = session.get('user_email', '').strip().lower()
+        user_email_clean = (user_email or '').strip().lower()
+        if not session_email or session_email != user_email_clean:
+            return jsonify({"error": "You must be logged in"}), 401
+
+        if not user_email:
+            return jsonify({"error": "You must be logged in"}), 401
+        if not project_name: return jsonify({"error": "Project name required"}), 400
+
+        # Un build activo por proyecto: reintentos devuelven el mismo job sin cobrar de nuevo.
+        active_job = build_jobs.active_for_project(project_name)
+        if active_job:
+            return jsonify({
+                "message": "Build already in progress",
+                "job_id": active_job["id"],
+                "project_name": project_name,
+                "path": os.path.join(projects_base_dir, project_name),
+                "status_url": f"/api/status/{project_name}",
+                "job_url": f"/api/build-jobs/{active_job['id']}",
+                "build": _build_job_view(active_job),
+            }), 202
+
+        ok_tokens, token_msg, remaining = consume_build_quota(
+            user_email,
+            project_name,
+            reason="construir proyecto"
+        )
+        if not ok_tokens:
+            return jsonify({"error": token_msg, "remaining_tokens": remaining}), 402
+
+        # Registra el proyecto al encolar; un dueño previo no se sobrescribe.
+        project_index.add(project_name, user_email_clean)
+        job_id = build_jobs.enqueue(
+            "project_build",
+            {"project_name": project_name, "plan": plan_content, "theme": theme, "user_email": user_email,
+             "charged_tokens": BUILD_TOKEN_COST if token_msg == "ok" else 0},
+            project_id=project_name,
+            owner=user_email_clean,
+        )
+        return jsonify({
+            "message": "Build queued",
+            "job_id": job_id,
+            "project_name": project_name,
+            "path": os.path.join(projects_base_dir, project_name),
+            "builder_mode": "codex_like",
+            "status_url": f"/api/status/{project_name}",
+            "job_url": f"/api/build-jobs/{job_id}",
+            "remaining_tokens": remaining
+        }), 202
+
+    except Exception as e:
+        print(f"Creation Error: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/build-jobs/<job_id>', methods=['GET'])
+def get_build_job(job_id):
+    job = build_jobs.get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    owner = str(session.get('user_email') or '').strip().lower()
+    if job.get("owner") != owner and not require_internal_auth():
+        return jsonify({"error": "Unauthorized"}), 401
+    view = _build_job_view(job)
+    view["project_name"] = job.get("project_id")
+    view["result"] = job.get("result")
+    return jsonify(view)
+
+
+@bp.route('/api/status/<project_id>', methods=['GET'])
+def check_status(project_id):
+    status = get_order_status(project_id)
+    if not status:
+        return jsonify({"status": "unknown"}), 404
+    return jsonify(status)
+
+
+# File Management Routes
+@bp.route('/list-projects', methods=['GET'])
+def list_projects():
+    try:
+        email = str(request.args.get('email') or '').strip().lower()
+        if email:
+            projects = project_index.for_owner(email)
+            # Legacy fallback: if there is exactly one project and no owners yet, assign it.
+            if not projects and project_index.claim_sole_unowned(email):
+                projects = project_index.for_owner(email)
+            return jsonify(projects)
+        return jsonify(project_index.names())
+    except Exception as e:
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/projects-meta', methods=['GET'])
+def projects_meta():
+    try:
+        email = str(request.args.get('email') or '').strip().lower()
+        meta = load_project_meta()
+        if not email:
+            return jsonify(meta)
+        filtered = {}
+        for project in project_index.for_owner(email):
+            if project in meta:
+                filtered[project] = meta.get(project)
+        return jsonify(filtered)
+    except Exception as e:
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/delete-project', methods=['POST'])
+def delete_project():
+    try:
+        data = request.json or {}
+        project_name = sanitize_project_name(data.get('project_name', ''))
+        user_email = str(data.get('user_email') or '').strip().lower()
+        if not project_name:
+            return jsonify({"error": "project_name is required"}), 400
+        if user_email:
+            owner = project_index.owner_of(project_name)
+            if owner and owner != user_email:
+                return jsonify({"error": "You do not have permission to delete this project."}), 403
+        project_path = os.path.join(projects_base_dir, project_name)
+        if not os.path.abspath(project_path).startswith(os.path.abspath(projects_base_dir)):
+            return jsonify({"error": "Invalid project path"}), 403
+        if os.path.exists(project_path):
+            shutil.rmtree(project_path)
+            project_index.remove(project_name)
+            meta = load_project_meta()
+            if project_name in meta:
+                meta.pop(project_name, None)
+                save_project_meta(meta)
+            project_store.delete_project(project_name)
+            return jsonify({"message": "Deleted", "project_name": project_name})
+        return jsonify({"error": "Not found"}), 404
+    except Exception as e:
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/create-empty-project', methods=['POST'])
+def create_empty_project():
+    try:
+        data = request.json or {}
+        raw_name = data.get('project_name', '')
+        user_email = str(data.get('user_email') or '').strip().lower()
+        phone = str(data.get('phone') or '').strip()
+        if not user_email:
+            return jsonify({"error": "login_required"}), 401
+        project_name = sanitize_project_name(raw_name)
+        project_path = os.path.join(projects_base_dir, project_name)
+        theme = str(data.get('theme') or '').strip()[:100]
+        # Kits de starter_templates/ cuyo nombre empieza por "starter" (starter, starter_saas, ...).
+        starter_kit = str(data.get('starter') or 'starter').strip().lower()
+        if not starter_kit.startswith('starter') or not templates.has_kit(starter_kit):
+            starter_kit = 'starter'
+
+        if os.path.exists(project_path):
+            # Si el proyecto ya existe y le pertenece al mismo usuario, retornarlo como éxito
+            existing_owner = project_index.owner_of(project_name) or ''
+            if existing_owner == user_email:
+                return jsonify({"project_name": project_name, "project_id": project_name, "resumed": True}), 200
+            return jsonify({"error": "That project name is already taken. Please choose a different name."}), 409
+
+        os.makedirs(project_path, exist_ok=True)
+
+        # Save owner mapping
+        project_index.add(project_name, user_email, replace=True)
+
+        # Save metadata (phone, owner, description, wizard fields)
+        description = str(data.get('description') or '').strip()[:500]
+        project_type = str(data.get('project_type') or '').strip()[:100]
+        business_model = str(data.get('business_model') or '').strip()[:100]
+        stage = str(data.get('stage') or '').strip()[:100]
+        meta = load_project_meta()
+        meta[project_name] = {
+            "phone": phone,
+            "owner": user_email,
+            "description": description,
+            "project_type": project_type,
+            "business_model": business_model,
+            "stage": stage,
+            "created_at": datetime.utcnow().isoformat()
+        }
+        save_project_meta(meta)
+
+        for fname, content in templates.render_kit(starter_kit, {"project_name": project_name}, theme=theme).items():
+            dest = os.path.join(project_path, *fname.split('/'))
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            with open(dest, 'w', encoding='utf-8') as f:
+                f.write(content)
+        record_project_version(project_name, "create", summary="Starter page", author=user_email)
+
+        # SMS notifications for new project (encolados en el outbox)
+        def _sms_project():
+            display = project_name.replace('_', ' ').title()
+            # SMS to client
+            if phone:
+                _send_sms(
+                    to_phone=phone,
+                    body=f"Hi! Your project \"{display}\" has been created on Anmar Enterprises. Our team will start working on it shortly. Reply STOP to unsubscribe."
+                )
+            # SMS to admin
+            if TWILIO_ADMIN_PHONE:
+                _send_sms(
+                    to_phone=TWILIO_ADMIN_PHONE,
+                    body=f"🚀 New project created!\nProject: {display}\nOwner: {user_email}\nPhone: {phone or 'not provided'}\nType: {project_type or 'N/A'}\nStage: {stage or 'N/A'}"
+                )
+        _sms_project()
+
+        return jsonify({
+            "status": "ok",
+            "project_name": project_name,
+            "preview_url": f"/projects/{project_name}/index.html"
+        })
+    except Exception as e:
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/delete-all-projects', methods=['POST'])
+def delete_all_projects():
+    if _rate_limit(request.remote_addr, max_requests=2, window=60):
+        return jsonify({"error": "Too many attempts."}), 429
+    try:
+        if not os.path.exists(projects_base_dir):
+            return jsonify({"status": "ok", "deleted": 0})
+        deleted = 0
+        # Se mueven a una carpeta oculta (rename, mismo disco) y se borran en background.
+        trash = os.path.join(projects_base_dir, f".trash-{uuid.uuid4().hex[:8]}")
+        os.makedirs(trash, exist_ok=True)
+        for name in os.listdir(projects_base_dir):
+            path = os.path.join(projects_base_dir, name)
+            if os.path.isdir(path) and not name.startswith('.'):
+                os.replace(path, os.path.join(trash, name))
+                project_store.delete_project(name)
+                project_index.remove(name)
+                deleted += 1
+        threading.Thread(target=shutil.rmtree, args=(trash,), kwargs={"ignore_errors": True}, daemon=True).start()
+        return jsonify({"status": "ok", "deleted": deleted})
+    except Exception as e:
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/projects/<path:filename>')
+def serve_projects(filename):
+    # Serve files from generated projects
+    full_path = safe_join(projects_base_dir, filename)
+    if not full_path or not os.path.isfile(full_path) or filename.endswith(('.gz', '.br', '.tmp')):
+        return jsonify({"error": "Not found"}), 404
+    project_name = filename.replace('\\', '/').split('/', 1)[0]
+
+    encodings = [enc for enc, suffix in (("br", ".br"), ("gzip", ".gz")) if variant_is_fresh(full_path, suffix)]
+    encoding = negotiate_encoding(request.headers.get('Accept-Encoding', ''), encodings)
+    etag = _preview_etag(project_name, filename, full_path, encoding)
+    headers = {'Vary': 'Accept-Encoding', 'Cache-Control': PREVIEW_CACHE_CONTROL}
+    if etag:
+        headers['ETag'] = etag
+    if _etag_matches(request.headers.get('If-None-Match'), etag):
+        CACHE_REQUESTS.labels("preview_etag", "hit").inc()
+        return Response(status=304, headers=headers)
+    if etag:
+        CACHE_REQUESTS.labels("preview_etag", "miss").inc()
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    if PREVIEW_OFFLOAD in ('x-accel', 'x-sendfile'):
+        response = Response(status=200, mimetype=mimetype, headers=headers)
+        if PREVIEW_OFFLOAD == 'x-accel':
+            # nginx decide la codificación con gzip_static/brotli_static.
+            response.headers['X-Accel-Redirect'] = f"{PREVIEW_ACCEL_PREFIX}/{filename}"
+        else:
+            sendfile_path = full_path + ('.br' if encoding == 'br' else '.gz') if encoding else full_path
+            response.headers['X-Sendfile'] = os.path.abspath(sendfile_path)
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+        return response
+
+    if encoding:
+        response = send_file(full_path + ('.br' if encoding == 'br' else '.gz'), mimetype=mimetype, etag=False)
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response = send_file(full_path, mimetype=mimetype, etag=False)
+    response.headers.update(headers)
+    return response
+
+
+@bp.route('/api/projects/<project_name>/versions', methods=['GET'])
+def project_versions(project_name):
+    project_name = sanitize_project_name(project_name)
+    if not can_access_project(project_name):
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        current, versions = project_store.list_versions(project_name)
+        return jsonify({"project_name": project_name, "current": current, "versions": versions[::-1]})
+    except Exception as e:
+        print(f"[VERSIONS] list error: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/projects/<project_name>/rollback', methods=['POST'])
+def rollback_project(project_name):
+    project_name = sanitize_project_name(project_name)
+    if not can_access_project(project_name):
+        return jsonify({"error": "Unauthorized"}), 401
+    data = request.json or {}
+    try:
+        version_number = int(data.get('version'))
+    except (TypeError, ValueError):
+        return jsonify({"error": "version is required"}), 400
+    project_path = os.path.join(projects_base_dir, project_name)
+    if not os.path.isdir(project_path):
+        return jsonify({"error": "Project folder not found"}), 404
+    try:
+        actor = session.get('user_email') or session.get('internal_user')
+        restored = project_store.rollback(project_name, project_path, version_number, author=actor)
+        if not restored:
+            return jsonify({"error": "Version not found"}), 404
+        precompress_project(project_name)
+        return jsonify({
+            "status": "ok",
+            "project_name": project_name,
+            "version": restored["version"],
+            "restored_from": version_number,
+            "files": sorted(restored["files"].keys()),
+            "preview_url": f"/projects/{project_name}/index.html"
+        })
+    except Exception as e:
+        print(f"[VERSIONS] rollback error: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/projects/<project_name>/export', methods=['GET'])
+def export_project(project_name):
+    project_name = sanitize_project_name(project_name)
+    if not can_access_project(project_name):
+        return jsonify({"error": "Unauthorized"}), 401
+    if not os.path.isdir(os.path.join(projects_base_dir, project_name)):
+        return jsonify({"error": "Project folder not found"}), 404
+    fmt = 'zip' if request.args.get('format') == 'zip' else 'tar'
+    return _export_response([project_name], fmt, project_name)
@@ -0,0 +1,829 @@
+"""
+Business-model chat routes: the BM generator, chat memory, the continue-*
+conversations, turn/idea analysis, the human chat bridge and the AI health
+check.
+"""
+import json
+import os
+import uuid
+from datetime import datetime
+from flask import Blueprint, jsonify, request, session
+from structured_output import coerce_to_schema
+from app import (
+    AI_RUNTIME, ANTHROPIC_API_KEY, BASE_DIR, BUSINESS_MODEL_SCHEMA, CAPITAL_SYSTEM_PROMPT,
+    TWILIO_ADMIN_PHONE, _rate_limit, analyze_turn_state, append_ticket_event, call_ai_text,
+    call_anthropic_chat, call_anthropic_json, coalesce_ai_request, compose_consultant_reply,
+    compute_brief_score, consume_chat_message_quota, describe_image_for_chat, detect_language,
+    generate_contextual_options, get_ai_model, get_chat_memory, get_db_connection,
+    get_user_token_balance, has_reset_intent, is_user_subscribed, load_alerts, load_human_chats,
+    log_debug, normalize_engine, queue_admin_chat_alert, require_internal_auth,
+    reset_memory_payload, save_alerts, save_chat_memory, save_human_chats, set_ticket_status,
+    trim_history_after_last_reset,
+)
+
+bp = Blueprint("chat", __name__)
+
+
+@bp.route('/api/generate-business-model', methods=['POST'])
+@coalesce_ai_request('generate-business-model')
+def generate_business_model():
+    """Generate a personalized business model analysis using Anthropic. Returns full JSON."""
+    data = request.json or {}
+    project_name    = data.get('project_name', 'tu proyecto')
+    description     = data.get('description', '')
+    project_type    = data.get('project_type', '')
+    biz_model_type  = data.get('business_model', '')
+    audience        = data.get('audience', '')
+    geography       = data.get('geography', '')
+    stage           = data.get('stage', '')
+
+    if not ANTHROPIC_API_KEY:
+        return jsonify({'error': 'AI not available'}), 503
+
+    prompt = f"""You are a world-class business analyst and venture strategist with access to real market data.
+An entrepreneur just described their idea. Generate a DEEP, SPECIFIC, IMPRESSIVE business analysis using real numbers and real company names.
+
+CRITICAL: RESPOND ENTIRELY IN ENGLISH. Every single field must be in English.
+
+PROJECT DATA:
+- Name: {project_name}
+- Description: {description}
+- Type: {project_type}
+- Business model: {biz_model_type}
+- Target audience: {audience}
+- Target geography: {geography}
+- Current stage: {stage}
+
+Respond ONLY with a valid JSON object. No markdown, no code fences, no extra text. Use this EXACT structure:
+{{
+  "market": {{
+    "size": "Total Addressable Market with real USD figure (e.g. '$18.4B TAM')",
+    "sam": "Serviceable Addressable Market — realistic capture for this product (e.g. '$1.2B SAM')",
+    "growth": "CAGR with specific years (e.g. '27.3% CAGR 2024–2031')",
+    "insight": "One sharp, non-obvious observation about WHY this specific moment is ideal to enter — cite a recent shift, regulation, or behavior change",
+    "trends": [
+      "Specific macro trend driving this market right now",
+      "Behavioral or technological shift creating the opening",
+      "Regulatory or economic factor accelerating adoption"
+    ]
+  }},
+  "competitors": [
+    {{"name": "Real company name", "share": "~XX% market share", "weakness": "Their biggest gap that {project_name} can exploit", "strength": "What they genuinely do best"}},
+    {{"name": "Real company name 2", "share": "~XX% market share", "weakness": "Their biggest gap", "strength": "Their strongest trait"}},
+    {{"name": "Real company name 3", "share": "~XX% market share", "weakness": "Their biggest gap", "strength": "Their strongest trait"}}
+  ],
+  "advantage": {{
+    "main": "The single strongest and most specific competitive advantage of {project_name} — be concrete, not generic",
+    "moat": "What makes this defensible and hard to replicate in 12–18 months",
+    "differentiation": "In one sentence: exactly how this differs from existing solutions in terms a customer would notice"
+  }},
+  "risk": {{
+    "description": "The most critical, specific risk for this exact business at this stage",
+    "mitigation": "2–3 concrete actions to reduce this risk starting now",
+    "probability": "Low"
+  }},
+  "persona": {{
+    "name": "Full description of ideal first customer (e.g. 'Marcus, 38, VP of Operations at a 50-person logistics startup')",
+    "painPoint": "The exact painful problem they face today that {project_name} eliminates — be specific",
+    "willingness": "Why they would pay and estimated amount (e.g. 'Would pay $X/mo — saves 12 hrs/week and replaces a $X/yr tool')"
+  }},
+  "channels": [
+    {{"name": "Channel name", "reason": "Why this specific channel works for this exact product and audience"}},
+    {{"name": "Channel name", "reason": "Why this specific channel works for this exact product and audience"}},
+    {{"name": "Channel name", "reason": "Why this specific channel works for this exact product and audience"}}
+  ],
+  "score": {{
+    "overall": <integer 0-100 reflecting genuine strength of this idea based on market, timing, advantage and risk>,
+    "grade": "<A+|A|A-|B+|B|B-|C+|C — matching the overall score>",
+    "breakdown": {{
+      "market": <0-100 — how large and accessible the market is>,
+      "timing": <0-100 — how good the timing is right now>,
+      "advantage": <0-100 — how strong and defensible the competitive advantage is>,
+      "risk": <0-100 — how manageable the risks are, higher = less risky>
+    }},
+    "verdict": "One compelling sentence summarizing why this idea is or isn't ready for investment"
+  }},
+  "revenue": {{
+    "year1": "Realistic Year 1 revenue (e.g. '$120K')",
+    "year2": "Year 2 projection (e.g. '$680K')",
+    "year3": "Year 3 projection (e.g. '$2.4M')",
+    "assumption": "Key assumption driving these projections (e.g. '2% SAM penetration by Y3 at $X/mo ACV')"
+  }},
+  "analogy": {{
+    "company": "Name of a real successful company with similar positioning or model",
+    "raised": "How much they raised or their current valuation (e.g. 'Raised $275M' or '$4.2B valuation')",
+    "insight": "One sentence on why {project_name} has a similar opportunity right now"
+  }},
+  "nextStep": "The single most important action in the next 7 days to validate this and build real momentum"
+}}"""
+
+    try:
+        parsed, complete = call_anthropic_json(
+            prompt,
+            BUSINESS_MODEL_SCHEMA,
+            tool_name="business_model",
+            system_prompt="You are a business analyst. Return the analysis through the business_model tool.",
+            timeout_seconds=45,
+            max_tokens_override=2048,
+        )
+        if not parsed:
+            return jsonify({'error': 'AI timeout or unavailable'}), 503
+        parsed, schema_errors = coerce_to_schema(parsed, BUSINESS_MODEL_SCHEMA)
+        if schema_errors and not complete:
+            return jsonify({'error': 'Invalid AI response', 'raw': json.dumps(parsed)[:300]}), 500
+
+        # ── Cache BM result so internal panel can load it ─────────────────────
+        try:
+            bm_cache_path = os.path.join(BASE_DIR, 'backend', 'bm_cache.json')
+            bm_cache = {}
+            if os.path.exists(bm_cache_path):
+                with open(bm_cache_path, 'r') as _f:
+                    bm_cache = json.load(_f)
+            cache_key = project_name.lower().strip().replace(' ', '_')
+            bm_cache[cache_key] = {
+                'data': parsed,
+                'project_name': project_name,
+                'updated_at': datetime.utcnow().isoformat()
+            }
+            with open(bm_cache_path, 'w') as _f:
+                json.dump(bm_cache, _f)
+        except Exception as _e:
+            print(f'[BM Cache] Error saving: {_e}')
+
+        return jsonify({'ok': True, 'data': parsed})
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@bp.route('/api/bm-data', methods=['GET'])
+def get_bm_data():
+    """Return cached BM analysis for a project. Used by internal panel for context."""
+    # BUG FIX: require authentication — internal team OR the project owner
+    is_internal = bool(session.get('internal_user'))
+    is_client   = bool(session.get('user_email'))
+    if not is_internal and not is_client:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    project_name = request.args.get('project_name', '').lower().strip().replace(' ', '_')
+    if not project_name:
+        return jsonify({'error': 'project_name required'}), 400
+
+    # Ownership check: clients may only access their own project's BM
+    if is_client and not is_internal:
+        client_email = session.get('user_email', '').strip().lower()
+        alerts = load_alerts()
+        project_ticket = next(
+            (t for t in alerts if str(t.get('project_name', '')).lower().replace(' ', '_') == project_name),
+            None
+        )
+        # If ticket exists, verify caller is the owner
+        if project_ticket and project_ticket.get('client_email', '').lower() != client_email:
+            return jsonify({'error': 'Forbidden'}), 403
+
+    bm_cache_path = os.path.join(BASE_DIR, 'backend', 'bm_cache.json')
+    if not os.path.exists(bm_cache_path):
+        return jsonify({'error': 'No BM cache found'}), 404
+    try:
+        with open(bm_cache_path, 'r') as f:
+            bm_cache = json.load(f)
+    except Exception:
+        return jsonify({'error': 'Error reading BM cache'}), 500
+    # Try both underscore and space variants
+    data = (bm_cache.get(project_name)
+            or bm_cache.get(project_name.replace('_', ' '))
+            or bm_cache.get(project_name.replace(' ', '_')))
+    if not data:
+        return jsonify({'error': 'BM not found for this project'}), 404
+    return jsonify(data)
+
+
+@bp.route('/api/chat-memory', methods=['GET'])
+def read_chat_memory():
+    email = request.args.get('email', '').strip().lower()
+    project_name = request.args.get('project_name', '').strip().lower()
+    if not email:
+        return jsonify({"error": "email is required"}), 400
+    # Auth: only the owner or an internal user may read memory
+    is_internal = bool(session.get('internal_user'))
+    session_email = session.get('user_email', '').strip().lower()
+    if not is_internal and (not session_email or session_email != email):
+        return jsonify({"error": "Unauthorized"}), 401
+    memory = get_chat_memory(email, project_name=project_name)
+    return jsonify({"memory": memory or {}})
+
+
+@bp.route('/api/chat-memory', methods=['POST'])
+def write_chat_memory():
+    data = request.json or {}
+    email = (data.get('email') or '').strip().lower()
+    project_name = (data.get('project_name') or '').strip().lower()
+    # Auth: only the owner may write their own memory
+    session_email = session.get('user_email', '').strip().lower()
+    if not session_email or session_email != email:
+        return jsonify({"error": "Unauthorized"}), 401
+    memory = data.get('memory')
+    if not email:
+        return jsonify({"error": "email is required"}), 400
+    if not isinstance(memory, dict):
+        return jsonify({"error": "memory must be an object"}), 400
+
+    # Merge with existing memory to avoid losing agent state.
+    existing = get_chat_memory(email, project_name=project_name) or {}
+    merged = dict(existing)
+    merged.update(memory)
+
+    # Keep payload bounded and predictable.
+    history = merged.get('conversation_history', [])
+    if isinstance(history, list):
+        merged['conversation_history'] = history[-40:]
+    else:
+        merged['conversation_history'] = []
+
+    merged['chat_stage'] = str(merged.get('chat_stage', 'initial'))
+    merged['current_project_name'] = str(merged.get('current_project_name', ''))
+    merged['current_ticket_project_id'] = str(merged.get('current_ticket_project_id', ''))
+    merged['summary'] = str(merged.get('summary', ''))[:500]
+    merged['audience'] = str(merged.get('audience', ''))[:500]
+    merged['business_model'] = str(merged.get('business_model', ''))[:500]
+    merged['timeline'] = str(merged.get('timeline', ''))[:250]
+
+    save_chat_memory(email, merged, project_name=project_name)
+    return jsonify({"status": "ok"})
+
+
+@bp.route('/api/chat-memory/reset', methods=['POST'])
+def reset_chat_memory_endpoint():
+    data = request.json or {}
+    email = (data.get('email') or '').strip().lower()
+    project_name = (data.get('project_name') or '').strip().lower()
+    if not email:
+        return jsonify({"error": "email is required"}), 400
+    # Auth: only the owner or internal user may reset memory
+    is_internal = bool(session.get('internal_user'))
+    session_email = session.get('user_email', '').strip().lower()
+    if not is_internal and (not session_email or session_email != email):
+        return jsonify({"error": "Unauthorized"}), 401
+
+    existing = get_chat_memory(email, project_name=project_name) or {}
+    reset_payload = reset_memory_payload(existing)
+    save_chat_memory(email, reset_payload, project_name=project_name)
+    return jsonify({"status": "ok", "memory": reset_payload})
+
+
+@bp.route('/analyze-idea', methods=['POST'])
+def analyze_idea():
+    if _rate_limit(request.remote_addr, max_requests=10, window=60):
+        return jsonify({"error": "Rate limit exceeded"}), 429
+    try:
+        data = request.json or {}
+        idea = data.get('idea', '').strip()
+        image_data_url = data.get('image_data_url', '')
+        engine = normalize_engine(data.get('engine'))
+        user_email = (data.get('user_email') or '').strip().lower()
+        project_name = (data.get('project_name') or '').strip().lower()
+        # Chat con IA es libre — paywall solo al enviar a equipo humano (/api/create-ticket)
+        image_context = describe_image_for_chat(image_data_url) if image_data_url else ""
+        enriched_idea = idea
+        if image_context:
+            enriched_idea = f"{idea}\n\nContexto de imagen adjunta:\n{image_context}".strip()
+        elif image_data_url and not idea:
+            enriched_idea = "El usuario adjuntó una imagen. Analiza el contexto visual para definir el producto."
+        ok_tokens, token_msg, remaining = consume_chat_message_quota(
+            user_email,
+            project_name,
+            reason="enviar mensaje al chat"
+        )
+        if not ok_tokens:
+            return jsonify({"error": token_msg, "remaining_tokens": remaining}), 402
+        if has_reset_intent(idea):
+            if user_email:
+                save_chat_memory(
+                    user_email,
+                    reset_memory_payload(get_chat_memory(user_email, project_name=project_name) or {}),
+                    project_name=project_name
+                )
+            return jsonify({
+                "status": "chat",
+                "message": "Done, we reset context. Let's start fresh: tell me your new idea in one sentence.",
+                "ready_to_build": False
+            })
+        history = [{"role": "user", "content": enriched_idea}]
+
+        existing_memory = None
+        if user_email:
+            stored = get_chat_memory(user_email, project_name=project_name) or {}
+            existing_memory = stored.get("agent_memory") if isinstance(stored, dict) else None
+
+        analysis = analyze_turn_state(history, enriched_idea, existing_memory=existing_memory)
+        reply = compose_consultant_reply(analysis, enriched_idea, history, engine=engine)
+
+        if user_email:
+            to_store = get_chat_memory(user_email, project_name=project_name) or {}
+            to_store["agent_memory"] = analysis["memory"]
+            to_store["summary"] = analysis["memory"].get("summary", "")
+            to_store["audience"] = analysis["memory"].get("audience", "")
+            to_store["business_model"] = analysis["memory"].get("business_model", "")
+            to_store["timeline"] = analysis["memory"].get("timeline", "")
+            to_store["engine_preference"] = engine
+            save_chat_memory(user_email, to_store, project_name=project_name)
+
+        return jsonify({
+            "status": "chat",
+            "message": reply,
+            "ready_to_build": analysis["ready_to_build"],
+            "ready_by_data": analysis.get("ready_by_data", False),
+            "missing_fields": analysis.get("missing_fields", []),
+            "brief_score": compute_brief_score(analysis.get("missing_fields", [])),
+            "remaining_tokens": remaining,
+            "memory_summary": analysis["memory"].get("summary", ""),
+            "memory_snapshot": {
+                "audience": analysis["memory"].get("audience", ""),
+                "business_model": analysis["memory"].get("business_model", ""),
+                "timeline": analysis["memory"].get("timeline", ""),
+                "features": analysis["memory"].get("features", []),
+            },
+            "engine_used": engine
+        })
+
+    except Exception as e:
+        print(f"Analyze Error: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/human-chat/send', methods=['POST'])
+def send_human_chat():
+    try:
+        data = request.json or {}
+        project_name = (data.get('project_name') or '').strip().lower()
+        role = data.get('role', 'human') # 'human' or 'client'
+        content = (data.get('content') or data.get('message') or '').strip()
+        actor = data.get('actor') or data.get('sender') or ''
+        client_email = (data.get('client_email') or '').strip().lower()
+        kind = (data.get('kind') or '').strip().lower()
+        payload = data.get('payload')
+
+        if role in ('human', 'internal') or kind == 'blueprint':
+            if not require_internal_auth():
+                return jsonify({"error": "unauthorized"}), 401
+            # For internal users, override actor with verified session identity
+            internal_user = session.get('internal_user', '')
+            if internal_user:
+                actor = internal_user
+        if role == 'client':
+            if not client_email:
+                return jsonify({"error": "You have not logged in."}), 401
+            # BUG FIX: verify client_email matches the authenticated session to prevent impersonation
+            # FIXED: changed from `if session_email and ...` to `if not session_email or ...`
+            # to prevent bypass when no session exists (unauthenticated attacker)
+            session_email = session.get('user_email', '').lower()
+            if not session_email or session_email != client_email.lower():
+                return jsonify({"error": "Forbidden"}), 403
+            if not is_user_subscribed(client_email):
+                return jsonify({"error": "Plan is required to chat with the team.", "code": "subscription_required"}), 402
+            # For clients, get verified name from DB to prevent spoofing
+            try:
+                conn = get_db_connection()
+                user_row = conn.execute('SELECT name FROM users WHERE email = ?', (client_email,)).fetchone()
+                conn.close()
+                if user_row and user_row['name']:
+                    actor = user_row['name']
+                else:
+                    actor = client_email
+            except Exception:
+                actor = client_email
+        
+        if not project_name or not content:
+            return jsonify({"error": "Missing parameters"}), 400
+            
+        chats = load_human_chats()
+        if project_name not in chats:
+            chats[project_name] = []
+            
+        message = {
+            "id": str(uuid.uuid4()),
+            "role": role,
+            "content": content,
+            "actor": actor,
+            "sender": actor,
+            "timestamp": datetime.now().isoformat()
+        }
+        if kind:
+            message["kind"] = kind
+        if payload is not None:
+            message["payload"] = payload
+        chats[project_name].append(message)
+        
+        save_human_chats(chats)
+        # Ensure an internal ticket exists and stays updated with unread counts.
+        try:
+            alerts = load_alerts()
+            ticket = next((t for t in alerts if str(t.get("project_name", "")).lower() == project_name), None)
+            now = datetime.now().isoformat()
+            summary_text = content[:140]
+            base_project = project_name[:-11] if project_name.endswith("__marketing") else project_name
+            if not ticket:
+                # Look up client plan for display in panel
+                client_plan = 'none'
+                try:
+                    _conn = get_db_connection()
+                    _row = _conn.execute('SELECT subscription_plan FROM users WHERE email_normalized = ?', (client_email.strip().lower(),)).fetchone()
+                    _conn.close()
+                    if _row: client_plan = _row['subscription_plan'] or 'none'
+                except Exception: pass
+
+                ticket = {
+                    "id": str(uuid.uuid4())[:8],
+                    "project_name": project_name,
+                    "client_email": client_email,
+                    "summary": summary_text,
+                    "timestamp": now,
+                    "updated_at": now,
+                    "status": "pending",
+                    "priority": "high",
+                    "channel": "validate",
+                    "client_plan": client_plan,
+                    "preview_url": f"/projects/{base_project}/index.html",
+                    "unread_messages": 0,
+                    "events": []
+                }
+                alerts.insert(0, ticket)
+            else:
+                if client_email:
+                    ticket["client_email"] = client_email
+                if summary_text:
+                    ticket["summary"] = summary_text
+                ticket["updated_at"] = now
+
+            if role == "client":
+                ticket["unread_messages"] = int(ticket.get("unread_messages") or 0) + 1
+                append_ticket_event(ticket, ticket.get("status", "pending"), "Nuevo mensaje del cliente.", actor="client")
+            else:
+                ticket["unread_messages"] = 0
+                append_ticket_event(ticket, ticket.get("status", "pending"), "Respuesta enviada al cliente.", actor=actor or "engineer")
+            save_alerts(alerts)
+        except Exception as e:
+            print(f"Error updating internal alerts for human chat: {e}")
+
+        # SMS notification to admin when a paying client sends a message
+        if role == "client" and TWILIO_ADMIN_PHONE:
+            try:
+                queue_admin_chat_alert(project_name, actor or client_email, content)
+            except Exception as e:
+                print(f"[SMS] Error sending admin alert: {e}")
+
+        return jsonify({"status": "success"})
+    except Exception as e:
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/human-chat/history', methods=['GET'])
+def get_human_chat_history():
+    try:
+        project_name = (request.args.get('project_name') or '').strip().lower()
+        mark_read = str(request.args.get('mark_read', '')).lower() in ('1', 'true', 'yes')
+        if not project_name:
+            return jsonify({"error": "Missing project_name"}), 400
+
+        # Auth: allow internal users OR the client who owns the project
+        client_email = (request.args.get('client_email') or request.args.get('email') or '').strip().lower()
+        is_internal = require_internal_auth()
+        if not is_internal:
+            # Verify client owns this project by checking alerts/tickets
+            if not client_email:
+                return jsonify({"error": "Authentication required"}), 401
+            alerts = load_alerts()
+            project_owner = next(
+                (t.get('client_email', '') for t in alerts if str(t.get('project_name', '')).lower() == project_name),
+                None
+            )
+            # Allow if project doesn't exist in alerts (new chat) or email matches
+            if project_owner and project_owner.lower() != client_email:
+                return jsonify({"error": "You do not have access to this project"}), 403
+
+        chats = load_human_chats()
+        history = chats.get(project_name, [])
+        if mark_read:
+            try:
+                alerts = load_alerts()
+                ticket = next((t for t in alerts if str(t.get("project_name", "")).lower() == project_name), None)
+                if ticket:
+                    ticket["unread_messages"] = 0
+                    ticket["updated_at"] = datetime.now().isoformat()
+                    save_alerts(alerts)
+            except Exception as e:
+                print(f"Error marking chat read: {e}")
+        return jsonify({"history": history})
+    except Exception as e:
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/human-chat/accept-blueprint', methods=['POST'])
+def accept_blueprint():
+    try:
+        data = request.json or {}
+        project_name = (data.get('project_name') or '').strip().lower()
+        blueprint_id = str(data.get('blueprint_id') or '').strip()
+        actor = str(data.get('actor') or 'Client').strip()
+        client_email = (data.get('client_email') or '').strip().lower()
+        if not project_name or not blueprint_id:
+            return jsonify({"error": "Missing parameters"}), 400
+
+        # Auth: require Flask session — prevent unauthenticated blueprint approval
+        session_email = session.get('user_email', '').strip().lower()
+        if not session_email:
+            return jsonify({"error": "Authentication required"}), 401
+        # client_email in body must match the session to prevent CSRF/impersonation
+        if client_email and client_email != session_email:
+            return jsonify({"error": "Forbidden"}), 403
+        # Use session email as canonical identity
+        if not client_email:
+            client_email = session_email
+
+        alerts = load_alerts()
+        project_ticket = next(
+            (t for t in alerts if str(t.get('project_name', '')).lower() == project_name),
+            None
+        )
+        if project_ticket and project_ticket.get('client_email', '').lower() != client_email:
+            return jsonify({"error": "You do not have permission to approve this blueprint"}), 403
+
+        chats = load_human_chats()
+        if project_name not in chats:
+            return jsonify({"error": "Project not found"}), 404
+
+        target = None
+        for msg in chats[project_name]:
+            if str(msg.get("id")) == blueprint_id:
+                target = msg
+                break
+
+        if not target or target.get("kind") != "blueprint":
+            return jsonify({"error": "Blueprint not found"}), 404
+
+        target["accepted"] = True
+        target["accepted_at"] = datetime.now().isoformat()
+        if client_email:
+            target["accepted_by"] = client_email
+
+        # Add confirmation message from client.
+        chats[project_name].append({
+            "id": str(uuid.uuid4()),
+            "role": "client",
+            "content": "✅ Blueprint approved. Ready to start.",
+            "actor": actor,
+            "timestamp": datetime.now().isoformat(),
+            "kind": "blueprint_accept"
+        })
+        save_human_chats(chats)
+
+        # Update internal ticket status to developing (if exists) and mark unread.
+        try:
+            alerts = load_alerts()
+            ticket = next((t for t in alerts if str(t.get("project_name", "")).lower() == project_name), None)
+            if ticket:
+                set_ticket_status(ticket.get("id"), "developing", actor="client", engineer=ticket.get("engineer"))
+                refreshed = load_alerts()
+                ticket_ref = next((t for t in refreshed if str(t.get("project_name", "")).lower() == project_name), None)
+                if ticket_ref:
+                    ticket_ref["unread_messages"] = int(ticket_ref.get("unread_messages") or 0) + 1
+                    ticket_ref["updated_at"] = datetime.now().isoformat()
+                    append_ticket_event(ticket_ref, ticket_ref.get("status", "developing"), "Blueprint approved by client.", actor=actor)
+                    save_alerts(refreshed)
+        except Exception as e:
+            print(f"Error updating ticket after blueprint accept: {e}")
+
+        return jsonify({"status": "ok"})
+    except Exception as e:
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/continue-chat', methods=['POST'])
+def continue_chat():
+    try:
+        data = request.json or {}
+        history = trim_history_after_last_reset(data.get('history', []))
+        current_input = data.get('message', '').strip()
+        image_data_url = data.get('image_data_url', '')
+        engine = normalize_engine(data.get('engine'))
+        user_email = (data.get('user_email') or '').strip().lower()
+        project_name = (data.get('project_name') or '').strip().lower()
+
+        # Auth: verify session matches requested email
+        session_email = session.get('user_email', '').strip().lower()
+        if not session_email or session_email != user_email:
+            return jsonify({"error": "You must be logged in"}), 401
+
+        if not user_email:
+            return jsonify({"error": "login_required"}), 401
+        if not project_name:
+            return jsonify({"error": "project_required"}), 400
+        image_context = describe_image_for_chat(image_data_url) if image_data_url else ""
+        enriched_input = current_input
+        if image_context:
+            enriched_input = f"{current_input}\n\nAttached image context:\n{image_context}".strip()
+        elif image_data_url and not current_input:
+            enriched_input = "The user attached an image. Analyze the visual context and continue the brief."
+
+        if not enriched_input:
+            return jsonify({"error": "message is required"}), 400
+        remaining = get_user_token_balance(user_email) if user_email else None
+        if has_reset_intent(current_input):
+            if user_email:
+                save_chat_memory(
+                    user_email,
+                    reset_memory_payload(get_chat_memory(user_email, project_name=project_name) or {}),
+                    project_name=project_name
+                )
+            return jsonify({
+                "ai_reply": "Done. Context reset. Let's start fresh. What product would you like to build now?",
+                "ready_to_build": False,
+                "missing_fields": ["summary", "audience", "business_model", "timeline", "features"]
+            })
+
+        full_history = history + [{"role": "user", "content": enriched_input}]
+        existing_memory = None
+        if user_email:
+            stored = get_chat_memory(user_email, project_name=project_name) or {}
+            existing_memory = stored.get("agent_memory") if isinstance(stored, dict) else None
+
+        analysis = analyze_turn_state(full_history, enriched_input, existing_memory=existing_memory)
+        reply = compose_consultant_reply(analysis, enriched_input, full_history, engine=engine)
+
+        if user_email:
+            to_store = get_chat_memory(user_email, project_name=project_name) or {}
+            to_store["agent_memory"] = analysis["memory"]
+            to_store["summary"] = analysis["memory"].get("summary", "")
+            to_store["audience"] = analysis["memory"].get("audience", "")
+            to_store["business_model"] = analysis["memory"].get("business_model", "")
+            to_store["timeline"] = analysis["memory"].get("timeline", "")
+            to_store["engine_preference"] = engine
+            save_chat_memory(user_email, to_store, project_name=project_name)
+
+        lang = detect_language(current_input)
+        options = generate_contextual_options(
+            analysis["missing_fields"],
+            analysis.get("phase", "initial"),
+            lang,
+            analysis["memory"]
+        )
+
+        return jsonify({
+            "ai_reply": reply,
+            "ready_to_build": analysis["ready_to_build"],
+            "ready_by_data": analysis.get("ready_by_data", False),
+            "missing_fields": analysis["missing_fields"],
+            "brief_score": compute_brief_score(analysis.get("missing_fields", [])),
+            "remaining_tokens": remaining,
+            "memory_summary": analysis["memory"].get("summary", ""),
+            "memory_snapshot": {
+                "audience": analysis["memory"].get("audience", ""),
+                "business_model": analysis["memory"].get("business_model", ""),
+                "timeline": analysis["memory"].get("timeline", ""),
+                "features": analysis["memory"].get("features", []),
+            },
+            "engine_used": engine,
+            "options": options
+        })
+        
+    except Exception as e:
+        print(f"SERVER ERROR: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/continue-capital', methods=['POST'])
+def continue_capital():
+    try:
+        data = request.json or {}
+        history = data.get('history', [])
+        current_input = (data.get('message') or '').strip()
+        image_data_url = data.get('image_data_url', '')
+        user_email = (data.get('user_email') or '').strip().lower()
+        project_name = (data.get('project_name') or '').strip().lower()
+
+        if not current_input:
+            return jsonify({"error": "message is required"}), 400
+
+        image_context = describe_image_for_chat(image_data_url) if image_data_url else ""
+        enriched_input = current_input
+        if image_context:
+            enriched_input = f"{current_input}\n\nContexto de imagen adjunta:\n{image_context}".strip()
+        elif image_data_url and not current_input:
+            enriched_input = "El usuario adjuntó una imagen. Analiza su contexto para la estrategia de capital e inversión."
+
+        if has_reset_intent(current_input):
+            if user_email:
+                save_chat_memory(
+                    user_email,
+                    reset_memory_payload(get_chat_memory(user_email, project_name=project_name) or {}),
+                    project_name=project_name
+                )
+            return jsonify({
+                "ai_reply": "Perfecto, empezamos de cero. Cuéntame sobre tu negocio: ¿qué etapa estás, cuánto capital necesitas y para qué lo usarías?",
+                "ready_for_handoff": False,
+            })
+
+        # Construir historial completo para Anthropic
+        full_history = list(history) + [{"role": "user", "content": enriched_input}]
+
+        # Llamar a Anthropic con historial real y system prompt de capital
+        ai_reply = None
+        if ANTHROPIC_API_KEY:
+            recent = full_history[-14:] if len(full_history) > 14 else full_history
+            ai_reply = call_anthropic_chat(
+                recent,
+                system_prompt=CAPITAL_SYSTEM_PROMPT,
+                timeout_seconds=35,
+            )
+
+        # Fallback a Gemini si Anthropic falla
+        if not ai_reply:
+            lang = detect_language(current_input)
+            fallback_prompt = f"""
+Eres Anmar AI, experto en capital, inversión y financiación para startups y negocios.
+Historial: {full_history[-6:]}
+Mensaje actual: {enriched_input}
+Responde como un CFO y asesor de inversión senior. Un solo mensaje al cliente, sin lista de preguntas. Máximo 1 pregunta al final.
+Idioma: {"English" if lang == "en" else "Spanish"}
+"""
+            ai_reply = call_ai_text(fallback_prompt)
+
+        if not ai_reply:
+            ai_reply = "Entiendo tu situación y veo varias rutas de financiación posibles. Cuéntame: ¿cuánto capital necesitas y en qué etapa está tu negocio?"
+
+        ai_reply = ai_reply.replace("```", "").strip()
+
+        # Guardar memoria
+        if user_email:
+            stored = get_chat_memory(user_email, project_name=project_name) or {}
+            stored["capital_last_message"] = enriched_input
+            stored["capital_last_reply"] = ai_reply[:500]
+            save_chat_memory(user_email, stored, project_name=project_name)
+
+        return jsonify({
+            "ai_reply": ai_reply,
+            "ready_for_handoff": False,
+            "channel": "capital"
+        })
+
+    except Exception as e:
+        log_debug(f"continue_capital error: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/analyze-turn', methods=['POST'])
+def analyze_turn_endpoint():
+    try:
+        data = request.json or {}
+        history = data.get('history', [])
+        current_input = (data.get('message') or '').strip()
+        user_email = (data.get('user_email') or '').strip().lower()
+        project_name = (data.get('project_name') or '').strip().lower()
+        if not current_input:
+            return jsonify({"error": "message is required"}), 400
+
+        full_history = history + [{"role": "user", "content": current_input}]
+        existing_memory = None
+        if user_email:
+            stored = get_chat_memory(user_email, project_name=project_name) or {}
+            existing_memory = stored.get("agent_memory") if isinstance(stored, dict) else None
+
+        analysis = analyze_turn_state(full_history, current_input, existing_memory=existing_memory)
+        # Safe payload for debug/inspection.
+        return jsonify({
+            "summary": analysis.get("summary"),
+            "missing_fields": analysis.get("missing_fields"),
+            "ready_by_data": analysis.get("ready_by_data"),
+            "ready_to_build": analysis.get("ready_to_build"),
+            "brief_score": compute_brief_score(analysis.get("missing_fields", [])),
+            "next_question": analysis.get("next_question"),
+            "memory": analysis.get("memory"),
+        })
+    except Exception as e:
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/ai-health', methods=['GET'])
+def ai_health():
+    # Optional ping via query param: /api/ai-health?ping=1
+    get_ai_model(retry=False)
+    do_ping = str(request.args.get("ping", "")).lower() in ("1", "true", "yes")
+    if do_ping:
+        probe = call_ai_text("Responde solo con: ok")
+        if not probe:
+            return jsonify({
+                "connected": False,
+                "model_name": AI_RUNTIME.get("model_name"),
+                "last_error": AI_RUNTIME.get("last_error"),
+                "last_check_at": AI_RUNTIME.get("last_check_at"),
+            }), 503
+
+    return jsonify({
+        "connected": bool(AI_RUNTIME.get("connected")),
+        "provider": AI_RUNTIME.get("provider"),
+        "model_name": AI_RUNTIME.get("model_name"),
+        "candidate_models": AI_RUNTIME.get("candidate_models", []),
+        "last_error": AI_RUNTIME.get("last_error"),
+        "last_check_at": AI_RUNTIME.get("last_check_at"),
+        "attempts": AI_RUNTIME.get("attempts", 0),
+    })
@@ -0,0 +1,761 @@
+"""
+Internal panel and operations routes (require_internal_auth): panel
+login/session, team and clients, notification and webhook stats, the token
+ledger audit, project store maintenance, import/export, startup timings,
+profiling and the Prometheus metrics endpoint.
+"""
+import os
+import shutil
+import tarfile
+import tempfile
+import uuid
+import zipfile
+from datetime import datetime
+from flask import Blueprint, Response, jsonify, request, send_from_directory, session
+from werkzeug.security import check_password_hash, generate_password_hash
+from lazy_imports import stripe
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+import project_archive
+from starter_templates import templates
+from app import (
+    ENGINE_ANTIGRAVITY, RESEND_ADMIN, STARTUP_WARMUP, STRIPE_SECRET_KEY, TOKEN_LEDGER_ENABLED,
+    _export_response, _rate_limit, _resend_send_email, call_ai_text, entitlements,
+    find_internal_user, get_db_connection, internal_path, load_alerts, load_internal_users,
+    load_project_meta, load_project_owners, metrics_registry, metrics_token_ok,
+    normalize_ticket_status, notification_outbox, project_index, project_store, projects_base_dir,
+    record_project_version, request_profiler, require_internal_auth, sampler,
+    sanitize_project_name, save_internal_users, save_project_meta, startup, stripe_events,
+    token_ledger, warm_up,
+)
+
+bp = Blueprint("internal", __name__)
+
+
+@bp.route('/internal/<path:filename>')
+def serve_internal(filename):
+    return send_from_directory(internal_path, filename)
+
+
+@bp.route('/api/internal/status', methods=['GET'])
+def internal_status():
+    users = load_internal_users()
+    return jsonify({
+        "has_users": len(users) > 0
+    })
+
+
+@bp.route('/api/internal/bootstrap', methods=['POST'])
+def internal_bootstrap():
+    try:
+        users = load_internal_users()
+        if users:
+            return jsonify({"error": "Bootstrap already completed"}), 403
+        data = request.json or {}
+        name = str(data.get('name') or '').strip()
+        username = str(data.get('username') or '').strip().lower()
+        email = str(data.get('email') or '').strip().lower()
+        password = str(data.get('password') or '').strip()
+        if not username and email:
+            username = email.split("@")[0]
+        if not username or not password:
+            return jsonify({"error": "username and password are required"}), 400
+        new_user = {
+            "id": str(uuid.uuid4()),
+            "name": name or username,
+            "username": username,
+            "email": email or "",
+            "role": "admin",
+            "password_hash": generate_password_hash(password),
+            "created_at": datetime.now().isoformat()
+        }
+        save_internal_users([new_user])
+        session.permanent = True
+        session['internal_user'] = {
+            "id": new_user["id"],
+            "name": new_user["name"],
+            "username": new_user["username"],
+            "email": new_user["email"],
+            "role": new_user["role"]
+        }
+        return jsonify({"status": "ok", "user": session['internal_user']})
+    except Exception as e:
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/internal/login', methods=['POST'])
+def internal_login():
+    try:
+        data = request.json or {}
+        identifier = str(data.get('identifier') or '').strip().lower()
+        password = str(data.get('password') or '').strip()
+        if not identifier or not password:
+            return jsonify({"error": "identifier and password are required"}), 400
+        user = find_internal_user(identifier)
+        if not user or not check_password_hash(user.get('password_hash', ''), password):
+            return jsonify({"error": "Invalid credentials"}), 401
+        session.permanent = True
+        session['internal_user'] = {
+            "id": user.get("id"),
+            "name": user.get("name"),
+            "username": user.get("username"),
+            "email": user.get("email"),
+            "role": user.get("role", "agent")
+        }
+        return jsonify({"status": "ok", "user": session['internal_user']})
+    except Exception as e:
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/internal/logout', methods=['POST'])
+def internal_logout():
+    session.pop('internal_user', None)
+    return jsonify({"status": "ok"})
+
+
+@bp.route('/api/internal/google-login', methods=['POST'])
+def internal_google_login():
+    """Allow internal team members to log in with Google OAuth."""
+    try:
+        data = request.json or {}
+        id_token = data.get('token', '').strip()
+        if not id_token:
+            return jsonify({"error": "Token is required"}), 400
+
+        # Validate token with Google
+        import urllib.request as _urllib_req
+        import json as _json
+        try:
+            token_url = f"https://oauth2.googleapis.com/tokeninfo?id_token={id_token}"
+            with _urllib_req.urlopen(token_url, timeout=8) as resp:
+                google_data = _json.loads(resp.read().decode())
+        except Exception as e:
+            return jsonify({"error": "Invalid Google token"}), 401
+
+        email = google_data.get("email", "").strip().lower()
+        name = google_data.get("name") or google_data.get("given_name") or email.split("@")[0]
+        email_verified = google_data.get("email_verified") == "true"
+
+        if not email or not email_verified:
+            return jsonify({"error": "Google email not verified"}), 401
+
+        # Load existing internal users
+        users = load_internal_users()
+
+        # Check if this email is already an internal user
+        existing = next((u for u in users if u.get("email", "").lower() == email), None)
+
+        if existing:
+            # Existing user — log them in
+            user_session = {
+                "id": existing["id"],
+                "name": existing.get("name", name),
+                "username": existing.get("username", email.split("@")[0]),
+                "email": email,
+                "role": existing.get("role", "agent")
+            }
+        elif not users:
+            # No internal users exist — auto-bootstrap this Google account as first admin
+            import uuid as _uuid
+            new_user = {
+                "id": str(_uuid.uuid4())[:8],
+                "name": name,
+                "username": email.split("@")[0],
+                "email": email,
+                "password_hash": "",
+                "role": "admin",
+                "auth_method": "google",
+                "created_at": datetime.now().isoformat()
+            }
+            users.append(new_user)
+            save_internal_users(users)
+            user_session = {
+                "id": new_user["id"],
+                "name": name,
+                "username": new_user["username"],
+                "email": email,
+                "role": "admin"
+            }
+        else:
+            # Users exist but this email is not registered
+            return jsonify({
+                "error": "This email does not have internal access. Ask an administrator to add you."
+            }), 403
+
+        session['internal_user'] = user_session
+        session.permanent = True
+        return jsonify({"user": user_session, "message": f"Welcome, {name}"})
+
+    except Exception as e:
+        print(f"Internal Google Login Error: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/internal/me', methods=['GET'])
+def internal_me():
+    user = session.get('internal_user')
+    if not user:
+        return jsonify({"error": "unauthorized"}), 401
+    return jsonify({"user": user})
+
+
+@bp.route('/api/internal/users', methods=['POST'])
+def create_internal_user():
+    if not require_internal_auth():
+        return jsonify({"error": "unauthorized"}), 401
+    actor = session.get('internal_user') or {}
+    if actor.get('role') != 'admin':
+        return jsonify({"error": "forbidden"}), 403
+    data = request.json or {}
+    name = str(data.get('name') or '').strip()
+    username = str(data.get('username') or '').strip().lower()
+    email = str(data.get('email') or '').strip().lower()
+    password = str(data.get('password') or '').strip()
+    if not username and email:
+        username = email.split("@")[0]
+    if not username:
+        return jsonify({"error": "username is required"}), 400
+    existing = find_internal_user(username) or (find_internal_user(email) if email else None)
+    if existing:
+        return jsonify({"error": "This user or email already exists"}), 409
+    users = load_internal_users()
+    new_member = {
+        "id": str(uuid.uuid4()),
+        "name": name or username,
+        "username": username,
+        "email": email or "",
+        "role": data.get("role") or "agent",
+        "auth_method": "google" if not password else "password",
+        "created_at": datetime.now().isoformat()
+    }
+    if password:
+        new_member["password_hash"] = generate_password_hash(password)
+    save_internal_users(users + [new_member])
+    return jsonify({"status": "ok", "user": {"name": new_member["name"], "username": username, "role": new_member["role"]}})
+
+
+@bp.route('/api/internal/team', methods=['GET'])
+def get_internal_team():
+    """Return list of internal team members (admins can see all)."""
+    if not require_internal_auth():
+        return jsonify({"error": "unauthorized"}), 401
+    users = load_internal_users()
+    safe = [{"id": u.get("id",""), "name": u.get("name",""), "username": u.get("username",""),
+             "email": u.get("email",""), "role": u.get("role","agent"),
+             "auth_method": u.get("auth_method","password"),
+             "created_at": u.get("created_at","")} for u in users]
+    return jsonify({"users": safe})
+
+
+@bp.route('/api/internal/notifications/stats', methods=['GET'])
+def notification_stats():
+    if not require_internal_auth():
+        return jsonify({"error": "unauthorized"}), 401
+    try:
+        return jsonify(notification_outbox.stats())
+    except Exception as e:
+        print(f"[OUTBOX] stats error: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/test-email', methods=['GET'])
+def test_email_endpoint():
+    """Diagnóstico: GET /api/test-email?to=x@x.com — envía email de prueba. Requiere auth interna."""
+    if not require_internal_auth():
+        return jsonify({"error": "unauthorized"}), 401
+    if _rate_limit(request.remote_addr, max_requests=3, window=60):
+        return jsonify({"error": "Too many attempts. Wait a moment."}), 429
+    to = request.args.get('to', RESEND_ADMIN)
+    try:
+        result = _resend_send_email(
+            to_addr=to,
+            subject="Test desde Anmar API",
+            html_body="<div style='font-family:sans-serif;padding:20px;background:#000;color:#fff;border-radius:12px;'><h2 style='color:#10b981;'>Email de prueba</h2><p>Si ves esto, Resend funciona correctamente desde Python.</p></div>"
+        )
+        return jsonify({"ok": True, "to": to})
+    except Exception as e:
+        print(f"[TEST-EMAIL] Error: {e}")
+        return jsonify({"ok": False, "error": "Error al enviar email de prueba."}), 500
+
+
+@bp.route('/api/internal/stripe/events', methods=['GET'])
+def stripe_events_stats():
+    if not require_internal_auth():
+        return jsonify({"error": "unauthorized"}), 401
+    try:
+        return jsonify(stripe_events.stats())
+    except Exception as e:
+        print(f"[WEBHOOK] stats error: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/internal/stripe/events/replay', methods=['POST'])
+def stripe_events_replay():
+    """Reencola eventos guardados: {"event_ids": [...]} y/o {"since": epoch}."""
+    if not require_internal_auth():
+        return jsonify({"error": "unauthorized"}), 401
+    try:
+        data = request.json or {}
+        event_ids = [str(e) for e in (data.get('event_ids') or []) if e]
+        since = data.get('since')
+        if not event_ids and since is None:
+            return jsonify({"error": "event_ids or since is required"}), 400
+        requeued = stripe_events.requeue(event_ids=event_ids or None, since=int(since) if since is not None else None)
+        return jsonify({"requeued": requeued})
+    except Exception as e:
+        print(f"[WEBHOOK] replay error: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/internal/clients', methods=['GET'])
+def get_internal_clients():
+    """
+    Returns a consolidated list of clients (one entry per unique email).
+    Merges data from the users table and alerts/tickets.
+    """
+    try:
+        if not require_internal_auth():
+            return jsonify({"error": "unauthorized"}), 401
+
+        conn = get_db_connection()  # BUG FIX Bug 2
+        # Get all users from the users table
+        users_rows = conn.execute(
+            'SELECT email, name, subscription_plan, subscription_active, created_at, stripe_customer_id FROM users ORDER BY created_at DESC'
+        ).fetchall()
+
+        # Get all alerts/tickets
+        alerts = [normalize_ticket_status(a) for a in load_alerts()]
+
+        # Build a map of client email → ticket data
+        ticket_map = {}
+        for a in alerts:
+            email = (a.get('user_email') or a.get('client_email') or '').strip().lower()
+            if not email:
+                continue
+            if email not in ticket_map:
+                ticket_map[email] = {
+                    'tickets': [],
+                    'channels': set(),
+                    'latest_activity': None
+                }
+            ticket_map[email]['tickets'].append(a)
+            ch = a.get('channel') or 'build'
+            ticket_map[email]['channels'].add(ch)
+            ts = a.get('updated_at') or a.get('created_at') or a.get('timestamp') or ''
+            if ts and (not ticket_map[email]['latest_activity'] or ts > ticket_map[email]['latest_activity']):
+                ticket_map[email]['latest_activity'] = ts
+
+        # Build consolidated client list
+        clients = []
+        seen_emails = set()
+        for row in users_rows:
+            email = row['email'].strip().lower() if row['email'] else ''
+            if not email or email in seen_emails:
+                continue
+            seen_emails.add(email)
+            tdata = ticket_map.get(email, {})
+            tickets = tdata.get('tickets', [])
+            open_tickets = [t for t in tickets if t.get('status') in ('pending', 'pending_human_review', 'accepted', 'developing')]
+            clients.append({
+                'email': email,
+                'name': row['name'] or email.split('@')[0],
+                'plan': row['subscription_plan'] or 'none',
+                'plan_active': bool(row['subscription_active']),
+                'stripe_customer_id': row['stripe_customer_id'] or '',
+                'created_at': row['created_at'] or '',
+                'total_tickets': len(tickets),
+                'open_tickets': len(open_tickets),
+                'channels': list(tdata.get('channels', [])),
+                'latest_activity': tdata.get('latest_activity', row['created_at'] or ''),
+            })
+
+        # Also add clients from tickets that aren't in users table
+        for email, tdata in ticket_map.items():
+            if email in seen_emails:
+                continue
+            seen_emails.add(email)
+            tickets = tdata.get('tickets', [])
+            open_tickets = [t for t in tickets if t.get('status') in ('pending', 'pending_human_review', 'accepted', 'developing')]
+            clients.append({
+                'email': email,
+                'name': email.split('@')[0],
+                'plan': 'none',
+                'plan_active': False,
+                'stripe_customer_id': '',
+                'created_at': '',
+                'total_tickets': len(tickets),
+                'open_tickets': len(open_tickets),
+                'channels': list(tdata.get('channels', [])),
+                'latest_activity': tdata.get('latest_activity', ''),
+            })
+
+        # Sort: paying clients first, then by latest activity
+        clients.sort(key=lambda c: (
+            0 if c['plan'] != 'none' and c['plan_active'] else 1,
+            c.get('latest_activity') or ''
+        ), reverse=False)
+        # Actually we want paying first (0 < 1), then newest activity first
+        clients.sort(key=lambda c: (
+            0 if c['plan'] != 'none' and c['plan_active'] else 1,
+            -(len(c.get('latest_activity') or ''))  # rough sort
+        ))
+        # Better sort
+        def client_sort_key(c):
+            is_paying = 1 if (c['plan'] != 'none' and c['plan_active']) else 0
+            activity = c.get('latest_activity') or '0'
+            return (-is_paying, activity)
+        clients.sort(key=client_sort_key, reverse=True)
+
+        return jsonify({"clients": clients, "total": len(clients)})
+    except Exception as e:
+        print(f"Error in get_internal_clients: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/internal/upgrade-client', methods=['POST'])
+def internal_upgrade_client():
+    """
+    Upgrade or change a client's plan internally.
+    Admin-only. Updates subscription_plan and subscription_active in the users table.
+    Optionally creates a Stripe subscription for MVP/Growth.
+    """
+    try:
+        if not require_internal_auth():
+            return jsonify({"error": "unauthorized"}), 401
+        # Check admin role
+        internal_user = session.get('internal_user', {})
+        if internal_user.get('role') != 'admin':
+            return jsonify({"error": "Admin access required"}), 403
+
+        data = request.json or {}
+        client_email = (data.get('client_email') or '').strip().lower()
+        new_plan = (data.get('plan') or '').strip().lower()
+        custom_price = (data.get('stripe_price_id') or '').strip()
+
+        if not client_email:
+            return jsonify({"error": "client_email is required"}), 400
+        if new_plan not in ('validate', 'mvp', 'growth', 'none'):
+            return jsonify({"error": "Invalid plan. Must be validate, mvp, growth, or none"}), 400
+
+        conn = get_db_connection()  # BUG FIX Bug 2
+        user = conn.execute('SELECT email, stripe_customer_id FROM users WHERE email = ?', (client_email,)).fetchone()
+        if not user:
+            return jsonify({"error": "Client not found in database"}), 404
+
+        # Update the plan in database
+        if new_plan == 'none':
+            conn.execute(
+                'UPDATE users SET subscription_plan = ?, subscription_active = 0 WHERE email = ?',
+                ('none', client_email)
+            )
+        else:
+            conn.execute(
+                'UPDATE users SET subscription_plan = ?, subscription_active = 1, subscription_started_at = CURRENT_TIMESTAMP WHERE email = ?',
+                (new_plan, client_email)
+            )
+        conn.commit()
+        entitlements.invalidate(client_email)
+
+        # Optionally create Stripe subscription for MVP/Growth
+        stripe_result = None
+        if custom_price and new_plan in ('mvp', 'growth') and STRIPE_SECRET_KEY:
+            try:
+                customer_id = user['stripe_customer_id'] if user['stripe_customer_id'] else None
+                if not customer_id:
+                    # Create a Stripe customer
+                    customer = stripe.Customer.create(email=client_email)
+                    customer_id = customer.id
+                    conn.execute('UPDATE users SET stripe_customer_id = ? WHERE email = ?', (customer_id, client_email))
+                    conn.commit()
+
+                # Create subscription with custom price
+                subscription = stripe.Subscription.create(
+                    customer=customer_id,
+                    items=[{"price": custom_price}],
+                    metadata={"plan": new_plan, "email": client_email, "source": "internal_upgrade"}
+                )
+                # Store subscription ID
+                conn.execute('UPDATE users SET stripe_subscription_id = ? WHERE email = ?', (subscription.id, client_email))
+                conn.commit()
+                stripe_result = {"subscription_id": subscription.id, "status": subscription.status}
+            except Exception as stripe_err:
+                print(f"Stripe error during internal upgrade: {stripe_err}")
+                stripe_result = {"error": str(stripe_err)}
+
+        return jsonify({
+            "status": "ok",
+            "client_email": client_email,
+            "new_plan": new_plan,
+            "stripe": stripe_result
+        })
+    except Exception as e:
+        print(f"Error in internal_upgrade_client: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/internal/ai-reply', methods=['POST'])
+def internal_ai_reply():
+    try:
+        if not require_internal_auth():
+            return jsonify({"error": "unauthorized"}), 401
+        data = request.json or {}
+        project_name = (data.get('project_name') or '').strip().lower()
+        client_email = (data.get('client_email') or '').strip().lower()
+        status = (data.get('status') or '').strip().lower()
+        messages = data.get('messages') or []
+
+        # Build short conversation context (last 8 messages).
+        convo_lines = []
+        for msg in messages[-8:]:
+            if not isinstance(msg, dict):
+                continue
+            role = (msg.get('role') or '').strip().lower()
+            label = "Cliente" if role == "client" else "Ingeniero"
+            content = str(msg.get('content') or '').strip()
+            if content:
+                convo_lines.append(f"{label}: {content}")
+        convo = "\n".join(convo_lines) if convo_lines else "Cliente: (sin mensajes previos)"
+
+        prompt = f"""
+Eres operador interno de ANMAR. Genera 3 posibles respuestas cortas para enviar al cliente.
+Reglas: español neutro, tono humano, máximo 2 frases por respuesta. Si falta información, incluye solo 1 pregunta.
+No prometas tiempos exactos ni menciones que eres IA.
+
+Proyecto: {project_name or 'N/D'}
+Estado: {status or 'pending'}
+Cliente: {client_email or 'N/D'}
+Conversación reciente:
+{convo}
+
+Devuelve 3 opciones, una por línea, sin numeración.
+""".strip()
+
+        text = call_ai_text(prompt, engine=ENGINE_ANTIGRAVITY) or ""
+        lines = [l.strip().lstrip("-•").strip() for l in text.splitlines() if l.strip()]
+        suggestions = lines[:3]
+        if not suggestions:
+            suggestions = [
+                "Gracias por el detalle. Ya lo revisé y te confirmo el siguiente paso en breve.",
+                "Perfecto, con eso avanzamos. ¿Hay algún ejemplo o referencia que quieras que tomemos en cuenta?",
+                "Entendido. Voy a preparar la primera propuesta y te la comparto para revisión."
+            ]
+
+        return jsonify({"suggestions": suggestions})
+    except Exception as e:
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/internal/token-ledger', methods=['GET'])
+def token_ledger_stats():
+    if not require_internal_auth():
+        return jsonify({"error": "unauthorized"}), 401
+    return jsonify({"enabled": TOKEN_LEDGER_ENABLED, **token_ledger.stats()})
+
+
+@bp.route('/api/internal/token-ledger/<path:email>', methods=['GET'])
+def token_ledger_audit(email):
+    """Saldo reconstruido desde el ledger vs users.tokens, más los últimos movimientos."""
+    if not require_internal_auth():
+        return jsonify({"error": "unauthorized"}), 401
+    try:
+        email = str(email or '').strip().lower()
+        if request.args.get('flush') == '1':
+            token_ledger.flush()
+        audit = token_ledger.audit(email)
+        audit["history"] = token_ledger.history(email, limit=min(int(request.args.get('limit', 100)), 1000))
+        return jsonify(audit)
+    except Exception as e:
+        print(f"[LEDGER] audit error: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/admin/system-status', methods=['GET'])
+def get_system_status():
+    if not require_internal_auth():
+        return jsonify({"error": "unauthorized"}), 401
+    import random
+    return jsonify({
+        "george_status": random.choice(["Free", "Busy", "Designing"]),
+        "julian_status": random.choice(["Coding", "Reviewing", "Free"]),
+        "server_load": f"{random.randint(10, 80)}%"
+    })
+
+
+@bp.route('/api/internal/project-store/gc', methods=['POST'])
+def project_store_gc():
+    if not require_internal_auth():
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        deleted, kept, freed = project_store.gc()
+        return jsonify({"status": "ok", "deleted_blobs": deleted, "kept_blobs": kept, "freed_bytes": freed})
+    except Exception as e:
+        print(f"[VERSIONS] gc error: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/internal/project-index/rebuild', methods=['POST'])
+def project_index_rebuild():
+    # Re-sincroniza el índice con las carpetas (p.ej. tras mover proyectos a mano).
+    if not require_internal_auth():
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        owners = dict(load_project_owners())
+        for name in project_index.names():
+            owners[name] = project_index.owner_of(name) or owners.get(name)
+        indexed = project_index.backfill(projects_base_dir, owners, load_project_meta(), force=True)
+        return jsonify({"status": "ok", "indexed": indexed})
+    except Exception as e:
+        print(f"[PROJECT INDEX] rebuild error: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/internal/templates/reload', methods=['POST'])
+def reload_starter_templates():
+    # Recarga starter_templates/ (kits nuevos) sin reiniciar.
+    if not require_internal_auth():
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        count = templates.load()
+        return jsonify({"status": "ok", "templates": count, "kits": templates.kits()})
+    except Exception as e:
+        print(f"[TEMPLATES] reload error: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/internal/projects/export', methods=['GET'])
+def export_projects():
+    # ?projects=a,b | ?owner=email | (nada) = todos. ?format=tar|zip
+    if not require_internal_auth():
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        requested = [sanitize_project_name(p) for p in str(request.args.get('projects') or '').split(',') if p.strip()]
+        owner = str(request.args.get('owner') or '').strip().lower()
+        if requested:
+            names = requested
+        elif owner:
+            names = project_index.for_owner(owner)
+        else:
+            names = project_index.names()
+        names = [n for n in names if os.path.isdir(os.path.join(projects_base_dir, n))]
+        fmt = 'zip' if request.args.get('format') == 'zip' else 'tar'
+        return _export_response(names, fmt, f"anmar-projects-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}")
+    except Exception as e:
+        print(f"[ARCHIVE] export error: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/internal/projects/import', methods=['POST'])
+def import_projects():
+    # multipart "archive" o el archivo como body (?format=tar|zip). ?overwrite=1 reemplaza existentes.
+    if not require_internal_auth():
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        overwrite = str(request.args.get('overwrite') or '').lower() in ('1', 'true', 'yes')
+        upload = request.files.get('archive')
+        if upload:
+            fileobj = upload.stream
+            fmt = project_archive.detect_format(fileobj, upload.filename)
+        else:
+            fmt = 'zip' if request.args.get('format') == 'zip' else 'tar'
+            fileobj = request.stream
+            if fmt == 'zip':
+                # zip necesita seek (directorio central al final): se vuelca a disco temporal.
+                spooled = tempfile.TemporaryFile()
+                shutil.copyfileobj(request.stream, spooled, 256 * 1024)
+                spooled.seek(0)
+                fileobj = spooled
+        os.makedirs(projects_base_dir, exist_ok=True)
+        result = project_archive.import_archive(
+            fileobj, projects_base_dir, fmt=fmt, overwrite=overwrite, sanitize=sanitize_project_name,
+        )
+        actor = session.get('internal_user')
+        meta = load_project_meta()
+        for name in result["imported"]:
+            info = result["projects"].get(name) or {}
+            project_index.add(name, info.get("owner"), replace=True)
+            if isinstance(info.get("meta"), dict):
+                meta[name] = info["meta"]
+            record_project_version(name, "import", summary="Imported from archive", author=actor)
+        if result["imported"]:
+            save_project_meta(meta)
+        print(f"[ARCHIVE] imported {len(result['imported'])} projects, skipped {len(result['skipped'])}")
+        return jsonify({
+            "status": "ok",
+            "imported": result["imported"],
+            "skipped": result["skipped"],
+            "errors": result["errors"],
+        })
+    except (tarfile.TarError, zipfile.BadZipFile) as e:
+        return jsonify({"error": f"Invalid archive: {e}"}), 400
+    except Exception as e:
+        print(f"[ARCHIVE] import error: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/internal/startup', methods=['GET'])
+def startup_timings():
+    if not require_internal_auth():
+        return jsonify({"error": "unauthorized"}), 401
+    return jsonify(dict(startup.timings(), warmup=STARTUP_WARMUP))
+
+
+@bp.route('/api/internal/warmup', methods=['POST'])
+def startup_warmup():
+    """Runs the pending warm-up phases now (e.g. from a deploy health check) and returns the timings.
+
+    ?all=1 also runs the phases left to first use (the Gemini client).
+    """
+    if not require_internal_auth():
+        return jsonify({"error": "unauthorized"}), 401
+    names = startup.names() if request.args.get('all') in ('1', 'true') else None
+    return jsonify(warm_up(background=False, trigger="warm-up route", names=names))
+
+
+@bp.route('/api/internal/profile', methods=['GET', 'POST'])
+def request_profile():
+    """Per-request timings of this worker. POST {"enabled", "sample_rate", "reset"} changes the settings."""
+    if not require_internal_auth():
+        return jsonify({"error": "unauthorized"}), 401
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        try:
+            request_profiler.configure(enabled=data.get('enabled'), sample_rate=data.get('sample_rate'))
+        except (TypeError, ValueError):
+            return jsonify({"error": "sample_rate must be a number between 0 and 1"}), 400
+        if data.get('reset'):
+            request_profiler.reset()
+    limit = request.args.get('recent', 20, type=int)
+    return jsonify(dict(request_profiler.summary(recent=limit), pid=os.getpid()))
+
+
+@bp.route('/api/internal/profile/sample', methods=['GET', 'POST'])
+def sampling_profile():
+    """POST {"seconds", "interval_ms"} starts the sampler; GET returns folded stacks (?format=json for status)."""
+    if not require_internal_auth():
+        return jsonify({"error": "unauthorized"}), 401
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        try:
+            seconds = float(data.get('seconds', 10))
+            interval = float(data.get('interval_ms', 5)) / 1000
+        except (TypeError, ValueError):
+            return jsonify({"error": "seconds and interval_ms must be numbers"}), 400
+        if not sampler.start(seconds, interval):
+            return jsonify({"error": "sampler already running", "status": sampler.status()}), 409
+        return jsonify(dict(sampler.status(), pid=os.getpid())), 202
+    if request.args.get('format') == 'json':
+        return jsonify(dict(sampler.status(), pid=os.getpid()))
+    return Response(sampler.folded() + "\n", mimetype='text/plain', headers={
+        'Content-Disposition': f'attachment; filename="anmar-{os.getpid()}.folded"',
+        'Cache-Control': 'no-store',
+    })
+
+
+@bp.route('/api/internal/metrics', methods=['GET'])
+def metrics_exposition():
+    """Prometheus text format for this worker (session or Bearer ANMAR_METRICS_TOKEN)."""
+    if not (require_internal_auth() or metrics_token_ok(request.headers.get('Authorization'))):
+        return jsonify({"error": "unauthorized"}), 401
+    return Response(metrics_registry.render(), headers={
+        'Content-Type': METRICS_CONTENT_TYPE,
+        'Cache-Control': 'no-store',
+    })
@@ -0,0 +1,382 @@
+"""
+Marketing routes: the marketing plan generator and the marketing /
+organic growth conversations.
+"""
+from flask import Blueprint, jsonify, request
+from app import (
+    ANTHROPIC_API_KEY, MARKETING_REQUIRED_FIELDS, MARKETING_SYSTEM_INSTRUCTION_TEXT,
+    ORGANIC_CONTENT_SYSTEM_PROMPT, call_ai_text, call_anthropic_chat, call_anthropic_text,
+    clean_and_parse_json, compute_marketing_missing, compute_marketing_score,
+    describe_image_for_chat, detect_language, get_ai_model, get_chat_memory, has_reset_intent,
+    log_debug, normalize_marketing_brief, request_profiler, reset_memory_payload, save_chat_memory,
+    trim_history_after_last_reset,
+)
+
+bp = Blueprint("marketing", __name__)
+
+
+# --- MARKETING MODULE ---
+@bp.route('/api/generate-marketing', methods=['POST'])
+def generate_marketing():
+    try:
+        data = request.json or {}
+        project_name = data.get('project_name')
+        focus = data.get('focus', 'Conversion') # Brand Awareness, Conversion, Retention
+        
+        # Context from Project Name (Simulating read of project content)
+        
+        prompt = f"""
+        ACT AS A LEGENDARY CREATIVE DIRECTOR (Ogilvy/Draper style).
+        Project: {project_name}
+        Goal: {focus}
+        
+        TASK:
+        Generate the "Base Assets" for a high-performance campaign.
+        
+        RETURN JSON:
+        {{
+            "strategy_hook": "A one-sentence powerful hook defining the campaign.",
+            "target_audience": "Specific user persona description.",
+            "ads": [
+                {{
+                    "platform": "Instagram/TikTok Reels",
+                    "concept": "Visual description of the video",
+                    "script": "Voiceover script 15s"
+                }},
+                {{
+                    "platform": "LinkedIn/Twitter",
+                    "concept": "Text-based value proposition",
+                    "copy": "The actual post text"
+                }}
+            ],
+            "visual_direction": "Moodboard description (colors, vibe) for human designers."
+        }}
+        """
+        
+        with request_profiler.phase("ai"):
+            model_response = get_ai_model().generate_content(prompt)
+        campaign = clean_and_parse_json(model_response.text)
+        
+        if not campaign:
+            return jsonify({"error": "Failed to generate campaign"}), 500
+            
+        return jsonify(campaign)
+
+    except Exception as e:
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/continue-marketing', methods=['POST'])
+def continue_marketing():
+    try:
+        data = request.json or {}
+        history = trim_history_after_last_reset(data.get('history', []))
+        current_input = str(data.get('message', '') or '').strip()
+        image_data_url = data.get('image_data_url', '')
+        user_email = (data.get('user_email') or '').strip().lower()
+        project_name = (data.get('project_name') or '').strip().lower()
+        construction_context = str(data.get('construction_context') or '').strip()
+        bootstrap = bool(data.get('bootstrap'))
+        channel = str(data.get('channel') or 'marketing').strip().lower()
+        if not user_email:
+            return jsonify({"error": "login_required"}), 401
+        if not project_name:
+            return jsonify({"error": "project_required"}), 400
+        if not current_input and not image_data_url and not construction_context:
+            return jsonify({"error": "message is required"}), 400
+
+        image_context = describe_image_for_chat(image_data_url) if image_data_url else ""
+        enriched_input = current_input
+        if image_context:
+            enriched_input = f"{current_input}\n\nContexto de imagen adjunta:\n{image_context}".strip()
+        elif image_data_url and not current_input:
+            enriched_input = "El usuario adjunto una imagen. Describe su contexto y sugiere activos de marketing."
+        if not enriched_input and construction_context:
+            enriched_input = "Inicia la estrategia de marketing con el contexto de construcción."
+
+        if has_reset_intent(current_input):
+            if user_email:
+                save_chat_memory(
+                    user_email,
+                    reset_memory_payload(get_chat_memory(user_email, project_name=project_name) or {}),
+                    project_name=project_name
+                )
+            return jsonify({
+                "ai_reply": "Contexto de marketing reiniciado. Definamos objetivo, audiencia y oferta.",
+                "missing_fields": MARKETING_REQUIRED_FIELDS,
+                "brief_score": 0,
+                "ready_for_handoff": False,
+                "marketing_brief": {}
+            })
+
+        history_text = "\n".join(
+            [f"{m.get('role', 'user')}: {m.get('content', '')}" for m in history[-12:] if isinstance(m, dict)]
+        )
+
+        context_block = f"Contexto de construcción:\n{construction_context}\n" if construction_context else ""
+        bootstrap_block = "INSTRUCCION: Comienza con propuesta directa. Primera linea debe mencionar que ya se esta construyendo el proyecto y que ahora toca marketing. No hagas preguntas en la primera respuesta.\n" if bootstrap else ""
+
+        # Channel-specific system instructions
+        channel_instructions = {
+            'organic': "CANAL: Contenido Orgánico. Enfócate en estrategia de contenido NO PAGO: posts, reels, stories, blogs, SEO, community management. NO incluir pauta pagada, CPC o presupuesto de ads. Los campos clave son: goal, audience, platforms, content_pillars, posting_frequency, brand_voice, key_topics.",
+            'capital': "CANAL: Inversión y Capital. Enfócate en preparar pitch deck, modelo de negocio, métricas de tracción, estrategia de levantamiento de capital, valuación. Los campos clave son: funding_stage, amount_needed, business_model, revenue, traction, use_of_funds, timeline.",
+            'marketing': ""
+        }
+        channel_block = channel_instructions.get(channel, '') + "\n" if channel_instructions.get(channel) else ""
+
+        prompt = f"""
+Proyecto: {project_name}
+{channel_block}{context_block}{bootstrap_block}
+Conversacion previa:
+{history_text}
+
+Mensaje actual:
+{enriched_input}
+
+Devuelve SOLO JSON valido con esta estructura:
+{{
+  "reply": "Respuesta corta y directa en espanol, con la siguiente pregunta o confirmacion.",
+  "brief": {{
+    "goal": "Objetivo de campana",
+    "audience": "Audiencia ideal",
+    "offer": "Oferta o propuesta de valor",
+    "channels": ["Instagram", "TikTok", "YouTube", "Facebook", "Google Ads", "LinkedIn", "X", "Pinterest"],
+    "budget": "Presupuesto o rango",
+    "timeline": "Timeline o fecha",
+    "brand_voice": "Tono de marca",
+    "key_message": "Mensaje principal"
+  }},
+  "preview_assets": [
+    {{
+      "platform": "Instagram",
+      "format": "Reel",
+      "hook": "Hook de 1 linea",
+      "caption": "Copy de 1-2 lineas",
+      "cta": "CTA",
+      "hashtags": ["#hashtag"],
+      "metrics": {{"views": 12000, "ctr": 1.8, "cpc": 0.6}}
+    }},
+    {{
+      "platform": "TikTok",
+      "format": "Short",
+      "hook": "...",
+      "caption": "...",
+      "cta": "...",
+      "hashtags": ["#hashtag"],
+      "metrics": {{"views": 18000, "ctr": 2.1, "cpc": 0.5}}
+    }},
+    {{
+      "platform": "YouTube",
+      "format": "Shorts",
+      "hook": "...",
+      "caption": "...",
+      "cta": "...",
+      "hashtags": ["#hashtag"],
+      "metrics": {{"views": 14000, "ctr": 1.6, "cpc": 0.7}}
+    }},
+    {{
+      "platform": "Facebook",
+      "format": "Ad",
+      "hook": "...",
+      "caption": "...",
+      "cta": "...",
+      "hashtags": ["#hashtag"],
+      "metrics": {{"views": 11000, "ctr": 1.4, "cpc": 0.8}}
+    }},
+    {{
+      "platform": "Google Ads",
+      "format": "Search",
+      "hook": "...",
+      "caption": "...",
+      "cta": "...",
+      "hashtags": ["#hashtag"],
+      "metrics": {{"views": 9000, "ctr": 2.3, "cpc": 1.1}}
+    }},
+    {{
+      "platform": "LinkedIn",
+      "format": "Sponsored",
+      "hook": "...",
+      "caption": "...",
+      "cta": "...",
+      "hashtags": ["#hashtag"],
+      "metrics": {{"views": 7000, "ctr": 1.2, "cpc": 1.4}}
+    }},
+    {{
+      "platform": "X",
+      "format": "Thread",
+      "hook": "...",
+      "caption": "...",
+      "cta": "...",
+      "hashtags": ["#hashtag"],
+      "metrics": {{"views": 8000, "ctr": 1.1, "cpc": 0.9}}
+    }},
+    {{
+      "platform": "Pinterest",
+      "format": "Pin",
+      "hook": "...",
+      "caption": "...",
+      "cta": "...",
+      "hashtags": ["#hashtag"],
+      "metrics": {{"views": 6000, "ctr": 1.0, "cpc": 0.7}}
+    }}
+  ],
+  "ready_for_handoff": false,
+  "next_step": "Proxima accion sugerida"
+}}
+"""
+
+        def _marketing_ai_payload():
+            text = None
+            parsed_local = None
+            # Marketing JSON es grande: usar max_tokens elevado y timeout mayor
+            MARKETING_MAX_TOKENS = 4096
+            if ANTHROPIC_API_KEY:
+                text = call_anthropic_text(
+                    prompt,
+                    system_prompt=MARKETING_SYSTEM_INSTRUCTION_TEXT,
+                    timeout_seconds=45,
+                    max_tokens_override=MARKETING_MAX_TOKENS,
+                )
+                if text:
+                    parsed_local = clean_and_parse_json(text)
+            else:
+                text = call_ai_text(prompt) or ""
+                parsed_local = clean_and_parse_json(text) if text else None
+            return parsed_local, text
+
+        try:
+            parsed, raw_text = _marketing_ai_payload()
+        except Exception as e:
+            return jsonify({"error": "ai_runtime_error", "detail": "Error en el motor de IA"}), 502
+        if not isinstance(parsed, dict):
+            # Fallback to raw text if JSON parse fails.
+            reply = str(raw_text or "").strip()
+            if not reply:
+                reply = "Estoy listo para ayudarte con tu estrategia de marketing. ¿Cuál es tu objetivo principal con esta campaña?"
+            return jsonify({
+                "ai_reply": reply[:1400],
+                "missing_fields": MARKETING_REQUIRED_FIELDS,
+                "brief_score": 0,
+                "ready_for_handoff": False,
+                "marketing_brief": {},
+                "preview_assets": []
+            })
+        reply = str(parsed.get("reply") or parsed.get("next_step") or "").strip()
+        if not reply:
+            return jsonify({"error": "ai_empty_reply"}), 502
+        brief = normalize_marketing_brief(parsed.get("brief", {}))
+        preview_assets = parsed.get("preview_assets") if isinstance(parsed.get("preview_assets"), list) else []
+        missing_fields = compute_marketing_missing(brief)
+        brief_score = compute_marketing_score(missing_fields)
+        ready_for_handoff = bool(parsed.get("ready_for_handoff")) or (len(missing_fields) == 0)
+        confirm_intent = any(k in (current_input or "").lower() for k in ["si", "sí", "yes", "ok", "listo", "confirmo", "confirmar", "de acuerdo", "dale", "envia", "envía"])
+        auto_handoff = bool(confirm_intent and ready_for_handoff)
+
+        if user_email:
+            stored = get_chat_memory(user_email, project_name=project_name) or {}
+            stored["marketing_brief"] = brief
+            stored["marketing_ready"] = ready_for_handoff
+            if preview_assets:
+                stored["marketing_preview_assets"] = preview_assets[:12]
+            stored["summary"] = brief.get("key_message") or brief.get("offer") or stored.get("summary", "")
+            save_chat_memory(user_email, stored, project_name=project_name)
+
+        return jsonify({
+            "ai_reply": reply,
+            "missing_fields": missing_fields,
+            "brief_score": brief_score,
+            "ready_for_handoff": ready_for_handoff,
+            "auto_handoff": auto_handoff,
+            "marketing_brief": brief,
+            "preview_assets": preview_assets
+        })
+    except Exception as e:
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@bp.route('/api/continue-organic', methods=['POST'])
+def continue_organic():
+    """
+    Endpoint para el canal de Contenido Organico / Community Manager.
+    Usa historial multi-turno real con Anthropic y el system prompt de organico.
+    """
+    try:
+        data = request.json or {}
+        history = data.get('history', [])
+        current_input = str(data.get('message') or '').strip()
+        image_data_url = data.get('image_data_url', '')
+        user_email = str(data.get('user_email') or '').strip().lower()
+        project_name = str(data.get('project_name') or '').strip().lower()
+
+        if not user_email:
+            return jsonify({"error": "login_required"}), 401
+        if not project_name:
+            return jsonify({"error": "project_required"}), 400
+        if not current_input and not image_data_url:
+            return jsonify({"error": "message is required"}), 400
+
+        image_context = describe_image_for_chat(image_data_url) if image_data_url else ""
+        enriched_input = current_input
+        if image_context:
+            enriched_input = f"{current_input}\n\nContexto de imagen adjunta:\n{image_context}".strip()
+        elif image_data_url and not current_input:
+            enriched_input = "El usuario adjunto una imagen. Analiza su contexto para la estrategia de contenido organico."
+
+        if has_reset_intent(current_input):
+            if user_email:
+                save_chat_memory(
+                    user_email,
+                    reset_memory_payload(get_chat_memory(user_email, project_name=project_name) or {}),
+                    project_name=project_name
+                )
+            return jsonify({
+                "ai_reply": "Listo, empezamos de cero. Cuentame sobre tu marca o negocio: que vendes, a quien le hablas y en que redes estas activo ahora mismo.",
+                "ready_for_handoff": False,
+            })
+
+        # Construir historial completo para Anthropic
+        full_history = list(history) + [{"role": "user", "content": enriched_input}]
+
+        # Llamar a Anthropic con historial real y system prompt organico
+        ai_reply = None
+        if ANTHROPIC_API_KEY:
+            recent = full_history[-14:] if len(full_history) > 14 else full_history
+            ai_reply = call_anthropic_chat(
+                recent,
+                system_prompt=ORGANIC_CONTENT_SYSTEM_PROMPT,
+                timeout_seconds=35,
+            )
+
+        # Fallback a Gemini si Anthropic falla
+        if not ai_reply:
+            lang = detect_language(current_input)
+            fallback_prompt = f"""
+Eres Anmar AI, experto en contenido organico y community management.
+Historial: {full_history[-6:]}
+Mensaje actual: {enriched_input}
+Responde como consultor senior de contenido organico. Un solo mensaje al cliente, sin lista de preguntas. Maximo 1 pregunta al final.
+Idioma: {"English" if lang == "en" else "Spanish"}
+"""
+            ai_reply = call_ai_text(fallback_prompt)
+
+        if not ai_reply:
+            ai_reply = "Entiendo tu marca y veo un potencial organico enorme. Cuentame: cual es el mayor reto que tienes hoy para crear contenido de forma consistente?"
+
+        ai_reply = ai_reply.replace("```", "").strip()
+
+        # Guardar memoria
+        if user_email:
+            stored = get_chat_memory(user_email, project_name=project_name) or {}
+            stored["organic_last_message"] = enriched_input
+            stored["organic_last_reply"] = ai_reply[:500]
+            save_chat_memory(user_email, stored, project_name=project_name)
+
+        return jsonify({
+            "ai_reply": ai_reply,
+            "ready_for_handoff": False,
+            "channel": "organic"
+        })
+
+    except Exception as e:
+        log_debug(f"continue_organic error: {e}")
+        return jsonify({"error": "Internal server error"}), 500
@@ -11,6 +11,26 @@ echo "Deploying internal messaging system + bug fixes..."
 cat "$BASE_LOCAL/frontend/script-v36.js" | ssh "$SERVER" "cat > $BASE_REMOTE/frontend/script-v36.js" && echo "OK script-v36.js" || echo "FAILED script-v36.js"
 cat "$BASE_LOCAL/app.py"                  | ssh "$SERVER" "cat > $BASE_REMOTE/app.py"                  && echo "OK app.py"              || echo "FAILED app.py"
 cat "$BASE_LOCAL/internal/panel.html"     | ssh "$SERVER" "cat > $BASE_REMOTE/internal/panel.html"     && echo "OK internal/panel.html" || echo "FAILED internal/panel.html"
+cat "$BASE_LOCAL/asset_pipeline.py"       | ssh "$SERVER" "cat > $BASE_REMOTE/asset_pipeline.py"       && echo "OK asset_pipeline.py"   || echo "FAILED asset_pipeline.py"
+cat "$BASE_LOCAL/schema_migrations.py"    | ssh "$SERVER" "cat > $BASE_REMOTE/schema_migrations.py"    && echo "OK schema_migrations.py" || echo "FAILED schema_migrations.py"
+tar -C "$BASE_LOCAL" -cf - starter_templates.py starter_templates | ssh "$SERVER" "tar -C $BASE_REMOTE -xf -" && echo "OK starter_templates" || echo "FAILED starter_templates"
+tar -C "$BASE_LOCAL" -cf - antigravity_sdk.py structured_output.py singleflight.py job_queue.py patch_edits.py \
+    project_versions.py edit_context.py project_index.py project_archive.py notification_outbox.py \
+    rate_limiter.py entitlements.py token_ledger.py webhook_events.py \
+    | ssh "$SERVER" "tar -C $BASE_REMOTE -xf -" && echo "OK backend modules" || echo "FAILED backend modules"
+tar -C "$BASE_LOCAL" -cf - blueprints lazy_imports.py startup_phases.py profiling.py metrics.py bench_import.py | ssh "$SERVER" "tar -C $BASE_REMOTE -xf -" && echo "OK blueprints" || echo "FAILED blueprints"
+
+echo ""
+echo "Building static assets (frontend/dist)..."
+ssh "$SERVER" "cd $BASE_REMOTE && python3 asset_pipeline.py" && echo "OK assets built" || echo "WARN asset build failed (serving frontend/ as-is)"
+
+echo ""
+echo "Applying database migrations..."
+ssh "$SERVER" "cd $BASE_REMOTE && python3 schema_migrations.py migrate" && echo "OK schema migrated" || { echo "FAILED migrations (service not restarted)"; exit 1; }
+
+echo ""
+echo "Checking app import time..."
+ssh "$SERVER" "cd $BASE_REMOTE && python3 bench_import.py --runs 3" && echo "OK import benchmark" || { echo "FAILED import benchmark (service not restarted)"; exit 1; }
 
 echo ""
 echo "Restarting anmar.service..."
@@ -0,0 +1,283 @@
+"""
+Relevance-selected context for edit prompts.
+
+Project files are split into chunks (HTML blocks, CSS rule blocks, JS
+top-level statements/functions), ranked against the edit instruction with
+a BM25-style score plus cross-file boosts (ids/classes shared with the
+best HTML chunks), and packed into a token budget. Files that fit whole
+are sent whole; omitted chunks are listed in an outline so the model
+still knows the page structure.
+"""
+import math
+import re
+import unicodedata
+
+_HTML_BLOCK_RE = re.compile(
+    r"^\s*<(head|header|nav|main|section|article|aside|footer|form|script|style|dialog)\b[^>]*>",
+    re.IGNORECASE,
+)
+_ATTR_RE = re.compile(r"""\b(id|class)\s*=\s*["']([^"']+)["']""", re.IGNORECASE)
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+# Sinónimos ES -> términos que aparecen en el código.
+QUERY_SYNONYMS = {
+    "boton": ["button", "btn"],
+    "botones": ["button", "btn"],
+    "fondo": ["background", "bg"],
+    "color": ["color", "background"],
+    "colores": ["color", "background"],
+    "titulo": ["h1", "h2", "title", "heading"],
+    "encabezado": ["header", "topbar"],
+    "cabecera": ["header", "topbar"],
+    "menu": ["nav", "menu"],
+    "navegacion": ["nav"],
+    "pie": ["footer"],
+    "formulario": ["form", "input"],
+    "imagen": ["img", "image"],
+    "imagenes": ["img", "image"],
+    "tarjeta": ["card"],
+    "tarjetas": ["card", "cards", "grid"],
+    "precios": ["pricing", "plans", "plan"],
+    "planes": ["plans", "plan", "pricing"],
+    "fuente": ["font", "family"],
+    "letra": ["font"],
+    "animacion": ["animation", "transition", "keyframes"],
+    "movil": ["media", "mobile"],
+    "responsive": ["media"],
+    "click": ["addeventlistener", "click", "onclick"],
+    "clic": ["addeventlistener", "click", "onclick"],
+    "modo": ["theme", "mode"],
+    "oscuro": ["dark"],
+    "claro": ["light"],
+    "contacto": ["contact", "form"],
+    "preguntas": ["faq", "details"],
+    "testimonios": ["testimonials", "testimonial"],
+}
+
+
+def estimate_tokens(text):
+    return max(1, len(text or "") // 4)
+
+
+def _fold(text):
+    text = unicodedata.normalize("NFKD", str(text or "").lower())
+    return "".join(ch for ch in text if not unicodedata.combining(ch))
+
+
+def _terms(text):
+    # camelCase / kebab-case -> palabras sueltas además del token completo.
+    raw = re.sub(r"([a-z])([A-Z])", r"\1 \2", str(text or ""))
+    folded = _fold(raw)
+    return [w for w in _WORD_RE.findall(folded) if len(w) > 1]
+
+
+def query_terms(instruction):
+    terms = []
+    for word in _terms(instruction):
+        terms.append(word)
+        terms.extend(QUERY_SYNONYMS.get(word, []))
+    return terms
+
+
+# ── chunkers ──
+def _chunk(fname, lines, start, end, label):
+    return {
+        "file": fname,
+        "start": start + 1,
+        "end": end,
+        "label": label,
+        "text": "".join(lines[start:end]),
+    }
+
+
+def chunk_html(fname, text):
+    lines = str(text or "").splitlines(keepends=True)
+    starts = [0]
+    for i, line in enumerate(lines):
+        if i and _HTML_BLOCK_RE.match(line):
+            starts.append(i)
+    starts.append(len(lines))
+    chunks = []
+    for a, b in zip(starts, starts[1:]):
+        if a >= b:
+            continue
+        head = "".join(lines[a:a + 1])
+        tag = _HTML_BLOCK_RE.match(head)
+        attrs = " ".join(f"{k}={v}" for k, v in _ATTR_RE.findall(head))
+        label = f"<{tag.group(1).lower()} {attrs}>".replace(" >", ">") if tag else "document start"
+        chunks.append(_chunk(fname, lines, a, b, label))
+    return chunks
+
+
+def _split_balanced(fname, text, label_fn):
+    """Cuts text at depth-0 boundaries ('}' or ';' closing a statement)."""
+    lines = str(text or "").splitlines(keepends=True)
+    chunks = []
+    depth = 0
+    start = 0
+    in_comment = False
+    for i, line in enumerate(lines):
+        j = 0
+        while j < len(line):
+            pair = line[j:j + 2]
+            if in_comment:
+                if pair == "*/":
+                    in_comment = False
+                    j += 1
+            elif pair == "/*":
+                in_comment = True
+                j += 1
+            elif line[j] == "{":
+                depth += 1
+            elif line[j] == "}":
+                depth = max(0, depth - 1)
+            j += 1
+        stripped = line.strip()
+        if depth == 0 and not in_comment and stripped.endswith(("}", ";", "});")):
+            # Agrupa sentencias cortas consecutivas.
+            if i + 1 - start >= 3 or stripped.endswith("}"):
+                chunks.append(_chunk(fname, lines, start, i + 1, label_fn(lines[start:i + 1])))
+                start = i + 1
+    if start < len(lines):
+        chunks.append(_chunk(fname, lines, start, len(lines), label_fn(lines[start:])))
+    return [c for c in chunks if c["text"].strip()]
+
+
+def _css_label(block_lines):
+    for line in block_lines:
+        if line.strip():
+            return line.strip().split("{")[0].strip()[:80] or "rule"
+    return "rule"
+
+
+def _js_label(block_lines):
+    for line in block_lines:
+        text = line.strip()
+        if not text or text.startswith("//"):
+            continue
+        match = re.search(r"(?:function\s+([\w$]+)|(?:const|let|var)\s+([\w$]+)|getElementById\(['\"]([\w-]+))", text)
+        if match:
+            return next(g for g in match.groups() if g)
+        return text[:60]
+    return "statement"
+
+
+def chunk_file(fname, text):
+    lower = fname.lower()
+    if lower.endswith((".html", ".htm")):
+        return chunk_html(fname, text)
+    if lower.endswith(".css"):
+        return _split_balanced(fname, text, _css_label)
+    if lower.endswith(".js"):
+        return _split_balanced(fname, text, _js_label)
+    lines = str(text or "").splitlines(keepends=True)
+    return [_chunk(fname, lines, 0, len(lines), fname)] if lines else []
+
+
+# ── ranking ──
+def rank_chunks(chunks, instruction):
+    query = query_terms(instruction)
+    if not chunks:
+        return []
+    docs = [_terms(c["text"]) + _terms(c["label"]) * 3 for c in chunks]
+    avg_len = sum(len(d) for d in docs) / len(docs) or 1.0
+    doc_freq = {}
+    for doc in docs:
+        for term in set(doc):
+            doc_freq[term] = doc_freq.get(term, 0) + 1
+    k1, b = 1.2, 0.75
+    for chunk, doc in zip(chunks, docs):
+        counts = {}
+        for term in doc:
+            counts[term] = counts.get(term, 0) + 1
+        score = 0.0
+        for term in set(query):
+            tf = counts.get(term, 0)
+            if not tf:
+                continue
+            idf = math.log(1 + (len(docs) - doc_freq[term] + 0.5) / (doc_freq[term] + 0.5))
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(doc) / avg_len))
+        chunk["score"] = score
+
+    # Ids/clases de los mejores bloques HTML suben el CSS/JS que los usa.
+    top_html = sorted(
+        [c for c in chunks if c["file"].endswith(".html") and c["score"] > 0],
+        key=lambda c: -c["score"],
+    )[:3]
+    selectors = set()
+    for chunk in top_html:
+        for _, value in _ATTR_RE.findall(chunk["text"]):
+            selectors.update(v for v in value.split() if len(v) > 2)
+    if selectors:
+        for chunk in chunks:
+            if chunk["file"].endswith(".html"):
+                continue
+            hits = sum(1 for sel in selectors if sel in chunk["text"])
+            chunk["score"] += 0.5 * min(hits, 4)
+    return sorted(chunks, key=lambda c: -c["score"])
+
+
+def select_context(file_snapshots, instruction, budget_tokens=6000):
+    """
+    Returns (context_text, stats). Files are sent whole when everything
+    fits; otherwise the highest ranked chunks are packed into the budget,
+    always keeping the document start of index.html for structure.
+    """
+    files = {f: c for f, c in (file_snapshots or {}).items() if c}
+    total = sum(estimate_tokens(c) for c in files.values())
+    if total <= budget_tokens:
+        text = "".join(f"\n===== {fname} (completo) =====\n{content}\n" for fname, content in files.items())
+        return text, {"mode": "full", "tokens": total, "chunks": None}
+
+    all_chunks = []
+    for fname, content in files.items():
+        all_chunks.extend(chunk_file(fname, content))
+    ranked = rank_chunks(all_chunks, instruction)
+
+    selected, used = [], 0
+    pinned = [c for c in ranked if c["file"] == "index.html" and c["start"] == 1]
+    for chunk in pinned + [c for c in ranked if c not in pinned]:
+        cost = estimate_tokens(chunk["text"])
+        if used + cost > budget_tokens:
+            continue
+        if chunk not in pinned and chunk["score"] <= 0 and used > budget_tokens * 0.5:
+            continue
+        selected.append(chunk)
+        used += cost
+
+    parts = []
+    for fname in files:
+        file_chunks = sorted([c for c in all_chunks if c["file"] == fname], key=lambda c: c["start"])
+        shown = [c for c in file_chunks if c in selected]
+        omitted = [c for c in file_chunks if c not in selected]
+        if not shown and not omitted:
+            continue
+        parts.append(f"\n===== {fname} (fragmentos relevantes) =====\n")
+        for chunk in shown:
+            parts.append(f"--- líneas {chunk['start']}-{chunk['end']}: {chunk['label']} ---\n{chunk['text']}")
+            if not chunk["text"].endswith("\n"):
+                parts.append("\n")
+        if omitted:
+            outline = ", ".join(f"{c['label']} (l.{c['start']}-{c['end']})" for c in omitted[:25])
+            parts.append(f"[omitidos: {outline}]\n")
+    return "".join(parts), {
+        "mode": "selected",
+        "tokens": used,
+        "total_tokens": total,
+        "chunks": len(selected),
+        "total_chunks": len(all_chunks),
+    }
+
+
+def compact_history(history, max_turns=6, max_chars=400):
+    """Last turns of the chat history, each message truncated."""
+    compact = []
+    for msg in (history or [])[-max_turns:]:
+        if isinstance(msg, dict):
+            role = str(msg.get("role") or "user")
+            content = str(msg.get("content") or "").strip()
+        else:
+            role, content = "user", str(msg or "").strip()
+        if content:
+            compact.append(f"{role}: {content[:max_chars]}")
+    return "\n".join(compact)
@@ -0,0 +1,117 @@
+"""
+Subscription + token balance checks against the users table.
+
+snapshot() reads subscription and balance in one query (creating the
+user row on first use, like the old ensure_user_exists_for_tokens), and
+consume() decides and deducts in a single UPDATE ... RETURNING: the row
+comes back only if the user is subscribed (no deduction) or has enough
+tokens. Subscription status is cached per process for cache_ttl seconds;
+invalidate(email) is called wherever subscription columns change, and the
+TTL bounds staleness across gunicorn workers.
+"""
+import sqlite3
+import threading
+import time
+
+SUPPORTS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+class EntitlementService:
+    def __init__(self, connect, default_tokens=50, cache_ttl=30, max_cached=20000):
+        self._connect = connect
+        self.default_tokens = int(default_tokens)
+        self.cache_ttl = float(cache_ttl)
+        self.max_cached = int(max_cached)
+        self._subscribed = {}  # email -> (subscribed, expires_at)
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+    # ── cache ──
+    def _remember(self, email, subscribed):
+        with self._lock:
+            if len(self._subscribed) >= self.max_cached:
+                self._subscribed.clear()
+            self._subscribed[email] = (bool(subscribed), time.time() + self.cache_ttl)
+
+    def invalidate(self, email=None):
+        with self._lock:
+            if email is None:
+                self._subscribed.clear()
+            else:
+                self._subscribed.pop(email, None)
+
+    # ── reads ──
+    def _fetch(self, conn, email):
+        return conn.execute(
+            "SELECT tokens, subscription_active FROM users WHERE email = ?", (email,)
+        ).fetchone()
+
+    def _provision(self, conn, email):
+        conn.execute(
+            "INSERT OR IGNORE INTO users (name, email, password, tokens) VALUES (?, ?, ?, ?)",
+            ("Anmar User", email, "auto_generated", self.default_tokens),
+        )
+        conn.commit()
+        return self._fetch(conn, email)
+
+    def snapshot(self, email):
+        """{"tokens", "subscribed"} in one query; the user row is created if missing."""
+        conn = self._connect()
+        try:
+            row = self._fetch(conn, email) or self._provision(conn, email)
+        finally:
+            conn.close()
+        subscribed = bool(row and int(row["subscription_active"] or 0) == 1)
+        self._remember(email, subscribed)
+        return {"tokens": int(row["tokens"]) if row else 0, "subscribed": subscribed}
+
+    def is_subscribed(self, email):
+        cached = self._subscribed.get(email)
+        if cached and cached[1] > time.time():
+            self.stats["hits"] += 1
+            return cached[0]
+        self.stats["misses"] += 1
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT subscription_active FROM users WHERE email = ?", (email,)).fetchone()
+        finally:
+            conn.close()
+        subscribed = bool(row and int(row["subscription_active"] or 0) == 1)
+        self._remember(email, subscribed)
+        return subscribed
+
+    # ── writes ──
+    def _deduct(self, conn, email, amount):
+        sql = """UPDATE users
+                 SET tokens = tokens - CASE WHEN subscription_active = 1 THEN 0 ELSE ? END
+                 WHERE email = ? AND (subscription_active = 1 OR tokens >= ?)"""
+        if SUPPORTS_RETURNING:
+            row = conn.execute(sql + " RETURNING tokens, subscription_active", (amount, email, amount)).fetchone()
+            conn.commit()
+            return row
+        cursor = conn.execute(sql, (amount, email, amount))
+        conn.commit()
+        return self._fetch(conn, email) if cursor.rowcount else None
+
+    def consume(self, email, amount, reason=""):
+        """Returns (ok, message, balance) like consume_user_tokens always did."""
+        conn = self._connect()
+        try:
+            row = self._deduct(conn, email, amount)
+            if row is None:
+                # Usuario inexistente o saldo insuficiente (camino poco frecuente).
+                current = self._fetch(conn, email)
+                if current is None:
+                    self._provision(conn, email)
+                    row = self._deduct(conn, email, amount)
+                if row is None:
+                    current = self._fetch(conn, email)
+                    balance = int(current["tokens"]) if current else 0
+                    if current is not None:
+                        self._remember(email, int(current["subscription_active"] or 0) == 1)
+                    return False, f"Insufficient credits for {reason or 'this action'} (requires {amount}).", balance
+        finally:
+            conn.close()
+        subscribed = int(row["subscription_active"] or 0) == 1
+        self._remember(email, subscribed)
+        return True, "subscribed" if subscribed else "ok", int(row["tokens"])
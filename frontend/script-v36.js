@@ -3090,6 +3090,30 @@ document.addEventListener('DOMContentLoaded', () => {
     let lastStatus = '';
     let lastDeployedUrl = '';
 
+    // /create-project responde 202 con job_id; el build corre en background.
+    async function waitForBuildJob(data, timeoutMs = 180000) {
+        if (!data || !data.job_id) return data;
+        const startedAt = Date.now();
+        let lastStep = '';
+        while (Date.now() - startedAt < timeoutMs) {
+            await new Promise(r => setTimeout(r, 2000));
+            const res = await fetch(`/api/build-jobs/${encodeURIComponent(data.job_id)}`, { credentials: 'include' });
+            if (!res.ok) continue;
+            const job = await res.json();
+            if (job.message && job.step !== lastStep) {
+                lastStep = job.step;
+                showThinking(job.message);
+            }
+            if (job.state === 'completed') {
+                return { ...data, ...(job.result || {}), remaining_tokens: data.remaining_tokens };
+            }
+            if (job.state === 'failed') {
+                return { ...data, ...(job.result || {}), error: job.error || 'Build failed' };
+            }
+        }
+        return data;
+    }
+
     function startPolling() {
         if (pollInterval) clearInterval(pollInterval);
         pollInterval = setInterval(async () => {
@@ -3263,7 +3287,8 @@ document.addEventListener('DOMContentLoaded', () => {
             })
         });
 
-        const data = await response.json();
+        let data = await response.json();
+        if (response.status === 202) data = await waitForBuildJob(data);
         stopThinking();
 
         // PAYWALL HANDLER
@@ -5026,7 +5051,8 @@ document.addEventListener('DOMContentLoaded', () => {
                     user_email: currentUser?.email || localStorage.getItem('user_email') || 'guest@anmar.ai'
                 })
             });
-            const data = await res.json();
+            let data = await res.json();
+            if (res.status === 202) data = await waitForBuildJob(data);
 
             if (data.error) throw new Error(data.error);
 
@@ -0,0 +1,280 @@
+"""
+Persistent background jobs on a local worker pool.
+
+Jobs live in a SQLite table (see schema_migrations) so a restart does not
+lose them. Handlers receive the job dict and a report(step, progress,
+message=None) callback and return a JSON-serializable result.
+
+Several gunicorn workers may share the table. A worker claims a job with a
+conditional UPDATE (status 'queued' -> 'running', claimed_by, claimed_at)
+and runs it only if it won; a heartbeat thread refreshes claimed_at on the
+jobs it is running. A 'running' job whose claim is older than
+lease_seconds belonged to a worker that died, and is requeued; live jobs
+in other workers are never touched.
+"""
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+JOB_STATES = ("queued", "running", "completed", "failed")
+
+
+def _now():
+    return datetime.now().isoformat()
+
+
+class JobQueue:
+    def __init__(self, connect, table="build_jobs", max_workers=2, max_attempts=3, lease_seconds=300):
+        self._connect = connect
+        self._table = table
+        self._max_workers = max(1, int(max_workers))
+        self._max_attempts = max(1, int(max_attempts))
+        self._lease_seconds = max(float(lease_seconds), 5.0)
+        self._handlers = {}
+        self._listeners = []
+        self._executor = None
+        self._heartbeat = None
+        self._lock = threading.Lock()
+        self._worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+    def register(self, kind, handler):
+        self._handlers[kind] = handler
+
+    def on_update(self, listener):
+        """listener(job) is called after every state/progress change."""
+        self._listeners.append(listener)
+
+    def start(self):
+        with self._lock:
+            if self._executor is not None:
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="anmar-job")
+            self._heartbeat = threading.Thread(target=self._heartbeat_loop, name="anmar-job-heartbeat", daemon=True)
+            self._heartbeat.start()
+        self._requeue_expired()
+        self._submit_queued()
+
+    def enqueue(self, kind, payload, project_id=None, owner=None):
+        if kind not in self._handlers:
+            raise ValueError(f"No handler registered for job kind '{kind}'")
+        job_id = uuid.uuid4().hex[:12]
+        now = _now()
+        conn = self._connect()
+        try:
+            conn.execute(
+                f"""INSERT INTO {self._table}
+                    (id, kind, status, project_id, owner, payload_json, step, progress, attempts, created_at, updated_at)
+                    VALUES (?, ?, 'queued', ?, ?, ?, 'queued', 0, 0, ?, ?)""",
+                (job_id, kind, project_id, owner, json.dumps(payload or {}), now, now),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        self._notify(self.get(job_id))
+        self.start()
+        self._executor.submit(self._run, job_id)
+        return job_id
+
+    def get(self, job_id):
+        conn = self._connect()
+        try:
+            row = conn.execute(f"SELECT * FROM {self._table} WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+        return self._row_to_job(row)
+
+    def active_for_project(self, project_id):
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                f"""SELECT * FROM {self._table}
+                    WHERE project_id = ? AND status IN ('queued', 'running')
+                    ORDER BY created_at DESC LIMIT 1""",
+                (project_id,),
+            ).fetchone()
+        finally:
+            conn.close()
+        return self._row_to_job(row)
+
+    def latest_for_project(self, project_id):
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                f"SELECT * FROM {self._table} WHERE project_id = ? ORDER BY created_at DESC LIMIT 1",
+                (project_id,),
+            ).fetchone()
+        finally:
+            conn.close()
+        return self._row_to_job(row)
+
+    def stats(self):
+        conn = self._connect()
+        try:
+            rows = conn.execute(f"SELECT status, COUNT(*) AS n FROM {self._table} GROUP BY status").fetchall()
+            oldest = conn.execute(
+                f"SELECT MIN(created_at) AS t FROM {self._table} WHERE status IN ('queued', 'running')"
+            ).fetchone()
+        finally:
+            conn.close()
+        lag = 0
+        if oldest and oldest["t"]:
+            try:
+                lag = round((datetime.now() - datetime.fromisoformat(oldest["t"])).total_seconds(), 1)
+            except ValueError:
+                pass
+        return {"jobs": {row["status"]: row["n"] for row in rows}, "oldest_pending_seconds": lag}
+
+    # ── internals ──
+    def _row_to_job(self, row):
+        if row is None:
+            return None
+        job = dict(row)
+        for field in ("payload_json", "result_json"):
+            raw = job.pop(field, None)
+            try:
+                job[field[:-5]] = json.loads(raw) if raw else None
+            except ValueError:
+                job[field[:-5]] = None
+        return job
+
+    def _update(self, job_id, owned=False, **fields):
+        """owned=True only writes while this worker still holds the claim."""
+        fields["updated_at"] = _now()
+        assignments = ", ".join(f"{k} = ?" for k in fields)
+        where, params = "id = ?", [job_id]
+        if owned:
+            where += " AND claimed_by = ? AND status = 'running'"
+            params.append(self._worker_id)
+        conn = self._connect()
+        try:
+            cur = conn.execute(
+                f"UPDATE {self._table} SET {assignments} WHERE {where}",
+                list(fields.values()) + params,
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        if cur.rowcount == 0:
+            if owned:
+                print(f"[JOBS] {job_id}: claim lost, update dropped")
+            return None
+        job = self.get(job_id)
+        self._notify(job)
+        return job
+
+    def _submit_queued(self):
+        conn = self._connect()
+        try:
+            pending = [r["id"] for r in conn.execute(
+                f"SELECT id FROM {self._table} WHERE status = 'queued' ORDER BY created_at"
+            ).fetchall()]
+        finally:
+            conn.close()
+        for job_id in pending:
+            self._executor.submit(self._run, job_id)
+
+    def _claim(self, job_id, attempts):
+        now = _now()
+        conn = self._connect()
+        try:
+            cur = conn.execute(
+                f"""UPDATE {self._table}
+                    SET status = 'running', step = 'started', attempts = ?, claimed_by = ?, claimed_at = ?,
+                        started_at = ?, updated_at = ?
+                    WHERE id = ? AND status = 'queued'""",
+                (attempts, self._worker_id, time.time(), now, now, job_id),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        if cur.rowcount == 0:
+            return None
+        job = self.get(job_id)
+        self._notify(job)
+        return job
+
+    def _requeue_expired(self):
+        # Solo trabajos cuyo worker dejó de latir (reinicio, SIGKILL); los vivos siguen su curso.
+        conn = self._connect()
+        try:
+            cur = conn.execute(
+                f"""UPDATE {self._table} SET status = 'queued', step = 'requeued', claimed_by = NULL
+                    WHERE status = 'running' AND (claimed_at IS NULL OR claimed_at < ?)""",
+                (time.time() - self._lease_seconds,),
+            )
+            conn.commit()
+            requeued = cur.rowcount
+        finally:
+            conn.close()
+        if requeued:
+            print(f"[JOBS] requeued {requeued} job(s) with an expired lease")
+        return requeued
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(self._lease_seconds / 3)
+            try:
+                conn = self._connect()
+                try:
+                    conn.execute(
+                        f"UPDATE {self._table} SET claimed_at = ? WHERE claimed_by = ? AND status = 'running'",
+                        (time.time(), self._worker_id),
+                    )
+                    conn.commit()
+                finally:
+                    conn.close()
+                if self._requeue_expired():
+                    self._submit_queued()
+            except Exception as e:
+                print(f"[JOBS] heartbeat error: {e}")
+
+    def _notify(self, job):
+        for listener in self._listeners:
+            try:
+                listener(job)
+            except Exception as e:
+                print(f"[JOBS] listener error: {e}")
+
+    def _run(self, job_id):
+        job = self.get(job_id)
+        if not job or job["status"] != "queued":
+            return
+        handler = self._handlers.get(job["kind"])
+        attempts = int(job.get("attempts") or 0) + 1
+        if handler is None or attempts > self._max_attempts:
+            conn = self._connect()
+            try:
+                conn.execute(
+                    f"""UPDATE {self._table} SET status = 'failed', step = 'failed', attempts = ?, error = ?,
+                        finished_at = ?, updated_at = ? WHERE id = ? AND status = 'queued'""",
+                    (attempts, "No handler" if handler is None else "Max attempts exceeded",
+                     _now(), _now(), job_id),
+                )
+                conn.commit()
+            finally:
+                conn.close()
+            self._notify(self.get(job_id))
+            return
+        job = self._claim(job_id, attempts)
+        if job is None:
+            return  # otro worker lo reclamó primero
+
+        def report(step, progress, message=None):
+            self._update(job_id, owned=True, step=str(step), progress=int(progress), message=message,
+                         claimed_at=time.time())
+
+        try:
+            result = handler(job, report)
+            self._update(job_id, owned=True, status="completed", step="completed", progress=100,
+                         result_json=json.dumps(result or {}), finished_at=_now())
+        except Exception as e:
+            print(f"[JOBS] {job['kind']} {job_id} failed: {e}")
+            traceback.print_exc()
+            result = getattr(e, "result", None)
+            self._update(job_id, owned=True, status="failed", step="failed", error=str(e)[:500],
+                         result_json=json.dumps(result) if result else None, finished_at=_now())
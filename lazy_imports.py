@@ -0,0 +1,58 @@
+"""
+Deferred imports for heavy provider SDKs.
+
+google.generativeai, stripe and requests account for most of app.py's
+import time, yet a worker serving static files or previews never touches
+them. LazyModule stands in for the module and imports it on the first
+attribute access (thread-safe); configuration that used to run at import
+time (stripe.api_key = ...) is registered with on_import() and applied
+right after the real import.
+"""
+import importlib
+import threading
+
+
+class LazyModule:
+    def __init__(self, name):
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_module", None)
+        object.__setattr__(self, "_hooks", [])
+        object.__setattr__(self, "_lock", threading.Lock())
+
+    def _load(self):
+        module = self._module
+        if module is None:
+            with self._lock:
+                module = self._module
+                if module is None:
+                    module = importlib.import_module(self._name)
+                    for hook in self._hooks:
+                        hook(module)
+                    object.__setattr__(self, "_module", module)
+        return module
+
+    def on_import(self, hook):
+        """hook(module) runs once after the import (immediately if already imported)."""
+        with self._lock:
+            if self._module is None:
+                self._hooks.append(hook)
+                return
+        hook(self._module)
+
+    def loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+genai = LazyModule("google.generativeai")
+stripe = LazyModule("stripe")
+requests = LazyModule("requests")
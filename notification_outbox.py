@@ -0,0 +1,315 @@
+"""
+Durable outbox for outgoing email/SMS.
+
+Callers only insert a row (see init_db for the table) and return; a
+background dispatcher claims due rows, groups them per (channel,
+recipient) so channels with a combiner (SMS) send one message instead of
+several, and delivers them on a bounded worker pool. Failures are retried
+with exponential backoff up to max_attempts; identical messages inside
+the dedupe window are dropped at enqueue time, and enqueue_digest() folds
+bursts of alerts into one delayed message per key. Claims are conditional
+UPDATEs, so several gunicorn workers can run a dispatcher on the same DB.
+"""
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+OUTBOX_STATES = ("queued", "sending", "sent", "failed")
+
+
+class NotificationOutbox:
+    def __init__(self, connect, table="notification_outbox", max_workers=2, max_attempts=5,
+                 base_backoff=30, dedupe_seconds=600, poll_interval=2.0, stale_after=300):
+        self._connect = connect
+        self._table = table
+        self._max_workers = max(1, int(max_workers))
+        self._max_attempts = max(1, int(max_attempts))
+        self._base_backoff = float(base_backoff)
+        self._dedupe_seconds = float(dedupe_seconds)
+        self._poll_interval = float(poll_interval)
+        self._stale_after = float(stale_after)
+        self._channels = {}
+        self._executor = None
+        self._thread = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self._worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._metrics = {
+            "enqueued": 0, "deduplicated": 0, "digested": 0, "sent": 0, "retried": 0,
+            "failed": 0, "batched": 0, "latency_total": 0.0, "latency_max": 0.0,
+        }
+
+    def register(self, channel, sender, combine=None):
+        """
+        sender(recipient, payload) delivers one message and raises on failure.
+        combine(payloads) -> payload merges messages queued for the same recipient.
+        """
+        self._channels[channel] = (sender, combine)
+
+    # ── enqueue ──
+    def enqueue(self, channel, recipient, payload, dedupe_key=None, delay=0):
+        """Returns the outbox id, or None if an identical message is already pending/sent."""
+        if channel not in self._channels:
+            raise ValueError(f"No sender registered for channel '{channel}'")
+        payload_json = json.dumps(payload or {}, sort_keys=True, ensure_ascii=False)
+        dedupe_key = dedupe_key or hashlib.sha256(
+            f"{channel}|{recipient}|{payload_json}".encode("utf-8")
+        ).hexdigest()
+        now = time.time()
+        conn = self._connect()
+        try:
+            duplicate = conn.execute(
+                f"""SELECT id FROM {self._table}
+                    WHERE dedupe_key = ? AND status != 'failed' AND created_at >= ? LIMIT 1""",
+                (dedupe_key, now - self._dedupe_seconds),
+            ).fetchone()
+            if duplicate:
+                self._bump("deduplicated")
+                return None
+            message_id = uuid.uuid4().hex[:16]
+            conn.execute(
+                f"""INSERT INTO {self._table}
+                    (id, channel, recipient, payload_json, dedupe_key, status, attempts, created_at, next_attempt_at)
+                    VALUES (?, ?, ?, ?, ?, 'queued', 0, ?, ?)""",
+                (message_id, channel, recipient, payload_json, dedupe_key, now, now + max(0.0, float(delay))),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        self._bump("enqueued")
+        self.start()
+        if not delay:
+            self._wake.set()
+        return message_id
+
+    def enqueue_digest(self, channel, recipient, digest_key, item, render, window=120, max_items=20):
+        """
+        Buffers item into the pending digest for digest_key (one row per open
+        window) instead of queueing a message per event. The row is sent
+        window seconds after its first item; render(items, count) -> payload
+        rebuilds the message on every append.
+        """
+        if channel not in self._channels:
+            raise ValueError(f"No sender registered for channel '{channel}'")
+        key = f"digest:{digest_key}"
+        now = time.time()
+        conn = self._connect()
+        try:
+            for _ in range(2):
+                row = conn.execute(
+                    f"""SELECT id, payload_json FROM {self._table}
+                        WHERE dedupe_key = ? AND status = 'queued' AND recipient = ?
+                        ORDER BY created_at DESC LIMIT 1""",
+                    (key, recipient),
+                ).fetchone()
+                if row is None:
+                    break
+                digest = (json.loads(row["payload_json"] or "{}").get("_digest") or {})
+                items = (digest.get("items") or []) + [item]
+                count = int(digest.get("count") or 0) + 1
+                payload = dict(render(items[-max_items:], count), _digest={"count": count, "items": items[-max_items:]})
+                # Si el dispatcher la reclamó entre el SELECT y el UPDATE, se abre otra ventana.
+                cur = conn.execute(
+                    f"UPDATE {self._table} SET payload_json = ? WHERE id = ? AND status = 'queued'",
+                    (json.dumps(payload, sort_keys=True, ensure_ascii=False), row["id"]),
+                )
+                conn.commit()
+                if cur.rowcount:
+                    self._bump("digested")
+                    return row["id"]
+            payload = dict(render([item], 1), _digest={"count": 1, "items": [item]})
+            message_id = uuid.uuid4().hex[:16]
+            conn.execute(
+                f"""INSERT INTO {self._table}
+                    (id, channel, recipient, payload_json, dedupe_key, status, attempts, created_at, next_attempt_at)
+                    VALUES (?, ?, ?, ?, ?, 'queued', 0, ?, ?)""",
+                (message_id, channel, recipient, json.dumps(payload, sort_keys=True, ensure_ascii=False),
+                 key, now, now + max(0.0, float(window))),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        self._bump("enqueued")
+        self.start()
+        return message_id
+
+    # ── dispatcher ──
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="anmar-outbox")
+            self._thread = threading.Thread(target=self._loop, name="anmar-outbox-dispatcher", daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        # Un worker que muere a mitad de _deliver deja filas en 'sending'; los
+        # demás las recuperan al vencer stale_after, no solo al arrancar.
+        next_requeue = 0.0
+        while True:
+            try:
+                if time.time() >= next_requeue:
+                    self._requeue_stale()
+                    next_requeue = time.time() + self._stale_after / 2
+                self._dispatch_due()
+            except Exception as e:
+                print(f"[OUTBOX] dispatcher error: {e}")
+            self._wake.wait(self._poll_interval)
+            self._wake.clear()
+
+    def _requeue_stale(self):
+        # Mensajes que quedaron en 'sending' por un worker caído vuelven a la cola.
+        conn = self._connect()
+        try:
+            conn.execute(
+                f"""UPDATE {self._table} SET status = 'queued', claimed_by = NULL
+                    WHERE status = 'sending' AND claimed_at < ?""",
+                (time.time() - self._stale_after,),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _dispatch_due(self):
+        capacity = self._max_workers * 2 - self._inflight
+        if capacity <= 0:
+            return
+        now = time.time()
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                f"""SELECT * FROM {self._table}
+                    WHERE status = 'queued' AND next_attempt_at <= ?
+                    ORDER BY next_attempt_at LIMIT ?""",
+                (now, capacity * 10),
+            ).fetchall()
+            claimed = []
+            for row in rows:
+                cur = conn.execute(
+                    f"""UPDATE {self._table} SET status = 'sending', claimed_by = ?, claimed_at = ?
+                        WHERE id = ? AND status = 'queued'""",
+                    (self._worker_id, now, row["id"]),
+                )
+                if cur.rowcount:
+                    claimed.append(dict(row))
+            conn.commit()
+        finally:
+            conn.close()
+
+        groups = {}
+        for row in claimed:
+            groups.setdefault((row["channel"], row["recipient"]), []).append(row)
+        for (channel, recipient), group in groups.items():
+            with self._lock:
+                self._inflight += 1
+            self._executor.submit(self._deliver, channel, recipient, group)
+
+    def _deliver(self, channel, recipient, rows):
+        try:
+            sender, combine = self._channels.get(channel, (None, None))
+            payloads = [json.loads(r["payload_json"] or "{}") for r in rows]
+            if sender is None:
+                raise RuntimeError(f"No sender registered for channel '{channel}'")
+            if combine and len(payloads) > 1:
+                sender(recipient, combine(payloads))
+                self._bump("batched", len(payloads) - 1)
+            else:
+                # Sin combinador: se envían uno a uno; un fallo solo reintenta los pendientes.
+                for idx, payload in enumerate(payloads):
+                    try:
+                        sender(recipient, payload)
+                    except Exception:
+                        self._mark_sent(rows[:idx])
+                        rows = rows[idx:]
+                        raise
+            self._mark_sent(rows)
+        except Exception as e:
+            self._mark_failed(rows, e)
+        finally:
+            with self._lock:
+                self._inflight -= 1
+            self._wake.set()
+
+    def _mark_sent(self, rows):
+        if not rows:
+            return
+        now = time.time()
+        conn = self._connect()
+        try:
+            for row in rows:
+                conn.execute(
+                    f"UPDATE {self._table} SET status = 'sent', sent_at = ?, attempts = attempts + 1, last_error = NULL WHERE id = ?",
+                    (now, row["id"]),
+                )
+            conn.commit()
+        finally:
+            conn.close()
+        with self._lock:
+            for row in rows:
+                latency = now - float(row["created_at"] or now)
+                self._metrics["sent"] += 1
+                self._metrics["latency_total"] += latency
+                self._metrics["latency_max"] = max(self._metrics["latency_max"], latency)
+
+    def _mark_failed(self, rows, error):
+        now = time.time()
+        conn = self._connect()
+        try:
+            for row in rows:
+                attempts = int(row["attempts"] or 0) + 1
+                if attempts >= self._max_attempts:
+                    conn.execute(
+                        f"UPDATE {self._table} SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?",
+                        (attempts, str(error)[:500], row["id"]),
+                    )
+                    self._bump("failed")
+                    print(f"[OUTBOX] {row['channel']} to {row['recipient']} failed permanently: {error}")
+                else:
+                    backoff = self._base_backoff * (2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+                    conn.execute(
+                        f"""UPDATE {self._table} SET status = 'queued', attempts = ?, last_error = ?, next_attempt_at = ?
+                            WHERE id = ?""",
+                        (attempts, str(error)[:500], now + backoff, row["id"]),
+                    )
+                    self._bump("retried")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _bump(self, key, amount=1):
+        with self._lock:
+            self._metrics[key] += amount
+
+    # ── metrics ──
+    def stats(self):
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                f"SELECT channel, status, COUNT(*) AS n FROM {self._table} GROUP BY channel, status"
+            ).fetchall()
+            oldest = conn.execute(
+                f"SELECT MIN(created_at) AS t FROM {self._table} WHERE status IN ('queued', 'sending')"
+            ).fetchone()
+        finally:
+            conn.close()
+        by_status = {}
+        for row in rows:
+            by_status.setdefault(row["channel"], {})[row["status"]] = row["n"]
+        with self._lock:
+            metrics = dict(self._metrics)
+            inflight = self._inflight
+        sent = metrics.pop("sent")
+        latency_total = metrics.pop("latency_total")
+        metrics["latency_max"] = round(metrics["latency_max"], 3)
+        return {
+            "queue": by_status,
+            "oldest_pending_seconds": round(time.time() - oldest["t"], 1) if oldest and oldest["t"] else 0,
+            "inflight_batches": inflight,
+            "process": dict(metrics, sent=sent, avg_latency_seconds=round(latency_total / sent, 3) if sent else 0),
+        }
@@ -0,0 +1,165 @@
+"""
+Targeted file edits: search/replace blocks and unified-diff hunks.
+
+The model returns small edits instead of whole files; they are applied
+here against the current contents. Matching is exact first and then
+whitespace-tolerant (line by line, ignoring indentation), and an edit
+must match exactly one place, otherwise it is reported as an error so the
+caller can retry or fall back to a full rewrite.
+"""
+import re
+
+_HUNK_RE = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+def _find_line_block(lines, block, hint=0):
+    """Indexes where block (list of lines) starts in lines, closest to hint first."""
+    if not block:
+        return []
+    size = len(block)
+    exact, loose = [], []
+    stripped_block = [b.strip() for b in block]
+    for i in range(len(lines) - size + 1):
+        window = lines[i:i + size]
+        if [w.rstrip("\r\n") for w in window] == [b.rstrip("\r\n") for b in block]:
+            exact.append(i)
+        elif [w.strip() for w in window] == stripped_block:
+            loose.append(i)
+    found = exact or loose
+    return sorted(found, key=lambda i: abs(i - hint))
+
+
+def apply_search_replace(content, search, replace):
+    """Returns (new_content, error)."""
+    content = content or ""
+    replace = replace or ""
+    if not search:
+        if not content.strip():
+            return replace, None
+        return None, "empty search block on a non-empty file"
+
+    count = content.count(search)
+    if count == 1:
+        return content.replace(search, replace, 1), None
+    if count > 1:
+        return None, f"search block matches {count} places; include more context"
+
+    lines = content.splitlines(keepends=True)
+    block = search.strip("\n").splitlines()
+    matches = _find_line_block(lines, block)
+    if not matches:
+        return None, "search block not found"
+    if len(matches) > 1:
+        return None, f"search block matches {len(matches)} places; include more context"
+    start = matches[0]
+    end = start + len(block)
+    new_text = replace.strip("\n")
+    if new_text:
+        new_text += "\n"
+    # Conserva el salto de línea final si el bloque reemplazado lo tenía.
+    if end == len(lines) and not lines[-1].endswith("\n"):
+        new_text = new_text.rstrip("\n")
+    return "".join(lines[:start]) + new_text + "".join(lines[end:]), None
+
+
+def parse_unified_diff(diff_text):
+    """Returns a list of hunks: {"old_start", "old": [lines], "new": [lines]}."""
+    hunks = []
+    current = None
+    for raw in str(diff_text or "").splitlines():
+        if raw.startswith("---") or raw.startswith("+++"):
+            continue
+        match = _HUNK_RE.match(raw)
+        if match:
+            current = {"old_start": int(match.group(1)), "old": [], "new": []}
+            hunks.append(current)
+            continue
+        if current is None or raw.startswith("\\"):
+            continue
+        marker, text = (raw[:1], raw[1:]) if raw else (" ", "")
+        if marker == " ":
+            current["old"].append(text)
+            current["new"].append(text)
+        elif marker == "-":
+            current["old"].append(text)
+        elif marker == "+":
+            current["new"].append(text)
+        else:
+            # Línea de contexto sin prefijo (modelos que omiten el espacio).
+            current["old"].append(raw)
+            current["new"].append(raw)
+    return hunks
+
+
+def apply_unified_diff(content, diff_text):
+    """Applies every hunk; returns (new_content, errors)."""
+    hunks = parse_unified_diff(diff_text)
+    if not hunks:
+        return None, ["diff has no hunks"]
+    trailing_newline = (content or "").endswith("\n")
+    lines = (content or "").splitlines()
+    errors = []
+    offset = 0
+    for idx, hunk in enumerate(hunks):
+        if not hunk["old"]:
+            # Hunk de solo inserción: se ubica por número de línea.
+            at = max(0, min(len(lines), hunk["old_start"] + offset))
+            lines[at:at] = hunk["new"]
+            offset += len(hunk["new"])
+            continue
+        hint = hunk["old_start"] - 1 + offset
+        matches = _find_line_block(lines, hunk["old"], hint=hint)
+        if not matches:
+            errors.append(f"hunk {idx + 1}: context not found")
+            continue
+        if len(matches) > 1:
+            # Con contexto repetido el número de línea no basta para saber cuál editar.
+            errors.append(f"hunk {idx + 1}: context matches {len(matches)} places; include more context")
+            continue
+        start = matches[0]
+        lines[start:start + len(hunk["old"])] = hunk["new"]
+        offset += len(hunk["new"]) - len(hunk["old"])
+    if errors:
+        return None, errors
+    result = "\n".join(lines)
+    if trailing_newline:
+        result += "\n"
+    return result, []
+
+
+def apply_edits(files, edits, allowed_files=None):
+    """
+    Applies a list of edits ({"file", "search", "replace"} or {"file", "diff"})
+    to a {filename: content} map. Returns (changed_files, errors); edits on
+    the same file are applied in order.
+    """
+    working = dict(files or {})
+    touched = set()
+    errors = []
+    for idx, edit in enumerate(edits or []):
+        if not isinstance(edit, dict):
+            errors.append(f"edit {idx + 1}: invalid format")
+            continue
+        fname = str(edit.get("file") or "").strip()
+        fname = fname[2:] if fname.startswith("./") else fname
+        if not fname or (allowed_files is not None and fname not in allowed_files):
+            errors.append(f"edit {idx + 1}: file '{fname}' not allowed")
+            continue
+        current = working.get(fname, "")
+        if edit.get("diff"):
+            updated, diff_errors = apply_unified_diff(current, edit.get("diff"))
+            if diff_errors:
+                errors.extend(f"edit {idx + 1} ({fname}): {e}" for e in diff_errors)
+                continue
+        else:
+            updated, error = apply_search_replace(current, edit.get("search"), edit.get("replace"))
+            if error:
+                errors.append(f"edit {idx + 1} ({fname}): {error}")
+                continue
+        working[fname] = updated
+        touched.add(fname)
+    changed = {
+        fname: working[fname] for fname in touched
+        if working[fname] != (files or {}).get(fname, "")
+    }
+    return changed, errors
@@ -0,0 +1,303 @@
+"""
+Opt-in request timing and a sampling profiler.
+
+RequestProfiler wraps the WSGI app. While it is enabled, each request
+records its wall time (until the app returns its response; streamed
+bodies are not included) and the time spent inside named phases (auth, db,
+json_store, ai, serialize). Code marks a phase with profiler.phase(name)
+or the @profiler.timed(name) decorator. Phases are inclusive. A phase
+nested inside itself (call_ai_text -> call_anthropic_text) counts only
+once. Whatever is left over is reported as "other". Results are kept per
+endpoint (count, total, max, per-phase totals) plus a ring of recent
+requests. When disabled, phase() is a flag check.
+
+SamplingProfiler walks sys._current_frames() every interval for N
+seconds, across every thread of the process, and aggregates the stacks in
+the folded format that flamegraph.pl, speedscope and inferno read:
+
+    thread;module:function;module:function <samples>
+
+Both work per process. Under gunicorn, every worker profiles itself.
+"""
+import contextvars
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+PHASES = ("auth", "db", "json_store", "ai", "serialize")
+
+_current = contextvars.ContextVar("anmar_request_profile", default=None)
+
+
+class RequestProfiler:
+    def __init__(self, enabled=False, sample_rate=1.0, recent=200):
+        self.enabled = bool(enabled)
+        self.sample_rate = float(sample_rate)
+        self._recent = deque(maxlen=int(recent))
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def configure(self, enabled=None, sample_rate=None):
+        if enabled is not None:
+            self.enabled = bool(enabled)
+        if sample_rate is not None:
+            self.sample_rate = min(max(float(sample_rate), 0.0), 1.0)
+
+    # ── WSGI ──
+    def middleware(self, wsgi_app):
+        @wraps(wsgi_app)
+        def profiled_app(environ, start_response):
+            if not self.enabled or (self.sample_rate < 1.0 and random.random() >= self.sample_rate):
+                return wsgi_app(environ, start_response)
+            record = {"phases": {}, "depth": {}, "started": {}, "endpoint": None, "status": None}
+            token = _current.set(record)
+            started = time.perf_counter()
+
+            def _start_response(status, headers, exc_info=None):
+                record["status"] = int(str(status).split(" ", 1)[0])
+                return start_response(status, headers, exc_info)
+
+            try:
+                return wsgi_app(environ, _start_response)
+            finally:
+                _current.reset(token)
+                self._finish(record, environ, (time.perf_counter() - started) * 1000)
+        return profiled_app
+
+    def label(self, endpoint):
+        """Names the current request (called from an after_request hook)."""
+        record = _current.get()
+        if record is not None:
+            record["endpoint"] = endpoint
+        return record is not None
+
+    def server_timing(self):
+        """Server-Timing header value for the phases recorded so far, or None."""
+        record = _current.get()
+        if not record or not record["phases"]:
+            return None
+        return ", ".join(f"{name};dur={ms:.1f}" for name, ms in record["phases"].items())
+
+    # ── phases ──
+    def phase(self, name):
+        record = _current.get()
+        if record is None:
+            return _NULL_PHASE
+        return _Phase(record, name)
+
+    def timed(self, name):
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                if _current.get() is None:
+                    return fn(*args, **kwargs)
+                with self.phase(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    # ── results ──
+    def _finish(self, record, environ, total_ms):
+        phases = {name: round(ms, 2) for name, ms in record["phases"].items()}
+        endpoint = record["endpoint"] or "unmatched"
+        entry = {
+            "at": time.time(),
+            "method": environ.get("REQUEST_METHOD"),
+            "path": environ.get("PATH_INFO"),
+            "endpoint": endpoint,
+            "status": record["status"],
+            "ms": round(total_ms, 2),
+            "phases": phases,
+        }
+        with self._lock:
+            self._recent.append(entry)
+            agg = self._endpoints.setdefault(endpoint, {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "phases": {}})
+            agg["count"] += 1
+            agg["total_ms"] += total_ms
+            agg["max_ms"] = max(agg["max_ms"], total_ms)
+            for name, ms in phases.items():
+                agg["phases"][name] = agg["phases"].get(name, 0.0) + ms
+
+    def summary(self, recent=20):
+        with self._lock:
+            endpoints = {}
+            for endpoint, agg in self._endpoints.items():
+                count = agg["count"]
+                phase_ms = {name: round(ms / count, 2) for name, ms in agg["phases"].items()}
+                mean = agg["total_ms"] / count
+                endpoints[endpoint] = {
+                    "count": count,
+                    "mean_ms": round(mean, 2),
+                    "max_ms": round(agg["max_ms"], 2),
+                    "phases_mean_ms": phase_ms,
+                    "other_mean_ms": round(max(mean - sum(phase_ms.values()), 0.0), 2),
+                }
+            latest = list(self._recent)[-int(recent):] if recent else []
+        ranked = dict(sorted(endpoints.items(), key=lambda kv: kv[1]["mean_ms"] * kv[1]["count"], reverse=True))
+        return {"enabled": self.enabled, "sample_rate": self.sample_rate, "endpoints": ranked, "recent": latest}
+
+    def reset(self):
+        with self._lock:
+            self._recent.clear()
+            self._endpoints.clear()
+
+
+class _Phase:
+    __slots__ = ("record", "name")
+
+    def __init__(self, record, name):
+        self.record = record
+        self.name = name
+
+    def __enter__(self):
+        depth = self.record["depth"]
+        depth[self.name] = depth.get(self.name, 0) + 1
+        if depth[self.name] == 1:
+            self.record["started"][self.name] = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        depth = self.record["depth"]
+        depth[self.name] -= 1
+        if depth[self.name] == 0:
+            elapsed = (time.perf_counter() - self.record["started"].pop(self.name)) * 1000
+            phases = self.record["phases"]
+            phases[self.name] = phases.get(self.name, 0.0) + elapsed
+        return False
+
+
+class _NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+def sqlite_factory(profiler, phase="db", observe=None):
+    """
+    sqlite3.Connection subclass (factory=) whose statements and commits
+    count as `phase`. observe(statement, seconds), if given, is called for
+    each one with statement = select/insert/update/delete/commit/other.
+    Rows fetched later from a cursor are not included.
+    """
+    import sqlite3
+
+    def _run(kind, fn, *args):
+        started = time.perf_counter()
+        try:
+            with profiler.phase(phase):
+                return fn(*args)
+        finally:
+            if observe is not None:
+                observe(kind, time.perf_counter() - started)
+
+    def _kind(sql):
+        word = str(sql).lstrip().split(None, 1)[0].lower() if str(sql).strip() else ""
+        return word if word in _STATEMENTS else "other"
+
+    class ProfiledConnection(sqlite3.Connection):
+        def execute(self, sql, *args):
+            return _run(_kind(sql), super().execute, sql, *args)
+
+        def executemany(self, sql, *args):
+            return _run(_kind(sql), super().executemany, sql, *args)
+
+        def executescript(self, script):
+            return _run("other", super().executescript, script)
+
+        def commit(self):
+            return _run("commit", super().commit)
+
+    return ProfiledConnection
+
+
+_STATEMENTS = ("select", "insert", "update", "delete", "with", "replace")
+
+
+def _module_label(filename):
+    if filename.startswith("<"):
+        return filename.strip("<>").replace(" ", "_")  # <frozen importlib._bootstrap>, <stdin>
+    module = os.path.splitext(os.path.basename(filename))[0]
+    if module == "__init__":
+        module = os.path.basename(os.path.dirname(filename))
+    return module
+
+
+class SamplingProfiler:
+    MAX_SECONDS = 300
+
+    def __init__(self, max_depth=128):
+        self.max_depth = int(max_depth)
+        self._stacks = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._status = {"running": False, "samples": 0}
+
+    def start(self, seconds=10, interval=0.005):
+        """Samples every thread for `seconds`. Returns False if a run is already in progress."""
+        seconds = min(max(float(seconds), 0.1), self.MAX_SECONDS)
+        interval = max(float(interval), 0.001)
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            self._stacks = {}
+            self._stop.clear()
+            self._status = {
+                "running": True, "samples": 0, "started_at": time.time(),
+                "seconds": seconds, "interval_ms": round(interval * 1000, 2),
+            }
+            self._thread = threading.Thread(
+                target=self._run, args=(seconds, interval), name="anmar-sampler", daemon=True
+            )
+            self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self, seconds, interval):
+        own = threading.get_ident()
+        deadline = time.perf_counter() + seconds
+        samples = 0
+        while not self._stop.is_set() and time.perf_counter() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            folded = [
+                self._fold(names.get(ident, f"thread-{ident}"), frame)
+                for ident, frame in sys._current_frames().items() if ident != own
+            ]
+            samples += 1
+            with self._lock:
+                for key in folded:
+                    self._stacks[key] = self._stacks.get(key, 0) + 1
+                self._status["samples"] = samples
+            self._stop.wait(interval)
+        with self._lock:
+            self._status.update(running=False, finished_at=time.time(), samples=samples)
+
+    def _fold(self, thread_name, frame):
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            code = frame.f_code
+            stack.append(f"{_module_label(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        stack.append(thread_name.replace(";", ":").replace(" ", "_"))
+        return ";".join(reversed(stack))
+
+    def folded(self):
+        """Collapsed stacks ("frame;frame;frame count" per line), heaviest first."""
+        with self._lock:
+            stacks = dict(self._stacks)
+        return "\n".join(f"{stack} {count}" for stack, count in sorted(stacks.items(), key=lambda kv: -kv[1]))
+
+    def status(self):
+        with self._lock:
+            return dict(self._status, stacks=len(self._stacks))
@@ -0,0 +1,215 @@
+"""
+Streaming export/import of generated projects.
+
+Exports are produced as a generator of byte chunks (tar.gz or zip) while
+the archive is being written, so a backup of thousands of projects never
+sits in memory or on disk. The first entry is anmar-export.json with the
+owner and meta of every exported project. Imports read the archive
+member by member, extract each project into a staging folder and only
+move it into place once it is complete.
+"""
+import io
+import json
+import os
+import re
+import shutil
+import tarfile
+import uuid
+import zipfile
+from datetime import datetime
+
+MANIFEST_NAME = "anmar-export.json"
+EXPORT_FORMATS = ("tar", "zip")
+# Variantes precomprimidas y temporales se regeneran; no viajan en el archivo.
+SKIPPED_SUFFIXES = (".tmp", ".gz", ".br")
+MAX_MEMBER_BYTES = 50 * 1024 * 1024
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only, non-seekable stream; the generator drains it after every entry."""
+
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if data:
+            self._chunks.append(bytes(data))
+            self._pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _project_files(base_dir, project_name):
+    root = os.path.join(base_dir, project_name)
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        for name in sorted(filenames):
+            if name.startswith(".") or name.endswith(SKIPPED_SUFFIXES):
+                continue
+            full = os.path.join(dirpath, name)
+            rel = os.path.relpath(full, base_dir).replace(os.sep, "/")
+            yield full, rel
+
+
+def build_manifest(names, owners=None, meta=None):
+    owners = owners or {}
+    meta = meta if isinstance(meta, dict) else {}
+    return {
+        "version": 1,
+        "exported_at": datetime.utcnow().isoformat(),
+        "projects": {name: {"owner": owners.get(name), "meta": meta.get(name)} for name in names},
+    }
+
+
+def iter_tar(base_dir, names, manifest):
+    sink = _ChunkSink()
+    with tarfile.open(fileobj=sink, mode="w|gz") as tar:
+        data = json.dumps(manifest, indent=2, ensure_ascii=False).encode("utf-8")
+        info = tarfile.TarInfo(MANIFEST_NAME)
+        info.size = len(data)
+        info.mtime = int(datetime.utcnow().timestamp())
+        tar.addfile(info, io.BytesIO(data))
+        yield sink.drain()
+        for name in names:
+            for full, rel in _project_files(base_dir, name):
+                tar.add(full, arcname=rel, recursive=False)
+                chunk = sink.drain()
+                if chunk:
+                    yield chunk
+    yield sink.drain()
+
+
+def iter_zip(base_dir, names, manifest):
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(MANIFEST_NAME, json.dumps(manifest, indent=2, ensure_ascii=False))
+        yield sink.drain()
+        for name in names:
+            for full, rel in _project_files(base_dir, name):
+                zf.write(full, arcname=rel)
+                chunk = sink.drain()
+                if chunk:
+                    yield chunk
+    yield sink.drain()
+
+
+def export_stream(base_dir, names, manifest, fmt="tar"):
+    if fmt == "zip":
+        return iter_zip(base_dir, names, manifest)
+    return iter_tar(base_dir, names, manifest)
+
+
+def _safe_member_path(member_name, sanitize):
+    """(project, relative path) or None for names outside a project folder."""
+    parts = [p for p in str(member_name).replace("\\", "/").split("/") if p not in ("", ".")]
+    if len(parts) < 2 or any(p == ".." for p in parts) or member_name.startswith("/"):
+        return None
+    if any(p.startswith(".") for p in parts) or parts[-1].endswith(SKIPPED_SUFFIXES):
+        return None
+    project = sanitize(parts[0]) if sanitize else parts[0]
+    if not project or not re.match(r"^[A-Za-z0-9_\-]+$", project):
+        return None
+    return project, "/".join(parts[1:])
+
+
+def _iter_members(fileobj, fmt):
+    """Yields (name, reader_or_None); reader_or_None is None for non-file entries."""
+    if fmt == "zip":
+        with zipfile.ZipFile(fileobj) as zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                if info.file_size > MAX_MEMBER_BYTES:
+                    yield info.filename, None
+                    continue
+                with zf.open(info) as reader:
+                    yield info.filename, reader
+        return
+    with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+        for member in tar:
+            if not member.isfile() or member.size > MAX_MEMBER_BYTES:
+                yield member.name, None
+                continue
+            yield member.name, tar.extractfile(member)
+
+
+def detect_format(fileobj, filename=None):
+    lower = str(filename or "").lower()
+    if lower.endswith(".zip"):
+        return "zip"
+    if lower.endswith((".tar", ".tar.gz", ".tgz")):
+        return "tar"
+    if hasattr(fileobj, "peek"):
+        head = fileobj.peek(4)[:4]
+    elif hasattr(fileobj, "seek"):
+        pos = fileobj.tell()
+        head = fileobj.read(4)
+        fileobj.seek(pos)
+    else:
+        return "tar"
+    return "zip" if head.startswith(b"PK\x03\x04") else "tar"
+
+
+def import_archive(fileobj, base_dir, fmt=None, overwrite=False, sanitize=None):
+    """
+    Extracts the projects of an export archive into base_dir. Existing
+    projects are skipped unless overwrite=True. Returns a summary with
+    imported/skipped names, errors and the embedded manifest.
+    """
+    fmt = fmt or detect_format(fileobj)
+    staging = os.path.join(base_dir, f".import-{uuid.uuid4().hex[:8]}")
+    os.makedirs(staging, exist_ok=True)
+    manifest = {}
+    seen, skipped, errors = set(), set(), []
+    try:
+        for name, reader in _iter_members(fileobj, fmt):
+            if name == MANIFEST_NAME and reader is not None:
+                try:
+                    manifest = json.loads(reader.read().decode("utf-8"))
+                except ValueError:
+                    errors.append("invalid manifest")
+                continue
+            target = _safe_member_path(name, sanitize)
+            if target is None or reader is None:
+                if name != MANIFEST_NAME:
+                    errors.append(f"skipped entry: {name}")
+                continue
+            project, rel = target
+            if project in skipped:
+                continue
+            if project not in seen and not overwrite and os.path.exists(os.path.join(base_dir, project)):
+                skipped.add(project)
+                continue
+            seen.add(project)
+            dest = os.path.join(staging, project, *rel.split("/"))
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            with open(dest, "wb") as out:
+                shutil.copyfileobj(reader, out, 256 * 1024)
+
+        imported = []
+        for project in sorted(seen):
+            final = os.path.join(base_dir, project)
+            if os.path.exists(final):
+                shutil.rmtree(final)
+            os.replace(os.path.join(staging, project), final)
+            imported.append(project)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    projects_info = manifest.get("projects") if isinstance(manifest.get("projects"), dict) else {}
+    return {
+        "imported": imported,
+        "skipped": sorted(skipped),
+        "errors": errors[:50],
+        "projects": {name: projects_info.get(name) or {} for name in imported},
+    }
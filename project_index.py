@@ -0,0 +1,102 @@
+"""
+Owner -> projects index.
+
+One SQLite row per generated project (table created in init_db, indexed
+by owner) kept in sync by the create/delete routes, so listing a user's
+projects is an indexed lookup instead of scanning generated_projects/ and
+the owners/meta JSON files on every request. backfill() seeds the table
+once from the folders and the legacy project_owners.json.
+"""
+import os
+from datetime import datetime
+
+
+class ProjectIndex:
+    def __init__(self, connect, table="project_index"):
+        self._connect = connect
+        self._table = table
+
+    def _execute(self, sql, params=(), fetch=None):
+        conn = self._connect()
+        try:
+            cursor = conn.execute(sql, params)
+            if fetch == "one":
+                return cursor.fetchone()
+            if fetch == "all":
+                return cursor.fetchall()
+            conn.commit()
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+    def add(self, name, owner=None, replace=False):
+        """Registers a project; an existing owner is kept unless replace=True."""
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        return self._execute(
+            f"{verb} INTO {self._table} (name, owner, created_at) VALUES (?, ?, ?)",
+            (name, (owner or "").strip().lower() or None, datetime.now().isoformat()),
+        )
+
+    def remove(self, name):
+        return self._execute(f"DELETE FROM {self._table} WHERE name = ?", (name,))
+
+    def clear(self):
+        return self._execute(f"DELETE FROM {self._table}")
+
+    def owner_of(self, name):
+        row = self._execute(f"SELECT owner FROM {self._table} WHERE name = ?", (name,), fetch="one")
+        return row["owner"] if row else None
+
+    def exists(self, name):
+        return self._execute(f"SELECT 1 FROM {self._table} WHERE name = ?", (name,), fetch="one") is not None
+
+    def for_owner(self, owner):
+        rows = self._execute(
+            f"SELECT name FROM {self._table} WHERE owner = ? ORDER BY created_at, name",
+            ((owner or "").strip().lower(),), fetch="all",
+        )
+        return [r["name"] for r in rows]
+
+    def names(self):
+        return [r["name"] for r in self._execute(f"SELECT name FROM {self._table} ORDER BY name", fetch="all")]
+
+    def count(self):
+        return self._execute(f"SELECT COUNT(*) AS n FROM {self._table}", fetch="one")["n"]
+
+    def claim_sole_unowned(self, owner):
+        """Legacy: a lone project without owner goes to the first user who lists projects."""
+        return self._execute(
+            f"""UPDATE {self._table} SET owner = ?
+                WHERE owner IS NULL AND (SELECT COUNT(*) FROM {self._table}) = 1""",
+            ((owner or "").strip().lower(),),
+        )
+
+    def backfill(self, base_dir, owners=None, meta=None, force=False):
+        """Seeds the index from project folders. Runs only on an empty table unless force=True."""
+        if not force and self.count() > 0:
+            return 0
+        if not os.path.isdir(base_dir):
+            return 0
+        owners = owners or {}
+        meta = meta if isinstance(meta, dict) else {}
+        rows = []
+        for name in os.listdir(base_dir):
+            if name.startswith(".") or not os.path.isdir(os.path.join(base_dir, name)):
+                continue
+            info = meta.get(name) if isinstance(meta.get(name), dict) else {}
+            owner = owners.get(name) or info.get("owner")
+            created_at = info.get("created_at") or datetime.fromtimestamp(
+                os.path.getmtime(os.path.join(base_dir, name))
+            ).isoformat()
+            rows.append((name, (owner or "").strip().lower() or None, created_at))
+        conn = self._connect()
+        try:
+            if force:
+                conn.execute(f"DELETE FROM {self._table}")
+            conn.executemany(
+                f"INSERT OR REPLACE INTO {self._table} (name, owner, created_at) VALUES (?, ?, ?)", rows
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        return len(rows)
@@ -0,0 +1,245 @@
+"""
+Version history for generated projects.
+
+File contents are stored once in a content-addressed blob store
+(sha256-named, zlib-compressed, sharded by the first two hex chars) and
+every build/edit appends a manifest entry {filename: sha256} for the
+project. Rolling back rewrites the project folder from the blobs of a
+previous manifest; gc() deletes blobs no manifest references anymore.
+
+Several gunicorn workers share the store, so writers also take flocks
+under <root>/locks: an exclusive per-project lock around each manifest
+read-modify-write, and a store-wide "gc" lock that writers hold shared
+and gc() holds exclusive. gc() therefore never sees a blob that was
+written but whose manifest is not saved yet.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Archivos que no forman parte del proyecto versionado.
+IGNORED_NAMES = {".DS_Store", ".write_test"}
+IGNORED_SUFFIXES = (".tmp", ".gz", ".br")
+MAX_TRACKED_FILE_BYTES = 5 * 1024 * 1024
+
+
+class ProjectVersionStore:
+    def __init__(self, root, max_versions=200):
+        self.root = root
+        self.blobs_dir = os.path.join(root, "blobs")
+        self.manifests_dir = os.path.join(root, "manifests")
+        self.locks_dir = os.path.join(root, "locks")
+        self.max_versions = max(1, int(max_versions))
+        self._lock = threading.RLock()
+        self._current_cache = {}
+
+    # ── locks ──
+    @contextmanager
+    def _flock(self, name, shared=False):
+        """Cross-process flock on <root>/locks/<name>.lock; a no-op where fcntl is unavailable."""
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(self.locks_dir, exist_ok=True)
+        safe = re.sub(r"[^A-Za-z0-9._-]", "_", name)
+        fd = os.open(os.path.join(self.locks_dir, f"{safe}.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    @contextmanager
+    def _project_lock(self, project_name):
+        # Orden fijo (gc compartido, luego proyecto) para no cruzarse con gc().
+        with self._lock, self._flock("gc", shared=True), self._flock(f"project-{project_name}"):
+            yield
+
+    # ── blobs ──
+    def _blob_path(self, digest):
+        return os.path.join(self.blobs_dir, digest[:2], digest[2:])
+
+    def put_blob(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(zlib.compress(data, 6))
+            os.replace(tmp_path, path)
+        return digest
+
+    def get_blob(self, digest):
+        with open(self._blob_path(digest), "rb") as f:
+            return zlib.decompress(f.read())
+
+    # ── manifests ──
+    def _manifest_path(self, project_name):
+        return os.path.join(self.manifests_dir, f"{project_name}.json")
+
+    def load_manifest(self, project_name):
+        path = self._manifest_path(project_name)
+        if not os.path.exists(path):
+            return {"project": project_name, "current": None, "versions": []}
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+            if isinstance(data, dict) and isinstance(data.get("versions"), list):
+                return data
+        except Exception:
+            pass
+        return {"project": project_name, "current": None, "versions": []}
+
+    def _save_manifest(self, project_name, manifest):
+        os.makedirs(self.manifests_dir, exist_ok=True)
+        path = self._manifest_path(project_name)
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"Error saving project manifest: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _snapshot_files(self, project_path):
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(project_path):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            for name in filenames:
+                if name in IGNORED_NAMES or name.startswith(".") or name.endswith(IGNORED_SUFFIXES):
+                    continue
+                full = os.path.join(dirpath, name)
+                if os.path.getsize(full) > MAX_TRACKED_FILE_BYTES:
+                    continue
+                rel = os.path.relpath(full, project_path).replace(os.sep, "/")
+                with open(full, "rb") as f:
+                    files[rel] = self.put_blob(f.read())
+        return files
+
+    def record_version(self, project_name, project_path, source, summary=None, author=None):
+        """Snapshots project_path; returns the new version (or the current one if nothing changed)."""
+        with self._project_lock(project_name):
+            return self._record_version(project_name, project_path, source, summary, author)
+
+    def _record_version(self, project_name, project_path, source, summary=None, author=None):
+        """Caller holds _project_lock(project_name) (flock is not reentrant)."""
+        files = self._snapshot_files(project_path)
+        manifest = self.load_manifest(project_name)
+        versions = manifest["versions"]
+        current = next((v for v in versions if v["version"] == manifest.get("current")), None)
+        if current and current["files"] == files:
+            return current
+        version = {
+            "version": (versions[-1]["version"] + 1) if versions else 1,
+            "created_at": datetime.now().isoformat(),
+            "source": source,
+            "summary": (summary or "")[:300],
+            "author": author,
+            "files": files,
+        }
+        versions.append(version)
+        if len(versions) > self.max_versions:
+            del versions[:len(versions) - self.max_versions]
+        manifest["current"] = version["version"]
+        self._save_manifest(project_name, manifest)
+        return version
+
+    def list_versions(self, project_name):
+        manifest = self.load_manifest(project_name)
+        return manifest.get("current"), [
+            dict({k: v for k, v in version.items() if k != "files"}, file_count=len(version["files"]))
+            for version in manifest["versions"]
+        ]
+
+    def current_version(self, project_name):
+        """Current version number; cached by manifest mtime (hot path for preview ETags)."""
+        path = self._manifest_path(project_name)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        cached = self._current_cache.get(project_name)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        current = self.load_manifest(project_name).get("current")
+        self._current_cache[project_name] = (mtime, current)
+        return current
+
+    def rollback(self, project_name, project_path, version_number, author=None):
+        """Restores project_path to version_number and records it as a new version."""
+        with self._project_lock(project_name):
+            manifest = self.load_manifest(project_name)
+            target = next((v for v in manifest["versions"] if v["version"] == int(version_number)), None)
+            if target is None:
+                return None
+            tracked = set()
+            for version in manifest["versions"]:
+                tracked.update(version["files"].keys())
+            # Leer todos los blobs antes de tocar disco: si falta uno, no se deja el proyecto a medias.
+            contents = {rel: self.get_blob(digest) for rel, digest in target["files"].items()}
+            for rel, data in contents.items():
+                dest = os.path.join(project_path, *rel.split("/"))
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                tmp_path = dest + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, dest)
+            # Solo se borran archivos versionados que no existen en la versión destino.
+            for rel in tracked - set(target["files"]):
+                stale = os.path.join(project_path, *rel.split("/"))
+                if os.path.exists(stale):
+                    os.remove(stale)
+            return self._record_version(
+                project_name, project_path, "rollback",
+                summary=f"Rollback to version {target['version']}", author=author,
+            )
+
+    def delete_project(self, project_name):
+        with self._project_lock(project_name):
+            path = self._manifest_path(project_name)
+            if os.path.exists(path):
+                os.remove(path)
+            self._current_cache.pop(project_name, None)
+
+    def gc(self):
+        """Deletes blobs not referenced by any manifest. Returns (deleted, kept, freed_bytes)."""
+        with self._lock, self._flock("gc"):
+            referenced = set()
+            if os.path.isdir(self.manifests_dir):
+                for name in os.listdir(self.manifests_dir):
+                    if not name.endswith(".json"):
+                        continue
+                    manifest = self.load_manifest(name[:-5])
+                    for version in manifest["versions"]:
+                        referenced.update(version["files"].values())
+            deleted = kept = freed = 0
+            if not os.path.isdir(self.blobs_dir):
+                return deleted, kept, freed
+            for shard in os.listdir(self.blobs_dir):
+                shard_dir = os.path.join(self.blobs_dir, shard)
+                if not os.path.isdir(shard_dir):
+                    continue
+                for name in os.listdir(shard_dir):
+                    if (shard + name) in referenced:
+                        kept += 1
+                        continue
+                    path = os.path.join(shard_dir, name)
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+                    deleted += 1
+            return deleted, kept, freed
@@ -0,0 +1,218 @@
+"""
+Sliding-window-counter rate limiter with pluggable storage.
+
+Each key keeps only (window_start, previous_count, current_count); the
+estimate is previous * (1 - elapsed/window) + current, so a check is O(1)
+in time and memory regardless of traffic. Backends:
+
+    MemoryBackend       per-process dict with LRU eviction (max_keys)
+    SQLiteBackend       rows in a small SQLite file, shared by all workers
+    SharedMemoryBackend fixed-size slot table in an mmap'ed file under
+                        /dev/shm guarded by flock; bounded memory, shared
+                        by all workers on the host
+
+Backends fail open: a storage error is logged and the request allowed.
+"""
+import hashlib
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+def slide(state, limit, window, now):
+    """Applies one hit to state=(window_start, prev, curr). Returns (new_state, allowed, retry_after)."""
+    window_start, prev, curr = state if state else (now, 0, 0)
+    elapsed_windows = int((now - window_start) // window)
+    if elapsed_windows == 1:
+        window_start, prev, curr = window_start + window, curr, 0
+    elif elapsed_windows > 1:
+        window_start, prev, curr = now, 0, 0
+    weight = 1.0 - (now - window_start) / window
+    estimate = prev * weight + curr
+    if estimate + 1 > limit:
+        # Tiempo hasta que el peso de la ventana anterior deje espacio para un hit más.
+        if prev > 0 and curr < limit:
+            needed = (prev - (limit - curr - 1)) / prev
+            retry_after = max(0.0, needed * window - (now - window_start))
+        else:
+            retry_after = window_start + window - now
+        return (window_start, prev, curr), False, max(1, int(retry_after + 0.999))
+    return (window_start, prev, curr + 1), True, 0
+
+
+class MemoryBackend:
+    def __init__(self, max_keys=50000):
+        self.max_keys = max(100, int(max_keys))
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key, limit, window, now):
+        with self._lock:
+            state, allowed, retry_after = slide(self._states.pop(key, None), limit, window, now)
+            self._states[key] = state
+            while len(self._states) > self.max_keys:
+                self._states.popitem(last=False)
+            return allowed, retry_after
+
+    def __len__(self):
+        return len(self._states)
+
+
+class SQLiteBackend:
+    def __init__(self, path, purge_every=500, idle_seconds=3600):
+        self.path = path
+        self.purge_every = max(1, int(purge_every))
+        self.idle_seconds = float(idle_seconds)
+        self._calls = 0
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS rate_limits (
+                key TEXT PRIMARY KEY, window_start REAL, prev INTEGER, curr INTEGER, updated_at REAL
+            )"""
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_rate_limits_updated ON rate_limits(updated_at)")
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=2, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def hit(self, key, limit, window, now):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT window_start, prev, curr FROM rate_limits WHERE key = ?", (key,)).fetchone()
+            state, allowed, retry_after = slide(tuple(row) if row else None, limit, window, now)
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_limits (key, window_start, prev, curr, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (key, state[0], state[1], state[2], now),
+            )
+            self._calls += 1
+            if self._calls % self.purge_every == 0:
+                conn.execute("DELETE FROM rate_limits WHERE updated_at < ?", (now - self.idle_seconds,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return allowed, retry_after
+
+
+class SharedMemoryBackend:
+    """Open-addressing table of SLOT structs; a full probe run evicts the slot that expires first."""
+
+    # key hash, window_start, window, prev, curr. Cada slot guarda su propia
+    # ventana: una clave de 60s no es reutilizable porque otra use 10s.
+    SLOT = struct.Struct("<QddII")
+    PROBES = 8
+
+    def __init__(self, path="/dev/shm/anmar-ratelimit-v2", slots=65536):
+        if fcntl is None:
+            raise RuntimeError("SharedMemoryBackend requires fcntl (POSIX)")
+        self.path = path
+        self.slots = max(1024, int(slots))
+        size = self.slots * self.SLOT.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size != size:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._fd).st_size != size:
+                    # Otro tamaño u otro formato de slot: se empieza con la tabla en ceros.
+                    os.ftruncate(self._fd, 0)
+                    os.ftruncate(self._fd, size)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little") or 1
+
+    def hit(self, key, limit, window, now):
+        key_hash = self._hash(key)
+        base = key_hash % self.slots
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                target, state, stalest = None, None, None
+                for i in range(self.PROBES):
+                    offset = ((base + i) % self.slots) * self.SLOT.size
+                    slot_hash, window_start, slot_window, prev, curr = self.SLOT.unpack_from(self._map, offset)
+                    if slot_hash == key_hash:
+                        target, state = offset, (window_start, prev, curr)
+                        break
+                    expires = window_start + 2 * slot_window
+                    if slot_hash == 0 or now > expires:
+                        if target is None:
+                            target = offset
+                        continue
+                    if stalest is None or expires < stalest[1]:
+                        stalest = (offset, expires)
+                if target is None:
+                    target = stalest[0]
+                state, allowed, retry_after = slide(state, limit, window, now)
+                self.SLOT.pack_into(
+                    self._map, target, key_hash, state[0], float(window), int(state[1]), int(state[2])
+                )
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return allowed, retry_after
+
+
+class RateLimiter:
+    def __init__(self, backend, policies=None):
+        self.backend = backend
+        self.policies = dict(policies or {})
+
+    def set_policy(self, scope, limit, window):
+        self.policies[scope] = (int(limit), float(window))
+
+    def check(self, scope, ident, limit, window, now=None):
+        """(allowed, retry_after_seconds). A configured policy for scope overrides limit/window."""
+        limit, window = self.policies.get(scope, (limit, window))
+        try:
+            return self.backend.hit(f"{scope}|{ident}", int(limit), float(window), now or time.time())
+        except Exception as e:
+            print(f"[RATE LIMIT] backend error ({type(self.backend).__name__}): {e}")
+            return True, 0
+
+
+def parse_policies(spec):
+    """'login=5/60,register=3/60' -> {"login": (5, 60.0), "register": (3, 60.0)}."""
+    policies = {}
+    for part in str(spec or "").split(","):
+        scope, _, rule = part.strip().partition("=")
+        limit, _, window = rule.partition("/")
+        try:
+            policies[scope.strip()] = (int(limit), float(window or 60))
+        except ValueError:
+            continue
+    return policies
+
+
+def make_backend(kind, sqlite_path=None, shm_path=None, max_keys=50000):
+    kind = (kind or "").strip().lower()
+    if kind == "sqlite":
+        return SQLiteBackend(sqlite_path)
+    if kind == "shm" or (not kind and fcntl is not None and os.path.isdir("/dev/shm")):
+        try:
+            return SharedMemoryBackend(shm_path or "/dev/shm/anmar-ratelimit-v2", slots=max_keys)
+        except Exception as e:
+            print(f"[RATE LIMIT] shared memory backend unavailable, using memory: {e}")
+    return MemoryBackend(max_keys=max_keys)
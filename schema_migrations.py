@@ -0,0 +1,345 @@
+"""
+Versioned schema migrations for database.db.
+
+Each migration is (version, name, apply) and runs once, inside its own
+transaction; applied versions are recorded in schema_version. New schema
+changes are appended to MIGRATIONS with the next version number and never
+edited once shipped. Migration 1 is the schema init_db used to create
+with CREATE TABLE IF NOT EXISTS, and 2 folds in the old PRAGMA table_info
+checks, so existing databases adopt the runner without manual steps.
+
+Migrations are meant to run once per deploy, before workers start:
+
+    python schema_migrations.py migrate [--db database.db]
+    python schema_migrations.py status  [--db database.db]   # exit 1 if behind
+
+Workers call ensure_schema(), which is a single SELECT when the schema is
+current. If it is behind, one process takes an flock on
+<db>.migrate.lock and migrates while the others wait and then find
+nothing to do; each migration also re-checks schema_version under
+BEGIN IMMEDIATE, so two runners can never apply the same version.
+"""
+import os
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+def _add_column(conn, table, column, ddl):
+    cols = {r[1] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+    if column not in cols:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+
+def _baseline(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            email TEXT NOT NULL UNIQUE,
+            password TEXT NOT NULL,
+            tokens INTEGER NOT NULL DEFAULT 50,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS tickets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            project_name TEXT NOT NULL,
+            user_email TEXT NOT NULL,
+            request TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending_human_review',
+            ai_suggestion TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_memory (
+            email TEXT PRIMARY KEY,
+            memory_json TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS pending_tickets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_email TEXT NOT NULL,
+            project_name TEXT,
+            history_json TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS processed_webhooks (
+            session_id TEXT PRIMARY KEY,
+            processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS build_jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            project_id TEXT,
+            owner TEXT,
+            payload_json TEXT,
+            result_json TEXT,
+            error TEXT,
+            step TEXT,
+            message TEXT,
+            progress INTEGER NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT,
+            updated_at TEXT,
+            started_at TEXT,
+            finished_at TEXT
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_build_jobs_project ON build_jobs(project_id, created_at)")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS project_index (
+            name TEXT PRIMARY KEY,
+            owner TEXT,
+            created_at TEXT
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_project_index_owner ON project_index(owner, created_at)")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id TEXT PRIMARY KEY,
+            channel TEXT NOT NULL,
+            recipient TEXT NOT NULL,
+            payload_json TEXT,
+            dedupe_key TEXT,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at REAL,
+            next_attempt_at REAL,
+            claimed_by TEXT,
+            claimed_at REAL,
+            sent_at REAL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON notification_outbox(status, next_attempt_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_dedupe ON notification_outbox(dedupe_key, created_at)")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS token_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT NOT NULL,
+            delta INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            reason TEXT,
+            ref TEXT,
+            created_at TEXT
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_token_ledger_email ON token_ledger(email, id)")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_token_ledger_ref ON token_ledger(ref)")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stripe_events (
+            id TEXT PRIMARY KEY,
+            event_type TEXT,
+            order_key TEXT,
+            created INTEGER,
+            payload_json TEXT,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            received_at REAL,
+            next_attempt_at REAL,
+            claimed_by TEXT,
+            claimed_at REAL,
+            processed_at REAL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stripe_events_due ON stripe_events(status, next_attempt_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stripe_events_order ON stripe_events(order_key, created)")
+
+
+def _users_subscription_columns(conn):
+    # Bases creadas antes de las suscripciones (antes lo hacía init_db en cada arranque).
+    _add_column(conn, "users", "tokens", "INTEGER NOT NULL DEFAULT 50")
+    _add_column(conn, "users", "subscription_active", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(conn, "users", "subscription_plan", "TEXT NOT NULL DEFAULT 'none'")
+    _add_column(conn, "users", "subscription_started_at", "TIMESTAMP")
+    _add_column(conn, "users", "stripe_customer_id", "TEXT")
+    _add_column(conn, "users", "stripe_subscription_id", "TEXT")
+    _add_column(conn, "users", "subscription_status", "TEXT NOT NULL DEFAULT 'inactive'")
+
+
+def _users_stripe_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_stripe_customer ON users(stripe_customer_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_stripe_subscription ON users(stripe_subscription_id)")
+
+
+def _users_email_normalized(conn):
+    # LOWER(email) = ? no puede usar el índice UNIQUE de email; esta columna sí.
+    # Los triggers la mantienen al día sin tocar cada INSERT/UPDATE de la app.
+    _add_column(conn, "users", "email_normalized", "TEXT")
+    conn.execute("UPDATE users SET email_normalized = LOWER(TRIM(email))")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_email_normalized ON users(email_normalized)")
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_email_normalized_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE users SET email_normalized = LOWER(TRIM(NEW.email)) WHERE id = NEW.id;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_email_normalized_update AFTER UPDATE OF email ON users
+        BEGIN
+            UPDATE users SET email_normalized = LOWER(TRIM(NEW.email)) WHERE id = NEW.id;
+        END
+    ''')
+
+
+def _tickets_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tickets_user_email ON tickets(user_email, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_pending_tickets_user ON pending_tickets(user_email, project_name)")
+
+
+def _build_jobs_claims(conn):
+    # Claim/lease de JobQueue: varios workers de gunicorn comparten build_jobs.
+    _add_column(conn, "build_jobs", "claimed_by", "TEXT")
+    _add_column(conn, "build_jobs", "claimed_at", "REAL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_build_jobs_status ON build_jobs(status, claimed_at)")
+
+
+def _token_ledger_opening_unique(conn):
+    # Una sola fila 'opening' por usuario; si dos workers la insertaron a la vez, queda la primera.
+    conn.execute('''
+        DELETE FROM token_ledger
+        WHERE kind = 'opening'
+          AND id NOT IN (SELECT MIN(id) FROM token_ledger WHERE kind = 'opening' GROUP BY email)
+    ''')
+    conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_token_ledger_opening ON token_ledger(email) WHERE kind = 'opening'"
+    )
+
+
+MIGRATIONS = [
+    (1, "baseline", _baseline),
+    (2, "users_subscription_columns", _users_subscription_columns),
+    (3, "users_stripe_indexes", _users_stripe_indexes),
+    (4, "users_email_normalized", _users_email_normalized),
+    (5, "tickets_indexes", _tickets_indexes),
+    (6, "build_jobs_claims", _build_jobs_claims),
+    (7, "token_ledger_opening_unique", _token_ledger_opening_unique),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _ensure_version_table(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT
+        )
+    ''')
+
+
+def applied_versions(conn):
+    _ensure_version_table(conn)
+    return {r[0] for r in conn.execute("SELECT version FROM schema_version").fetchall()}
+
+
+def pending_migrations(conn, migrations=None):
+    """Versions not applied yet, without creating anything (safe for read-only checks)."""
+    try:
+        done = {r[0] for r in conn.execute("SELECT version FROM schema_version").fetchall()}
+    except sqlite3.OperationalError:
+        done = set()
+    return [(v, name) for v, name, _ in sorted(migrations or MIGRATIONS, key=lambda m: m[0]) if v not in done]
+
+
+def _default_lock_path(conn):
+    row = conn.execute("PRAGMA database_list").fetchone()
+    path = row[2] if row and row[2] else "database.db"
+    return path + ".migrate.lock"
+
+
+@contextmanager
+def migration_lock(path):
+    """Exclusive flock across processes; a no-op where fcntl is unavailable."""
+    if fcntl is None:
+        yield
+        return
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def migrate(conn, migrations=None):
+    """Applies pending migrations in order. Returns the list of (version, name) applied."""
+    migrations = sorted(migrations or MIGRATIONS, key=lambda m: m[0])
+    previous_isolation = conn.isolation_level
+    conn.isolation_level = None  # transacciones explícitas: DDL + registro de versión juntos
+    applied = []
+    try:
+        done = applied_versions(conn)
+        for version, name, apply in migrations:
+            if version in done:
+                continue
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Otro proceso pudo aplicarla mientras esperábamos el lock de escritura.
+                if conn.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,)).fetchone():
+                    conn.execute("COMMIT")
+                    continue
+                apply(conn)
+                conn.execute(
+                    "INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                    (version, name, datetime.now().isoformat()),
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            applied.append((version, name))
+    finally:
+        conn.isolation_level = previous_isolation
+    return applied
+
+
+def ensure_schema(conn, lock_path=None, migrations=None):
+    """Worker startup check: one SELECT when current, otherwise migrates under the lock."""
+    if not pending_migrations(conn, migrations):
+        return []
+    with migration_lock(lock_path or _default_lock_path(conn)):
+        return migrate(conn, migrations)
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Apply or inspect database schema migrations.")
+    parser.add_argument("command", nargs="?", choices=("migrate", "status"), default="migrate")
+    parser.add_argument("--db", default="database.db")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db, timeout=30)
+    try:
+        if args.command == "status":
+            missing = pending_migrations(conn)
+            for version, name in missing:
+                print(f"[MIGRATIONS] pending {version:04d} {name}")
+            print(f"[MIGRATIONS] {args.db}: {LATEST_VERSION - len(missing)}/{LATEST_VERSION} applied")
+            sys.exit(1 if missing else 0)
+        with migration_lock(_default_lock_path(conn)):
+            result = migrate(conn)
+    finally:
+        conn.close()
+    for version, name in result:
+        print(f"[MIGRATIONS] applied {version:04d} {name}")
+    print(f"[MIGRATIONS] {args.db} at version {LATEST_VERSION}")
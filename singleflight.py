@@ -0,0 +1,118 @@
+"""
+In-flight request coalescing and per-key concurrency caps.
+
+SingleFlight runs one call per key at a time: concurrent callers with the
+same key wait for the leader and share its result (or its exception).
+ConcurrencyLimiter bounds how many calls a single owner (user) can have
+running at once.
+"""
+import hashlib
+import json
+import threading
+
+
+class _Call:
+    __slots__ = ("event", "result", "error", "waiters")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.stats = {"leaders": 0, "shared": 0, "timeouts": 0}
+
+    def do(self, key, fn, timeout=None):
+        """
+        Runs fn() once per key among concurrent callers.
+        Returns (result, shared); shared is True for callers that joined
+        an existing call. Raises the leader's exception for everyone, and
+        TimeoutError if a follower waits longer than timeout.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self.stats["leaders"] += 1
+            else:
+                call.waiters += 1
+                self.stats["shared"] += 1
+
+        if leader:
+            try:
+                call.result = fn()
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    self._calls.pop(key, None)
+                call.event.set()
+            if call.error is not None:
+                raise call.error
+            return call.result, False
+
+        if not call.event.wait(timeout):
+            with self._lock:
+                self.stats["timeouts"] += 1
+            raise TimeoutError(f"single-flight wait exceeded {timeout}s")
+        if call.error is not None:
+            raise call.error
+        return call.result, True
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+class ConcurrencyLimiter:
+    def __init__(self, max_per_key=2):
+        self.max_per_key = max(1, int(max_per_key))
+        self._lock = threading.Lock()
+        self._active = {}
+
+    def try_acquire(self, key):
+        with self._lock:
+            current = self._active.get(key, 0)
+            if current >= self.max_per_key:
+                return False
+            self._active[key] = current + 1
+            return True
+
+    def release(self, key):
+        with self._lock:
+            current = self._active.get(key, 0) - 1
+            if current > 0:
+                self._active[key] = current
+            else:
+                self._active.pop(key, None)
+
+    def active(self, key):
+        with self._lock:
+            return self._active.get(key, 0)
+
+
+# Campos que cambian entre reintentos del frontend y no afectan el resultado.
+VOLATILE_FIELDS = {"request_id", "requestId", "nonce", "ts", "timestamp", "_t", "client_ts"}
+
+
+def _normalize(value):
+    if isinstance(value, dict):
+        return {str(k): _normalize(v) for k, v in value.items() if k not in VOLATILE_FIELDS}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    if isinstance(value, str):
+        return " ".join(value.split())
+    return value
+
+
+def payload_fingerprint(payload):
+    """Stable hash of a JSON payload (whitespace-normalized, volatile fields dropped)."""
+    blob = json.dumps(_normalize(payload or {}), sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
@@ -0,0 +1,144 @@
+"""
+Precompiled templates for generated scaffolds and built-in pages.
+
+Layout: starter_templates/<kit>/<variant>/<file>. Every kit has a
+"default" variant; other variants (light, ...) only need the files they
+change, the rest falls back to default. Templates use {{ name }}
+placeholders (HTML-escaped in .html files, {{ name|raw }} to skip that)
+and are split into literal/placeholder parts once at load time, so
+rendering is a single join. New kits are picked up by dropping a folder,
+no code changes.
+"""
+import html
+import os
+import re
+import threading
+
+DEFAULT_VARIANT = "default"
+_PLACEHOLDER_RE = re.compile(r"\{\{\s*([A-Za-z_][A-Za-z0-9_]*)\s*(\|\s*raw\s*)?\}\}")
+_ESCAPED_EXTENSIONS = (".html", ".htm")
+
+
+class CompiledTemplate:
+    __slots__ = ("name", "parts")
+
+    def __init__(self, name, source, escape=False):
+        self.name = name
+        parts = []
+        pos = 0
+        for match in _PLACEHOLDER_RE.finditer(source):
+            if match.start() > pos:
+                parts.append((True, source[pos:match.start()], False))
+            parts.append((False, match.group(1), escape and not match.group(2)))
+            pos = match.end()
+        if pos < len(source):
+            parts.append((True, source[pos:], False))
+        self.parts = tuple(parts)
+
+    def render(self, context):
+        out = []
+        for literal, value, escape in self.parts:
+            if literal:
+                out.append(value)
+                continue
+            if value not in context:
+                raise KeyError(f"{self.name}: missing template variable '{value}'")
+            text = "" if context[value] is None else str(context[value])
+            out.append(html.escape(text, quote=True) if escape else text)
+        return "".join(out)
+
+
+def variant_for_theme(theme):
+    return re.sub(r"[^a-z0-9]+", "_", str(theme or "").strip().lower()).strip("_")
+
+
+class TemplateRegistry:
+    def __init__(self, root):
+        self.root = root
+        self._kits = {}  # kit -> variant -> filename -> CompiledTemplate
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def load(self):
+        """(Re)compiles every template under root; returns the number of files."""
+        kits = {}
+        count = 0
+        if os.path.isdir(self.root):
+            for kit in sorted(os.listdir(self.root)):
+                kit_dir = os.path.join(self.root, kit)
+                if kit.startswith((".", "_")) or not os.path.isdir(kit_dir):
+                    continue
+                for variant in sorted(os.listdir(kit_dir)):
+                    variant_dir = os.path.join(kit_dir, variant)
+                    if not os.path.isdir(variant_dir):
+                        continue
+                    for dirpath, dirnames, filenames in os.walk(variant_dir):
+                        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+                        for fname in filenames:
+                            if fname.startswith("."):
+                                continue
+                            full = os.path.join(dirpath, fname)
+                            rel = os.path.relpath(full, variant_dir).replace(os.sep, "/")
+                            with open(full, "r", encoding="utf-8") as f:
+                                source = f.read()
+                            kits.setdefault(kit, {}).setdefault(variant, {})[rel] = CompiledTemplate(
+                                f"{kit}/{variant}/{rel}", source, escape=rel.lower().endswith(_ESCAPED_EXTENSIONS)
+                            )
+                            count += 1
+        with self._lock:
+            self._kits = kits
+            self._loaded = True
+        return count
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    def kits(self):
+        self._ensure_loaded()
+        return sorted(self._kits)
+
+    def variants(self, kit):
+        self._ensure_loaded()
+        return sorted(self._kits.get(kit, {}))
+
+    def has_kit(self, kit):
+        self._ensure_loaded()
+        return kit in self._kits
+
+    def resolve_variant(self, kit, theme=None):
+        """Exact theme slug first, then any variant named after a word of the theme."""
+        variants = self._kits.get(kit, {})
+        slug = variant_for_theme(theme)
+        if slug in variants:
+            return slug
+        for word in slug.split("_"):
+            if word and word in variants:
+                return word
+        return DEFAULT_VARIANT
+
+    def _template(self, kit, variant, filename):
+        variants = self._kits.get(kit)
+        if not variants:
+            raise KeyError(f"Unknown template kit '{kit}'")
+        template = variants.get(variant, {}).get(filename) or variants.get(DEFAULT_VARIANT, {}).get(filename)
+        if template is None:
+            raise KeyError(f"Template '{kit}/{filename}' not found")
+        return template
+
+    def render(self, kit, filename, context, theme=None):
+        self._ensure_loaded()
+        return self._template(kit, self.resolve_variant(kit, theme), filename).render(context)
+
+    def render_kit(self, kit, context, theme=None):
+        """{filename: text} for every file of the kit (variant files override default ones)."""
+        self._ensure_loaded()
+        variant = self.resolve_variant(kit, theme)
+        variants = self._kits.get(kit)
+        if not variants:
+            raise KeyError(f"Unknown template kit '{kit}'")
+        names = set(variants.get(DEFAULT_VARIANT, {})) | set(variants.get(variant, {}))
+        return {name: self._template(kit, variant, name).render(context) for name in sorted(names)}
+
+
+templates = TemplateRegistry(os.path.join(os.path.dirname(os.path.abspath(__file__)), "starter_templates"))
@@ -0,0 +1,3 @@
+document.getElementById('ctaBtn')?.addEventListener('click', () => {
+  alert('MVP generado. Continúa iterando desde el chat de ANMAR.');
+});
@@ -0,0 +1,2 @@
+const pulse = (id)=>document.getElementById(id)?.addEventListener('click',()=>alert('Perfecto. Siguiente paso: test inicial y onboarding.'));
+pulse('ctaTop'); pulse('ctaHero');
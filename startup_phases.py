@@ -0,0 +1,124 @@
+"""
+Lazy, timed process initialization.
+
+Expensive setup (AI client, schema check, session secret, background
+workers, index backfill) is registered as a named phase instead of being
+run at import time. A phase runs once, on the first ensure(name) — from
+whatever code path needs it first — or from warm(), the warm-up hook
+called after fork / by the internal warm-up route. Phases registered with
+warm=False (the AI client, whose SDK is the heaviest import) are left to
+first use unless warm() is given their names explicitly. Each run is timed, and
+mark() times the import itself, so timings() shows where boot time goes.
+
+A phase that raises is not final: after retry_after seconds (doubling per
+consecutive failure, up to MAX_RETRY_SECONDS) the next ensure() runs it
+again, so a database that was briefly unavailable at boot does not leave
+the worker without its schema check until restart. retry_after=None makes
+a failure permanent.
+"""
+import threading
+import time
+
+
+class StartupPhases:
+    MAX_RETRY_SECONDS = 300
+
+    def __init__(self):
+        self._phases = {}   # name -> callable
+        self._warm = {}     # name -> incluida en warm() por defecto
+        self._retry = {}    # name -> segundos antes de reintentar tras un fallo (None = nunca)
+        self._order = []
+        self._state = {}    # name -> {"status", "ms", "error", "trigger", "result"}
+        self._locks = {}
+        self._guard = threading.Lock()
+        self._created = time.perf_counter()
+        self._last_mark = self._created
+        self._marks = []    # (label, ms)
+
+    # ── import timing ──
+    def mark(self, label):
+        """Records the time spent since the previous mark (or since creation)."""
+        now = time.perf_counter()
+        self._marks.append((label, round((now - self._last_mark) * 1000, 2)))
+        self._last_mark = now
+
+    def import_ms(self):
+        return round((self._last_mark - self._created) * 1000, 2)
+
+    # ── phases ──
+    def register(self, name, fn, warm=True, retry_after=5.0):
+        with self._guard:
+            if name not in self._phases:
+                self._order.append(name)
+            self._phases[name] = fn
+            self._warm[name] = bool(warm)
+            self._retry[name] = None if retry_after is None else float(retry_after)
+            self._locks.setdefault(name, threading.RLock())
+            self._state.setdefault(name, {"status": "pending"})
+
+    def names(self):
+        return list(self._order)
+
+    def _retry_due(self, name, state):
+        base = self._retry.get(name)
+        if state.get("status") != "error" or base is None:
+            return False
+        delay = min(base * 2 ** (state.get("failures", 1) - 1), self.MAX_RETRY_SECONDS)
+        return time.monotonic() - state["failed_at"] >= delay
+
+    def done(self, name):
+        state = self._state.get(name, {})
+        return state.get("status") == "ok" or (state.get("status") == "error" and not self._retry_due(name, state))
+
+    def ensure(self, name, trigger="first use"):
+        """
+        Runs the phase once and returns its result (None while a failed phase
+        waits for its retry). Re-entrant calls from the phase itself return None.
+        """
+        state = self._state.get(name)
+        if state is None:
+            raise KeyError(f"Unknown startup phase '{name}'")
+        if state["status"] == "ok" or (state["status"] == "error" and not self._retry_due(name, state)):
+            return state.get("result")
+        with self._locks[name]:
+            state = self._state[name]
+            retrying = self._retry_due(name, state)
+            if state["status"] != "pending" and not retrying:
+                return state.get("result")  # ya terminó, o es la misma hebra dentro de la fase
+            failures = state.get("failures", 0)
+            state["status"] = "running"
+            started = time.perf_counter()
+            try:
+                result = self._phases[name]()
+                self._state[name] = {"status": "ok", "result": result}
+                if retrying:
+                    print(f"[STARTUP] phase '{name}' recovered after {failures} failure(s)")
+            except Exception as e:
+                print(f"[STARTUP] phase '{name}' failed: {e}")
+                self._state[name] = {
+                    "status": "error", "error": str(e), "result": None,
+                    "failures": failures + 1, "failed_at": time.monotonic(),
+                }
+            self._state[name]["ms"] = round((time.perf_counter() - started) * 1000, 2)
+            self._state[name]["trigger"] = trigger
+            return self._state[name]["result"]
+
+    def warm(self, names=None, trigger="warm-up"):
+        for name in (names or [n for n in self._order if self._warm[n]]):
+            self.ensure(name, trigger=trigger)
+        return self.timings()
+
+    def warm_async(self, names=None, trigger="warm-up"):
+        thread = threading.Thread(target=self.warm, args=(names, trigger), name="anmar-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def timings(self):
+        return {
+            "import_ms": self.import_ms(),
+            "import": [{"label": label, "ms": ms} for label, ms in self._marks],
+            "phases": {
+                name: {k: v for k, v in self._state[name].items() if k not in ("result", "failed_at")}
+                for name in self._order
+            },
+        }
@@ -0,0 +1,334 @@
+"""
+Structured output helpers for AI responses.
+
+Parses JSON coming back from the models without re-asking for a full
+generation: fence stripping, a tolerant scanner that repairs the usual
+LLM mistakes (raw newlines inside strings, trailing commas, prose around
+the payload, truncated output) and a small JSON-schema subset used both
+to describe the payload to the providers and to coerce what comes back.
+"""
+import ast
+import json
+import re
+
+_FENCE_RE = re.compile(r"^\s*```[a-zA-Z0-9_-]*\s*\n?|\n?\s*```\s*$")
+
+_CONTROL_ESCAPES = {
+    "\n": "\\n",
+    "\r": "\\r",
+    "\t": "\\t",
+    "\b": "\\b",
+    "\f": "\\f",
+}
+
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+def strip_code_fences(text):
+    """Quita ```json ... ``` alrededor del payload (solo en los bordes)."""
+    text = str(text or "").strip()
+    if text.startswith("```"):
+        text = _FENCE_RE.sub("", text).strip()
+    return text
+
+
+class TolerantJSONScanner:
+    """
+    Incremental scanner that rewrites almost-JSON into valid JSON.
+
+    Feed it chunks as they arrive (streaming) or the whole text at once;
+    `result()` returns (json_text, complete). When the input is cut off,
+    json_text is the longest valid prefix with every open container
+    closed, so callers can still use what was generated.
+    """
+
+    def __init__(self):
+        self._out = []
+        self._stack = []          # [opener, expect_key]
+        self._started = False
+        self._done = False
+        self._in_string = False
+        self._escape = False
+        self._string_is_key = False
+        self._scalar = []
+        self._safe_len = 0
+        self._safe_closers = ""
+
+    @property
+    def done(self):
+        return self._done
+
+    def feed(self, chunk):
+        for ch in str(chunk or ""):
+            if self._done:
+                break
+            self._consume(ch)
+        return self
+
+    def result(self):
+        """Returns (json_text, complete); json_text is None if no container was found."""
+        if not self._started:
+            return None, False
+        if self._done:
+            return "".join(self._out), True
+
+        out = list(self._out)
+        safe_len, safe_closers = self._safe_len, self._safe_closers
+        if self._in_string and not self._string_is_key:
+            # Valor string cortado: se conserva el texto parcial.
+            if self._escape:
+                out.pop()
+            out.append('"')
+            safe_len, safe_closers = len(out), self._closers()
+        elif self._scalar and not self._in_string:
+            token = "".join(self._scalar)
+            if _is_complete_scalar(token):
+                out.append(token)
+                safe_len, safe_closers = len(out), self._closers()
+        return "".join(out[:safe_len]) + safe_closers, False
+
+    # ── internals ──
+    def _closers(self):
+        return "".join(_CLOSERS[frame[0]] for frame in reversed(self._stack))
+
+    def _mark_safe(self):
+        self._safe_len = len(self._out)
+        self._safe_closers = self._closers()
+
+    def _flush_scalar(self):
+        if not self._scalar:
+            return
+        self._out.append(_normalize_scalar("".join(self._scalar)))
+        self._scalar = []
+        self._mark_safe()
+
+    def _strip_trailing_comma(self):
+        idx = len(self._out) - 1
+        while idx >= 0 and self._out[idx].isspace():
+            idx -= 1
+        if idx >= 0 and self._out[idx] == ",":
+            del self._out[idx]
+
+    def _consume(self, ch):
+        if not self._started:
+            if ch in "{[":
+                self._started = True
+                self._stack.append([ch, ch == "{"])
+                self._out.append(ch)
+                self._mark_safe()
+            return
+
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+                self._out.append(ch)
+            elif ch == "\\":
+                self._escape = True
+                self._out.append(ch)
+            elif ch == '"':
+                self._in_string = False
+                self._out.append(ch)
+                if not self._string_is_key:
+                    self._mark_safe()
+            elif ch < " ":
+                self._out.append(_CONTROL_ESCAPES.get(ch) or "\\u%04x" % ord(ch))
+            else:
+                self._out.append(ch)
+            return
+
+        if self._scalar and (ch in ",}]:" or ch.isspace()):
+            self._flush_scalar()
+
+        if ch == '"':
+            frame = self._stack[-1]
+            self._string_is_key = frame[0] == "{" and frame[1]
+            if self._string_is_key:
+                frame[1] = False
+            self._in_string = True
+            self._out.append(ch)
+        elif ch in "{[":
+            self._stack.append([ch, ch == "{"])
+            self._out.append(ch)
+            self._mark_safe()
+        elif ch in "}]":
+            self._strip_trailing_comma()
+            opener = self._stack.pop()[0]
+            self._out.append(_CLOSERS[opener])
+            if not self._stack:
+                self._done = True
+            self._mark_safe()
+        elif ch == ",":
+            frame = self._stack[-1]
+            if frame[0] == "{":
+                frame[1] = True
+            self._out.append(ch)
+        elif ch == ":" or ch.isspace():
+            self._out.append(ch)
+        else:
+            self._scalar.append(ch)
+
+
+def _normalize_scalar(token):
+    # Literales estilo Python que algunos modelos devuelven.
+    return {"True": "true", "False": "false", "None": "null"}.get(token, token)
+
+
+def _is_complete_scalar(token):
+    try:
+        json.loads(_normalize_scalar(token))
+        return True
+    except ValueError:
+        return False
+
+
+def repair_json(text):
+    """Returns (json_text, complete) for the first JSON container found in text."""
+    return TolerantJSONScanner().feed(text).result()
+
+
+def loads_tolerant(text, allow_partial=False):
+    """
+    Parses model output as JSON. Strict parse first, then the tolerant
+    scanner; truncated payloads are only accepted with allow_partial.
+    Returns None when nothing usable is found.
+    """
+    if isinstance(text, (dict, list)):
+        return text
+    cleaned = strip_code_fences(text)
+    if not cleaned:
+        return None
+    try:
+        return json.loads(cleaned)
+    except ValueError:
+        pass
+
+    repaired, complete = repair_json(cleaned)
+    if repaired and (complete or allow_partial):
+        try:
+            return json.loads(repaired)
+        except ValueError:
+            pass
+
+    # Último recurso: dict con comillas simples (repr de Python).
+    start = min([i for i in (cleaned.find("{"), cleaned.find("[")) if i >= 0] or [0])
+    try:
+        value = ast.literal_eval(cleaned[start:])
+        if isinstance(value, (dict, list)):
+            return value
+    except Exception:
+        pass
+    return None
+
+
+class StreamingJSONParser:
+    """
+    Accumulates a streamed JSON payload (e.g. Anthropic input_json_delta
+    chunks) and exposes the best-effort value at any point.
+    """
+
+    def __init__(self):
+        self._scanner = TolerantJSONScanner()
+        self._raw = []
+
+    def feed(self, chunk):
+        chunk = str(chunk or "")
+        self._raw.append(chunk)
+        self._scanner.feed(chunk)
+        return self
+
+    @property
+    def complete(self):
+        return self._scanner.done
+
+    @property
+    def raw(self):
+        return "".join(self._raw)
+
+    def snapshot(self):
+        """Current value (partial if the stream is not finished) or None."""
+        repaired, _ = self._scanner.result()
+        if not repaired:
+            return None
+        try:
+            return json.loads(repaired)
+        except ValueError:
+            return None
+
+
+# ── SCHEMA (subset of JSON Schema) ──
+def coerce_to_schema(value, schema, path="$"):
+    """
+    Coerces value to a JSON-schema subset (type, properties, required,
+    items, enum). Returns (value, errors); errors lists missing or
+    mismatched paths so callers decide whether a retry is worth it.
+    """
+    errors = []
+    if not isinstance(schema, dict) or not schema:
+        return value, errors
+    expected = schema.get("type")
+
+    if expected == "object":
+        if not isinstance(value, dict):
+            return value, [f"{path}: expected object"]
+        props = schema.get("properties") or {}
+        result = dict(value)
+        for key, sub_schema in props.items():
+            if key in result:
+                result[key], sub_errors = coerce_to_schema(result[key], sub_schema, f"{path}.{key}")
+                errors.extend(sub_errors)
+        for key in schema.get("required") or []:
+            if key not in result or result[key] in (None, ""):
+                errors.append(f"{path}.{key}: missing")
+        return result, errors
+
+    if expected == "array":
+        if not isinstance(value, list):
+            return value, [f"{path}: expected array"]
+        items = schema.get("items") or {}
+        result = []
+        for idx, item in enumerate(value):
+            coerced, sub_errors = coerce_to_schema(item, items, f"{path}[{idx}]")
+            result.append(coerced)
+            errors.extend(sub_errors)
+        return result, errors
+
+    if expected == "integer":
+        if isinstance(value, bool):
+            return value, [f"{path}: expected integer"]
+        if isinstance(value, float):
+            return int(round(value)), errors
+        if isinstance(value, str):
+            match = re.search(r"-?\d+(?:\.\d+)?", value)
+            if match:
+                return int(round(float(match.group(0)))), errors
+            return value, [f"{path}: expected integer"]
+        if not isinstance(value, int):
+            return value, [f"{path}: expected integer"]
+    elif expected == "number":
+        if isinstance(value, str):
+            try:
+                return float(value.strip()), errors
+            except ValueError:
+                return value, [f"{path}: expected number"]
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return value, [f"{path}: expected number"]
+    elif expected == "string":
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = str(value)
+        elif not isinstance(value, str):
+            return value, [f"{path}: expected string"]
+    elif expected == "boolean":
+        if isinstance(value, str) and value.strip().lower() in ("true", "false"):
+            value = value.strip().lower() == "true"
+        elif not isinstance(value, bool):
+            return value, [f"{path}: expected boolean"]
+
+    enum = schema.get("enum")
+    if enum and value not in enum:
+        errors.append(f"{path}: not in enum")
+    return value, errors
+
+
+def schema_prompt_hint(schema):
+    """Compact schema text to append to prompts for providers without a JSON mode."""
+    return "Respond ONLY with a JSON value matching this JSON Schema:\n" + json.dumps(schema, ensure_ascii=False)
@@ -0,0 +1,306 @@
+"""
+Append-only token ledger with in-memory authorization.
+
+Debits (chat/build/edit charges) are authorized against an in-process
+view of the balance and queued; a flusher thread settles them in one
+transaction per batch (ledger rows + one UPDATE per user), so message
+charges do not take SQLite's write lock on the request path. Credits
+(token packs, plan grants, refunds) are written synchronously and are
+idempotent by ref. Every user gets an "opening" row with the balance they
+had when the ledger first saw them, so SUM(delta) reconstructs the
+balance and audit() can compare it with users.tokens.
+
+Each gunicorn worker authorizes against its own view, refreshed from the
+database every refresh_seconds while it has nothing pending, after each
+flush, and before declining a charge (so a credit applied by another
+worker is seen at once). Concurrent workers can therefore authorize up to one batch
+more than the user has. Settlement never takes users.tokens below zero:
+the debit is a conditional UPDATE, and when it fails the user is charged
+what is left and the shortfall is written off with an "adjust" row
+(counted in stats()["overdrafts"]), so the ledger still sums to the
+balance.
+
+Queued debits live only in memory until the next flush. A clean exit
+(SIGTERM, atexit) flushes them; a SIGKILL or crash loses at most
+flush_interval seconds (or max_batch rows) of charges, in the user's
+favour.
+"""
+import atexit
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+LEDGER_KINDS = ("opening", "debit", "credit", "purchase", "grant", "refund", "adjust")
+
+
+def _now():
+    return datetime.now().isoformat()
+
+
+class TokenLedger:
+    def __init__(self, connect, load_balance, table="token_ledger", flush_interval=1.0,
+                 max_batch=500, refresh_seconds=30):
+        self._connect = connect
+        self._load_balance = load_balance  # email -> tokens (crea el usuario si falta)
+        self._table = table
+        self.flush_interval = float(flush_interval)
+        self.max_batch = int(max_batch)
+        self.refresh_seconds = float(refresh_seconds)
+        self._accounts = {}  # email -> {"settled", "pending", "loaded_at"}
+        self._queue = []     # (email, delta, kind, reason, created_at)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._generation = 0  # sube cada vez que flush/credit fijan un saldo liquidado
+        self._metrics = {
+            "authorized": 0, "declined": 0, "settled_rows": 0, "batches": 0, "flush_errors": 0,
+            "overdrafts": 0, "written_off": 0,
+        }
+
+    # ── accounts ──
+    def _ensure_opening(self, email, balance):
+        conn = self._connect()
+        try:
+            exists = conn.execute(f"SELECT 1 FROM {self._table} WHERE email = ? LIMIT 1", (email,)).fetchone()
+            if not exists:
+                # El índice único parcial (email) WHERE kind='opening' descarta la de otro worker.
+                conn.execute(
+                    f"""INSERT OR IGNORE INTO {self._table} (email, delta, kind, reason, created_at)
+                        VALUES (?, ?, 'opening', ?, ?)""",
+                    (email, int(balance), "balance before ledger", _now()),
+                )
+                conn.commit()
+        finally:
+            conn.close()
+
+    def _account(self, email, force=False):
+        """
+        Loads or refreshes email's view with the DB work outside self._lock.
+        force=True re-reads it even inside refresh_seconds (never while debits
+        are pending). Callers then read self._accounts[email] under the lock.
+        """
+        with self._lock:
+            account = self._accounts.get(email)
+            fresh = not force and account and time.time() - account["loaded_at"] < self.refresh_seconds
+            if account and (account["pending"] or fresh):
+                return
+            generation = self._generation
+        balance = int(self._load_balance(email) or 0)
+        if account is None:
+            self._ensure_opening(email, balance)
+        with self._lock:
+            current = self._accounts.get(email)
+            if current is not None and (current["pending"] or self._generation != generation):
+                return  # se cargó o liquidó mientras leíamos; esa vista es más nueva
+            self._accounts[email] = {"settled": balance, "pending": 0, "loaded_at": time.time()}
+
+    def balance(self, email):
+        # Sin cargos pendientes se lee la BD: un crédito aplicado por otro worker se ve al momento.
+        self._account(email, force=True)
+        with self._lock:
+            account = self._accounts[email]
+            return account["settled"] + account["pending"]
+
+    # ── debits ──
+    def authorize(self, email, amount, reason=""):
+        """Reserves amount tokens without touching the DB. Returns (ok, balance_after)."""
+        amount = int(amount)
+        for attempt in range(2):
+            self._account(email, force=attempt > 0)
+            with self._lock:
+                account = self._accounts[email]
+                available = account["settled"] + account["pending"]
+                if available < amount:
+                    if attempt == 0 and not account["pending"]:
+                        continue  # antes de rechazar, releer: otro worker pudo acreditar tokens
+                    self._metrics["declined"] += 1
+                    return False, available
+                account["pending"] -= amount
+                self._queue.append((email, -amount, "debit", reason, _now()))
+                self._metrics["authorized"] += 1
+                backlog = len(self._queue)
+                break
+        self.start()
+        if backlog >= self.max_batch:
+            self._wake.set()
+        return True, available - amount
+
+    # ── credits (síncronos, idempotentes por ref) ──
+    def credit(self, email, amount, kind="credit", reason="", ref=None):
+        """Adds tokens now. Returns the new balance, or None if ref was already applied."""
+        amount = int(amount)
+        self._account(email)
+        # Bajo _flush_lock: el saldo leído aquí y los de flush() se aplican en orden.
+        with self._flush_lock:
+            conn = self._connect()
+            try:
+                if ref:
+                    seen = conn.execute(f"SELECT 1 FROM {self._table} WHERE ref = ? LIMIT 1", (ref,)).fetchone()
+                    if seen:
+                        return None
+                try:
+                    conn.execute(
+                        f"""INSERT INTO {self._table} (email, delta, kind, reason, ref, created_at)
+                            VALUES (?, ?, ?, ?, ?, ?)""",
+                        (email, amount, kind, reason, ref, _now()),
+                    )
+                except sqlite3.IntegrityError:
+                    # Otro worker aplicó el mismo ref entre el SELECT y el INSERT (índice único).
+                    conn.rollback()
+                    return None
+                conn.execute("UPDATE users SET tokens = tokens + ? WHERE email = ?", (amount, email))
+                row = conn.execute("SELECT tokens FROM users WHERE email = ?", (email,)).fetchone()
+                conn.commit()
+            finally:
+                conn.close()
+            with self._lock:
+                self._generation += 1
+                account = self._accounts.get(email)
+                if account:
+                    account["settled"] = int(row["tokens"]) if row else account["settled"] + amount
+                    account["loaded_at"] = time.time()
+                    return account["settled"] + account["pending"]
+        return self.balance(email)
+
+    def refund(self, email, amount, reason="", ref=None):
+        return self.credit(email, amount, kind="refund", reason=reason, ref=ref)
+
+    # ── settlement ──
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._loop, name="anmar-token-ledger", daemon=True)
+            self._thread.start()
+        atexit.register(self.flush)
+
+    def _loop(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"[LEDGER] flush error: {e}")
+
+    def flush(self):
+        """Settles queued debits in one transaction. Returns the number of rows written."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._queue = self._queue, []
+            if not batch:
+                return 0
+            totals = {}
+            for email, delta, *_ in batch:
+                totals[email] = totals.get(email, 0) + delta
+            settled, overdrafts = {}, []
+            conn = self._connect()
+            try:
+                conn.executemany(
+                    f"INSERT INTO {self._table} (email, delta, kind, reason, created_at) VALUES (?, ?, ?, ?, ?)",
+                    batch,
+                )
+                for email, delta in totals.items():
+                    cur = conn.execute(
+                        "UPDATE users SET tokens = tokens + ? WHERE email = ? AND tokens >= ?",
+                        (delta, email, -delta),
+                    )
+                    if cur.rowcount == 0:
+                        shortfall = self._write_off(conn, email, -delta)
+                        if shortfall:
+                            overdrafts.append((email, shortfall))
+                    row = conn.execute("SELECT tokens FROM users WHERE email = ?", (email,)).fetchone()
+                    if row:
+                        settled[email] = int(row["tokens"])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                with self._lock:
+                    self._queue[:0] = batch
+                    self._metrics["flush_errors"] += 1
+                raise
+            finally:
+                conn.close()
+            with self._lock:
+                self._generation += 1
+                now = time.time()
+                for email, delta in totals.items():
+                    account = self._accounts.get(email)
+                    if account:
+                        # Saldo real tras el lote: incluye lo que liquidaron otros workers.
+                        account["settled"] = settled.get(email, account["settled"] + delta)
+                        account["pending"] -= delta
+                        account["loaded_at"] = now
+                self._metrics["settled_rows"] += len(batch)
+                self._metrics["batches"] += 1
+                self._metrics["overdrafts"] += len(overdrafts)
+                self._metrics["written_off"] += sum(amount for _, amount in overdrafts)
+            for email, shortfall in overdrafts:
+                print(f"[LEDGER] {email}: overdraft of {shortfall} tokens written off")
+            return len(batch)
+
+    def _write_off(self, conn, email, charge):
+        """
+        Settles a debit the user can no longer cover (another worker spent the
+        same tokens): charges what is left and books the rest as an "adjust"
+        row. Returns the amount written off (0 if the user row is gone).
+        """
+        row = conn.execute("SELECT tokens FROM users WHERE email = ?", (email,)).fetchone()
+        if row is None:
+            return 0
+        available = max(int(row["tokens"]), 0)
+        shortfall = charge - available
+        conn.execute("UPDATE users SET tokens = tokens - ? WHERE email = ?", (available, email))
+        conn.execute(
+            f"INSERT INTO {self._table} (email, delta, kind, reason, created_at) VALUES (?, ?, 'adjust', ?, ?)",
+            (email, shortfall, "overdraft written off", _now()),
+        )
+        return shortfall
+
+    # ── audit ──
+    def history(self, email, limit=100):
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                f"SELECT * FROM {self._table} WHERE email = ? ORDER BY id DESC LIMIT ?", (email, int(limit))
+            ).fetchall()
+        finally:
+            conn.close()
+        return [dict(r) for r in rows]
+
+    def reconstruct(self, email):
+        """Balance rebuilt from the ledger (settled rows only)."""
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                f"SELECT COALESCE(SUM(delta), 0) AS total, COUNT(*) AS n FROM {self._table} WHERE email = ?", (email,)
+            ).fetchone()
+        finally:
+            conn.close()
+        return int(row["total"]), int(row["n"])
+
+    def audit(self, email):
+        ledger_balance, entries = self.reconstruct(email)
+        conn = self._connect()
+        try:
+            user = conn.execute("SELECT tokens FROM users WHERE email = ?", (email,)).fetchone()
+        finally:
+            conn.close()
+        with self._lock:
+            account = self._accounts.get(email) or {}
+            pending = account.get("pending", 0)
+        users_tokens = int(user["tokens"]) if user else None
+        return {
+            "email": email,
+            "ledger_balance": ledger_balance,
+            "ledger_entries": entries,
+            "users_tokens": users_tokens,
+            "pending": pending,
+            "drift": None if users_tokens is None else users_tokens - ledger_balance,
+        }
+
+    def stats(self):
+        with self._lock:
+            return dict(self._metrics, queued=len(self._queue), accounts=len(self._accounts))
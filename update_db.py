@@ -1,17 +1,18 @@
-
 import sqlite3
 
+from schema_migrations import ensure_schema
+
 def add_tokens_column():
+    # Las columnas de users ahora las añade schema_migrations (migración 0002).
     conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
     try:
-        cursor.execute("ALTER TABLE users ADD COLUMN tokens INTEGER DEFAULT 3")
-        print("✅ Columna 'tokens' añadida exitosamente.")
-    except sqlite3.OperationalError as e:
-        print(f"⚠️ Nota: {e}")
-    
-    conn.commit()
-    conn.close()
+        applied = ensure_schema(conn)
+        for version, name in applied:
+            print(f"✅ Migración {version:04d} {name} aplicada.")
+        if not applied:
+            print("⚠️ Nota: el esquema ya estaba al día.")
+    finally:
+        conn.close()
 
 if __name__ == "__main__":
     add_tokens_column()
@@ -0,0 +1,360 @@
+"""
+Persist-and-ack inbox for provider webhooks (Stripe).
+
+The HTTP handler only verifies the signature and calls record(), which
+stores the raw event keyed by its provider id (retries of the same event
+are no-ops), then replies 200. A processor thread applies stored events
+through the handler registered for their type:
+
+  - events sharing an order_key (the Stripe customer) run one at a time,
+    oldest provider timestamp first; a failing event blocks the ones
+    behind it until it succeeds or exhausts max_attempts;
+  - types registered with latest_wins=True are skipped ("stale") when a
+    newer event of the same object type was already applied for the key,
+    so out-of-order subscription updates cannot roll state back;
+  - handlers must be idempotent: replays and crash recovery re-run them.
+    Events left 'processing' by a dead worker are requeued by every
+    processor once their claim is older than stale_after (checked every
+    stale_after / 2). Token grants carry a ref (the checkout session) that
+    only deduplicates with the token ledger on (ANMAR_TOKEN_LEDGER=1).
+
+Replay: requeue() sends stored events back through the processor, and
+running this module replays a database's events against a stub handler
+without touching anything else:
+
+    python webhook_events.py database.db [--since 1700000000] [--event evt_123] [--handler module:function]
+"""
+import importlib
+import json
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+EVENT_STATES = ("queued", "processing", "done", "stale", "ignored", "failed")
+
+# Un evento solo corre si es la cabeza de la cola de su order_key.
+_HEAD_OF_KEY = """
+    NOT EXISTS (
+        SELECT 1 FROM {table} p
+        WHERE p.order_key = e.order_key AND p.id != e.id AND (
+            p.status = 'processing' OR (p.status = 'queued' AND (
+                p.created < e.created OR (p.created = e.created AND p.received_at < e.received_at)
+            ))
+        )
+    )
+"""
+
+
+def _object_group(event_type):
+    return str(event_type or "").rsplit(".", 1)[0]
+
+
+def _order_key(event):
+    obj = (event.get("data") or {}).get("object") or {}
+    return obj.get("customer") or (obj.get("customer_email") or "").strip().lower() or event.get("id")
+
+
+class WebhookInbox:
+    def __init__(self, connect, table="stripe_events", max_workers=2, max_attempts=8,
+                 base_backoff=15, poll_interval=2.0, stale_after=300):
+        self._connect = connect
+        self._table = table
+        self._max_workers = max(1, int(max_workers))
+        self._max_attempts = max(1, int(max_attempts))
+        self._base_backoff = float(base_backoff)
+        self._poll_interval = float(poll_interval)
+        self._stale_after = float(stale_after)
+        self._handlers = {}
+        self._executor = None
+        self._thread = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self._worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._metrics = {"received": 0, "duplicates": 0, "applied": 0, "stale": 0, "ignored": 0, "retried": 0, "failed": 0}
+
+    def register(self, event_type, handler, latest_wins=False):
+        """handler(event) applies one event and raises on failure."""
+        self._handlers[event_type] = (handler, bool(latest_wins))
+
+    # ── intake ──
+    def record(self, event, raw=None):
+        """Stores a verified event. Returns False if this event id was already stored."""
+        event_id = event.get("id") or f"local_{uuid.uuid4().hex[:16]}"
+        payload = raw.decode("utf-8") if isinstance(raw, bytes) else (raw or json.dumps(event))
+        now = time.time()
+        conn = self._connect()
+        try:
+            cur = conn.execute(
+                f"""INSERT OR IGNORE INTO {self._table}
+                    (id, event_type, order_key, created, payload_json, status, attempts, received_at, next_attempt_at)
+                    VALUES (?, ?, ?, ?, ?, 'queued', 0, ?, ?)""",
+                (event_id, event.get("type"), _order_key(event), int(event.get("created") or now), payload, now, now),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        if not cur.rowcount:
+            self._bump("duplicates")
+            return False
+        self._bump("received")
+        self.start()
+        self._wake.set()
+        return True
+
+    def requeue(self, event_ids=None, since=None):
+        """Sends stored events back through the processor. Returns how many were requeued."""
+        clauses, params = ["status != 'processing'"], []
+        if event_ids:
+            clauses.append(f"id IN ({', '.join('?' for _ in event_ids)})")
+            params.extend(event_ids)
+        if since is not None:
+            clauses.append("created >= ?")
+            params.append(int(since))
+        conn = self._connect()
+        try:
+            cur = conn.execute(
+                f"""UPDATE {self._table} SET status = 'queued', attempts = 0, last_error = NULL, next_attempt_at = ?
+                    WHERE {' AND '.join(clauses)}""",
+                [time.time()] + params,
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        self.start()
+        self._wake.set()
+        return cur.rowcount
+
+    # ── processor ──
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="anmar-webhook")
+            self._thread = threading.Thread(target=self._loop, name="anmar-webhook-processor", daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        # Un worker que muere a mitad de un evento lo deja en 'processing'; los
+        # demás lo recuperan al vencer stale_after, no solo al arrancar.
+        next_requeue = 0.0
+        while True:
+            try:
+                if time.time() >= next_requeue:
+                    self._requeue_stale()
+                    next_requeue = time.time() + self._stale_after / 2
+                self._dispatch_due()
+            except Exception as e:
+                print(f"[WEBHOOK] processor error: {e}")
+            self._wake.wait(self._poll_interval)
+            self._wake.clear()
+
+    def _requeue_stale(self):
+        conn = self._connect()
+        try:
+            conn.execute(
+                f"UPDATE {self._table} SET status = 'queued' WHERE status = 'processing' AND claimed_at < ?",
+                (time.time() - self._stale_after,),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _dispatch_due(self):
+        capacity = self._max_workers * 2 - self._inflight
+        if capacity <= 0:
+            return
+        now = time.time()
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                f"""SELECT * FROM {self._table} e
+                    WHERE e.status = 'queued' AND e.next_attempt_at <= ? AND {_HEAD_OF_KEY.format(table=self._table)}
+                    ORDER BY e.created, e.received_at LIMIT ?""",
+                (now, capacity),
+            ).fetchall()
+            claimed = []
+            for row in rows:
+                cur = conn.execute(
+                    f"""UPDATE {self._table} SET status = 'processing', claimed_by = ?, claimed_at = ?
+                        WHERE id = ? AND status = 'queued'""",
+                    (self._worker_id, now, row["id"]),
+                )
+                if cur.rowcount:
+                    claimed.append(dict(row))
+            conn.commit()
+        finally:
+            conn.close()
+        for row in claimed:
+            with self._lock:
+                self._inflight += 1
+            self._executor.submit(self._process, row)
+
+    def _is_superseded(self, row):
+        conn = self._connect()
+        try:
+            newer = conn.execute(
+                f"""SELECT 1 FROM {self._table}
+                    WHERE order_key = ? AND id != ? AND status = 'done' AND created > ?
+                      AND (event_type = ? OR event_type LIKE ?) LIMIT 1""",
+                (row["order_key"], row["id"], row["created"], row["event_type"], _object_group(row["event_type"]) + ".%"),
+            ).fetchone()
+        finally:
+            conn.close()
+        return newer is not None
+
+    def _process(self, row):
+        try:
+            handler, latest_wins = self._handlers.get(row["event_type"], (None, False))
+            if handler is None:
+                self._finish(row, "ignored")
+            elif latest_wins and self._is_superseded(row):
+                self._finish(row, "stale")
+            else:
+                handler(json.loads(row["payload_json"] or "{}"))
+                self._finish(row, "done")
+        except Exception as e:
+            self._fail(row, e)
+        finally:
+            with self._lock:
+                self._inflight -= 1
+            self._wake.set()
+
+    def _finish(self, row, status):
+        conn = self._connect()
+        try:
+            conn.execute(
+                f"""UPDATE {self._table} SET status = ?, attempts = attempts + 1, last_error = NULL, processed_at = ?
+                    WHERE id = ?""",
+                (status, time.time(), row["id"]),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        self._bump({"done": "applied"}.get(status, status))
+
+    def _fail(self, row, error):
+        attempts = int(row["attempts"] or 0) + 1
+        conn = self._connect()
+        try:
+            if attempts >= self._max_attempts:
+                conn.execute(
+                    f"UPDATE {self._table} SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?",
+                    (attempts, str(error)[:500], row["id"]),
+                )
+                self._bump("failed")
+                print(f"[WEBHOOK] {row['event_type']} {row['id']} failed permanently: {error}")
+            else:
+                backoff = self._base_backoff * (2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+                conn.execute(
+                    f"""UPDATE {self._table} SET status = 'queued', attempts = ?, last_error = ?, next_attempt_at = ?
+                        WHERE id = ?""",
+                    (attempts, str(error)[:500], time.time() + backoff, row["id"]),
+                )
+                self._bump("retried")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _bump(self, key, amount=1):
+        with self._lock:
+            self._metrics[key] += amount
+
+    # ── replay / metrics ──
+    def iter_events(self, event_ids=None, since=None):
+        """Stored events in processing order (per order_key, oldest first)."""
+        clauses, params = ["1 = 1"], []
+        if event_ids:
+            clauses.append(f"id IN ({', '.join('?' for _ in event_ids)})")
+            params.extend(event_ids)
+        if since is not None:
+            clauses.append("created >= ?")
+            params.append(int(since))
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                f"SELECT * FROM {self._table} WHERE {' AND '.join(clauses)} ORDER BY order_key, created, received_at",
+                params,
+            ).fetchall()
+        finally:
+            conn.close()
+        for row in rows:
+            yield dict(row), json.loads(row["payload_json"] or "{}")
+
+    def replay(self, handler, event_ids=None, since=None):
+        """Runs stored events through handler(event) synchronously; statuses are left untouched."""
+        results = []
+        for row, event in self.iter_events(event_ids, since):
+            try:
+                outcome = handler(event)
+                results.append({"id": row["id"], "type": row["event_type"], "ok": True, "result": outcome})
+            except Exception as e:
+                results.append({"id": row["id"], "type": row["event_type"], "ok": False, "error": str(e)})
+        return results
+
+    def stats(self):
+        conn = self._connect()
+        try:
+            rows = conn.execute(f"SELECT status, COUNT(*) AS n FROM {self._table} GROUP BY status").fetchall()
+            oldest = conn.execute(
+                f"SELECT MIN(received_at) AS t FROM {self._table} WHERE status IN ('queued', 'processing')"
+            ).fetchone()
+        finally:
+            conn.close()
+        with self._lock:
+            metrics, inflight = dict(self._metrics), self._inflight
+        return {
+            "events": {row["status"]: row["n"] for row in rows},
+            "oldest_pending_seconds": round(time.time() - oldest["t"], 1) if oldest and oldest["t"] else 0,
+            "inflight": inflight,
+            "process": metrics,
+        }
+
+
+def stub_handler(event):
+    """Describes what the app would apply for event, without side effects."""
+    obj = (event.get("data") or {}).get("object") or {}
+    metadata = obj.get("metadata") or {}
+    return {
+        "customer": obj.get("customer"),
+        "email": obj.get("customer_email"),
+        "object": obj.get("id"),
+        "status": obj.get("status"),
+        "metadata": {k: metadata[k] for k in ("type", "plan", "pack") if k in metadata},
+    }
+
+
+def _load_handler(spec):
+    module_name, _, attr = spec.partition(":")
+    return getattr(importlib.import_module(module_name), attr or "handle")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Replay stored webhook events against a stub handler.")
+    parser.add_argument("db", nargs="?", default="database.db")
+    parser.add_argument("--table", default="stripe_events")
+    parser.add_argument("--since", type=int, default=None, help="provider timestamp (epoch seconds)")
+    parser.add_argument("--event", action="append", default=None, help="event id (repeatable)")
+    parser.add_argument("--handler", default=None, help="module:function to use instead of the stub")
+    args = parser.parse_args()
+
+    def _connect():
+        conn = sqlite3.connect(args.db)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    inbox = WebhookInbox(_connect, table=args.table)
+    handler = _load_handler(args.handler) if args.handler else stub_handler
+    results = inbox.replay(handler, event_ids=args.event, since=args.since)
+    for item in results:
+        print(json.dumps(item, ensure_ascii=False, default=str))
+    failed = sum(1 for r in results if not r["ok"])
+    print(f"[WEBHOOK] replayed {len(results)} events, {failed} failed", file=sys.stderr)
+    sys.exit(1 if failed else 0)